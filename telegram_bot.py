@@ -14,23 +14,37 @@
 """
 
 import asyncio
+import base64
+import bisect
+import functools
+import hashlib
+import heapq
 import json
 import os
+import random
 import re
 import secrets
 import string
+import threading
 import time
 import traceback
-from datetime import timedelta
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timedelta
 from html import escape, unescape
 
+import httpx
 import psycopg2
-import requests
-from psycopg2.extras import Json, RealDictCursor
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2.extras import RealDictCursor
 from telegram import InlineKeyboardButton as TelegramInlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
 from telegram.ext import (
     Application,
+    BaseUpdateProcessor,
     CallbackQueryHandler,
+    ChatMemberHandler,
     CommandHandler,
     ContextTypes,
     MessageHandler,
@@ -84,6 +98,7 @@ def consume_action_cooldown(user_id: int, action: str, cooldown_seconds: int) ->
     return 0
 
 
+@functools.lru_cache(maxsize=4096)
 def _default_button_style(text: str, callback_data: str | None = None, url: str | None = None) -> str:
     """اختيار لون افتراضي مرتب لكل زر دون تغيير وظيفته."""
     value = f"{text or ''} {callback_data or ''}".lower()
@@ -115,9 +130,78 @@ def InlineKeyboardButton(text, *args, style=None, transparent=False, **kwargs):
         )
     return TelegramInlineKeyboardButton(text, *args, style=style, **kwargs)
 
+
+# لوحات الأزرار الثابتة تُبنى مرة واحدة لكل (قائمة، دور، نسخة البيانات التي تعتمد عليها).
+# كائنات InlineKeyboardMarkup غير قابلة للتعديل في PTB، فمشاركتها بين الأعضاء آمنة.
+KEYBOARD_CACHE = {}
+KEYBOARD_VERSIONS = {"channels": 0, "paid_domains": 0}
+KEYBOARD_STATS = {"hits": 0, "builds": 0}
+
+
+def cached_keyboard(menu: str, role: str, build, depends_on: str = None):
+    key = (menu, role, depends_on, KEYBOARD_VERSIONS.get(depends_on, 0))
+    markup = KEYBOARD_CACHE.get(key)
+    if markup is not None:
+        KEYBOARD_STATS["hits"] += 1
+        return markup
+    markup = build()
+    KEYBOARD_STATS["builds"] += 1
+    if markup is not None:
+        KEYBOARD_CACHE[key] = markup
+    return markup
+
+
+def invalidate_keyboards(*names) -> None:
+    """تفريغ اللوحات المعتمدة على بيانات تغيرت، أو كل اللوحات بدون أسماء."""
+    if not names:
+        KEYBOARD_CACHE.clear()
+        return
+    for name in names:
+        KEYBOARD_VERSIONS[name] = KEYBOARD_VERSIONS.get(name, 0) + 1
+    for key in [key for key in KEYBOARD_CACHE if key[2] in names]:
+        KEYBOARD_CACHE.pop(key, None)
+
+
+def back_keyboard(callback_data: str, style: str = None):
+    """لوحة زر الرجوع الوحيد، الأكثر تكراراً في كل الشاشات."""
+    return cached_keyboard(
+        f"back:{callback_data}",
+        style or "",
+        lambda: InlineKeyboardMarkup([[
+            InlineKeyboardButton(get_text("ar", "btn_back"), callback_data=callback_data, style=style)
+        ]]),
+    )
+
 # ================== قاعدة البيانات ==================
 
+# مجمع اتصالات واحد يخدم كل دوال قاعدة البيانات بدلاً من فتح اتصال جديد لكل استعلام.
+DB_POOL_MIN_SIZE = max(0, int(os.getenv("DB_POOL_MIN_SIZE", "1")))
+DB_POOL_MAX_SIZE = max(1, int(os.getenv("DB_POOL_MAX_SIZE", "8")))
+DB_POOL_WAIT_SECONDS = float(os.getenv("DB_POOL_WAIT_SECONDS", "5"))
+DB_POOL_MAX_LIFETIME_SECONDS = int(os.getenv("DB_POOL_MAX_LIFETIME_SECONDS", "1800"))
+DB_POOL_HEALTHCHECK_IDLE_SECONDS = 30
+DB_POOL_LEAK_SECONDS = int(os.getenv("DB_POOL_LEAK_SECONDS", "60"))
+DB_POOL_CONDITION = threading.Condition()
+DB_POOL_IDLE = []
+DB_POOL_IN_USE = {}
+DB_POOL_STATE = {"pending": 0}
+DB_POOL_STATS = {
+    "created": 0,
+    "closed": 0,
+    "checkouts": 0,
+    "waits": 0,
+    "timeouts": 0,
+    "failed_checks": 0,
+    "leaks": 0,
+    "wait_ms_total": 0,
+}
+_DB_POOL_INTERNAL_FRAMES = {
+    "_db_pool_caller", "acquire_db_connection", "db_connection", "__enter__",
+}
+
+
 def get_db_connection():
+    """فتح اتصال خام جديد؛ يستخدمه مجمع الاتصالات فقط."""
     try:
         if not DATABASE_URL:
             print("❌ DATABASE_URL غير موجود")
@@ -128,1967 +212,4341 @@ def get_db_connection():
         return None
 
 
-def init_database():
-    conn = get_db_connection()
-    if not conn:
-        return
-    try:
-        with conn.cursor() as cur:
-            # users
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS bot_users (
-                    telegram_id BIGINT PRIMARY KEY,
-                    language VARCHAR(10),
-                    first_name VARCHAR(255),
-                    last_name VARCHAR(255),
-                    username VARCHAR(255),
-                    emails JSONB DEFAULT '[]'::jsonb,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-
-            # channels
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS channels (
-                    id SERIAL PRIMARY KEY,
-                    channel_username VARCHAR(255) UNIQUE NOT NULL,
-                    channel_id BIGINT,
-                    channel_title VARCHAR(500),
-                    subscription_message TEXT,
-                    subscription_enabled BOOLEAN DEFAULT TRUE,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-
-            # admins
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS admins (
-                    id SERIAL PRIMARY KEY,
-                    telegram_id BIGINT UNIQUE NOT NULL,
-                    username VARCHAR(255),
-                    first_name VARCHAR(255),
-                    added_by BIGINT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-
-            # settings (جديد)
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS bot_settings (
-                    key TEXT PRIMARY KEY,
-                    value TEXT,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-
-            # banned users (جديد)
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS banned_users (
-                    telegram_id BIGINT PRIMARY KEY,
-                    reason TEXT,
-                    banned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    banned_by BIGINT
-                )
-            """)
-
-            # email seen state (جديد) - لتتبع آخر رسالة تم إرسالها لكل بريد
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS email_seen (
-                    email_address TEXT PRIMARY KEY,
-                    last_message_id TEXT,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-
-            # يمنع تكرار إشعار اشتراك العضو في القناة الإجبارية.
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS subscription_notifications (
-                    telegram_id BIGINT NOT NULL,
-                    channel_key TEXT NOT NULL,
-                    notified_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    PRIMARY KEY (telegram_id, channel_key)
-                )
-            """)
-
-            # إحصائيات الاستخدام اليومية.
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS usage_daily_stats (
-                    stat_date DATE PRIMARY KEY DEFAULT CURRENT_DATE,
-                    new_users BIGINT NOT NULL DEFAULT 0,
-                    emails_created BIGINT NOT NULL DEFAULT 0,
-                    inbox_opens BIGINT NOT NULL DEFAULT 0
-                )
-            """)
-
-            # الواجهة أصبحت عربية فقط؛ توحيد بيانات المستخدمين القديمة دون تغيير بنية الجدول.
-            cur.execute("UPDATE bot_users SET language='ar' WHERE language IS DISTINCT FROM 'ar'")
-
-            conn.commit()
-            print("✅ تم تهيئة قاعدة البيانات بنجاح")
-    except Exception as e:
-        print(f"❌ خطأ في تهيئة قاعدة البيانات: {e}")
-        conn.rollback()
-    finally:
-        conn.close()
+def _db_pool_caller() -> str:
+    """اسم الدالة التي استعارت الاتصال لتسهيل تتبع الاتصالات غير المُرجعة."""
+    for frame in reversed(traceback.extract_stack(limit=8)[:-1]):
+        if frame.name not in _DB_POOL_INTERNAL_FRAMES and "contextlib" not in frame.filename:
+            return f"{frame.name}:{frame.lineno}"
+    return "غير معروف"
 
 
-def load_user_data():
-    conn = get_db_connection()
-    if not conn:
-        return {}
+def _close_pooled_connection(conn) -> None:
+    with DB_POOL_CONDITION:
+        DB_POOL_STATS["closed"] += 1
     try:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("SELECT telegram_id, language, first_name, last_name, username, emails FROM bot_users")
-            rows = cur.fetchall()
-
-        user_data = {}
-        for row in rows:
-            user_id = str(row["telegram_id"])
-            user_data[user_id] = {
-                "lang": "ar",
-                "first_name": row.get("first_name", "") or "",
-                "last_name": row.get("last_name", "") or "",
-                "username": row.get("username", "") or "",
-                "emails": row.get("emails") or [],
-            }
-        return user_data
-    except Exception as e:
-        print(f"❌ خطأ في تحميل البيانات: {e}")
-        return {}
-    finally:
         conn.close()
+    except Exception:
+        pass
 
 
-def save_single_user(telegram_id, user_info) -> bool:
-    conn = get_db_connection()
-    if not conn:
+def _pooled_connection_usable(entry) -> bool:
+    """فحص الاتصال الخامل قبل تسليمه: العمر الأقصى ثم SELECT 1 إذا طال خموله."""
+    conn = entry["conn"]
+    if conn.closed:
+        return False
+    now = time.monotonic()
+    if DB_POOL_MAX_LIFETIME_SECONDS and now - entry["created_at"] > DB_POOL_MAX_LIFETIME_SECONDS:
         return False
+    if now - entry["last_used"] < DB_POOL_HEALTHCHECK_IDLE_SECONDS:
+        return True
     try:
         with conn.cursor() as cur:
-            cur.execute("""
-                INSERT INTO bot_users (telegram_id, language, first_name, last_name, username, emails, updated_at)
-                VALUES (%s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP)
-                ON CONFLICT (telegram_id)
-                DO UPDATE SET
-                    language = EXCLUDED.language,
-                    first_name = EXCLUDED.first_name,
-                    last_name = EXCLUDED.last_name,
-                    username = EXCLUDED.username,
-                    emails = EXCLUDED.emails,
-                    updated_at = CURRENT_TIMESTAMP
-            """, (
-                int(telegram_id),
-                user_info.get("lang"),
-                user_info.get("first_name", ""),
-                user_info.get("last_name", ""),
-                user_info.get("username", ""),
-                Json(user_info.get("emails", [])),
-            ))
-            conn.commit()
-            return True
-    except Exception as e:
-        print(f"❌ خطأ في حفظ البيانات: {e}")
+            cur.execute("SELECT 1")
         conn.rollback()
+        return True
+    except Exception as error:
+        print(f"⚠️ اتصال خامل غير صالح في المجمع: {error}")
         return False
-    finally:
-        conn.close()
 
 
-# ---------- Settings (جديد) ----------
-def get_setting(key: str, default: str = "") -> str:
-    conn = get_db_connection()
-    if not conn:
-        return default
-    try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT value FROM bot_settings WHERE key=%s", (key,))
-            row = cur.fetchone()
-            return row[0] if row and row[0] is not None else default
-    except Exception as e:
-        print(f"⚠️ خطأ في get_setting: {e}")
-        return default
-    finally:
-        conn.close()
+def check_db_pool_leaks() -> int:
+    """عدد الاتصالات المحجوزة أطول من المسموح، مع طباعة كل تسريب مرة واحدة."""
+    now = time.monotonic()
+    leaked = []
+    active = 0
+    with DB_POOL_CONDITION:
+        for entry in DB_POOL_IN_USE.values():
+            held = now - entry["checked_out_at"]
+            if held < DB_POOL_LEAK_SECONDS:
+                continue
+            active += 1
+            if not entry["leak_reported"]:
+                entry["leak_reported"] = True
+                DB_POOL_STATS["leaks"] += 1
+                leaked.append((int(held), entry["caller"]))
+    for held, caller in leaked:
+        print(f"⚠️ اتصال قاعدة بيانات محجوز منذ {held} ثانية دون إرجاع: {caller}")
+    return active
+
+
+def acquire_db_connection(timeout=None):
+    """استعارة اتصال من المجمع مع انتظار محدود عند امتلائه؛ None عند الفشل."""
+    wait_limit = DB_POOL_WAIT_SECONDS if timeout is None else max(0.0, float(timeout))
+    started = time.monotonic()
+    deadline = started + wait_limit
+    waited = False
+
+    while True:
+        entry = None
+        action = "timeout"
+        with DB_POOL_CONDITION:
+            while True:
+                if DB_POOL_IDLE:
+                    entry = DB_POOL_IDLE.pop()
+                    DB_POOL_STATE["pending"] += 1
+                    action = "reuse"
+                    break
+                if len(DB_POOL_IN_USE) + DB_POOL_STATE["pending"] < DB_POOL_MAX_SIZE:
+                    DB_POOL_STATE["pending"] += 1
+                    action = "open"
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    DB_POOL_STATS["timeouts"] += 1
+                    break
+                if not waited:
+                    DB_POOL_STATS["waits"] += 1
+                    waited = True
+                DB_POOL_CONDITION.wait(remaining)
+
+        if action == "timeout":
+            check_db_pool_leaks()
+            print(f"⚠️ انتهت مهلة انتظار اتصال من مجمع قاعدة البيانات ({wait_limit:g} ثانية)")
+            return None
 
+        if action == "open":
+            conn = get_db_connection()
+            if conn is None:
+                with DB_POOL_CONDITION:
+                    DB_POOL_STATE["pending"] -= 1
+                    DB_POOL_CONDITION.notify()
+                return None
+            now = time.monotonic()
+            entry = {"conn": conn, "created_at": now, "last_used": now}
+            with DB_POOL_CONDITION:
+                DB_POOL_STATS["created"] += 1
+        elif not _pooled_connection_usable(entry):
+            with DB_POOL_CONDITION:
+                DB_POOL_STATE["pending"] -= 1
+                DB_POOL_STATS["failed_checks"] += 1
+            _close_pooled_connection(entry["conn"])
+            continue
 
-def set_setting(key: str, value: str) -> bool:
-    conn = get_db_connection()
-    if not conn:
-        return False
+        entry["checked_out_at"] = time.monotonic()
+        entry["caller"] = _db_pool_caller()
+        entry["leak_reported"] = False
+        with DB_POOL_CONDITION:
+            DB_POOL_STATE["pending"] -= 1
+            DB_POOL_IN_USE[id(entry["conn"])] = entry
+            DB_POOL_STATS["checkouts"] += 1
+            if waited:
+                DB_POOL_STATS["wait_ms_total"] += int((time.monotonic() - started) * 1000)
+        return entry["conn"]
+
+
+def release_db_connection(conn, discard: bool = False) -> None:
+    """إرجاع الاتصال للمجمع بعد إنهاء أي معاملة مفتوحة، أو إغلاقه إذا تعطل أو انتهى عمره."""
+    if conn is None:
+        return
+    with DB_POOL_CONDITION:
+        entry = DB_POOL_IN_USE.get(id(conn))
+    if entry is None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+        return
+
+    if not discard and not conn.closed:
+        try:
+            if conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        except Exception:
+            discard = True
+
+    expired = (
+        DB_POOL_MAX_LIFETIME_SECONDS
+        and time.monotonic() - entry["created_at"] > DB_POOL_MAX_LIFETIME_SECONDS
+    )
+    close_now = bool(discard or conn.closed or expired)
+    with DB_POOL_CONDITION:
+        # الاتصال يبقى محسوباً ضمن المستخدم حتى هذه اللحظة كي لا يتجاوز المجمع حده الأعلى.
+        DB_POOL_IN_USE.pop(id(conn), None)
+        if close_now:
+            DB_POOL_STATE["pending"] += 1
+        else:
+            entry["last_used"] = time.monotonic()
+            DB_POOL_IDLE.append(entry)
+        DB_POOL_CONDITION.notify()
+    if close_now:
+        _close_pooled_connection(conn)
+        with DB_POOL_CONDITION:
+            DB_POOL_STATE["pending"] -= 1
+            DB_POOL_CONDITION.notify()
+
+
+@contextmanager
+def db_connection(timeout=None):
+    """مدير سياق لاستعارة اتصال من المجمع؛ يعطي None إذا تعذر الحصول على اتصال."""
+    conn = acquire_db_connection(timeout)
+    discard = False
     try:
-        with conn.cursor() as cur:
-            cur.execute("""
-                INSERT INTO bot_settings(key, value, updated_at)
-                VALUES (%s, %s, CURRENT_TIMESTAMP)
-                ON CONFLICT(key)
-                DO UPDATE SET value=EXCLUDED.value, updated_at=CURRENT_TIMESTAMP
-            """, (key, value))
-            conn.commit()
-            return True
-    except Exception as e:
-        print(f"⚠️ خطأ في set_setting: {e}")
-        conn.rollback()
-        return False
+        yield conn
+    except BaseException:
+        discard = True
+        raise
     finally:
-        conn.close()
+        release_db_connection(conn, discard=discard)
 
 
+def warm_db_pool() -> None:
+    """فتح الحد الأدنى من الاتصالات مسبقاً عند التشغيل."""
+    connections = []
+    for _ in range(min(DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE)):
+        conn = acquire_db_connection(timeout=0)
+        if conn is None:
+            break
+        connections.append(conn)
+    for conn in connections:
+        release_db_connection(conn)
 
-def message_custom_emoji_html(message) -> str:
-    """تحويل نص رسالة تلجرام إلى HTML آمن مع إبقاء Custom Emoji في مكانه."""
-    text = str(getattr(message, "text", None) or "")
-    entities = [
-        entity
-        for entity in (getattr(message, "entities", None) or ())
-        if getattr(entity, "type", "") == "custom_emoji"
-        and getattr(entity, "custom_emoji_id", None)
-    ]
-    if not entities:
-        return escape(text, quote=False)
 
-    encoded = text.encode("utf-16-le")
-    parts = []
-    cursor = 0
-    for entity in sorted(entities, key=lambda item: int(item.offset)):
-        start = max(0, int(entity.offset))
-        end = max(start, start + int(entity.length))
-        if start < cursor:
-            continue
-        before = encoded[cursor * 2:start * 2].decode("utf-16-le")
-        emoji_text = encoded[start * 2:end * 2].decode("utf-16-le")
-        parts.append(escape(before, quote=False))
-        emoji_id = escape(str(entity.custom_emoji_id), quote=True)
-        parts.append(
-            f'<tg-emoji emoji-id="{emoji_id}">{escape(emoji_text, quote=False)}</tg-emoji>'
-        )
-        cursor = end
+def close_db_pool() -> None:
+    """إغلاق الاتصالات الخاملة عند إيقاف البوت."""
+    with DB_POOL_CONDITION:
+        idle = list(DB_POOL_IDLE)
+        DB_POOL_IDLE.clear()
+    for entry in idle:
+        _close_pooled_connection(entry["conn"])
 
-    parts.append(encoded[cursor * 2:].decode("utf-16-le"))
-    # آخر جزء لم يمر عبر escape حتى الآن.
-    parts[-1] = escape(parts[-1], quote=False)
-    return "".join(parts)
 
+def get_db_pool_stats() -> dict:
+    """لقطة من حالة المجمع لعرضها في شاشة حالة البوت."""
+    leaking = check_db_pool_leaks()
+    with DB_POOL_CONDITION:
+        stats = dict(DB_POOL_STATS)
+        stats["in_use"] = len(DB_POOL_IN_USE)
+        stats["idle"] = len(DB_POOL_IDLE)
+    stats["size"] = stats["in_use"] + stats["idle"]
+    stats["min_size"] = DB_POOL_MIN_SIZE
+    stats["max_size"] = DB_POOL_MAX_SIZE
+    stats["leaking"] = leaking
+    stats["avg_wait_ms"] = int(stats["wait_ms_total"] / stats["waits"]) if stats["waits"] else 0
+    return stats
 
-def save_rich_text_setting(key: str, message) -> bool:
-    """حفظ النص العادي ونسخته التي تحتوي معرفات الإيموجي المميز."""
-    text = str(getattr(message, "text", None) or "")
-    rich_html = message_custom_emoji_html(message)
-    if not set_setting(key, text):
-        return False
-    if not set_setting(f"{key}_rich_html", rich_html):
-        # منع بقاء نسخة Rich قديمة لا تطابق النص الجديد.
-        set_setting(f"{key}_rich_html", "")
-        return False
-    return True
 
+# نفس التعبيرات في الفهارس وفي استعلامات البحث حتى يستخدمها PostgreSQL.
+MEMBER_SEARCH_USERNAME_SQL = "LOWER(COALESCE(username, ''))"
+MEMBER_SEARCH_NAME_SQL = "LOWER(COALESCE(first_name, '') || ' ' || COALESCE(last_name, ''))"
 
-def get_rich_text_setting(key: str, default: str = ""):
-    """إرجاع النص العادي وHTML الآمن؛ متوافق مع الإعدادات القديمة."""
-    text = get_setting(key, default)
-    if not str(text or "").strip() and default:
-        text = default
-        return text, escape(text, quote=False)
 
-    rich_html = get_setting(f"{key}_rich_html", "")
-    if rich_html:
-        return text, rich_html
-    return text, escape(str(text or ""), quote=False)
+def init_database():
+    with db_connection() as conn:
+        if not conn:
+            return
+        try:
+            with conn.cursor() as cur:
+                # users
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS bot_users (
+                        telegram_id BIGINT PRIMARY KEY,
+                        language VARCHAR(10),
+                        first_name VARCHAR(255),
+                        last_name VARCHAR(255),
+                        username VARCHAR(255),
+                        emails JSONB DEFAULT '[]'::jsonb,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                """)
 
-def increment_daily_stat(stat_name: str) -> bool:
-    """زيادة عداد يومي واحد بشكل ذري وآمن مع تعدد المستخدمين."""
-    allowed = {"new_users", "emails_created", "inbox_opens"}
-    if stat_name not in allowed:
-        return False
+                # channels
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS channels (
+                        id SERIAL PRIMARY KEY,
+                        channel_username VARCHAR(255) UNIQUE NOT NULL,
+                        channel_id BIGINT,
+                        channel_title VARCHAR(500),
+                        subscription_message TEXT,
+                        subscription_enabled BOOLEAN DEFAULT TRUE,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                """)
 
-    conn = get_db_connection()
-    if not conn:
-        return False
-    try:
-        with conn.cursor() as cur:
-            cur.execute(
-                f"""
-                INSERT INTO usage_daily_stats(stat_date, {stat_name})
-                VALUES (CURRENT_DATE, 1)
-                ON CONFLICT(stat_date)
-                DO UPDATE SET {stat_name} = usage_daily_stats.{stat_name} + 1
-                """
-            )
-            conn.commit()
-            return True
-    except Exception as error:
-        print(f"⚠️ خطأ في تسجيل إحصائية {stat_name}: {error}")
-        conn.rollback()
-        return False
-    finally:
-        conn.close()
+                # admins
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS admins (
+                        id SERIAL PRIMARY KEY,
+                        telegram_id BIGINT UNIQUE NOT NULL,
+                        username VARCHAR(255),
+                        first_name VARCHAR(255),
+                        added_by BIGINT,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                """)
 
+                # settings (جديد)
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS bot_settings (
+                        key TEXT PRIMARY KEY,
+                        value TEXT,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                """)
 
-def get_last_seven_days_usage():
-    """إرجاع آخر 7 أيام بما فيها الأيام التي لم يحدث فيها استخدام."""
-    conn = get_db_connection()
-    if not conn:
-        return []
-    try:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("SELECT CURRENT_DATE AS today")
-            today = cur.fetchone()["today"]
-            cur.execute("""
-                SELECT stat_date, new_users, emails_created, inbox_opens
-                FROM usage_daily_stats
-                WHERE stat_date BETWEEN CURRENT_DATE - INTERVAL '6 days' AND CURRENT_DATE
-                ORDER BY stat_date DESC
-            """)
-            rows = cur.fetchall()
-
-        by_date = {row["stat_date"]: row for row in rows}
-        result = []
-        for offset in range(7):
-            day = today - timedelta(days=offset)
-            row = by_date.get(day) or {}
-            result.append({
-                "stat_date": day,
-                "new_users": int(row.get("new_users") or 0),
-                "emails_created": int(row.get("emails_created") or 0),
-                "inbox_opens": int(row.get("inbox_opens") or 0),
-            })
-        return result
-    except Exception as error:
-        print(f"⚠️ خطأ في قراءة الإحصائيات اليومية: {error}")
-        return []
-    finally:
-        conn.close()
+                # banned users (جديد)
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS banned_users (
+                        telegram_id BIGINT PRIMARY KEY,
+                        reason TEXT,
+                        banned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        banned_by BIGINT
+                    )
+                """)
 
+                # email seen state (جديد) - لتتبع آخر رسالة تم إرسالها لكل بريد
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS email_seen (
+                        email_address TEXT PRIMARY KEY,
+                        last_message_id TEXT,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                """)
 
-def get_global_subscription_message() -> str:
-    """رسالة اشتراك إجبارية عامة واحدة لكل القنوات."""
-    value = get_setting("global_subscription_message", DEFAULT_SUBSCRIPTION_MESSAGE)
-    return value if str(value or "").strip() else DEFAULT_SUBSCRIPTION_MESSAGE
+                # يمنع تكرار إشعار اشتراك العضو في القناة الإجبارية.
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS subscription_notifications (
+                        telegram_id BIGINT NOT NULL,
+                        channel_key TEXT NOT NULL,
+                        notified_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        PRIMARY KEY (telegram_id, channel_key)
+                    )
+                """)
 
+                # إحصائيات الاستخدام اليومية.
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS usage_daily_stats (
+                        stat_date DATE PRIMARY KEY DEFAULT CURRENT_DATE,
+                        new_users BIGINT NOT NULL DEFAULT 0,
+                        emails_created BIGINT NOT NULL DEFAULT 0,
+                        inbox_opens BIGINT NOT NULL DEFAULT 0
+                    )
+                """)
 
-def get_global_subscription_message_html() -> str:
-    value, rich_html = get_rich_text_setting(
-        "global_subscription_message",
-        DEFAULT_SUBSCRIPTION_MESSAGE,
-    )
-    if not str(value or "").strip():
-        return escape(DEFAULT_SUBSCRIPTION_MESSAGE, quote=False)
-    return rich_html
+                # إيميلات الأعضاء: صف لكل عنوان بدل مصفوفة JSONB داخل bot_users.
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS user_emails (
+                        id BIGSERIAL PRIMARY KEY,
+                        telegram_id BIGINT NOT NULL,
+                        address TEXT NOT NULL,
+                        token TEXT,
+                        password TEXT,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        last_opened_at TIMESTAMP,
+                        UNIQUE (telegram_id, address)
+                    )
+                """)
+                cur.execute("CREATE INDEX IF NOT EXISTS user_emails_telegram_id_idx ON user_emails(telegram_id, id)")
+                cur.execute("CREATE INDEX IF NOT EXISTS user_emails_address_idx ON user_emails(LOWER(address))")
 
+                # ملخص الأعضاء يُحدَّث مع كل تعديل بدل عدّ الجداول عند كل فتح للوحة الأدمن.
+                cur.execute("ALTER TABLE bot_users ADD COLUMN IF NOT EXISTS emails_count INTEGER NOT NULL DEFAULT 0")
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS member_stats (
+                        id SMALLINT PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+                        total_users BIGINT NOT NULL DEFAULT 0,
+                        active_users BIGINT NOT NULL DEFAULT 0,
+                        total_emails BIGINT NOT NULL DEFAULT 0,
+                        blocked_users BIGINT NOT NULL DEFAULT 0,
+                        blocked_active_users BIGINT NOT NULL DEFAULT 0,
+                        rebuilt_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                """)
+                cur.execute("CREATE INDEX IF NOT EXISTS bot_users_created_idx ON bot_users(created_at, telegram_id)")
+                cur.execute("""
+                    CREATE INDEX IF NOT EXISTS bot_users_active_created_idx
+                    ON bot_users(created_at, telegram_id) WHERE emails_count > 0
+                """)
+                # قائمة الأكثر إيميلات تُقرأ بمؤشر (emails_count, telegram_id) بنفس اتجاه الفهرس.
+                cur.execute("""
+                    CREATE INDEX IF NOT EXISTS bot_users_top_keyset_idx
+                    ON bot_users(emails_count DESC, telegram_id DESC) WHERE emails_count > 0
+                """)
+                # مؤشر الصفحات يعتمد على created_at، فلا يُترك فارغاً لأعضاء قدامى.
+                cur.execute(
+                    "UPDATE bot_users SET created_at = COALESCE(updated_at, CURRENT_TIMESTAMP) WHERE created_at IS NULL"
+                )
 
-def set_global_subscription_message(message: str) -> bool:
-    value = str(message or "")
-    if not value.strip():
-        return False
-    if not set_setting("global_subscription_message", value):
-        return False
-    return set_setting("global_subscription_message_rich_html", "")
+                # بحث الأعضاء: فهارس للمطابقة التامة وبالبادئة، وفهارس trigram للبحث داخل النص إن توفر pg_trgm.
+                cur.execute(f"""
+                    CREATE INDEX IF NOT EXISTS bot_users_username_search_idx
+                    ON bot_users (({MEMBER_SEARCH_USERNAME_SQL}) text_pattern_ops)
+                """)
+                cur.execute(f"""
+                    CREATE INDEX IF NOT EXISTS bot_users_name_search_idx
+                    ON bot_users (({MEMBER_SEARCH_NAME_SQL}) text_pattern_ops)
+                """)
+                cur.execute("""
+                    CREATE INDEX IF NOT EXISTS bot_users_id_search_idx
+                    ON bot_users ((telegram_id::text) text_pattern_ops)
+                """)
+                cur.execute("SAVEPOINT member_search_trgm")
+                try:
+                    cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+                    cur.execute(f"""
+                        CREATE INDEX IF NOT EXISTS bot_users_username_trgm_idx
+                        ON bot_users USING gin (({MEMBER_SEARCH_USERNAME_SQL}) gin_trgm_ops)
+                    """)
+                    cur.execute(f"""
+                        CREATE INDEX IF NOT EXISTS bot_users_name_trgm_idx
+                        ON bot_users USING gin (({MEMBER_SEARCH_NAME_SQL}) gin_trgm_ops)
+                    """)
+                    cur.execute("RELEASE SAVEPOINT member_search_trgm")
+                except Exception as error:
+                    # غالباً صلاحيات غير كافية لإنشاء الإضافة؛ يبقى البحث داخل النص بدون فهرس.
+                    cur.execute("ROLLBACK TO SAVEPOINT member_search_trgm")
+                    print(f"⚠️ تعذر تفعيل pg_trgm لبحث الأعضاء: {error}")
+
+                # الإذاعة: المهمة ومستلموها محفوظون لاستكمال الإرسال بعد إعادة التشغيل.
+                cur.execute("ALTER TABLE bot_users ADD COLUMN IF NOT EXISTS blocked_at TIMESTAMP")
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                        id BIGSERIAL PRIMARY KEY,
+                        audience TEXT NOT NULL,
+                        message_html TEXT NOT NULL,
+                        status TEXT NOT NULL DEFAULT 'running',
+                        created_by BIGINT,
+                        progress_chat_id BIGINT,
+                        progress_message_id BIGINT,
+                        cursor BIGINT NOT NULL DEFAULT 0,
+                        total BIGINT NOT NULL DEFAULT 0,
+                        sent BIGINT NOT NULL DEFAULT 0,
+                        failed BIGINT NOT NULL DEFAULT 0,
+                        blocked BIGINT NOT NULL DEFAULT 0,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        finished_at TIMESTAMP
+                    )
+                """)
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS broadcast_recipients (
+                        job_id BIGINT NOT NULL REFERENCES broadcast_jobs(id) ON DELETE CASCADE,
+                        telegram_id BIGINT NOT NULL,
+                        status TEXT NOT NULL DEFAULT 'pending',
+                        attempts INTEGER NOT NULL DEFAULT 0,
+                        updated_at TIMESTAMP,
+                        PRIMARY KEY (job_id, telegram_id)
+                    )
+                """)
+                cur.execute("""
+                    CREATE INDEX IF NOT EXISTS broadcast_recipients_pending_idx
+                    ON broadcast_recipients(job_id, telegram_id) WHERE status = 'pending'
+                """)
 
+                # حسابات mail.tm جاهزة مسبقاً تُسلَّم فوراً عند الإنشاء السريع.
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS mail_account_pool (
+                        address TEXT PRIMARY KEY,
+                        domain TEXT NOT NULL,
+                        password TEXT NOT NULL,
+                        token TEXT NOT NULL,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                """)
+                cur.execute("""
+                    CREATE INDEX IF NOT EXISTS mail_account_pool_domain_idx
+                    ON mail_account_pool(domain, created_at)
+                """)
 
-def get_email_limit() -> int:
-    """يرجع الحد العام لكل مستخدم؛ صفر يعني غير محدود."""
-    raw_value = get_setting("email_limit", str(DEFAULT_EMAIL_LIMIT)).strip()
-    try:
-        return max(0, int(raw_value))
-    except (TypeError, ValueError):
-        return DEFAULT_EMAIL_LIMIT
+                # الواجهة أصبحت عربية فقط؛ توحيد بيانات المستخدمين القديمة دون تغيير بنية الجدول.
+                cur.execute("UPDATE bot_users SET language='ar' WHERE language IS DISTINCT FROM 'ar'")
 
+                conn.commit()
+                print("✅ تم تهيئة قاعدة البيانات بنجاح")
+        except Exception as e:
+            print(f"❌ خطأ في تهيئة قاعدة البيانات: {e}")
+            conn.rollback()
 
-def get_member_email_limit(user_id: int):
-    """يرجع الحد الخاص بعضو معيّن، أو None ليستخدم الحد العام."""
-    raw_value = get_setting(f"member_email_limit_{int(user_id)}", "").strip()
-    if raw_value == "":
-        return None
-    try:
-        return max(0, int(raw_value))
-    except (TypeError, ValueError):
-        return None
 
+USER_EMAILS_MIGRATION_BATCH = int(os.getenv("USER_EMAILS_MIGRATION_BATCH", "200"))
 
-def set_member_email_limit(user_id: int, limit: int) -> bool:
-    """حفظ حد خاص للعضو؛ صفر يعني غير محدود لهذا العضو."""
-    return set_setting(f"member_email_limit_{int(user_id)}", str(max(0, int(limit))))
+# إيميلات العضو بنفس شكل بيانات الذاكرة القديمة، لاستخدامها داخل SELECT من bot_users.
+USER_EMAILS_SQL = """
+    COALESCE((
+        SELECT jsonb_agg(
+            jsonb_strip_nulls(jsonb_build_object('address', e.address, 'token', e.token, 'password', e.password))
+            ORDER BY e.id
+        )
+        FROM user_emails e
+        WHERE e.telegram_id = bot_users.telegram_id
+    ), '[]'::jsonb) AS emails
+"""
 
 
-def get_effective_email_limit(user_id: int) -> int:
-    """الحد الخاص يسبق الحد العام عند وجوده."""
-    member_limit = get_member_email_limit(user_id)
-    return member_limit if member_limit is not None else get_email_limit()
-
+def migrate_user_emails() -> int:
+    """نقل مصفوفات emails القديمة إلى جدول user_emails على دفعات قصيرة دون إيقاف البوت.
 
-def check_database_health():
-    """فحص اتصال قاعدة البيانات مع زمن الاستجابة بالمللي ثانية."""
-    started = time.perf_counter()
-    conn = get_db_connection()
-    if not conn:
-        return False, None, "تعذر الاتصال بقاعدة البيانات"
-    try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT 1")
-            row = cur.fetchone()
-        elapsed = int((time.perf_counter() - started) * 1000)
-        return bool(row and row[0] == 1), elapsed, ""
-    except Exception as error:
-        elapsed = int((time.perf_counter() - started) * 1000)
-        return False, elapsed, str(error)[:120]
-    finally:
-        conn.close()
+    كل دفعة معاملة مستقلة تقفل عدداً محدوداً من الأعضاء فقط، والتشغيل المتكرر آمن.
+    """
+    moved = 0
+    while True:
+        with db_connection() as conn:
+            if not conn:
+                return moved
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        SELECT telegram_id FROM bot_users
+                        WHERE jsonb_typeof(emails) = 'array' AND jsonb_array_length(emails) > 0
+                        LIMIT %s
+                        FOR UPDATE SKIP LOCKED
+                    """, (USER_EMAILS_MIGRATION_BATCH,))
+                    user_ids = [row[0] for row in cur.fetchall()]
+                    if not user_ids:
+                        conn.commit()
+                        return moved
+
+                    cur.execute("""
+                        INSERT INTO user_emails (telegram_id, address, token, password)
+                        SELECT u.telegram_id, item->>'address', item->>'token', item->>'password'
+                        FROM bot_users u
+                        CROSS JOIN LATERAL jsonb_array_elements(u.emails) WITH ORDINALITY AS items(item, position)
+                        WHERE u.telegram_id = ANY(%s) AND COALESCE(item->>'address', '') <> ''
+                        ORDER BY u.telegram_id, position
+                        ON CONFLICT (telegram_id, address) DO NOTHING
+                    """, (user_ids,))
+                    moved += cur.rowcount
+                    cur.execute(
+                        "UPDATE bot_users SET emails='[]'::jsonb WHERE telegram_id = ANY(%s)",
+                        (user_ids,),
+                    )
+                    conn.commit()
+            except Exception as e:
+                print(f"❌ خطأ في ترحيل الإيميلات إلى user_emails: {e}")
+                conn.rollback()
+                return moved
 
 
-def check_mail_service_health():
-    """فحص خدمة mail.tm مع زمن الاستجابة بالمللي ثانية."""
-    started = time.perf_counter()
-    response, request_error = mail_request("GET", "/domains", return_error=True)
-    elapsed = int((time.perf_counter() - started) * 1000)
-    if response is not None and response.status_code == 200:
+def rebuild_member_stats() -> bool:
+    """إعادة حساب emails_count لكل عضو وملخص member_stats من الصفر (أول تشغيل أو بعد الترحيل)."""
+    with db_connection() as conn:
+        if not conn:
+            return False
         try:
-            domains = response.json().get("hydra:member") or []
-            if isinstance(domains, list):
-                return True, elapsed, ""
-        except (ValueError, AttributeError):
-            return False, elapsed, "استجابة غير صالحة"
-    if response is not None:
-        return False, elapsed, f"HTTP {response.status_code}"
-    return False, elapsed, request_error or "تعذر الاتصال"
+            with conn.cursor() as cur:
+                cur.execute("LOCK TABLE member_stats IN EXCLUSIVE MODE")
+                cur.execute("""
+                    UPDATE bot_users u
+                    SET emails_count = c.emails_count
+                    FROM (
+                        SELECT b.telegram_id, COUNT(e.id) AS emails_count
+                        FROM bot_users b
+                        LEFT JOIN user_emails e ON e.telegram_id = b.telegram_id
+                        GROUP BY b.telegram_id
+                    ) c
+                    WHERE u.telegram_id = c.telegram_id AND u.emails_count <> c.emails_count
+                """)
+                cur.execute("""
+                    INSERT INTO member_stats (
+                        id, total_users, active_users, total_emails, blocked_users, blocked_active_users, rebuilt_at
+                    )
+                    SELECT 1,
+                           COUNT(*),
+                           COUNT(*) FILTER (WHERE emails_count > 0),
+                           (SELECT COUNT(*) FROM user_emails),
+                           COUNT(*) FILTER (WHERE blocked_at IS NOT NULL),
+                           COUNT(*) FILTER (WHERE blocked_at IS NOT NULL AND emails_count > 0),
+                           CURRENT_TIMESTAMP
+                    FROM bot_users
+                    ON CONFLICT (id) DO UPDATE SET
+                        total_users = EXCLUDED.total_users,
+                        active_users = EXCLUDED.active_users,
+                        total_emails = EXCLUDED.total_emails,
+                        blocked_users = EXCLUDED.blocked_users,
+                        blocked_active_users = EXCLUDED.blocked_active_users,
+                        rebuilt_at = EXCLUDED.rebuilt_at
+                """)
+                conn.commit()
+                return True
+        except Exception as e:
+            print(f"❌ خطأ في إعادة حساب ملخص الأعضاء: {e}")
+            conn.rollback()
+            return False
 
 
-def format_bot_uptime() -> str:
-    total_seconds = max(0, int(time.time() - BOT_STARTED_AT))
-    days, remainder = divmod(total_seconds, 86400)
-    hours, remainder = divmod(remainder, 3600)
-    minutes, seconds = divmod(remainder, 60)
-    parts = []
-    if days:
-        parts.append(f"{days} يوم")
-    if hours or days:
-        parts.append(f"{hours} ساعة")
-    if minutes or hours or days:
-        parts.append(f"{minutes} دقيقة")
-    if not parts:
-        parts.append(f"{seconds} ثانية")
-    return " و".join(parts)
+def member_stats_ready() -> bool:
+    with db_connection() as conn:
+        if not conn:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1 FROM member_stats WHERE id = 1")
+                return cur.fetchone() is not None
+        except Exception as e:
+            print(f"⚠️ خطأ في member_stats_ready: {e}")
+            conn.rollback()
+            return True
 
 
-def normalize_telegram_username(value: str) -> str:
-    """تنظيف والتحقق من يوزر تلجرام دون @."""
-    username = str(value or "").strip().lstrip("@")
-    if re.fullmatch(r"[A-Za-z0-9_]{5,32}", username):
-        return username
-    return ""
+def _adjust_member_emails(conn, telegram_id: int, delta: int) -> None:
+    """تعديل emails_count للعضو وملخص member_stats داخل معاملة الاستدعاء نفسها."""
+    if not delta:
+        return
+    with conn.cursor() as cur:
+        cur.execute(
+            "UPDATE bot_users SET emails_count = emails_count + %s "
+            "WHERE telegram_id = %s RETURNING emails_count, blocked_at IS NOT NULL",
+            (delta, int(telegram_id)),
+        )
+        row = cur.fetchone()
+        active_delta = 0
+        blocked = False
+        if row is not None:
+            count, blocked = row
+            active_delta = (1 if count > 0 else 0) - (1 if count - delta > 0 else 0)
+        cur.execute("""
+            UPDATE member_stats
+            SET total_emails = total_emails + %s,
+                active_users = active_users + %s,
+                blocked_active_users = blocked_active_users + %s
+            WHERE id = 1
+        """, (delta, active_delta, active_delta if blocked else 0))
+
+
+def _adjust_member_blocked(conn, rows) -> None:
+    """rows: أزواج (1 أو -1، emails_count) للأعضاء الذين تغيرت حالة حظرهم للبوت."""
+    blocked_delta = sum(sign for sign, _count in rows)
+    active_delta = sum(sign for sign, count in rows if count > 0)
+    if not (blocked_delta or active_delta):
+        return
+    with conn.cursor() as cur:
+        cur.execute(
+            "UPDATE member_stats SET blocked_users = blocked_users + %s, "
+            "blocked_active_users = blocked_active_users + %s WHERE id = 1",
+            (blocked_delta, active_delta),
+        )
 
 
-def get_admin_contact_username() -> str:
-    return normalize_telegram_username(get_setting("admin_contact_username", ""))
+USER_CACHE_MAX_ENTRIES = int(os.getenv("USER_CACHE_MAX_ENTRIES", "5000"))
+USER_CACHE_TTL_SECONDS = int(os.getenv("USER_CACHE_TTL_SECONDS", "900"))
+
+
+class MemberPrefixIndex:
+    """فهرس بادئات في الذاكرة (ID واليوزر والاسم) لأعضاء الكاش، للبحث عند تعذر الوصول لقاعدة البيانات."""
+
+    def __init__(self):
+        self._keys = []
+        self._by_user = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def member_keys(user_id: str, info) -> tuple:
+        info = info or {}
+        first_name = str(info.get("first_name") or "").lower()
+        last_name = str(info.get("last_name") or "").lower()
+        keys = {str(user_id), str(info.get("username") or "").lower(), first_name, last_name}
+        keys.add(f"{first_name} {last_name}".strip())
+        keys.discard("")
+        return tuple(keys)
+
+    def _discard(self, user_id: str) -> None:
+        for key in self._by_user.pop(user_id, ()):
+            position = bisect.bisect_left(self._keys, (key, user_id))
+            if position < len(self._keys) and self._keys[position] == (key, user_id):
+                del self._keys[position]
+
+    def add(self, user_id, info) -> None:
+        uid = str(user_id)
+        keys = self.member_keys(uid, info)
+        with self._lock:
+            self._discard(uid)
+            for key in keys:
+                bisect.insort(self._keys, (key, uid))
+            self._by_user[uid] = keys
+
+    def discard(self, user_id) -> None:
+        with self._lock:
+            self._discard(str(user_id))
+
+    def search(self, prefix: str, limit: int = 10) -> list:
+        """أعضاء يبدأ أحد مفاتيحهم بـ prefix؛ المطابقة التامة أولاً لأنها الأصغر في الترتيب."""
+        prefix = str(prefix or "").lower()
+        if not prefix:
+            return []
+        found, seen = [], set()
+        with self._lock:
+            position = bisect.bisect_left(self._keys, (prefix, ""))
+            while position < len(self._keys) and len(found) < limit:
+                key, uid = self._keys[position]
+                if not key.startswith(prefix):
+                    break
+                if uid not in seen:
+                    seen.add(uid)
+                    found.append(uid)
+                position += 1
+        return found
+
+    def exact(self, key: str) -> list:
+        """كل الأعضاء الذين يساوي أحد مفاتيحهم key تماماً."""
+        key = str(key or "").lower()
+        found = []
+        with self._lock:
+            position = bisect.bisect_left(self._keys, (key, ""))
+            while position < len(self._keys) and self._keys[position][0] == key:
+                found.append(self._keys[position][1])
+                position += 1
+        return found
+
+
+class UserCache:
+    """كاش LRU محدود الحجم لبيانات الأعضاء مع مدة صلاحية لكل عنصر.
+
+    يُستخدم من حلقة الأحداث ومن خيوط DB_EXECUTOR معاً، لذلك كل العمليات تحت قفل.
+    """
 
+    def __init__(self, max_entries: int, ttl_seconds: int, index: MemberPrefixIndex = None):
+        self.max_entries = max(1, max_entries)
+        self.ttl_seconds = ttl_seconds
+        self.index = index
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0}
+
+    def get(self, user_id, default=None):
+        uid = str(user_id)
+        with self._lock:
+            entry = self._entries.get(uid)
+            if entry is None:
+                self.stats["misses"] += 1
+                return default
+            stored_at, info = entry
+            if time.monotonic() - stored_at > self.ttl_seconds:
+                del self._entries[uid]
+                if self.index is not None:
+                    self.index.discard(uid)
+                self.stats["expired"] += 1
+                self.stats["misses"] += 1
+                return default
+            self._entries.move_to_end(uid)
+            self.stats["hits"] += 1
+            return info
+
+    def __setitem__(self, user_id, info) -> None:
+        uid = str(user_id)
+        with self._lock:
+            self._entries[uid] = (time.monotonic(), info)
+            self._entries.move_to_end(uid)
+            if self.index is not None:
+                self.index.add(uid, info)
+            while len(self._entries) > self.max_entries:
+                evicted_uid, _entry = self._entries.popitem(last=False)
+                if self.index is not None:
+                    self.index.discard(evicted_uid)
+                self.stats["evictions"] += 1
+
+    def pop(self, user_id, default=None):
+        with self._lock:
+            entry = self._entries.pop(str(user_id), None)
+            if entry and self.index is not None:
+                self.index.discard(user_id)
+        return entry[1] if entry else default
+
+    def items(self):
+        with self._lock:
+            return [(uid, info) for uid, (_stored_at, info) in self._entries.items()]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.stats)
+            stats["size"] = len(self._entries)
+        stats["max_entries"] = self.max_entries
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] * 100 / lookups) if lookups else 0
+        return stats
+
+
+def load_user(telegram_id):
+    """قراءة عضو واحد مع إيميلاته من PostgreSQL.
+
+    يرجع (info, True) عند النجاح، و(None, True) إذا لم يكن العضو موجوداً، و(None, False) عند تعذر القراءة.
+    """
+    with db_connection() as conn:
+        if not conn:
+            return None, False
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(
+                    f"""
+                    SELECT telegram_id, language, first_name, last_name, username, {USER_EMAILS_SQL}
+                    FROM bot_users
+                    WHERE telegram_id=%s
+                    """,
+                    (int(telegram_id),),
+                )
+                row = cur.fetchone()
+            return (_db_row_to_user_info(row) if row else None), True
+        except Exception as e:
+            print(f"❌ خطأ في تحميل بيانات العضو {telegram_id}: {e}")
+            return None, False
 
-def normalize_paid_domain(value: str) -> str:
-    """تنظيف اسم دومين شكلي مدفوع والتحقق من صيغته."""
-    domain = str(value or "").strip().lower().lstrip("@")
-    if len(domain) > 253 or "." not in domain:
-        return ""
 
-    labels = domain.split(".")
-    if any(
-        not label
-        or len(label) > 63
-        or label.startswith("-")
-        or label.endswith("-")
-        or not re.fullmatch(r"[a-z0-9-]+", label)
-        for label in labels
-    ):
-        return ""
-    return domain
+def upsert_user_profile(telegram_id, user_info):
+    """حفظ بيانات العضو الأساسية؛ يرجع True إذا كان العضو جديداً، False إذا كان موجوداً، None عند الفشل."""
+    with db_connection() as conn:
+        if not conn:
+            return None
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO bot_users (
+                        telegram_id, language, first_name, last_name, username, updated_at, emails_count
+                    )
+                    VALUES (
+                        %s, %s, %s, %s, %s, CURRENT_TIMESTAMP,
+                        (SELECT COUNT(*) FROM user_emails WHERE telegram_id = %s)
+                    )
+                    ON CONFLICT (telegram_id)
+                    DO UPDATE SET
+                        language = EXCLUDED.language,
+                        first_name = EXCLUDED.first_name,
+                        last_name = EXCLUDED.last_name,
+                        username = EXCLUDED.username,
+                        updated_at = CURRENT_TIMESTAMP
+                    RETURNING (xmax = 0) AS inserted, emails_count
+                """, (
+                    int(telegram_id),
+                    user_info.get("lang"),
+                    user_info.get("first_name", ""),
+                    user_info.get("last_name", ""),
+                    user_info.get("username", ""),
+                    int(telegram_id),
+                ))
+                inserted, emails_count = cur.fetchone()
+                inserted = bool(inserted)
+                if inserted:
+                    cur.execute(
+                        "UPDATE member_stats SET total_users = total_users + 1, active_users = active_users + %s "
+                        "WHERE id = 1",
+                        (1 if emails_count > 0 else 0,),
+                    )
+                else:
+                    # عاد العضو للتفاعل مع البوت بعد حظره: يرجع لجمهور الإذاعة.
+                    cur.execute(
+                        "UPDATE bot_users SET blocked_at = NULL WHERE telegram_id = %s AND blocked_at IS NOT NULL "
+                        "RETURNING emails_count",
+                        (int(telegram_id),),
+                    )
+                    _adjust_member_blocked(conn, [(-1, row[0]) for row in cur.fetchall()])
+                conn.commit()
+                return inserted
+        except Exception as e:
+            print(f"❌ خطأ في حفظ البيانات: {e}")
+            conn.rollback()
+            return None
 
 
-def get_paid_domains() -> list[str]:
-    """جلب الدومينات الشكلية المدفوعة من الإعدادات بترتيب إضافتها."""
-    raw = get_setting("paid_domains", "")
-    domains = []
-    for line in raw.splitlines():
-        domain = normalize_paid_domain(line)
-        if domain and domain not in domains:
-            domains.append(domain)
-    return domains
+def save_single_user(telegram_id, user_info) -> bool:
+    if upsert_user_profile(telegram_id, user_info) is None:
+        return False
+    user_cache[str(telegram_id)] = user_info
+    return True
 
 
-def save_paid_domains(domains) -> bool:
-    cleaned = []
-    for value in domains:
-        domain = normalize_paid_domain(value)
-        if domain and domain not in cleaned:
-            cleaned.append(domain)
-    return set_setting("paid_domains", "\n".join(cleaned))
+def save_email_token(telegram_id, address: str, token: str) -> bool:
+    with db_connection() as conn:
+        if not conn:
+            return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "UPDATE user_emails SET token=%s WHERE telegram_id=%s AND address=%s",
+                    (token, int(telegram_id), address),
+                )
+                conn.commit()
+                return cur.rowcount > 0
+        except Exception as e:
+            print(f"⚠️ خطأ في save_email_token: {e}")
+            conn.rollback()
+            return False
 
 
-def add_paid_domain(value: str):
-    domain = normalize_paid_domain(value)
-    if not domain:
-        return False, "invalid", ""
+def insert_user_email(telegram_id, address: str, token: str, password=None) -> bool:
+    with db_connection() as conn:
+        if not conn:
+            return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO user_emails (telegram_id, address, token, password)
+                    VALUES (%s, %s, %s, %s)
+                    ON CONFLICT (telegram_id, address)
+                    DO UPDATE SET token=EXCLUDED.token, password=EXCLUDED.password
+                    RETURNING (xmax = 0) AS inserted
+                """, (int(telegram_id), address, token, password))
+                if cur.fetchone()[0]:
+                    _adjust_member_emails(conn, telegram_id, 1)
+                conn.commit()
+                return True
+        except Exception as e:
+            print(f"❌ خطأ في حفظ الإيميل: {e}")
+            conn.rollback()
+            return False
 
-    domains = get_paid_domains()
-    if domain in domains:
-        return False, "exists", domain
 
-    domains.append(domain)
-    if not save_paid_domains(domains):
-        return False, "save_failed", domain
-    return True, "added", domain
+def delete_user_email(telegram_id, address: str) -> bool:
+    with db_connection() as conn:
+        if not conn:
+            return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "DELETE FROM user_emails WHERE telegram_id=%s AND address=%s",
+                    (int(telegram_id), address),
+                )
+                _adjust_member_emails(conn, telegram_id, -cur.rowcount)
+                conn.commit()
+                return True
+        except Exception as e:
+            print(f"❌ خطأ في حذف الإيميل: {e}")
+            conn.rollback()
+            return False
 
 
-def remove_paid_domain(index: int):
-    domains = get_paid_domains()
-    if index < 0 or index >= len(domains):
-        return False, ""
+# (telegram_id, address) لبرائد فتحها أصحابها منذ آخر حفظ؛ تُكتب مع العدادات اليومية.
+EMAIL_TOUCH_PENDING = set()
+EMAIL_TOUCH_LOCK = threading.Lock()
 
-    removed = domains.pop(index)
-    if not save_paid_domains(domains):
-        return False, ""
-    return True, removed
 
+def touch_user_email(telegram_id, address: str) -> None:
+    """تسجيل فتح البريد في الذاكرة؛ الكتابة الفعلية في flush_email_touches."""
+    if not address:
+        return
+    with EMAIL_TOUCH_LOCK:
+        EMAIL_TOUCH_PENDING.add((int(telegram_id), address))
 
-def build_main_menu_text(user_id: int) -> str:
-    """دمج رسالة الترحيب مع القائمة الرئيسية في رسالة واحدة."""
-    emails_count = len(get_user_emails(user_id))
-    menu_text = get_text("ar", "main_menu", emails_count=emails_count)
-    welcome_message = get_setting("welcome_message", "")
-    if str(welcome_message or "").strip():
-        return f"{welcome_message}\n\n{menu_text}"
-    return menu_text
 
+def flush_email_touches() -> bool:
+    """كتابة last_opened_at لكل البرائد المفتوحة باستعلام واحد، وإرجاعها للذاكرة إذا فشلت الكتابة."""
+    with EMAIL_TOUCH_LOCK:
+        touches = list(EMAIL_TOUCH_PENDING)
+        EMAIL_TOUCH_PENDING.clear()
+    if not touches:
+        return True
 
-def build_main_menu_html(user_id: int) -> str:
-    """نسخة HTML من القائمة الرئيسية تحافظ على الإيموجي المميز برسالة الترحيب."""
-    emails_count = len(get_user_emails(user_id))
-    menu_text = get_text("ar", "main_menu", emails_count=emails_count)
-    welcome_text, welcome_html = get_rich_text_setting("welcome_message", "")
-    if str(welcome_text or "").strip():
-        return f"{welcome_html}\n\n{escape(menu_text, quote=False)}"
-    return escape(menu_text, quote=False)
+    with db_connection() as conn:
+        if conn:
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        UPDATE user_emails AS e SET last_opened_at=CURRENT_TIMESTAMP
+                        FROM unnest(%s::bigint[], %s::text[]) AS v(telegram_id, address)
+                        WHERE e.telegram_id=v.telegram_id AND e.address=v.address
+                    """, ([item[0] for item in touches], [item[1] for item in touches]))
+                    conn.commit()
+                    return True
+            except Exception as e:
+                print(f"⚠️ خطأ في flush_email_touches: {e}")
+                conn.rollback()
 
+    with EMAIL_TOUCH_LOCK:
+        EMAIL_TOUCH_PENDING.update(touches)
+    return False
 
-def telegram_html(value) -> str:
-    """حماية النصوص الخارجية قبل إرسالها بوضع HTML في تلجرام."""
-    return escape(str(value or ""), quote=False)
 
+# ---------- Settings (جديد) ----------
+def get_setting(key: str, default: str = "") -> str:
+    with db_connection() as conn:
+        if not conn:
+            return default
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT value FROM bot_settings WHERE key=%s", (key,))
+                row = cur.fetchone()
+                return row[0] if row and row[0] is not None else default
+        except Exception as e:
+            print(f"⚠️ خطأ في get_setting: {e}")
+            return default
 
-# ---------- Ban (جديد) ----------
-def is_banned(user_id: int) -> bool:
-    conn = get_db_connection()
-    if not conn:
-        return False
-    try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT 1 FROM banned_users WHERE telegram_id=%s", (user_id,))
-            return cur.fetchone() is not None
-    except Exception as e:
-        print(f"⚠️ خطأ في is_banned: {e}")
-        return False
-    finally:
-        conn.close()
 
+def set_setting(key: str, value: str) -> bool:
+    with db_connection() as conn:
+        if not conn:
+            return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO bot_settings(key, value, updated_at)
+                    VALUES (%s, %s, CURRENT_TIMESTAMP)
+                    ON CONFLICT(key)
+                    DO UPDATE SET value=EXCLUDED.value, updated_at=CURRENT_TIMESTAMP
+                """, (key, value))
+                conn.commit()
+                return True
+        except Exception as e:
+            print(f"⚠️ خطأ في set_setting: {e}")
+            conn.rollback()
+            return False
 
-def ban_user_db(user_id: int, reason: str, banned_by: int) -> bool:
-    conn = get_db_connection()
-    if not conn:
-        return False
-    try:
-        with conn.cursor() as cur:
-            cur.execute("""
-                INSERT INTO banned_users(telegram_id, reason, banned_by)
-                VALUES (%s, %s, %s)
-                ON CONFLICT(telegram_id)
-                DO UPDATE SET reason=EXCLUDED.reason, banned_by=EXCLUDED.banned_by, banned_at=CURRENT_TIMESTAMP
-            """, (user_id, reason, banned_by))
-            conn.commit()
-            return True
-    except Exception as e:
-        print(f"⚠️ خطأ في ban_user_db: {e}")
-        conn.rollback()
-        return False
-    finally:
-        conn.close()
 
+def get_text_overrides(prefix: str) -> dict:
+    """نصوص البوت المخصصة المحفوظة في bot_settings (المفتاح بدون البادئة)."""
+    with db_connection() as conn:
+        if not conn:
+            return {}
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT key, value FROM bot_settings WHERE key LIKE %s AND value IS NOT NULL",
+                    (prefix + "%",),
+                )
+                return {key[len(prefix):]: value for key, value in cur.fetchall()}
+        except Exception as e:
+            print(f"⚠️ خطأ في get_text_overrides: {e}")
+            return {}
 
-def unban_user_db(user_id: int) -> bool:
-    conn = get_db_connection()
-    if not conn:
-        return False
-    try:
-        with conn.cursor() as cur:
-            cur.execute("DELETE FROM banned_users WHERE telegram_id=%s", (user_id,))
-            conn.commit()
-            return cur.rowcount > 0
-    except Exception as e:
-        print(f"⚠️ خطأ في unban_user_db: {e}")
-        conn.rollback()
-        return False
-    finally:
-        conn.close()
 
 
+def message_custom_emoji_html(message) -> str:
+    """تحويل نص رسالة تلجرام إلى HTML آمن مع إبقاء Custom Emoji في مكانه."""
+    text = str(getattr(message, "text", None) or "")
+    entities = [
+        entity
+        for entity in (getattr(message, "entities", None) or ())
+        if getattr(entity, "type", "") == "custom_emoji"
+        and getattr(entity, "custom_emoji_id", None)
+    ]
+    if not entities:
+        return escape(text, quote=False)
 
+    encoded = text.encode("utf-16-le")
+    parts = []
+    cursor = 0
+    for entity in sorted(entities, key=lambda item: int(item.offset)):
+        start = max(0, int(entity.offset))
+        end = max(start, start + int(entity.length))
+        if start < cursor:
+            continue
+        before = encoded[cursor * 2:start * 2].decode("utf-16-le")
+        emoji_text = encoded[start * 2:end * 2].decode("utf-16-le")
+        parts.append(escape(before, quote=False))
+        emoji_id = escape(str(entity.custom_emoji_id), quote=True)
+        parts.append(
+            f'<tg-emoji emoji-id="{emoji_id}">{escape(emoji_text, quote=False)}</tg-emoji>'
+        )
+        cursor = end
 
-# ---------- إشعارات الاشتراك الإجباري ----------
-def subscription_notification_exists(user_id: int, channel_key: str) -> bool:
-    conn = get_db_connection()
-    if not conn:
-        return False
-    try:
-        with conn.cursor() as cur:
-            cur.execute(
-                "SELECT 1 FROM subscription_notifications WHERE telegram_id=%s AND channel_key=%s",
-                (user_id, channel_key),
-            )
-            return cur.fetchone() is not None
-    except Exception as e:
-        print(f"⚠️ خطأ في فحص سجل إشعار الاشتراك: {e}")
-        return False
-    finally:
-        conn.close()
+    parts.append(encoded[cursor * 2:].decode("utf-16-le"))
+    # آخر جزء لم يمر عبر escape حتى الآن.
+    parts[-1] = escape(parts[-1], quote=False)
+    return "".join(parts)
 
 
-def mark_subscription_notified(user_id: int, channel_key: str) -> bool:
-    conn = get_db_connection()
-    if not conn:
+def save_rich_text_setting(key: str, message) -> bool:
+    """حفظ النص العادي ونسخته التي تحتوي معرفات الإيموجي المميز."""
+    text = str(getattr(message, "text", None) or "")
+    rich_html = message_custom_emoji_html(message)
+    if not set_setting(key, text):
         return False
-    try:
-        with conn.cursor() as cur:
-            cur.execute(
-                """
-                INSERT INTO subscription_notifications(telegram_id, channel_key)
-                VALUES (%s, %s)
-                ON CONFLICT (telegram_id, channel_key) DO NOTHING
-                """,
-                (user_id, channel_key),
-            )
-            conn.commit()
-            return True
-    except Exception as e:
-        print(f"⚠️ خطأ في حفظ سجل إشعار الاشتراك: {e}")
-        conn.rollback()
+    if not set_setting(f"{key}_rich_html", rich_html):
+        # منع بقاء نسخة Rich قديمة لا تطابق النص الجديد.
+        set_setting(f"{key}_rich_html", "")
         return False
-    finally:
-        conn.close()
-
-
-# ---------- Email Seen (جديد) ----------
-def get_last_seen_message_id(email_address: str) -> str:
-    """يرجع آخر message_id تم إرساله لهذا البريد (أو نص فارغ)."""
-    conn = get_db_connection()
-    if not conn:
-        return ""
-    try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT last_message_id FROM email_seen WHERE email_address=%s", (email_address.lower(),))
-            row = cur.fetchone()
-            return row[0] if row and row[0] else ""
-    except Exception as e:
-        print(f"⚠️ خطأ في get_last_seen_message_id: {e}")
-        return ""
-    finally:
-        conn.close()
-
-
-def set_last_seen_message_id(email_address: str, message_id: str) -> None:
-    conn = get_db_connection()
-    if not conn:
-        return
-    try:
-        with conn.cursor() as cur:
-            cur.execute("""
-                INSERT INTO email_seen(email_address, last_message_id, updated_at)
-                VALUES (%s, %s, CURRENT_TIMESTAMP)
-                ON CONFLICT(email_address)
-                DO UPDATE SET last_message_id=EXCLUDED.last_message_id, updated_at=CURRENT_TIMESTAMP
-            """, (email_address.lower(), message_id))
-            conn.commit()
-    except Exception as e:
-        print(f"⚠️ خطأ في set_last_seen_message_id: {e}")
-        try:
-            conn.rollback()
-        except Exception:
-            pass
-    finally:
-        conn.close()
-def delete_email_seen_records(addresses) -> None:
-    clean_addresses = [str(address).lower() for address in addresses if address]
-    if not clean_addresses:
-        return
-
-    conn = get_db_connection()
-    if not conn:
-        return
-    try:
-        with conn.cursor() as cur:
-            cur.execute("DELETE FROM email_seen WHERE email_address = ANY(%s)", (clean_addresses,))
-            conn.commit()
-    except Exception as e:
-        print(f"⚠️ خطأ في تنظيف سجل الرسائل: {e}")
-        conn.rollback()
-    finally:
-        conn.close()
+    return True
 
 
-def _db_row_to_user_info(row) -> dict:
-    """تحويل صف العضو من PostgreSQL إلى نفس شكل بيانات الذاكرة."""
-    return {
-        "lang": "ar",
-        "first_name": row.get("first_name", "") or "",
-        "last_name": row.get("last_name", "") or "",
-        "username": row.get("username", "") or "",
-        "emails": row.get("emails") or [],
-    }
+def get_rich_text_setting(key: str, default: str = ""):
+    """إرجاع النص العادي وHTML الآمن؛ متوافق مع الإعدادات القديمة."""
+    text = get_setting(key, default)
+    if not str(text or "").strip() and default:
+        text = default
+        return text, escape(text, quote=False)
 
+    rich_html = get_setting(f"{key}_rich_html", "")
+    if rich_html:
+        return text, rich_html
+    return text, escape(str(text or ""), quote=False)
 
-def find_user_by_username_or_id(search_value: str):
-    """البحث عن العضو من PostgreSQL مباشرة، ثم مزامنة نسخة الذاكرة."""
-    query = str(search_value or "").strip().lstrip("@").lower()
-    if not query:
-        return None
+# العدادات اليومية تُجمع في الذاكرة وتُكتب دفعة واحدة كل DAILY_STATS_FLUSH_SECONDS،
+# فأقصى ما يضيع عند توقف مفاجئ هو عدادات هذه الفترة فقط.
+DAILY_STATS_FLUSH_SECONDS = max(1, int(os.getenv("DAILY_STATS_FLUSH_SECONDS", "5")))
+DAILY_STAT_NAMES = ("new_users", "emails_created", "inbox_opens")
+DAILY_STATS_PENDING = dict.fromkeys(DAILY_STAT_NAMES, 0)
+DAILY_STATS_LOCK = threading.Lock()
+DAILY_STATS_FLUSH = {"flushes": 0, "failures": 0, "last_ms": 0, "max_ms": 0, "last_flush_at": 0.0}
 
-    conn = get_db_connection()
-    if conn:
-        try:
-            with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                if query.isdigit():
-                    cur.execute(
-                        """
-                        SELECT telegram_id, language, first_name, last_name, username, emails
-                        FROM bot_users
-                        WHERE telegram_id=%s
-                        LIMIT 1
-                        """,
-                        (int(query),),
-                    )
-                else:
-                    cur.execute(
-                        """
-                        SELECT telegram_id, language, first_name, last_name, username, emails
-                        FROM bot_users
-                        WHERE LOWER(COALESCE(username, ''))=%s
-                        LIMIT 1
-                        """,
-                        (query,),
-                    )
-                row = cur.fetchone()
 
-            if row:
-                user_id = int(row["telegram_id"])
-                info = _db_row_to_user_info(row)
-                user_database[str(user_id)] = info
-                return user_id, info
-        except Exception as error:
-            print(f"⚠️ فشل البحث عن العضو في قاعدة البيانات: {error}")
-        finally:
-            conn.close()
+def increment_daily_stat(stat_name: str) -> bool:
+    """زيادة عداد يومي في الذاكرة؛ الكتابة الفعلية في flush_daily_stats."""
+    if stat_name not in DAILY_STATS_PENDING:
+        return False
+    with DAILY_STATS_LOCK:
+        DAILY_STATS_PENDING[stat_name] += 1
+    return True
 
-    # احتياط عند تعذر الاتصال المؤقت بقاعدة البيانات.
-    if query.isdigit() and query in user_database:
-        return int(query), user_database[query]
 
-    for uid, info in user_database.items():
-        username = str((info or {}).get("username") or "").lower()
-        if username and username == query:
-            return int(uid), info
-    return None
+def get_pending_daily_stats() -> int:
+    with DAILY_STATS_LOCK:
+        return sum(DAILY_STATS_PENDING.values())
 
 
-def clear_user_emails(user_id: int):
-    """حذف إيميلات العضو من PostgreSQL مباشرة وتحديث الذاكرة فوراً."""
-    conn = get_db_connection()
-    if not conn:
-        return False, 0
+def flush_daily_stats() -> bool:
+    """كتابة كل العدادات المتراكمة باستعلام واحد، وإرجاعها للذاكرة إذا فشلت الكتابة."""
+    with DAILY_STATS_LOCK:
+        deltas = dict(DAILY_STATS_PENDING)
+        if not any(deltas.values()):
+            return True
+        for name in DAILY_STAT_NAMES:
+            DAILY_STATS_PENDING[name] = 0
 
-    try:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute(
-                """
-                SELECT telegram_id, language, first_name, last_name, username, emails
-                FROM bot_users
-                WHERE telegram_id=%s
-                FOR UPDATE
-                """,
-                (int(user_id),),
-            )
-            row = cur.fetchone()
-            if not row:
+    started = time.perf_counter()
+    saved = False
+    with db_connection() as conn:
+        if conn:
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        INSERT INTO usage_daily_stats(stat_date, new_users, emails_created, inbox_opens)
+                        VALUES (CURRENT_DATE, %s, %s, %s)
+                        ON CONFLICT(stat_date) DO UPDATE SET
+                            new_users = usage_daily_stats.new_users + EXCLUDED.new_users,
+                            emails_created = usage_daily_stats.emails_created + EXCLUDED.emails_created,
+                            inbox_opens = usage_daily_stats.inbox_opens + EXCLUDED.inbox_opens
+                    """, tuple(deltas[name] for name in DAILY_STAT_NAMES))
+                    conn.commit()
+                    saved = True
+            except Exception as error:
+                print(f"⚠️ خطأ في حفظ الإحصائيات اليومية: {error}")
                 conn.rollback()
-                return False, 0
-
-            old_emails = list(row.get("emails") or [])
-            addresses = [(item or {}).get("address") for item in old_emails]
-            cur.execute(
-                """
-                UPDATE bot_users
-                SET emails='[]'::jsonb, updated_at=CURRENT_TIMESTAMP
-                WHERE telegram_id=%s
-                """,
-                (int(user_id),),
-            )
-            conn.commit()
-
-        info = _db_row_to_user_info(row)
-        info["emails"] = []
-        user_database[str(user_id)] = info
-        delete_email_seen_records(addresses)
-        return True, len(old_emails)
-    except Exception as error:
-        print(f"❌ فشل حذف إيميلات العضو من قاعدة البيانات: {error}")
-        try:
-            conn.rollback()
-        except Exception:
-            pass
-        return False, 0
-    finally:
-        conn.close()
 
+    elapsed_ms = int((time.perf_counter() - started) * 1000)
+    if not saved:
+        DAILY_STATS_FLUSH["failures"] += 1
+        with DAILY_STATS_LOCK:
+            for name, value in deltas.items():
+                DAILY_STATS_PENDING[name] += value
+        return False
+    DAILY_STATS_FLUSH["flushes"] += 1
+    DAILY_STATS_FLUSH["last_ms"] = elapsed_ms
+    DAILY_STATS_FLUSH["max_ms"] = max(DAILY_STATS_FLUSH["max_ms"], elapsed_ms)
+    DAILY_STATS_FLUSH["last_flush_at"] = time.time()
+    return True
 
-# ================== إدارة المشرفين (مثل كودك) ==================
 
-def get_all_admins():
-    conn = get_db_connection()
-    if not conn:
-        return []
-    try:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("SELECT * FROM admins ORDER BY created_at DESC")
-            return cur.fetchall()
-    except Exception as e:
-        print(f"❌ خطأ في جلب المشرفين: {e}")
-        return []
-    finally:
-        conn.close()
+def get_last_seven_days_usage():
+    """إرجاع آخر 7 أيام بما فيها الأيام التي لم يحدث فيها استخدام."""
+    with db_connection() as conn:
+        if not conn:
+            return []
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute("SELECT CURRENT_DATE AS today")
+                today = cur.fetchone()["today"]
+                cur.execute("""
+                    SELECT stat_date, new_users, emails_created, inbox_opens
+                    FROM usage_daily_stats
+                    WHERE stat_date BETWEEN CURRENT_DATE - INTERVAL '6 days' AND CURRENT_DATE
+                    ORDER BY stat_date DESC
+                """)
+                rows = cur.fetchall()
+
+            by_date = {row["stat_date"]: row for row in rows}
+            result = []
+            for offset in range(7):
+                day = today - timedelta(days=offset)
+                row = by_date.get(day) or {}
+                result.append({
+                    "stat_date": day,
+                    "new_users": int(row.get("new_users") or 0),
+                    "emails_created": int(row.get("emails_created") or 0),
+                    "inbox_opens": int(row.get("inbox_opens") or 0),
+                })
+            return result
+        except Exception as error:
+            print(f"⚠️ خطأ في قراءة الإحصائيات اليومية: {error}")
+            return []
 
 
-def is_admin(user_id: int) -> bool:
-    if user_id == ADMIN_ID:
-        return True
-    conn = get_db_connection()
-    if not conn:
-        return False
-    try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT 1 FROM admins WHERE telegram_id=%s", (user_id,))
-            return cur.fetchone() is not None
-    except Exception as e:
-        print(f"❌ خطأ في التحقق من المشرف: {e}")
-        return False
-    finally:
-        conn.close()
+def get_global_subscription_message() -> str:
+    """رسالة اشتراك إجبارية عامة واحدة لكل القنوات."""
+    value = get_setting("global_subscription_message", DEFAULT_SUBSCRIPTION_MESSAGE)
+    return value if str(value or "").strip() else DEFAULT_SUBSCRIPTION_MESSAGE
 
 
-def add_admin(telegram_id, username=None, first_name=None, added_by=None):
-    conn = get_db_connection()
-    if not conn:
-        return False
-    try:
-        with conn.cursor() as cur:
-            cur.execute("""
-                INSERT INTO admins (telegram_id, username, first_name, added_by)
-                VALUES (%s, %s, %s, %s)
-                ON CONFLICT (telegram_id) DO NOTHING
-            """, (telegram_id, username, first_name, added_by))
-            conn.commit()
-            return cur.rowcount > 0
-    except Exception as e:
-        print(f"❌ خطأ في إضافة المشرف: {e}")
-        return False
-    finally:
-        conn.close()
+def get_global_subscription_message_html() -> str:
+    value, rich_html = get_rich_text_setting(
+        "global_subscription_message",
+        DEFAULT_SUBSCRIPTION_MESSAGE,
+    )
+    if not str(value or "").strip():
+        return escape(DEFAULT_SUBSCRIPTION_MESSAGE, quote=False)
+    return rich_html
 
 
-def remove_admin(telegram_id):
-    if telegram_id == ADMIN_ID:
-        return False
-    conn = get_db_connection()
-    if not conn:
+def set_global_subscription_message(message: str) -> bool:
+    value = str(message or "")
+    if not value.strip():
         return False
-    try:
-        with conn.cursor() as cur:
-            cur.execute("DELETE FROM admins WHERE telegram_id=%s", (telegram_id,))
-            conn.commit()
-            return cur.rowcount > 0
-    except Exception as e:
-        print(f"❌ خطأ في إزالة المشرف: {e}")
+    if not set_setting("global_subscription_message", value):
         return False
-    finally:
-        conn.close()
-
+    return set_setting("global_subscription_message_rich_html", "")
 
-# ================== إدارة القنوات (اشتراك إجباري متعدد) ==================
 
-def get_channels(only_enabled=True):
-    """جلب كل قنوات الاشتراك، مع الحفاظ على ترتيب إضافتها."""
-    conn = get_db_connection()
-    if not conn:
-        return []
+def get_email_limit() -> int:
+    """يرجع الحد العام لكل مستخدم؛ صفر يعني غير محدود."""
+    raw_value = get_setting("email_limit", str(DEFAULT_EMAIL_LIMIT)).strip()
     try:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            if only_enabled:
-                cur.execute("""
-                    SELECT id, channel_username, channel_id, channel_title,
-                           subscription_message, subscription_enabled, created_at
-                    FROM channels
-                    WHERE subscription_enabled = TRUE
-                    ORDER BY created_at ASC, id ASC
-                """)
-            else:
-                cur.execute("""
-                    SELECT id, channel_username, channel_id, channel_title,
-                           subscription_message, subscription_enabled, created_at
-                    FROM channels
-                    ORDER BY created_at ASC, id ASC
-                """)
-            return cur.fetchall()
-    except Exception as e:
-        print(f"❌ خطأ في الحصول على قائمة القنوات: {e}")
-        return []
-    finally:
-        conn.close()
+        return max(0, int(raw_value))
+    except (TypeError, ValueError):
+        return DEFAULT_EMAIL_LIMIT
 
 
-def get_channel_by_id(channel_db_id: int):
-    conn = get_db_connection()
-    if not conn:
+def get_member_email_limit(user_id: int):
+    """يرجع الحد الخاص بعضو معيّن، أو None ليستخدم الحد العام."""
+    raw_value = get_setting(f"member_email_limit_{int(user_id)}", "").strip()
+    if raw_value == "":
         return None
     try:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("""
-                SELECT id, channel_username, channel_id, channel_title,
-                       subscription_message, subscription_enabled, created_at
-                FROM channels
-                WHERE id=%s
-                LIMIT 1
-            """, (int(channel_db_id),))
-            return cur.fetchone()
-    except Exception as e:
-        print(f"❌ خطأ في جلب القناة: {e}")
+        return max(0, int(raw_value))
+    except (TypeError, ValueError):
         return None
-    finally:
-        conn.close()
 
 
-def get_channel_info(only_enabled=True):
-    """للتوافق مع الأجزاء القديمة: يرجع قناة واحدة فقط عند الحاجة."""
-    channels = get_channels(only_enabled=only_enabled)
-    if not channels:
-        return None
-    return channels[0] if only_enabled else channels[-1]
+def set_member_email_limit(user_id: int, limit: int) -> bool:
+    """حفظ حد خاص للعضو؛ صفر يعني غير محدود لهذا العضو."""
+    return set_setting(f"member_email_limit_{int(user_id)}", str(max(0, int(limit))))
 
 
-def set_channel(channel_username, channel_id=None, channel_title=None):
-    """إضافة قناة جديدة أو تحديث القناة نفسها بدون حذف القنوات الأخرى."""
-    conn = get_db_connection()
-    if not conn:
-        return False
-    try:
-        with conn.cursor() as cur:
-            cur.execute("""
-                INSERT INTO channels (channel_username, channel_id, channel_title, subscription_enabled)
-                VALUES (%s, %s, %s, TRUE)
-                ON CONFLICT (channel_username)
-                DO UPDATE SET
-                    channel_id = EXCLUDED.channel_id,
-                    channel_title = EXCLUDED.channel_title,
-                    subscription_enabled = TRUE,
-                    updated_at = CURRENT_TIMESTAMP
-            """, (channel_username, channel_id, channel_title))
-            conn.commit()
-            return True
-    except Exception as e:
-        print(f"❌ خطأ في إضافة القناة: {e}")
-        conn.rollback()
-        return False
-    finally:
-        conn.close()
+def get_effective_email_limit(user_id: int) -> int:
+    """الحد الخاص يسبق الحد العام عند وجوده."""
+    member_limit = get_member_email_limit(user_id)
+    return member_limit if member_limit is not None else get_email_limit()
 
 
-def set_channel_message(channel_username, message):
-    conn = get_db_connection()
-    if not conn:
-        return False
-    try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT id FROM channels WHERE channel_username=%s", (channel_username,))
-            if not cur.fetchone():
-                return False
-            cur.execute("""
-                UPDATE channels
-                SET subscription_message=%s, updated_at=CURRENT_TIMESTAMP
-                WHERE channel_username=%s
-            """, (message, channel_username))
-            conn.commit()
-            return cur.rowcount > 0
-    except Exception as e:
-        print(f"❌ خطأ في تعيين رسالة القناة: {e}")
-        conn.rollback()
-        return False
-    finally:
-        conn.close()
+def check_database_health():
+    """فحص اتصال قاعدة البيانات مع زمن الاستجابة بالمللي ثانية."""
+    started = time.perf_counter()
+    with db_connection() as conn:
+        if not conn:
+            return False, None, "تعذر الاتصال بقاعدة البيانات"
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+                row = cur.fetchone()
+            elapsed = int((time.perf_counter() - started) * 1000)
+            return bool(row and row[0] == 1), elapsed, ""
+        except Exception as error:
+            elapsed = int((time.perf_counter() - started) * 1000)
+            return False, elapsed, str(error)[:120]
 
 
-def delete_channel(channel_username):
-    conn = get_db_connection()
-    if not conn:
-        return False
-    try:
-        with conn.cursor() as cur:
-            cur.execute("DELETE FROM channels WHERE channel_username=%s", (channel_username,))
-            deleted = cur.rowcount > 0
-            conn.commit()
-            return deleted
-    except Exception as e:
-        print(f"❌ خطأ في حذف القناة: {e}")
-        conn.rollback()
-        return False
-    finally:
-        conn.close()
+async def check_mail_service_health():
+    """فحص خدمة mail.tm مع زمن الاستجابة بالمللي ثانية."""
+    started = time.perf_counter()
+    response, request_error = await mail_request("GET", "/domains", return_error=True)
+    elapsed = int((time.perf_counter() - started) * 1000)
+    if response is not None and response.status_code == 200:
+        try:
+            payload = response.json()
+            domains = payload.get("hydra:member") or []
+            if isinstance(domains, list):
+                # الفحص الحي يحدّث كاش الدومينات أيضاً بدلاً من طلب منفصل لاحقاً.
+                store_domain_cache(parse_available_domains(payload))
+                return True, elapsed, ""
+        except (ValueError, AttributeError):
+            return False, elapsed, "استجابة غير صالحة"
+    if response is not None:
+        return False, elapsed, f"HTTP {response.status_code}"
+    return False, elapsed, request_error or "تعذر الاتصال"
 
 
-def toggle_subscription(channel_username):
-    conn = get_db_connection()
-    if not conn:
-        return False
-    try:
-        with conn.cursor() as cur:
-            cur.execute("""
-                UPDATE channels
-                SET subscription_enabled = NOT subscription_enabled, updated_at=CURRENT_TIMESTAMP
-                WHERE channel_username=%s
-                RETURNING subscription_enabled
-            """, (channel_username,))
-            row = cur.fetchone()
-            conn.commit()
-            return row[0] if row else False
-    except Exception as e:
-        print(f"❌ خطأ في تبديل حالة الاشتراك: {e}")
-        conn.rollback()
-        return False
-    finally:
-        conn.close()
+def format_bot_uptime() -> str:
+    total_seconds = max(0, int(time.time() - BOT_STARTED_AT))
+    days, remainder = divmod(total_seconds, 86400)
+    hours, remainder = divmod(remainder, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    parts = []
+    if days:
+        parts.append(f"{days} يوم")
+    if hours or days:
+        parts.append(f"{hours} ساعة")
+    if minutes or hours or days:
+        parts.append(f"{minutes} دقيقة")
+    if not parts:
+        parts.append(f"{seconds} ثانية")
+    return " و".join(parts)
 
 
-def get_channel_subscription_stats():
-    """إحصائيات التحقق المسجلة لكل قناة اشتراك إجباري."""
-    channels = get_channels(only_enabled=False)
-    conn = get_db_connection()
-    if not conn:
-        return None
-    try:
-        with conn.cursor() as cur:
-            cur.execute("""
-                SELECT channel_key, COUNT(*)
-                FROM subscription_notifications
-                GROUP BY channel_key
-            """)
-            counts = {str(row[0]).lower(): int(row[1] or 0) for row in cur.fetchall()}
-
-        result = []
-        for channel in channels:
-            item = dict(channel)
-            channel_key = str(
-                item.get("channel_id") or item.get("channel_username") or ""
-            ).lower()
-            item["verified_count"] = counts.get(channel_key, 0)
-            result.append(item)
-        return result
-    except Exception as error:
-        print(f"⚠️ خطأ في إحصائيات قنوات الاشتراك: {error}")
-        return None
-    finally:
-        conn.close()
+def normalize_telegram_username(value: str) -> str:
+    """تنظيف والتحقق من يوزر تلجرام دون @."""
+    username = str(value or "").strip().lstrip("@")
+    if re.fullmatch(r"[A-Za-z0-9_]{5,32}", username):
+        return username
+    return ""
 
 
-# ================== اشتراك إجباري متعدد ==================
+def get_admin_contact_username() -> str:
+    return normalize_telegram_username(get_setting("admin_contact_username", ""))
 
-async def get_missing_subscription_channels(user_id: int, context: ContextTypes.DEFAULT_TYPE):
-    """يرجع القنوات المفعّلة التي لم يشترك بها العضو بعد."""
-    missing = []
-    channels = get_channels(only_enabled=True)
 
-    for channel_info in channels:
-        channel_username = channel_info["channel_username"]
-        channel_id = channel_info.get("channel_id")
-        chat_identifier = channel_id if channel_id else f"@{channel_username}"
-        subscribed = False
-        temporary_failure = False
+def normalize_paid_domain(value: str) -> str:
+    """تنظيف اسم دومين شكلي مدفوع والتحقق من صيغته."""
+    domain = str(value or "").strip().lower().lstrip("@")
+    if len(domain) > 253 or "." not in domain:
+        return ""
 
-        for attempt in range(2):
-            try:
-                member = await context.bot.get_chat_member(chat_identifier, user_id)
-                subscribed = member.status in ("member", "administrator", "creator")
-                break
-            except Exception as error:
-                error_text = str(error).lower()
-                temporary_failure = any(term in error_text for term in (
-                    "readerror", "timeout", "timed out", "network", "connection",
-                    "bad gateway", "temporarily unavailable", "server error",
-                ))
-                if temporary_failure and attempt == 0:
-                    await asyncio.sleep(1.5)
-                    continue
+    labels = domain.split(".")
+    if any(
+        not label
+        or len(label) > 63
+        or label.startswith("-")
+        or label.endswith("-")
+        or not re.fullmatch(r"[a-z0-9-]+", label)
+        for label in labels
+    ):
+        return ""
+    return domain
 
-                print(
-                    f"⚠️ فشل فحص اشتراك المستخدم {user_id} في @{channel_username}: "
-                    f"{type(error).__name__}: {error}"
-                )
-                break
 
-        # عطل الشبكة المؤقت لا يمنع المستخدم، مثل السلوك السابق.
-        if temporary_failure and not subscribed:
-            continue
-        if not subscribed:
-            missing.append(channel_info)
+def get_paid_domains() -> list[str]:
+    """جلب الدومينات الشكلية المدفوعة من الإعدادات بترتيب إضافتها."""
+    raw = get_setting("paid_domains", "")
+    domains = []
+    for line in raw.splitlines():
+        domain = normalize_paid_domain(line)
+        if domain and domain not in domains:
+            domains.append(domain)
+    return domains
 
-    return missing
 
+def save_paid_domains(domains) -> bool:
+    cleaned = []
+    for value in domains:
+        domain = normalize_paid_domain(value)
+        if domain and domain not in cleaned:
+            cleaned.append(domain)
+    if not set_setting("paid_domains", "\n".join(cleaned)):
+        return False
+    invalidate_keyboards("paid_domains")
+    return True
 
-async def check_user_subscription_strict(user_id: int, context: ContextTypes.DEFAULT_TYPE) -> bool:
-    """يجب أن يكون العضو مشتركاً بكل القنوات المفعّلة."""
-    missing = await get_missing_subscription_channels(user_id, context)
-    return len(missing) == 0
 
+def add_paid_domain(value: str):
+    domain = normalize_paid_domain(value)
+    if not domain:
+        return False, "invalid", ""
 
-def subscription_prompt(_lang: str, channels, message: str = ""):
-    """عرض الرسالة العامة مع القنوات الناقصة وأزرار الانضمام."""
-    if isinstance(channels, str):
-        channels = [{
-            "channel_username": channels,
-            "channel_title": channels,
-        }]
-    channels = list(channels or [])
+    domains = get_paid_domains()
+    if domain in domains:
+        return False, "exists", domain
 
-    channel_lines = []
-    for index, channel in enumerate(channels, start=1):
-        username = str(channel.get("channel_username") or "").lstrip("@")
-        title = str(channel.get("channel_title") or username)
-        channel_lines.append(
-            f"{index}. 📢 {telegram_html(title)} — @{telegram_html(username)}"
-        )
+    domains.append(domain)
+    if not save_paid_domains(domains):
+        return False, "save_failed", domain
+    return True, "added", domain
 
-    channels_text = "\n".join(channel_lines)
-    global_message = get_global_subscription_message_html()
-    message_parts = global_message.split("\n\n", 1)
-    if len(message_parts) == 2:
-        text = f"{message_parts[0]}\n\n{channels_text}\n\n{message_parts[1]}"
-    elif channels_text:
-        text = f"{global_message}\n\n{channels_text}"
-    else:
-        text = global_message
 
-    rows = []
-    for channel in channels:
-        username = str(channel.get("channel_username") or "").lstrip("@")
-        title = str(channel.get("channel_title") or username)
-        display_title = title if len(title) <= 28 else title[:25] + "..."
-        rows.append([
-            InlineKeyboardButton(
-                f"📢 الانضمام: {display_title}",
-                url=f"https://t.me/{username}",
-                style="primary",
-            )
-        ])
-    rows.append([
-        InlineKeyboardButton(
-            "✅ التحقق من الاشتراك",
-            callback_data="verify_subscription",
-            style="success",
-        )
-    ])
-    return text, InlineKeyboardMarkup(rows)
+def remove_paid_domain(index: int):
+    domains = get_paid_domains()
+    if index < 0 or index >= len(domains):
+        return False, ""
 
-# ================== mail.tm API ==================
-# ================== mail.tm API ==================
+    removed = domains.pop(index)
+    if not save_paid_domains(domains):
+        return False, ""
+    return True, removed
 
-def mail_request(method: str, path: str, return_error=False, **kwargs):
-    """طلب إلى mail.tm مع إعادة محاولة وإبقاء سبب الفشل عند طلبه."""
-    last_response = None
-    last_error_code = None
-    supplied_headers = kwargs.pop("headers", {}) or {}
-    request_headers = {"User-Agent": "TelegramTempMailBot/3.1", **supplied_headers}
 
-    for attempt in range(3):
-        try:
-            response = requests.request(
-                method,
-                f"{API}{path}",
-                timeout=(5, 20),
-                headers=request_headers,
-                **kwargs,
-            )
-            last_response = response
-            if response.status_code not in (429, 500, 502, 503, 504):
-                return (response, None) if return_error else response
-
-            last_error_code = f"http_{response.status_code}"
-            print(f"⚠️ mail.tm {path}: HTTP {response.status_code}")
-        except requests.Timeout as error:
-            last_error_code = "timeout"
-            print(f"⚠️ mail.tm {path}: {type(error).__name__}: {error}")
-        except requests.ConnectionError as error:
-            last_error_code = "connection"
-            print(f"⚠️ mail.tm {path}: {type(error).__name__}: {error}")
-        except requests.RequestException as error:
-            last_error_code = "network"
-            print(f"⚠️ mail.tm {path}: {type(error).__name__}: {error}")
-
-        if attempt < 2:
-            time.sleep(2 ** attempt)
-
-    if return_error:
-        return last_response, last_error_code or "network"
-    return last_response
-
-
-def get_available_domains():
-    response = mail_request("GET", "/domains")
-    if response is None or response.status_code != 200:
-        return []
-    try:
-        data = response.json()
-    except ValueError as error:
-        print(f"⚠️ رد النطاقات غير صالح: {error}")
-        return []
+def build_main_menu_text(user_id: int) -> str:
+    """دمج رسالة الترحيب مع القائمة الرئيسية في رسالة واحدة."""
+    emails_count = len(get_user_emails(user_id))
+    menu_text = get_text("ar", "main_menu", emails_count=emails_count)
+    welcome_message = get_setting("welcome_message", "")
+    if str(welcome_message or "").strip():
+        return f"{welcome_message}\n\n{menu_text}"
+    return menu_text
 
-    domains = data.get("hydra:member") or []
-    available = []
-    for item in domains:
-        domain = item.get("domain")
-        if not domain:
-            continue
-        if item.get("isActive") is False or item.get("isPrivate") is True:
-            continue
-        if domain not in available:
-            available.append(domain)
-    return available
 
+def build_main_menu_html(user_id: int) -> str:
+    """نسخة HTML من القائمة الرئيسية تحافظ على الإيموجي المميز برسالة الترحيب."""
+    emails_count = len(get_user_emails(user_id))
+    menu_text = get_text("ar", "main_menu", emails_count=emails_count)
+    welcome_text, welcome_html = get_rich_text_setting("welcome_message", "")
+    if str(welcome_text or "").strip():
+        return f"{welcome_html}\n\n{escape(menu_text, quote=False)}"
+    return escape(menu_text, quote=False)
 
-def create_email():
-    """إنشاء بريد مع تجربة الدومينات المجانية المتاحة تلقائياً عند فشل أحدها."""
-    try:
-        domains = get_available_domains()
-        if not domains:
-            return None, None, None
 
-        domains = list(domains)
-        secrets.SystemRandom().shuffle(domains)
-        username_chars = string.ascii_lowercase + string.digits
+def telegram_html(value) -> str:
+    """حماية النصوص الخارجية قبل إرسالها بوضع HTML في تلجرام."""
+    return escape(str(value or ""), quote=False)
 
-        for domain in domains:
-            for _ in range(2):
-                username = "".join(secrets.choice(username_chars) for _ in range(10))
-                email_address = f"{username}@{domain}"
-                password = FIXED_MAIL_PASSWORD
-
-                response = mail_request(
-                    "POST",
-                    "/accounts",
-                    json={"address": email_address, "password": password},
-                )
-                if response is None:
-                    print(f"⚠️ تعذر إنشاء حساب على الدومين @{domain}، تجربة دومين آخر")
-                    break
 
-                if response.status_code == 422:
-                    continue
+# ---------- Ban (جديد) ----------
+# ---------- Auth Cache ----------
+AUTH_CACHE_TTL_SECONDS = int(os.getenv("AUTH_CACHE_TTL_SECONDS", "60"))
+AUTH_CACHE_NOTIFIED_MAX = int(os.getenv("AUTH_CACHE_NOTIFIED_MAX", "50000"))
+# admins / banned / channels تحفظ (القيمة، وقت التحميل). notified يحفظ فقط الإشعارات المؤكدة
+# لأنها لا تُحذف بعد تسجيلها.
+AUTH_CACHE = {"admins": None, "banned": None, "channels": None, "notified": set()}
+# يزداد مع كل تفريغ؛ التحميل الذي بدأ قبل التفريغ لا يكتب نتيجته القديمة في الكاش.
+AUTH_CACHE_GENERATION = {"admins": 0, "banned": 0, "channels": 0}
+AUTH_CACHE_LOCK = threading.Lock()
+
+
+def _auth_cached(name: str, loader):
+    with AUTH_CACHE_LOCK:
+        entry = AUTH_CACHE[name]
+        generation = AUTH_CACHE_GENERATION[name]
+    if entry is not None and time.monotonic() - entry[1] < AUTH_CACHE_TTL_SECONDS:
+        return entry[0]
+
+    value = loader()
+    if value is None:
+        # تعذر التحميل: آخر قيمة معروفة أفضل من اعتبار الجميع غير محظورين/غير مشرفين.
+        return entry[0] if entry is not None else None
+    with AUTH_CACHE_LOCK:
+        if AUTH_CACHE_GENERATION[name] == generation:
+            AUTH_CACHE[name] = (value, time.monotonic())
+    return value
+
+
+def auth_cache_ready(*names) -> bool:
+    """هل الأجزاء المطلوبة محمّلة وصالحة، فيمكن قراءتها من حلقة الأحداث مباشرة؟"""
+    now = time.monotonic()
+    with AUTH_CACHE_LOCK:
+        return all(
+            AUTH_CACHE[name] is not None and now - AUTH_CACHE[name][1] < AUTH_CACHE_TTL_SECONDS
+            for name in names
+        )
 
-                if response.status_code != 201:
-                    print(
-                        f"⚠️ فشل إنشاء حساب على @{domain}: HTTP {response.status_code}، "
-                        "تجربة دومين آخر"
-                    )
-                    break
 
-                token_response = mail_request(
-                    "POST",
-                    "/token",
-                    json={"address": email_address, "password": password},
-                )
-                if token_response is None or token_response.status_code != 200:
-                    status = token_response.status_code if token_response is not None else "network"
-                    print(f"⚠️ فشل جلب توكن البريد {email_address}: {status}")
-                    break
+def invalidate_auth_cache(*names) -> None:
+    """تفريغ جزء من كاش الصلاحيات بعد أي تعديل عليه من لوحة الأدمن."""
+    with AUTH_CACHE_LOCK:
+        for name in names or tuple(AUTH_CACHE_GENERATION):
+            AUTH_CACHE[name] = None
+            AUTH_CACHE_GENERATION[name] += 1
+    if not names or "channels" in names:
+        invalidate_keyboards("channels")
 
-                try:
-                    token = token_response.json().get("token")
-                except (ValueError, AttributeError):
-                    token = None
-                if token:
-                    return email_address, token, password
-                break
 
-        return None, None, None
-    except Exception as error:
-        print(f"❌ create_email: {type(error).__name__}: {error}")
-        return None, None, None
+def _load_id_set(table: str):
+    with db_connection() as conn:
+        if not conn:
+            return None
+        try:
+            with conn.cursor() as cur:
+                cur.execute(f"SELECT telegram_id FROM {table}")
+                return frozenset(int(row[0]) for row in cur.fetchall())
+        except Exception as e:
+            print(f"⚠️ خطأ في تحميل {table}: {e}")
+            return None
 
 
-def create_email_with_domain(domain):
-    """إنشاء بريد على دومين مجاني محدد من قائمة mail.tm المتاحة حالياً."""
-    try:
-        domain = str(domain or "").strip().lower().lstrip("@")
-        if not domain:
-            return None, None, None
+def is_banned(user_id: int) -> bool:
+    banned = _auth_cached("banned", lambda: _load_id_set("banned_users"))
+    return bool(banned) and int(user_id) in banned
 
-        available_domains = get_available_domains()
-        if domain not in available_domains:
-            print(f"⚠️ الدومين @{domain} لم يعد متاحاً ضمن الدومينات المجانية العامة")
-            return None, None, None
 
-        username_chars = string.ascii_lowercase + string.digits
+def ban_user_db(user_id: int, reason: str, banned_by: int) -> bool:
+    with db_connection() as conn:
+        if not conn:
+            return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO banned_users(telegram_id, reason, banned_by)
+                    VALUES (%s, %s, %s)
+                    ON CONFLICT(telegram_id)
+                    DO UPDATE SET reason=EXCLUDED.reason, banned_by=EXCLUDED.banned_by, banned_at=CURRENT_TIMESTAMP
+                """, (user_id, reason, banned_by))
+                conn.commit()
+                invalidate_auth_cache("banned")
+                return True
+        except Exception as e:
+            print(f"⚠️ خطأ في ban_user_db: {e}")
+            conn.rollback()
+            return False
 
-        for _ in range(2):
-            username = "".join(secrets.choice(username_chars) for _ in range(10))
-            email_address = f"{username}@{domain}"
-            password = FIXED_MAIL_PASSWORD
 
-            response = mail_request(
-                "POST",
-                "/accounts",
-                json={"address": email_address, "password": password},
-            )
-            if response is None:
-                break
-            if response.status_code == 422:
-                continue
-            if response.status_code != 201:
-                print(f"⚠️ فشل إنشاء حساب على @{domain}: HTTP {response.status_code}")
-                break
+def unban_user_db(user_id: int) -> bool:
+    with db_connection() as conn:
+        if not conn:
+            return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute("DELETE FROM banned_users WHERE telegram_id=%s", (user_id,))
+                conn.commit()
+                invalidate_auth_cache("banned")
+                return cur.rowcount > 0
+        except Exception as e:
+            print(f"⚠️ خطأ في unban_user_db: {e}")
+            conn.rollback()
+            return False
 
-            token_response = mail_request(
-                "POST",
-                "/token",
-                json={"address": email_address, "password": password},
-            )
-            if token_response is None or token_response.status_code != 200:
-                status = token_response.status_code if token_response is not None else "network"
-                print(f"⚠️ فشل جلب توكن البريد {email_address}: {status}")
-                break
 
-            try:
-                token = token_response.json().get("token")
-            except (ValueError, AttributeError):
-                token = None
-            if token:
-                return email_address, token, password
-            break
 
-        return None, None, None
-    except Exception as error:
-        print(f"❌ create_email_with_domain: {type(error).__name__}: {error}")
-        return None, None, None
 
+# ---------- إشعارات الاشتراك الإجباري ----------
+def subscription_notification_exists(user_id: int, channel_key: str) -> bool:
+    if (int(user_id), channel_key) in AUTH_CACHE["notified"]:
+        return True
+    with db_connection() as conn:
+        if not conn:
+            return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT 1 FROM subscription_notifications WHERE telegram_id=%s AND channel_key=%s",
+                    (user_id, channel_key),
+                )
+                exists = cur.fetchone() is not None
+            if exists:
+                _remember_subscription_notified(user_id, channel_key)
+            return exists
+        except Exception as e:
+            print(f"⚠️ خطأ في فحص سجل إشعار الاشتراك: {e}")
+            return False
 
-def refresh_email_token_data(email_data):
-    """تجديد توكن بريد واحد من العنوان وكلمة المرور المحفوظة."""
-    if not isinstance(email_data, dict):
-        return None
 
-    address = str(email_data.get("address") or "").strip()
-    password = str(email_data.get("password") or LEGACY_MAIL_PASSWORD)
-    if not address or not password:
-        return None
+def _remember_subscription_notified(user_id: int, channel_key: str) -> None:
+    with AUTH_CACHE_LOCK:
+        notified = AUTH_CACHE["notified"]
+        if len(notified) >= AUTH_CACHE_NOTIFIED_MAX:
+            notified.clear()
+        notified.add((int(user_id), channel_key))
 
-    response = mail_request(
-        "POST",
-        "/token",
-        json={"address": address, "password": password},
-    )
-    if response is None or response.status_code != 200:
-        status = response.status_code if response is not None else "network"
-        print(f"⚠️ تعذر تجديد توكن {address}: {status}")
-        return None
 
-    try:
-        token = response.json().get("token")
-    except (ValueError, AttributeError):
-        token = None
-    if not token:
-        return None
+def mark_subscription_notified(user_id: int, channel_key: str) -> bool:
+    with db_connection() as conn:
+        if not conn:
+            return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    INSERT INTO subscription_notifications(telegram_id, channel_key)
+                    VALUES (%s, %s)
+                    ON CONFLICT (telegram_id, channel_key) DO NOTHING
+                    """,
+                    (user_id, channel_key),
+                )
+                conn.commit()
+            _remember_subscription_notified(user_id, channel_key)
+            return True
+        except Exception as e:
+            print(f"⚠️ خطأ في حفظ سجل إشعار الاشتراك: {e}")
+            conn.rollback()
+            return False
 
-    email_data["token"] = token
-    email_data["password"] = password
-    return token
 
+# ---------- Email Seen (جديد) ----------
+def get_last_seen_message_id(email_address: str) -> str:
+    """يرجع آخر message_id تم إرساله لهذا البريد (أو نص فارغ)."""
+    with db_connection() as conn:
+        if not conn:
+            return ""
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT last_message_id FROM email_seen WHERE email_address=%s", (email_address.lower(),))
+                row = cur.fetchone()
+                return row[0] if row and row[0] else ""
+        except Exception as e:
+            print(f"⚠️ خطأ في get_last_seen_message_id: {e}")
+            return ""
 
-def refresh_user_email_token(user_id: int, email_index: int):
-    """تجديد توكن بريد المستخدم وحفظه في PostgreSQL."""
-    emails = get_user_emails(user_id)
-    if email_index < 0 or email_index >= len(emails):
-        return None
 
-    token = refresh_email_token_data(emails[email_index])
-    if not token:
-        return None
+def set_last_seen_message_id(email_address: str, message_id: str) -> None:
+    with db_connection() as conn:
+        if not conn:
+            return
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO email_seen(email_address, last_message_id, updated_at)
+                    VALUES (%s, %s, CURRENT_TIMESTAMP)
+                    ON CONFLICT(email_address)
+                    DO UPDATE SET last_message_id=EXCLUDED.last_message_id, updated_at=CURRENT_TIMESTAMP
+                """, (email_address.lower(), message_id))
+                conn.commit()
+        except Exception as e:
+            print(f"⚠️ خطأ في set_last_seen_message_id: {e}")
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+def delete_email_seen_records(addresses) -> None:
+    clean_addresses = [str(address).lower() for address in addresses if address]
+    if not clean_addresses:
+        return
 
-    data = get_user_data(user_id)
-    user_database[str(user_id)] = data
-    if not save_single_user(str(user_id), data):
-        print(f"⚠️ تم تجديد التوكن لكن تعذر حفظه للمستخدم {user_id}")
-    return token
+    with db_connection() as conn:
+        if not conn:
+            return
+        try:
+            with conn.cursor() as cur:
+                cur.execute("DELETE FROM email_seen WHERE email_address = ANY(%s)", (clean_addresses,))
+                conn.commit()
+        except Exception as e:
+            print(f"⚠️ خطأ في تنظيف سجل الرسائل: {e}")
+            conn.rollback()
 
 
-def check_user_inbox_detailed(user_id: int, email_index: int):
-    """فحص الصندوق وتجديد التوكن تلقائياً مرة واحدة عند HTTP 401."""
-    emails = get_user_emails(user_id)
-    if email_index < 0 or email_index >= len(emails):
-        return {"messages": None, "error": "email_missing", "status": None}
+# ---------- Mail Account Pool ----------
+ACCOUNT_POOL_LOW_WATERMARK = int(os.getenv("ACCOUNT_POOL_LOW_WATERMARK", "3"))
+ACCOUNT_POOL_HIGH_WATERMARK = int(os.getenv("ACCOUNT_POOL_HIGH_WATERMARK", "8"))
+ACCOUNT_POOL_REFILL_INTERVAL_SECONDS = int(os.getenv("ACCOUNT_POOL_REFILL_INTERVAL_SECONDS", "30"))
+# أقصى عدد حسابات تُنشأ في كل دورة تعبئة، حتى يبقى الضغط على mail.tm ثابتاً ومنخفضاً.
+ACCOUNT_POOL_REFILL_BATCH = int(os.getenv("ACCOUNT_POOL_REFILL_BATCH", "2"))
+ACCOUNT_POOL_MAX_AGE_HOURS = int(os.getenv("ACCOUNT_POOL_MAX_AGE_HOURS", "24"))
 
-    email_data = emails[email_index]
-    result = check_inbox_detailed(email_data.get("token"))
-    if result.get("error") != "token_invalid":
-        return result
 
-    new_token = refresh_user_email_token(user_id, email_index)
-    if not new_token:
-        return result
+def pop_pooled_account(domain: str | None = None):
+    """سحب حساب جاهز واحد وحذفه في نفس العملية؛ لا يُسلَّم الحساب لعضوين أبداً."""
+    with db_connection() as conn:
+        if not conn:
+            return None, None, None
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    DELETE FROM mail_account_pool
+                    WHERE address = (
+                        SELECT address FROM mail_account_pool
+                        WHERE (%s::text IS NULL OR domain=%s)
+                          AND created_at > CURRENT_TIMESTAMP - make_interval(hours => %s)
+                        ORDER BY created_at
+                        LIMIT 1
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING address, token, password
+                """, (domain, domain, ACCOUNT_POOL_MAX_AGE_HOURS))
+                row = cur.fetchone()
+                conn.commit()
+                return tuple(row) if row else (None, None, None)
+        except Exception as e:
+            print(f"⚠️ خطأ في pop_pooled_account: {e}")
+            conn.rollback()
+            return None, None, None
+
 
-    retry_result = check_inbox_detailed(new_token)
-    retry_result["token_refreshed"] = retry_result.get("error") is None
-    return retry_result
+def store_pooled_account(address: str, domain: str, password: str, token: str) -> bool:
+    with db_connection() as conn:
+        if not conn:
+            return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO mail_account_pool(address, domain, password, token)
+                    VALUES (%s, %s, %s, %s)
+                    ON CONFLICT(address) DO NOTHING
+                """, (address.lower(), domain, password, token))
+                conn.commit()
+                return cur.rowcount > 0
+        except Exception as e:
+            print(f"⚠️ خطأ في store_pooled_account: {e}")
+            conn.rollback()
+            return False
 
 
-def get_user_message_content(user_id: int, email_index: int, message_id: str):
-    """تحميل رسالة كاملة، مع تجديد التوكن تلقائياً إذا انتهى أثناء الفتح."""
-    emails = get_user_emails(user_id)
-    if email_index < 0 or email_index >= len(emails):
+def prune_account_pool(active_domains) -> dict:
+    """حذف الحسابات المنتهية أو التابعة لدومينات لم تعد متاحة، ثم إرجاع العدد لكل دومين."""
+    with db_connection() as conn:
+        if not conn:
+            return {}
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    DELETE FROM mail_account_pool
+                    WHERE created_at <= CURRENT_TIMESTAMP - make_interval(hours => %s)
+                       OR NOT (domain = ANY(%s))
+                """, (ACCOUNT_POOL_MAX_AGE_HOURS, list(active_domains)))
+                cur.execute("SELECT domain, COUNT(*) FROM mail_account_pool GROUP BY domain")
+                counts = {row[0]: int(row[1]) for row in cur.fetchall()}
+                conn.commit()
+                return counts
+        except Exception as e:
+            print(f"⚠️ خطأ في prune_account_pool: {e}")
+            conn.rollback()
+            return {}
+
+
+def get_account_pool_size() -> int:
+    with db_connection() as conn:
+        if not conn:
+            return 0
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT COUNT(*) FROM mail_account_pool")
+                return int(cur.fetchone()[0])
+        except Exception as e:
+            print(f"⚠️ خطأ في get_account_pool_size: {e}")
+            return 0
+
+
+def _db_row_to_user_info(row) -> dict:
+    """تحويل صف العضو من PostgreSQL إلى نفس شكل بيانات الذاكرة."""
+    return {
+        "lang": "ar",
+        "first_name": row.get("first_name", "") or "",
+        "last_name": row.get("last_name", "") or "",
+        "username": row.get("username", "") or "",
+        "emails": row.get("emails") or [],
+    }
+
+
+def find_user_by_username_or_id(search_value: str):
+    """البحث عن العضو من PostgreSQL مباشرة، ثم مزامنة نسخة الذاكرة."""
+    query = str(search_value or "").strip().lstrip("@").lower()
+    if not query:
         return None
 
-    token = emails[email_index].get("token")
-    for attempt in range(2):
-        headers = {"Authorization": f"Bearer {token}"}
-        response = mail_request("GET", f"/messages/{message_id}", headers=headers)
-        if response is not None and response.status_code == 200:
+    with db_connection() as conn:
+        if conn:
             try:
-                return response.json()
-            except ValueError as error:
-                print(f"⚠️ رد محتوى الرسالة غير صالح: {error}")
-                return None
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    if query.isdigit():
+                        cur.execute(
+                            f"""
+                            SELECT telegram_id, language, first_name, last_name, username, {USER_EMAILS_SQL}
+                            FROM bot_users
+                            WHERE telegram_id=%s
+                            LIMIT 1
+                            """,
+                            (int(query),),
+                        )
+                    else:
+                        cur.execute(
+                            f"""
+                            SELECT telegram_id, language, first_name, last_name, username, {USER_EMAILS_SQL}
+                            FROM bot_users
+                            WHERE LOWER(COALESCE(username, ''))=%s
+                            LIMIT 1
+                            """,
+                            (query,),
+                        )
+                    row = cur.fetchone()
 
-        if attempt == 0 and response is not None and response.status_code == 401:
-            token = refresh_user_email_token(user_id, email_index)
-            if token:
-                continue
-        return None
-    return None
+                if row:
+                    user_id = int(row["telegram_id"])
+                    info = _db_row_to_user_info(row)
+                    user_cache[str(user_id)] = info
+                    return user_id, info
+            except Exception as error:
+                print(f"⚠️ فشل البحث عن العضو في قاعدة البيانات: {error}")
+
+    # احتياط عند تعذر الاتصال المؤقت بقاعدة البيانات.
+    if query.isdigit() and user_cache.get(query) is not None:
+        return int(query), user_cache.get(query)
 
+    for uid in member_search_index.exact(query):
+        info = user_cache.get(uid)
+        username = str((info or {}).get("username") or "").lower()
+        if username and username == query:
+            return int(uid), info
+    return None
 
-def check_inbox_detailed(token):
-    """فحص الصندوق مع سبب واضح للفشل دون كشف التوكن."""
-    headers = {"Authorization": f"Bearer {token}"}
-    response, request_error = mail_request(
-        "GET",
-        "/messages",
-        headers=headers,
-        return_error=True,
-    )
 
-    if response is None:
-        return {"messages": None, "error": request_error or "network", "status": None}
+def clear_user_emails(user_id: int):
+    """حذف إيميلات العضو من PostgreSQL مباشرة وتحديث الذاكرة فوراً."""
+    with db_connection() as conn:
+        if not conn:
+            return False, 0
 
-    status = response.status_code
-    if status == 200:
         try:
-            payload = response.json()
-            messages = payload.get("hydra:member", [])
-            if not isinstance(messages, list):
-                raise ValueError("hydra:member ليس قائمة")
-            return {"messages": messages, "error": None, "status": 200}
-        except (ValueError, AttributeError) as error:
-            print(f"⚠️ رد صندوق الوارد غير صالح: {error}")
-            return {"messages": None, "error": "invalid_response", "status": 200}
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(
+                    """
+                    SELECT telegram_id, language, first_name, last_name, username
+                    FROM bot_users
+                    WHERE telegram_id=%s
+                    FOR UPDATE
+                    """,
+                    (int(user_id),),
+                )
+                row = cur.fetchone()
+                if not row:
+                    conn.rollback()
+                    return False, 0
 
-    if status == 401:
-        print("⚠️ توكن البريد غير صالح أو منتهي")
-        error_code = "token_invalid"
-    elif status == 429:
-        print("⚠️ ضغط مؤقت على خدمة البريد: HTTP 429")
-        error_code = "rate_limited"
-    elif status in (500, 502, 503, 504):
-        print(f"⚠️ خدمة البريد غير متاحة مؤقتاً: HTTP {status}")
-        error_code = "service_unavailable"
-    else:
-        print(f"⚠️ فشل فحص الصندوق: HTTP {status}")
-        error_code = "http_error"
+                cur.execute(
+                    "DELETE FROM user_emails WHERE telegram_id=%s RETURNING address",
+                    (int(user_id),),
+                )
+                addresses = [item["address"] for item in cur.fetchall()]
+                cur.execute(
+                    "UPDATE bot_users SET updated_at=CURRENT_TIMESTAMP WHERE telegram_id=%s",
+                    (int(user_id),),
+                )
+                _adjust_member_emails(conn, user_id, -len(addresses))
+                conn.commit()
+
+            info = _db_row_to_user_info(row)
+            info["emails"] = []
+            user_cache[str(user_id)] = info
+            delete_email_seen_records(addresses)
+            return True, len(addresses)
+        except Exception as error:
+            print(f"❌ فشل حذف إيميلات العضو من قاعدة البيانات: {error}")
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+            return False, 0
+
+# ---------- Members (استعلامات لوحة الأدمن) ----------
+# (الشرط، عمود مفتاح الصفحات، اتجاه الترتيب، عمود العدد في member_stats)؛ كل ترتيب يطابق فهرساً على bot_users.
+MEMBERS_LIST_ORDER = {
+    "all": ("TRUE", "u.created_at", "ASC", "total_users"),
+    "active": ("u.emails_count > 0", "u.created_at", "ASC", "active_users"),
+    "top": ("u.emails_count > 0", "u.emails_count", "DESC", "active_users"),
+}
+MEMBERS_CURSOR_EPOCH = datetime(1970, 1, 1)
+
+MEMBERS_SELECT_SQL = """
+    SELECT u.telegram_id, u.first_name, u.last_name, u.username, u.emails_count, u.created_at
+    FROM bot_users u
+"""
 
-    return {"messages": None, "error": error_code, "status": status}
 
+def _member_row(row):
+    return str(row["telegram_id"]), {
+        "first_name": row.get("first_name") or "",
+        "last_name": row.get("last_name") or "",
+        "username": row.get("username") or "",
+        "emails_count": int(row.get("emails_count") or 0),
+    }
 
-def check_inbox(token):
-    """واجهة متوافقة مع منطق عرض تفاصيل الرسالة القديم."""
-    result = check_inbox_detailed(token)
-    return result["messages"] if result.get("error") is None else None
 
+MEMBER_STATS_FIELDS = ("total_users", "active_users", "total_emails", "blocked_users", "blocked_active_users")
 
-def build_inbox_error_view(error_code, email_index: int, status=None):
-    """رسالة وأزرار مناسبة لسبب فشل تحميل صندوق الوارد."""
-    if error_code == "token_invalid":
-        text = (
-            "⚠️ تعذر تجديد جلسة هذا البريد تلقائياً.\n\n"
-            "قد تكون بيانات البريد قديمة أو لم يعد البريد متاحاً حالياً."
-        )
-        rows = [
-            [InlineKeyboardButton(
-                "🗑️ حذف هذا البريد",
-                callback_data=f"confirm_delete_{email_index}",
-                style="danger",
-            )],
-            [InlineKeyboardButton(
-                "✨ إنشاء بريد جديد",
-                callback_data="create_email",
-                style="success",
-            )],
-            [InlineKeyboardButton(
-                get_text("ar", "btn_back"),
-                callback_data="select_inbox",
-                style="primary",
-            )],
-        ]
-        return text, InlineKeyboardMarkup(rows)
 
-    if error_code == "rate_limited":
-        text = (
-            "⏳ يوجد ضغط مؤقت على خدمة البريد.\n\n"
-            "انتظر قليلاً ثم اضغط تحديث للمحاولة من جديد."
+def get_member_counts() -> dict:
+    """ملخص الأعضاء من صف member_stats الواحد؛ لا يعتمد زمنه على عدد الأعضاء."""
+    counts = dict.fromkeys(MEMBER_STATS_FIELDS, 0)
+    with db_connection() as conn:
+        if not conn:
+            return counts
+        try:
+            with conn.cursor() as cur:
+                cur.execute(f"SELECT {', '.join(MEMBER_STATS_FIELDS)} FROM member_stats WHERE id = 1")
+                row = cur.fetchone()
+            if row:
+                counts.update(zip(MEMBER_STATS_FIELDS, (max(0, int(value)) for value in row)))
+        except Exception as e:
+            print(f"⚠️ خطأ في get_member_counts: {e}")
+        return counts
+
+
+def _member_cursor_key(kind: str, row) -> int:
+    """قيمة مفتاح الصفحات كرقم صحيح يُحمل داخل callback_data (created_at بالميكروثانية)."""
+    if MEMBERS_LIST_ORDER[kind][1] == "u.created_at":
+        return (row["created_at"] - MEMBERS_CURSOR_EPOCH) // timedelta(microseconds=1)
+    return int(row["emails_count"])
+
+
+def get_members_page(kind: str, direction: str = None, cursor_key: int = None, cursor_id: int = None):
+    """صفحة من قوائم الأعضاء بمؤشر (keyset) بدل OFFSET: تكلفتها بحجم الصفحة مهما كان رقمها.
+
+    direction: None للصفحة الأولى، "n" لما بعد المؤشر، "p" لما قبله.
+    يرجع (الأعضاء، الإجمالي، مؤشر أول عنصر، مؤشر آخر عنصر، هل توجد صفحة تالية).
+    """
+    where_sql, key_sql, order, total_field = MEMBERS_LIST_ORDER[kind]
+    backward = direction == "p"
+    params = []
+    if direction in ("n", "p") and cursor_key is not None and cursor_id is not None:
+        after = (order == "ASC") != backward
+        where_sql += f" AND ({key_sql}, u.telegram_id) {'>' if after else '<'} (%s, %s)"
+        cursor_value = (
+            MEMBERS_CURSOR_EPOCH + timedelta(microseconds=cursor_key)
+            if key_sql == "u.created_at"
+            else cursor_key
         )
-    elif error_code == "service_unavailable":
-        text = (
-            "🛠️ خدمة البريد متوقفة أو تواجه مشكلة مؤقتة.\n\n"
-            "حاول التحديث بعد قليل."
-        )
-    elif error_code == "timeout":
-        text = (
-            "⏱️ انتهت مهلة الاتصال بخدمة البريد.\n\n"
-            "هذه مشكلة مؤقتة، حاول التحديث لاحقاً."
-        )
-    elif error_code in ("connection", "network"):
-        text = (
-            "🌐 تعذر الاتصال بخدمة البريد مؤقتاً.\n\n"
-            "تحقق لاحقاً واضغط تحديث للمحاولة."
-        )
-    elif error_code == "invalid_response":
-        text = (
-            "⚠️ وصلت استجابة غير صالحة من خدمة البريد.\n\n"
-            "حاول التحديث بعد قليل."
-        )
-    elif error_code == "http_error" and status:
-        text = (
-            f"⚠️ تعذر تحميل الرسائل بسبب خطأ HTTP {status}.\n\n"
-            "حاول التحديث لاحقاً."
-        )
-    else:
-        text = get_text("ar", "error_load_messages")
+        params.extend([cursor_value, cursor_id])
+    scan_order = order if not backward else ("DESC" if order == "ASC" else "ASC")
+    with db_connection() as conn:
+        if not conn:
+            return [], 0, None, None, False
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(f"SELECT {total_field} AS total FROM member_stats WHERE id = 1")
+                row = cur.fetchone()
+                total = max(0, int(row["total"])) if row else 0
+                cur.execute(
+                    f"""
+                    {MEMBERS_SELECT_SQL}
+                    WHERE {where_sql}
+                    ORDER BY {key_sql} {scan_order}, u.telegram_id {scan_order}
+                    LIMIT %s
+                    """,
+                    (*params, MEMBERS_PAGE_SIZE + 1),
+                )
+                rows = cur.fetchall()
+        except Exception as e:
+            print(f"⚠️ خطأ في get_members_page: {e}")
+            return [], 0, None, None, False
+
+    has_more = len(rows) > MEMBERS_PAGE_SIZE
+    rows = rows[:MEMBERS_PAGE_SIZE]
+    if backward:
+        rows.reverse()
+    if not rows:
+        return [], total, None, None, False
+    first_cursor = (_member_cursor_key(kind, rows[0]), int(rows[0]["telegram_id"]))
+    last_cursor = (_member_cursor_key(kind, rows[-1]), int(rows[-1]["telegram_id"]))
+    # عند الرجوع للخلف توجد دائماً صفحة تالية (الصفحة التي جئنا منها).
+    has_next = True if backward else has_more
+    return [_member_row(row) for row in rows], total, first_cursor, last_cursor, has_next
+
+
+def _like_escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+# كل فرع يقرأ من فهرسه الخاص بحد أقصى LIMIT، ثم تُرتب النتائج: مطابقة تامة، ثم بادئة، ثم داخل النص.
+MEMBER_SEARCH_SQL = f"""
+    WITH matches AS (
+        (SELECT telegram_id, CASE WHEN {MEMBER_SEARCH_USERNAME_SQL} = %(q)s THEN 0 ELSE 1 END AS rank
+         FROM bot_users WHERE {MEMBER_SEARCH_USERNAME_SQL} LIKE %(prefix)s LIMIT %(limit)s)
+        UNION ALL
+        (SELECT telegram_id, CASE WHEN telegram_id::text = %(q)s THEN 0 ELSE 1 END
+         FROM bot_users WHERE telegram_id::text LIKE %(prefix)s LIMIT %(limit)s)
+        UNION ALL
+        (SELECT telegram_id, CASE WHEN {MEMBER_SEARCH_NAME_SQL} = %(q)s THEN 0 ELSE 1 END
+         FROM bot_users WHERE {MEMBER_SEARCH_NAME_SQL} LIKE %(prefix)s LIMIT %(limit)s)
+        UNION ALL
+        (SELECT telegram_id, 2
+         FROM bot_users
+         WHERE {MEMBER_SEARCH_USERNAME_SQL} LIKE %(contains)s OR {MEMBER_SEARCH_NAME_SQL} LIKE %(contains)s
+         LIMIT %(limit)s)
+    )
+    {MEMBERS_SELECT_SQL}
+    JOIN (SELECT telegram_id, MIN(rank) AS rank FROM matches GROUP BY telegram_id) m
+      ON m.telegram_id = u.telegram_id
+    ORDER BY m.rank, u.emails_count DESC, u.telegram_id
+    LIMIT %(limit)s
+"""
 
-    rows = [
-        [InlineKeyboardButton(
-            get_text("ar", "btn_refresh"),
-            callback_data=f"inbox_{email_index}",
-            style="success",
-        )],
-        [InlineKeyboardButton(
-            get_text("ar", "btn_back"),
-            callback_data="select_inbox",
-            style="primary",
-        )],
-    ]
-    return text, InlineKeyboardMarkup(rows)
 
+def search_members(search_value: str, limit: int = 10):
+    """البحث في الـ ID والاسم واليوزر من PostgreSQL، أو من فهرس الذاكرة إذا تعذر الاتصال."""
+    query = str(search_value or "").strip().lstrip("@").lower()
+    if not query:
+        return []
+    escaped = _like_escape(query)
+    with db_connection() as conn:
+        if conn:
+            try:
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    cur.execute(MEMBER_SEARCH_SQL, {
+                        "q": query,
+                        "prefix": escaped + "%",
+                        "contains": "%" + escaped + "%",
+                        "limit": limit,
+                    })
+                    return [_member_row(row) for row in cur.fetchall()]
+            except Exception as e:
+                print(f"⚠️ خطأ في search_members: {e}")
+                conn.rollback()
 
-def get_message_content(message_id, token):
-    headers = {"Authorization": f"Bearer {token}"}
-    response = mail_request("GET", f"/messages/{message_id}", headers=headers)
-    if response is None or response.status_code != 200:
-        return None
-    try:
-        return response.json()
-    except ValueError as error:
-        print(f"⚠️ رد محتوى الرسالة غير صالح: {error}")
-        return None
+    results = []
+    for uid in member_search_index.search(query, limit):
+        info = user_cache.get(uid)
+        if info is not None:
+            results.append((uid, {
+                "first_name": info.get("first_name") or "",
+                "last_name": info.get("last_name") or "",
+                "username": info.get("username") or "",
+                "emails_count": len(info.get("emails") or []),
+            }))
+    return results
+
+
+# الأعضاء الذين حظروا البوت لا يُرسل لهم حتى يعودوا للتفاعل معه.
+BROADCAST_AUDIENCE_SQL = {
+    False: "blocked_at IS NULL",
+    True: "blocked_at IS NULL AND emails_count > 0",
+}
+
+
+def count_broadcast_audience(active_only: bool = False) -> int:
+    counts = get_member_counts()
+    if active_only:
+        return max(0, counts["active_users"] - counts["blocked_active_users"])
+    return max(0, counts["total_users"] - counts["blocked_users"])
+
+
+# ---------- Broadcast Jobs ----------
+def create_broadcast_job(audience: str, message_html: str, created_by: int):
+    """إنشاء مهمة إذاعة وتسجيل كل مستلميها دفعة واحدة؛ يرجع (job_id, العدد)."""
+    with db_connection() as conn:
+        if not conn:
+            return None, 0
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "INSERT INTO broadcast_jobs (audience, message_html, created_by) VALUES (%s, %s, %s) RETURNING id",
+                    (audience, message_html, created_by),
+                )
+                job_id = cur.fetchone()[0]
+                cur.execute(
+                    f"""
+                    INSERT INTO broadcast_recipients (job_id, telegram_id)
+                    SELECT %s, telegram_id FROM bot_users
+                    WHERE {BROADCAST_AUDIENCE_SQL[audience == "active"]}
+                    """,
+                    (job_id,),
+                )
+                total = cur.rowcount
+                cur.execute("UPDATE broadcast_jobs SET total=%s WHERE id=%s", (total, job_id))
+                conn.commit()
+                return job_id, total
+        except Exception as e:
+            print(f"❌ خطأ في إنشاء مهمة الإذاعة: {e}")
+            conn.rollback()
+            return None, 0
 
 
-def extract_otp(text):
-    if not text:
-        return None
-    match = re.search(r"\b(\d{4,8})\b", str(text))
-    return match.group(1) if match else None
+def set_broadcast_progress_message(job_id: int, chat_id: int, message_id: int) -> None:
+    with db_connection() as conn:
+        if not conn:
+            return
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "UPDATE broadcast_jobs SET progress_chat_id=%s, progress_message_id=%s WHERE id=%s",
+                    (chat_id, message_id, job_id),
+                )
+                conn.commit()
+        except Exception as e:
+            print(f"⚠️ خطأ في set_broadcast_progress_message: {e}")
+            conn.rollback()
 
 
-def normalize_text_value(value) -> str:
-    if isinstance(value, list):
-        return "\n".join(str(item) for item in value if item)
-    return str(value or "")
+def get_broadcast_job(job_id: int):
+    with db_connection() as conn:
+        if not conn:
+            return None
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute("SELECT * FROM broadcast_jobs WHERE id=%s", (job_id,))
+                return cur.fetchone()
+        except Exception as e:
+            print(f"⚠️ خطأ في get_broadcast_job: {e}")
+            return None
 
 
-def html_to_text(html_value) -> str:
-    """تحويل HTML إلى نص آمن للعرض داخل تلجرام."""
-    html_text = normalize_text_value(html_value)
-    if not html_text:
-        return ""
+def get_running_broadcast_job_ids() -> list[int]:
+    with db_connection() as conn:
+        if not conn:
+            return []
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT id FROM broadcast_jobs WHERE status='running' ORDER BY id")
+                return [int(row[0]) for row in cur.fetchall()]
+        except Exception as e:
+            print(f"⚠️ خطأ في get_running_broadcast_job_ids: {e}")
+            return []
 
-    # فك الترميز أولاً حتى تُحذف الوسوم التي وصلت بصورة &lt;tag&gt;.
-    html_text = unescape(html_text)
-    html_text = re.sub(
-        r"<\s*(script|style)[^>]*>.*?<\s*/\s*\1\s*>",
-        " ",
-        html_text,
-        flags=re.IGNORECASE | re.DOTALL,
-    )
-    html_text = re.sub(r"<\s*br\s*/?>", "\n", html_text, flags=re.IGNORECASE)
-    html_text = re.sub(r"</\s*p\s*>", "\n", html_text, flags=re.IGNORECASE)
-    html_text = re.sub(r"<[^>]+>", " ", html_text)
-    html_text = re.sub(r"[\t\r ]+", " ", html_text)
-    html_text = re.sub(r"\n{3,}", "\n\n", html_text)
-    return html_text.strip()
 
+def claim_broadcast_batch(job_id: int, cursor: int, limit: int):
+    """الدفعة التالية من المستلمين الذين لم يُرسل لهم بعد، بعد آخر ID تمت معالجته.
 
-def get_message_text(full: dict) -> str:
-    """يرجع أفضل نص متاح من رسالة mail.tm."""
-    if not full:
-        return ""
+    قائمة فارغة تعني انتهاء المستلمين، وNone تعني تعذر القراءة.
+    """
+    with db_connection() as conn:
+        if not conn:
+            return None
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT telegram_id FROM broadcast_recipients
+                    WHERE job_id=%s AND status='pending' AND telegram_id > %s
+                    ORDER BY telegram_id
+                    LIMIT %s
+                """, (job_id, cursor, limit))
+                return [int(row[0]) for row in cur.fetchall()]
+        except Exception as e:
+            print(f"⚠️ خطأ في claim_broadcast_batch: {e}")
+            return None
 
-    text_value = normalize_text_value(full.get("text")).strip()
-    if text_value:
-        return text_value
 
-    intro = normalize_text_value(full.get("intro")).strip()
-    if intro:
-        return intro
+def record_broadcast_results(job_id: int, results, cursor: int):
+    """حفظ نتيجة دفعة واحدة وتحديث العدادات والمؤشر؛ يرجع حالة المهمة الحالية."""
+    results = list(results)
+    with db_connection() as conn:
+        if not conn:
+            return None
+        try:
+            with conn.cursor() as cur:
+                if results:
+                    cur.execute("""
+                        UPDATE broadcast_recipients AS r
+                        SET status=v.status, attempts=r.attempts + 1, updated_at=CURRENT_TIMESTAMP
+                        FROM unnest(%s::bigint[], %s::text[]) AS v(telegram_id, status)
+                        WHERE r.job_id=%s AND r.telegram_id=v.telegram_id
+                    """, ([item[0] for item in results], [item[1] for item in results], job_id))
+                blocked_ids = [chat_id for chat_id, status in results if status == "blocked"]
+                if blocked_ids:
+                    cur.execute(
+                        "UPDATE bot_users SET blocked_at=CURRENT_TIMESTAMP "
+                        "WHERE telegram_id = ANY(%s) AND blocked_at IS NULL RETURNING emails_count",
+                        (blocked_ids,),
+                    )
+                    _adjust_member_blocked(conn, [(1, row[0]) for row in cur.fetchall()])
+                cur.execute("""
+                    UPDATE broadcast_jobs
+                    SET cursor=%s, sent=sent + %s, failed=failed + %s, blocked=blocked + %s
+                    WHERE id=%s
+                    RETURNING status
+                """, (
+                    cursor,
+                    sum(1 for _chat_id, status in results if status == "sent"),
+                    sum(1 for _chat_id, status in results if status == "failed"),
+                    len(blocked_ids),
+                    job_id,
+                ))
+                row = cur.fetchone()
+                conn.commit()
+                return row[0] if row else None
+        except Exception as e:
+            print(f"❌ خطأ في حفظ نتائج الإذاعة: {e}")
+            conn.rollback()
+            return None
 
-    html_value = full.get("html")
-    return html_to_text(html_value) if html_value else ""
 
-# ================== بيانات المستخدمين ==================
+def finish_broadcast_job(job_id: int, status: str) -> bool:
+    with db_connection() as conn:
+        if not conn:
+            return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE broadcast_jobs SET status=%s, finished_at=CURRENT_TIMESTAMP
+                    WHERE id=%s AND status='running'
+                """, (status, job_id))
+                conn.commit()
+                return cur.rowcount > 0
+        except Exception as e:
+            print(f"⚠️ خطأ في finish_broadcast_job: {e}")
+            conn.rollback()
+            return False
 
-init_database()
-forwarding_enabled = get_setting("forwarding_enabled", "0") == "1"
-user_database = load_user_data()
 
+# ================== إدارة المشرفين (مثل كودك) ==================
 
-def get_user_data(user_id):
-    uid = str(user_id)
-    if uid not in user_database:
-        user_database[uid] = {"lang": "ar", "emails": []}
-        save_single_user(uid, user_database[uid])
-    else:
-        user_database[uid]["lang"] = "ar"
-    return user_database[uid]
+def get_all_admins():
+    with db_connection() as conn:
+        if not conn:
+            return []
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute("SELECT * FROM admins ORDER BY created_at DESC")
+                return cur.fetchall()
+        except Exception as e:
+            print(f"❌ خطأ في جلب المشرفين: {e}")
+            return []
 
 
-def get_user_emails(user_id):
-    return get_user_data(user_id).get("emails", [])
+def is_admin(user_id: int) -> bool:
+    if user_id == ADMIN_ID:
+        return True
+    admins = _auth_cached("admins", lambda: _load_id_set("admins"))
+    return bool(admins) and int(user_id) in admins
 
 
-def get_user_language(_user_id):
-    return "ar"
+def add_admin(telegram_id, username=None, first_name=None, added_by=None):
+    with db_connection() as conn:
+        if not conn:
+            return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO admins (telegram_id, username, first_name, added_by)
+                    VALUES (%s, %s, %s, %s)
+                    ON CONFLICT (telegram_id) DO NOTHING
+                """, (telegram_id, username, first_name, added_by))
+                conn.commit()
+                invalidate_auth_cache("admins")
+                return cur.rowcount > 0
+        except Exception as e:
+            print(f"❌ خطأ في إضافة المشرف: {e}")
+            return False
 
 
-def update_user_info(user_id, user):
-    if user is None:
-        return
-    data = get_user_data(user_id)
-    data["lang"] = "ar"
-    data["first_name"] = user.first_name or ""
-    data["last_name"] = user.last_name or ""
-    data["username"] = user.username or ""
-    user_database[str(user_id)] = data
-    save_single_user(str(user_id), data)
+def remove_admin(telegram_id):
+    if telegram_id == ADMIN_ID:
+        return False
+    with db_connection() as conn:
+        if not conn:
+            return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute("DELETE FROM admins WHERE telegram_id=%s", (telegram_id,))
+                conn.commit()
+                invalidate_auth_cache("admins")
+                return cur.rowcount > 0
+        except Exception as e:
+            print(f"❌ خطأ في إزالة المشرف: {e}")
+            return False
 
 
-def set_user_language(user_id, _lang="ar", user=None):
-    """للتوافق مع البيانات القديمة؛ اللغة ثابتة دائماً على العربية."""
-    data = get_user_data(user_id)
-    data["lang"] = "ar"
-    if user:
-        data["first_name"] = user.first_name or ""
-        data["last_name"] = user.last_name or ""
-        data["username"] = user.username or ""
-    user_database[str(user_id)] = data
-    save_single_user(str(user_id), data)
+# ================== إدارة القنوات (اشتراك إجباري متعدد) ==================
 
+def get_channels(only_enabled=True):
+    """جلب كل قنوات الاشتراك، مع الحفاظ على ترتيب إضافتها.
 
-def add_user_email(user_id, email, token, password=None):
-    data = get_user_data(user_id)
-    email_record = {"address": email, "token": token}
-    if password:
-        email_record["password"] = password
-    data.setdefault("emails", []).append(email_record)
-    user_database[str(user_id)] = data
-    save_single_user(str(user_id), data)
+    القنوات المفعّلة تُقرأ من كاش الصلاحيات لأنها تُفحص مع كل تحديث يصل للبوت.
+    """
+    if only_enabled:
+        return list(_auth_cached("channels", lambda: _fetch_channels(True)) or [])
+    return _fetch_channels(False) or []
 
 
-def remove_user_email(user_id, email):
-    data = get_user_data(user_id)
-    data["emails"] = [item for item in data.get("emails", []) if item.get("address") != email]
-    user_database[str(user_id)] = data
-    if save_single_user(str(user_id), data):
-        delete_email_seen_records([email])
+def _fetch_channels(only_enabled: bool):
+    with db_connection() as conn:
+        if not conn:
+            return None
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                if only_enabled:
+                    cur.execute("""
+                        SELECT id, channel_username, channel_id, channel_title,
+                               subscription_message, subscription_enabled, created_at
+                        FROM channels
+                        WHERE subscription_enabled = TRUE
+                        ORDER BY created_at ASC, id ASC
+                    """)
+                else:
+                    cur.execute("""
+                        SELECT id, channel_username, channel_id, channel_title,
+                               subscription_message, subscription_enabled, created_at
+                        FROM channels
+                        ORDER BY created_at ASC, id ASC
+                    """)
+                return cur.fetchall()
+        except Exception as e:
+            print(f"❌ خطأ في الحصول على قائمة القنوات: {e}")
+            return None
 
-async def notify_admin_new_user(context: ContextTypes.DEFAULT_TYPE, user) -> None:
-    """إشعار المشرف الرئيسي مرة واحدة عند دخول عضو جديد للبوت."""
-    if user is None or user.id == ADMIN_ID:
-        return
 
-    full_name = user.first_name or "غير معروف"
-    if user.last_name:
-        full_name += f" {user.last_name}"
-    username = f"@{user.username}" if user.username else "لا يوجد"
-    text = (
-        "🆕 <b>مستخدم جديد دخل البوت</b>\n\n"
-        f"👤 الاسم: {telegram_html(full_name)}\n"
-        f"🆔 اليوزر: {telegram_html(username)}\n"
-        f"🔢 ID: <code>{user.id}</code>"
-    )
-    try:
-        await context.bot.send_message(chat_id=ADMIN_ID, text=text, parse_mode="HTML")
-    except Exception as e:
-        print(f"⚠️ فشل إرسال إشعار دخول المستخدم {user.id}: {e}")
+def get_channel_by_id(channel_db_id: int):
+    with db_connection() as conn:
+        if not conn:
+            return None
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute("""
+                    SELECT id, channel_username, channel_id, channel_title,
+                           subscription_message, subscription_enabled, created_at
+                    FROM channels
+                    WHERE id=%s
+                    LIMIT 1
+                """, (int(channel_db_id),))
+                return cur.fetchone()
+        except Exception as e:
+            print(f"❌ خطأ في جلب القناة: {e}")
+            return None
 
 
-async def register_user_activity(context: ContextTypes.DEFAULT_TYPE, user) -> bool:
-    """تحديث بيانات العضو وإرسال إشعار الدخول عند أول ظهور فقط."""
-    if user is None:
-        return False
+def get_channel_info(only_enabled=True):
+    """للتوافق مع الأجزاء القديمة: يرجع قناة واحدة فقط عند الحاجة."""
+    channels = get_channels(only_enabled=only_enabled)
+    if not channels:
+        return None
+    return channels[0] if only_enabled else channels[-1]
 
-    is_new = str(user.id) not in user_database
-    update_user_info(user.id, user)
-    if user.id == ADMIN_ID and user.username and not get_admin_contact_username():
-        set_setting("admin_contact_username", user.username)
-    if is_new:
-        await asyncio.to_thread(increment_daily_stat, "new_users")
-        await notify_admin_new_user(context, user)
-    return is_new
 
+def set_channel(channel_username, channel_id=None, channel_title=None):
+    """إضافة قناة جديدة أو تحديث القناة نفسها بدون حذف القنوات الأخرى."""
+    with db_connection() as conn:
+        if not conn:
+            return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO channels (channel_username, channel_id, channel_title, subscription_enabled)
+                    VALUES (%s, %s, %s, TRUE)
+                    ON CONFLICT (channel_username)
+                    DO UPDATE SET
+                        channel_id = EXCLUDED.channel_id,
+                        channel_title = EXCLUDED.channel_title,
+                        subscription_enabled = TRUE,
+                        updated_at = CURRENT_TIMESTAMP
+                """, (channel_username, channel_id, channel_title))
+                conn.commit()
+                invalidate_auth_cache("channels")
+                return True
+        except Exception as e:
+            print(f"❌ خطأ في إضافة القناة: {e}")
+            conn.rollback()
+            return False
 
-async def notify_admin_subscription(
-    context: ContextTypes.DEFAULT_TYPE,
-    user_id: int,
-    channel_info,
-) -> None:
-    """إشعار المشرف مرة واحدة عند تحقق اشتراك العضو بالقناة الإجبارية."""
-    if user_id == ADMIN_ID or not channel_info:
-        return
 
-    channel_username = str(channel_info.get("channel_username") or "").lstrip("@")
+def set_channel_message(channel_username, message):
+    with db_connection() as conn:
+        if not conn:
+            return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT id FROM channels WHERE channel_username=%s", (channel_username,))
+                if not cur.fetchone():
+                    return False
+                cur.execute("""
+                    UPDATE channels
+                    SET subscription_message=%s, updated_at=CURRENT_TIMESTAMP
+                    WHERE channel_username=%s
+                """, (message, channel_username))
+                conn.commit()
+                invalidate_auth_cache("channels")
+                return cur.rowcount > 0
+        except Exception as e:
+            print(f"❌ خطأ في تعيين رسالة القناة: {e}")
+            conn.rollback()
+            return False
+
+
+def delete_channel(channel_username):
+    with db_connection() as conn:
+        if not conn:
+            return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute("DELETE FROM channels WHERE channel_username=%s", (channel_username,))
+                deleted = cur.rowcount > 0
+                conn.commit()
+                invalidate_auth_cache("channels")
+                return deleted
+        except Exception as e:
+            print(f"❌ خطأ في حذف القناة: {e}")
+            conn.rollback()
+            return False
+
+
+def toggle_subscription(channel_username):
+    with db_connection() as conn:
+        if not conn:
+            return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE channels
+                    SET subscription_enabled = NOT subscription_enabled, updated_at=CURRENT_TIMESTAMP
+                    WHERE channel_username=%s
+                    RETURNING subscription_enabled
+                """, (channel_username,))
+                row = cur.fetchone()
+                conn.commit()
+                invalidate_auth_cache("channels")
+                return row[0] if row else False
+        except Exception as e:
+            print(f"❌ خطأ في تبديل حالة الاشتراك: {e}")
+            conn.rollback()
+            return False
+
+
+def get_channel_subscription_stats():
+    """إحصائيات التحقق المسجلة لكل قناة اشتراك إجباري."""
+    channels = get_channels(only_enabled=False)
+    with db_connection() as conn:
+        if not conn:
+            return None
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT channel_key, COUNT(*)
+                    FROM subscription_notifications
+                    GROUP BY channel_key
+                """)
+                counts = {str(row[0]).lower(): int(row[1] or 0) for row in cur.fetchall()}
+
+            result = []
+            for channel in channels:
+                item = dict(channel)
+                channel_key = str(
+                    item.get("channel_id") or item.get("channel_username") or ""
+                ).lower()
+                item["verified_count"] = counts.get(channel_key, 0)
+                result.append(item)
+            return result
+        except Exception as error:
+            print(f"⚠️ خطأ في إحصائيات قنوات الاشتراك: {error}")
+            return None
+
+
+# ================== اشتراك إجباري متعدد ==================
+
+MEMBERSHIP_POSITIVE_TTL_SECONDS = int(os.getenv("MEMBERSHIP_POSITIVE_TTL_SECONDS", "600"))
+MEMBERSHIP_NEGATIVE_TTL_SECONDS = int(os.getenv("MEMBERSHIP_NEGATIVE_TTL_SECONDS", "20"))
+MEMBERSHIP_CACHE_MAX_USERS = int(os.getenv("MEMBERSHIP_CACHE_MAX_USERS", "20000"))
+# user_id -> {channel_key: (subscribed, expires_at)}؛ الأقدم استخداماً يخرج أولاً.
+MEMBERSHIP_CACHE = OrderedDict()
+MEMBERSHIP_STATS = {"hits": 0, "misses": 0, "updates": 0}
+
+
+def channel_cache_key(channel_info) -> str:
+    return str(channel_info.get("channel_id") or channel_info.get("channel_username") or "").lower()
+
+
+def cache_membership(user_id: int, channel_key: str, subscribed: bool) -> None:
+    ttl = MEMBERSHIP_POSITIVE_TTL_SECONDS if subscribed else MEMBERSHIP_NEGATIVE_TTL_SECONDS
+    entries = MEMBERSHIP_CACHE.setdefault(int(user_id), {})
+    entries[channel_key] = (subscribed, time.monotonic() + ttl)
+    MEMBERSHIP_CACHE.move_to_end(int(user_id))
+    while len(MEMBERSHIP_CACHE) > MEMBERSHIP_CACHE_MAX_USERS:
+        MEMBERSHIP_CACHE.popitem(last=False)
+
+
+def get_cached_membership(user_id: int, channel_key: str):
+    """نتيجة الاشتراك المحفوظة إن كانت صالحة، أو None عند الحاجة لسؤال تلجرام."""
+    entry = (MEMBERSHIP_CACHE.get(int(user_id)) or {}).get(channel_key)
+    if entry is None or entry[1] <= time.monotonic():
+        MEMBERSHIP_STATS["misses"] += 1
+        return None
+    MEMBERSHIP_STATS["hits"] += 1
+    return entry[0]
+
+
+def invalidate_membership(user_id: int) -> None:
+    MEMBERSHIP_CACHE.pop(int(user_id), None)
+
+
+async def _check_channel_membership(user_id: int, channel_info, context: ContextTypes.DEFAULT_TYPE):
+    """سؤال تلجرام عن اشتراك العضو بقناة واحدة؛ يرجع (مشترك، عطل مؤقت)."""
+    channel_username = channel_info["channel_username"]
     channel_id = channel_info.get("channel_id")
-    channel_key = str(channel_id or channel_username).lower()
-    if not channel_key or subscription_notification_exists(user_id, channel_key):
-        return
+    chat_identifier = channel_id if channel_id else f"@{channel_username}"
+    subscribed = False
+    temporary_failure = False
 
-    info = user_database.get(str(user_id), {}) or {}
-    full_name = info.get("first_name") or "غير معروف"
-    if info.get("last_name"):
-        full_name += f" {info['last_name']}"
-    username = f"@{info.get('username')}" if info.get("username") else "لا يوجد"
-    text = (
-        "✅ <b>عضو اشترك بالقناة الإجبارية</b>\n\n"
-        f"👤 الاسم: {telegram_html(full_name)}\n"
-        f"🆔 اليوزر: {telegram_html(username)}\n"
-        f"🔢 ID: <code>{user_id}</code>\n"
-        f"📢 القناة: @{telegram_html(channel_username)}"
-    )
-    try:
-        await context.bot.send_message(chat_id=ADMIN_ID, text=text, parse_mode="HTML")
-        mark_subscription_notified(user_id, channel_key)
-    except Exception as e:
-        print(f"⚠️ فشل إرسال إشعار اشتراك المستخدم {user_id}: {e}")
+    for attempt in range(2):
+        try:
+            member = await context.bot.get_chat_member(chat_identifier, user_id)
+            subscribed = member.status in ("member", "administrator", "creator")
+            break
+        except Exception as error:
+            error_text = str(error).lower()
+            temporary_failure = any(term in error_text for term in (
+                "readerror", "timeout", "timed out", "network", "connection",
+                "bad gateway", "temporarily unavailable", "server error",
+            ))
+            if temporary_failure and attempt == 0:
+                await asyncio.sleep(1.5)
+                continue
 
+            print(
+                f"⚠️ فشل فحص اشتراك المستخدم {user_id} في @{channel_username}: "
+                f"{type(error).__name__}: {error}"
+            )
+            break
 
-# ================== عرض البريد يدوياً فقط ==================
-# لا توجد مهمة خلفية لإرسال رسائل البريد إلى محادثة البوت.
-# المستخدم يفتح «الرسائل الواردة»، يختار الإيميل، ثم يقرأ رسائله.
+    return subscribed, temporary_failure
 
-# ================== النصوص العربية ==================
 
-def get_text(_lang, key, **kwargs):
-    texts = {
-        "welcome": "🎉 مرحباً بك في بوت الإيميلات المؤقتة!",
-        "main_menu": "📬 القائمة الرئيسية\n\nعدد الإيميلات النشطة: {emails_count}",
-        "email_created": "✅ تم إنشاء بريد إلكتروني جديد!\n\n📧 الإيميل: <code>{email}</code>\n\nاضغط على الإيميل للنسخ",
-        "no_emails": "❌ لا توجد إيميلات نشطة\n\nقم بإنشاء إيميل جديد أولاً",
-        "select_email": "📋 اختر الإيميل:\n\nعدد الإيميلات: {count}",
-        "no_messages": "📭 لا توجد رسائل\n\n📧 {email}",
-        "messages_list": "📬 الرسائل الواردة ({count})\n📧 الإيميل: {email}\n\n",
-        "message_detail": "✉️ تفاصيل الرسالة\n\n📧 من: {sender}\n📌 الموضوع: {subject}\n📅 التاريخ: {date}\n\n📝 المحتوى:\n{content}\n",
-        "otp_found": "🔢 تم العثور على رمز OTP:\n\nالرمز: <code>{otp}</code>\n\nاضغط على الرمز للنسخ",
-        "email_deleted": "🗑️ تم حذف الإيميل\n\n📧 {email}",
-        "all_emails_deleted": "🗑️ تم حذف جميع الإيميلات ({count})",
-        "error_create_email": "❌ فشل إنشاء الإيميل\n\nحاول مرة أخرى.",
-        "error_load_messages": "❌ فشل تحميل الرسائل\n\nاضغط 🔄 تحديث للمحاولة.",
-        "error_load_message": "❌ فشل تحميل الرسالة\n\nحاول لاحقاً.",
-        "unauthorized": "⛔ هذا الأمر للمشرف فقط",
-        "banned": "⛔ تم حظرك من استخدام البوت.",
-        "btn_create": "✨ إنشاء إيميل جديد",
-        "btn_my_emails": "📧 إيميلاتي",
-        "btn_inbox": "📥 الرسائل الواردة",
-        "btn_delete_all": "🗑️ حذف الكل",
-        "btn_back": "🔙 رجوع",
-        "btn_delete": "🗑️ حذف",
-        "btn_confirm": "✅ تأكيد",
-        "btn_cancel": "❌ إلغاء",
-        "btn_refresh": "🔄 تحديث",
-        "btn_admin_panel": "👑 لوحة المشرف",
-    }
-    value = texts.get(key, "")
-    return value.format(**kwargs) if kwargs else value
+async def get_missing_subscription_channels(user_id: int, context: ContextTypes.DEFAULT_TYPE, channels=None):
+    """يرجع القنوات المفعّلة التي لم يشترك بها العضو بعد.
 
+    النتائج تُحفظ في MEMBERSHIP_CACHE، والقنوات غير المحفوظة تُفحص بالتوازي.
+    """
+    if channels is None:
+        channels = await get_channels_async(only_enabled=True)
 
-# ================== لوحات الأزرار ==================
+    results = {}
+    unchecked = []
+    for channel_info in channels:
+        cached = get_cached_membership(user_id, channel_cache_key(channel_info))
+        if cached is None:
+            unchecked.append(channel_info)
+        else:
+            results[channel_cache_key(channel_info)] = cached
 
-def get_main_menu_keyboard(_lang, user_id):
-    keyboard = [
-        [InlineKeyboardButton(get_text("ar", "btn_create"), callback_data="create_email", style="success")],
-        [
-            InlineKeyboardButton(get_text("ar", "btn_my_emails"), callback_data="my_emails", style="primary"),
-            InlineKeyboardButton(get_text("ar", "btn_inbox"), callback_data="select_inbox", style="primary"),
-        ],
-        [InlineKeyboardButton("⚙️ إدارة إيميلاتك", callback_data="manage_emails", style="danger")],
-    ]
-    if is_admin(user_id):
-        keyboard.append([
-            InlineKeyboardButton(get_text("ar", "btn_admin_panel"), callback_data="admin_panel", style="primary")
-        ])
-    return InlineKeyboardMarkup(keyboard)
+    checks = await asyncio.gather(*(
+        _check_channel_membership(user_id, channel_info, context) for channel_info in unchecked
+    ))
+    for channel_info, (subscribed, temporary_failure) in zip(unchecked, checks):
+        # عطل الشبكة المؤقت لا يمنع المستخدم، مثل السلوك السابق، ولا يُحفظ في الكاش.
+        if temporary_failure and not subscribed:
+            results[channel_cache_key(channel_info)] = True
+            continue
+        cache_membership(user_id, channel_cache_key(channel_info), subscribed)
+        results[channel_cache_key(channel_info)] = subscribed
 
+    return [channel_info for channel_info in channels if not results[channel_cache_key(channel_info)]]
+
+
+async def track_channel_membership(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """تحديث كاش الاشتراك من تحديثات ChatMember في القنوات التي يشرف عليها البوت."""
+    change = update.chat_member
+    if change is None:
+        return
+
+    chat = change.chat
+    member = change.new_chat_member
+    subscribed = member.status in ("member", "administrator", "creator")
+    chat_username = str(chat.username or "").lower()
+    for channel_info in await get_channels_async(only_enabled=True):
+        channel_id = channel_info.get("channel_id")
+        channel_username = str(channel_info.get("channel_username") or "").lstrip("@").lower()
+        if (channel_id and int(channel_id) == chat.id) or (chat_username and channel_username == chat_username):
+            cache_membership(member.user.id, channel_cache_key(channel_info), subscribed)
+            MEMBERSHIP_STATS["updates"] += 1
+
+
+async def check_user_subscription_strict(user_id: int, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """يجب أن يكون العضو مشتركاً بكل القنوات المفعّلة."""
+    missing = await get_missing_subscription_channels(user_id, context)
+    return len(missing) == 0
+
+
+def subscription_prompt(_lang: str, channels, message: str = ""):
+    """عرض الرسالة العامة مع القنوات الناقصة وأزرار الانضمام."""
+    if isinstance(channels, str):
+        channels = [{
+            "channel_username": channels,
+            "channel_title": channels,
+        }]
+    channels = list(channels or [])
+
+    channel_lines = []
+    for index, channel in enumerate(channels, start=1):
+        username = str(channel.get("channel_username") or "").lstrip("@")
+        title = str(channel.get("channel_title") or username)
+        channel_lines.append(
+            f"{index}. 📢 {telegram_html(title)} — @{telegram_html(username)}"
+        )
+
+    channels_text = "\n".join(channel_lines)
+    global_message = get_global_subscription_message_html()
+    message_parts = global_message.split("\n\n", 1)
+    if len(message_parts) == 2:
+        text = f"{message_parts[0]}\n\n{channels_text}\n\n{message_parts[1]}"
+    elif channels_text:
+        text = f"{global_message}\n\n{channels_text}"
+    else:
+        text = global_message
 
-def get_free_domains_keyboard(domains):
-    """عرض الدومينات المجانية النشطة التي تم جلبها مباشرة من mail.tm."""
     rows = []
-    for index, domain in enumerate(domains):
-        display_domain = str(domain)
-        if len(display_domain) > 40:
-            display_domain = display_domain[:37] + "..."
+    for channel in channels:
+        username = str(channel.get("channel_username") or "").lstrip("@")
+        title = str(channel.get("channel_title") or username)
+        display_title = title if len(title) <= 28 else title[:25] + "..."
         rows.append([
             InlineKeyboardButton(
-                f"@{display_domain}",
-                callback_data=f"free_domain_{index}",
+                f"📢 الانضمام: {display_title}",
+                url=f"https://t.me/{username}",
                 style="primary",
             )
         ])
-
     rows.append([
         InlineKeyboardButton(
-            "🔄 تحديث الدومينات",
-            callback_data="refresh_free_domains",
+            "✅ التحقق من الاشتراك",
+            callback_data="verify_subscription",
             style="success",
         )
     ])
-    rows.append([
-        InlineKeyboardButton(
-            get_text("ar", "btn_back"),
-            callback_data="create_email",
-            style="primary",
-        )
-    ])
-    return InlineKeyboardMarkup(rows)
+    return text, InlineKeyboardMarkup(rows)
 
+# ================== mail.tm API ==================
+# ================== mail.tm API ==================
 
-def get_email_list_keyboard(emails, action_prefix, _lang):
-    keyboard = []
-    for index, email_info in enumerate(emails):
-        email = email_info["address"]
-        display_email = email if len(email) <= 30 else email[:27] + "..."
-        keyboard.append([
-            InlineKeyboardButton(
-                f"📧 {display_email}",
-                callback_data=f"{action_prefix}_{index}",
-                style="primary",
-            )
-        ])
-    keyboard.append([InlineKeyboardButton(get_text("ar", "btn_back"), callback_data="back_to_menu")])
-    return InlineKeyboardMarkup(keyboard)
+MAIL_MAX_CONNECTIONS = max(1, int(os.getenv("MAIL_MAX_CONNECTIONS", "20")))
+MAIL_MAX_CONCURRENCY_PER_HOST = max(1, int(os.getenv("MAIL_MAX_CONCURRENCY_PER_HOST", "8")))
+# mail.tm يسمح بنحو 8 طلبات/ثانية لكل IP؛ المعدل يبدأ من هنا ويتكيف مع ردود 429.
+MAIL_RATE_PER_SECOND = float(os.getenv("MAIL_RATE_PER_SECOND", "8"))
+MAIL_RATE_MIN_PER_SECOND = float(os.getenv("MAIL_RATE_MIN_PER_SECOND", "1"))
+MAIL_RATE_MAX_PER_SECOND = float(os.getenv("MAIL_RATE_MAX_PER_SECOND", "8"))
+# زيادة جمعية (طلب/ثانية لكل ثانية استخدام كامل بلا 429) وتخفيض ضربي عند 429.
+MAIL_RATE_INCREASE = float(os.getenv("MAIL_RATE_INCREASE", "0.5"))
+MAIL_RATE_DECREASE = float(os.getenv("MAIL_RATE_DECREASE", "0.5"))
+
+# الأولوية الأصغر تُخدم أولاً عند الازدحام.
+MAIL_PRIORITY_INTERACTIVE = 0
+MAIL_PRIORITY_CREATE = 1
+MAIL_PRIORITY_TOKEN = 2
+MAIL_PRIORITY_BACKGROUND = 3
+MAIL_PRIORITY_NAMES = {
+    MAIL_PRIORITY_INTERACTIVE: "تفاعلي",
+    MAIL_PRIORITY_CREATE: "إنشاء",
+    MAIL_PRIORITY_TOKEN: "توكن",
+    MAIL_PRIORITY_BACKGROUND: "خلفية",
+}
+
+
+class MailRateLimiter:
+    """محدد معدل عام لكل طلبات mail.tm في العملية: رصيد يمتلئ بالمعدل الحالي، وطابور بأولويات.
+
+    المعدل يتكيف بأسلوب AIMD: يزيد تدريجياً مع الردود الناجحة، وينخفض للنصف عند HTTP 429
+    مع إيقاف الجميع حتى Retry-After. يُستخدم من حلقة الأحداث فقط.
+    """
 
+    def __init__(self, rate: float, min_rate: float, max_rate: float, increase: float, decrease: float):
+        self.min_rate = max(0.1, min_rate)
+        self.max_rate = max(self.min_rate, max_rate)
+        self.rate = min(self.max_rate, max(self.min_rate, rate))
+        self.increase = increase
+        self.decrease = min(max(decrease, 0.1), 1.0)
+        self.tokens = 1.0
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self._last_decrease = 0.0
+        self._waiters = []
+        self._sequence = 0
+        self._dispatcher = None
+        self.stats = {"requests": 0, "immediate": 0, "queued": 0, "throttled": 0, "max_waiting": 0, "wait_ms_total": 0.0}
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self, priority: int = MAIL_PRIORITY_INTERACTIVE) -> None:
+        now = time.monotonic()
+        self.stats["requests"] += 1
+        if not self._waiters and now >= self.paused_until:
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                self.stats["immediate"] += 1
+                return
+
+        future = asyncio.get_running_loop().create_future()
+        self._sequence += 1
+        heapq.heappush(self._waiters, (priority, self._sequence, future))
+        self.stats["queued"] += 1
+        self.stats["max_waiting"] = max(self.stats["max_waiting"], len(self._waiters))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        try:
+            await future
+        finally:
+            self.stats["wait_ms_total"] += (time.monotonic() - now) * 1000
 
-def get_messages_keyboard(messages, email_index, _lang):
-    keyboard = []
-    for index, message in enumerate(messages[:10]):
-        subject = message.get("subject") or "بدون موضوع"
-        display_subject = subject if len(subject) <= 30 else subject[:27] + "..."
-        keyboard.append([
-            InlineKeyboardButton(
-                f"✉️ {display_subject}",
-                callback_data=f"msg_{email_index}_{index}",
-                style="primary",
+    async def _dispatch(self) -> None:
+        while self._waiters:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self._refill(now)
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                continue
+            _priority, _sequence, future = heapq.heappop(self._waiters)
+            if future.done():
+                continue
+            self.tokens -= 1
+            future.set_result(None)
+
+    def record(self, status_code, retry_after=None) -> None:
+        """تعديل المعدل من رد mail.tm: 429 يخفضه ويوقف الجميع، والنجاح يرفعه تدريجياً."""
+        if status_code == 429:
+            self.stats["throttled"] += 1
+            now = time.monotonic()
+            # دفعة ردود 429 من نفس اللحظة تُحسب تخفيضاً واحداً.
+            if now - self._last_decrease >= 1.0:
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+                self._last_decrease = now
+            try:
+                pause = float(retry_after or 0)
+            except ValueError:
+                pause = 0.0
+            pause = pause if 0 < pause <= 60 else 1 / self.rate
+            self.paused_until = max(self.paused_until, now + pause)
+            self.tokens = 0.0
+        elif status_code is not None and status_code < 500:
+            self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+    def get_stats(self) -> dict:
+        stats = dict(self.stats)
+        stats["rate"] = round(self.rate, 2)
+        stats["waiting"] = len(self._waiters)
+        waiting_by_priority = {}
+        for priority, _sequence, future in self._waiters:
+            if not future.done():
+                waiting_by_priority[priority] = waiting_by_priority.get(priority, 0) + 1
+        stats["waiting_by_priority"] = waiting_by_priority
+        stats["paused_seconds"] = max(0, round(self.paused_until - time.monotonic(), 1))
+        stats["avg_wait_ms"] = int(stats["wait_ms_total"] / stats["queued"]) if stats["queued"] else 0
+        return stats
+
+
+class MailTmClient:
+    """عميل mail.tm غير متزامن: اتصالات HTTP دائمة، حد للطلبات المتزامنة لكل مضيف،
+    وإعادة محاولة بتأخير عشوائي لا يحجب حلقة asyncio."""
+
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(
+        self,
+        base_url: str = API,
+        max_connections: int = MAIL_MAX_CONNECTIONS,
+        max_concurrency_per_host: int = MAIL_MAX_CONCURRENCY_PER_HOST,
+        attempts: int = 3,
+        limiter: MailRateLimiter = None,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.limiter = limiter
+        self.max_connections = max_connections
+        self.max_concurrency_per_host = max_concurrency_per_host
+        self.attempts = max(1, attempts)
+        self._client = None
+        self._host_limits = {}
+
+    def _http(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(20.0, connect=5.0),
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                    keepalive_expiry=30.0,
+                ),
+                headers={"User-Agent": "TelegramTempMailBot/3.1"},
             )
-        ])
-    keyboard.append([
-        InlineKeyboardButton(get_text("ar", "btn_refresh"), callback_data=f"inbox_{email_index}", style="success"),
-        InlineKeyboardButton(get_text("ar", "btn_back"), callback_data="select_inbox"),
-    ])
-    return InlineKeyboardMarkup(keyboard)
+        return self._client
+
+    def _host_limit(self, url: str) -> asyncio.Semaphore:
+        host = httpx.URL(url).host
+        limit = self._host_limits.get(host)
+        if limit is None:
+            limit = asyncio.Semaphore(self.max_concurrency_per_host)
+            self._host_limits[host] = limit
+        return limit
+
+    @staticmethod
+    def _backoff_seconds(attempt: int, response=None) -> float:
+        """تأخير أسي مع تشويش عشوائي، ويحترم Retry-After القصير عند HTTP 429."""
+        if response is not None and response.status_code == 429:
+            try:
+                retry_after = float(response.headers.get("Retry-After", ""))
+            except ValueError:
+                retry_after = 0.0
+            if 0 < retry_after <= 10:
+                return retry_after
+        return (2 ** attempt) * random.uniform(0.5, 1.5)
+
+    async def request(self, method: str, path: str, return_error=False, priority: int = MAIL_PRIORITY_INTERACTIVE, **kwargs):
+        """نفس سلوك mail_request القديم: الاستجابة، أو (الاستجابة، رمز الخطأ) عند return_error.
+
+        كل محاولة تنتظر دورها في المحدد العام حسب priority.
+        """
+        url = path if path.startswith("http") else f"{self.base_url}{path}"
+        last_response = None
+        last_error_code = None
+
+        for attempt in range(self.attempts):
+            response = None
+            try:
+                if self.limiter is not None:
+                    await self.limiter.acquire(priority)
+                async with self._host_limit(url):
+                    response = await self._http().request(method, url, **kwargs)
+                if self.limiter is not None:
+                    self.limiter.record(response.status_code, response.headers.get("Retry-After"))
+                last_response = response
+                if response.status_code not in self.RETRY_STATUSES:
+                    return (response, None) if return_error else response
+
+                last_error_code = f"http_{response.status_code}"
+                print(f"⚠️ mail.tm {path}: HTTP {response.status_code}")
+            except httpx.TimeoutException as error:
+                last_error_code = "timeout"
+                print(f"⚠️ mail.tm {path}: {type(error).__name__}: {error}")
+            except (httpx.ConnectError, httpx.RemoteProtocolError, httpx.ReadError) as error:
+                last_error_code = "connection"
+                print(f"⚠️ mail.tm {path}: {type(error).__name__}: {error}")
+            except httpx.HTTPError as error:
+                last_error_code = "network"
+                print(f"⚠️ mail.tm {path}: {type(error).__name__}: {error}")
+
+            if attempt < self.attempts - 1:
+                if self.limiter is not None and response is not None and response.status_code == 429:
+                    # المحدد أوقف كل الطلبات حتى Retry-After، فلا حاجة لانتظار إضافي هنا.
+                    continue
+                await asyncio.sleep(self._backoff_seconds(attempt, response))
 
+        if return_error:
+            return last_response, last_error_code or "network"
+        return last_response
 
-def get_admin_section_keyboard(buttons, back_callback="admin_panel"):
-    rows = [buttons[index:index + 2] for index in range(0, len(buttons), 2)]
-    rows.append([
-        InlineKeyboardButton(
-            get_text("ar", "btn_back"),
-            callback_data=back_callback,
-            style="primary",
-        )
-    ])
-    return InlineKeyboardMarkup(rows)
+    async def close(self) -> None:
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
 
 
-def get_admin_panel_keyboard(_lang, user_id):
-    keyboard = [
-        [
-            InlineKeyboardButton("📊 قسم الإحصائيات", callback_data="section_stats", style="primary"),
-            InlineKeyboardButton("📢 قسم الإذاعة", callback_data="section_broadcast", style="primary"),
-        ],
-        [
-            InlineKeyboardButton("📨 قسم توجيه الرسائل", callback_data="section_forward", style="primary"),
-            InlineKeyboardButton("📢 إدارة القنوات", callback_data="channel_management", style="primary"),
-        ],
-        [
-            InlineKeyboardButton("⚙️ الإعدادات", callback_data="section_settings", style="primary"),
-            InlineKeyboardButton("👥 إدارة الأعضاء", callback_data="section_members", style="primary"),
-        ],
-        [
-            InlineKeyboardButton("🔢 حد إنشاء الإيميلات", callback_data="section_email_limit", style="primary"),
-            InlineKeyboardButton("🌐 إدارة الدومينات المدفوعة", callback_data="section_paid_domains", style="primary"),
-        ],
-        [InlineKeyboardButton("🩺 حالة البوت والخدمات", callback_data="section_health", style="primary")],
-    ]
+MAIL_RATE_LIMITER = MailRateLimiter(
+    MAIL_RATE_PER_SECOND,
+    MAIL_RATE_MIN_PER_SECOND,
+    MAIL_RATE_MAX_PER_SECOND,
+    MAIL_RATE_INCREASE,
+    MAIL_RATE_DECREASE,
+)
+MAIL_CLIENT = MailTmClient(limiter=MAIL_RATE_LIMITER)
 
-    if user_id == ADMIN_ID:
-        keyboard.append([
-            InlineKeyboardButton("👮 إدارة المشرفين", callback_data="section_admins", style="primary"),
-            InlineKeyboardButton("🛑 الحظر / فك الحظر", callback_data="section_ban", style="danger"),
-        ])
-    else:
-        keyboard.append([
-            InlineKeyboardButton("🛑 الحظر / فك الحظر", callback_data="section_ban", style="danger")
-        ])
 
-    keyboard.extend([
-        [
-            InlineKeyboardButton("👋 رسالة الترحيب", callback_data="section_welcome", style="success"),
-            InlineKeyboardButton("ℹ️ معلومات البوت", callback_data="bot_info", style="primary"),
-        ],
-        [InlineKeyboardButton(get_text("ar", "btn_back"), callback_data="back_to_menu", style="primary")],
+async def mail_request(method: str, path: str, return_error=False, priority: int = MAIL_PRIORITY_INTERACTIVE, **kwargs):
+    """طلب إلى mail.tm عبر العميل المشترك مع إبقاء سبب الفشل عند طلبه."""
+    return await MAIL_CLIENT.request(method, path, return_error=return_error, priority=priority, **kwargs)
+
+
+DOMAIN_CACHE_TTL_SECONDS = int(os.getenv("DOMAIN_CACHE_TTL_SECONDS", "300"))
+DOMAIN_CACHE_STALE_SECONDS = int(os.getenv("DOMAIN_CACHE_STALE_SECONDS", "3600"))
+# قائمة الدومينات المجانية مشتركة بين كل مسارات الإنشاء؛ تُحدَّث في الخلفية عند تقادمها.
+DOMAIN_CACHE = {"domains": [], "fetched_at": 0.0, "refresh_task": None}
+
+
+def parse_available_domains(payload) -> list[str]:
+    """استخراج الدومينات العامة النشطة من رد GET /domains."""
+    domains = (payload or {}).get("hydra:member") or []
+    available = []
+    for item in domains:
+        domain = item.get("domain")
+        if not domain:
+            continue
+        if item.get("isActive") is False or item.get("isPrivate") is True:
+            continue
+        if domain not in available:
+            available.append(domain)
+    return available
+
+
+def store_domain_cache(domains) -> None:
+    if domains:
+        DOMAIN_CACHE["domains"] = list(domains)
+        DOMAIN_CACHE["fetched_at"] = time.monotonic()
+
+
+async def fetch_available_domains():
+    """جلب الدومينات مباشرة من mail.tm وتحديث الكاش عند النجاح."""
+    response = await mail_request("GET", "/domains", priority=MAIL_PRIORITY_CREATE)
+    if response is None or response.status_code != 200:
+        return []
+    try:
+        data = response.json()
+    except ValueError as error:
+        print(f"⚠️ رد النطاقات غير صالح: {error}")
+        return []
+
+    available = parse_available_domains(data)
+    store_domain_cache(available)
+    return available
+
+
+async def _refresh_domain_cache():
+    """طلب تحديث واحد فقط مهما تزامن عدد المنتظرين."""
+    task = DOMAIN_CACHE["refresh_task"]
+    if task is None or task.done():
+        task = asyncio.create_task(fetch_available_domains())
+        DOMAIN_CACHE["refresh_task"] = task
+    return await asyncio.shield(task)
+
+
+def invalidate_domain_cache() -> None:
+    """مسح الكاش ليُجلب أحدث قائمة في الطلب التالي (من لوحة الأدمن)."""
+    DOMAIN_CACHE["domains"] = []
+    DOMAIN_CACHE["fetched_at"] = 0.0
+
+
+def get_domain_cache_age():
+    """عمر الكاش بالثواني، أو None إذا كان فارغاً."""
+    if not DOMAIN_CACHE["domains"]:
+        return None
+    return int(time.monotonic() - DOMAIN_CACHE["fetched_at"])
+
+
+async def get_available_domains():
+    """الدومينات المجانية من الكاش؛ القائمة المتقادمة تُرجع فوراً مع تحديثها في الخلفية."""
+    cached = list(DOMAIN_CACHE["domains"])
+    age = time.monotonic() - DOMAIN_CACHE["fetched_at"]
+    if cached and age < DOMAIN_CACHE_TTL_SECONDS:
+        return cached
+    if cached and age < DOMAIN_CACHE_STALE_SECONDS:
+        task = DOMAIN_CACHE["refresh_task"]
+        if task is None or task.done():
+            DOMAIN_CACHE["refresh_task"] = asyncio.create_task(fetch_available_domains())
+        return cached
+    return list(await _refresh_domain_cache())
+
+
+async def create_account_on_domain(domain: str, priority: int = MAIL_PRIORITY_CREATE):
+    """إنشاء حساب وجلب توكنه على دومين واحد، مع إعادة المحاولة عند تكرار الاسم (422)."""
+    username_chars = string.ascii_lowercase + string.digits
+
+    for _ in range(2):
+        username = "".join(secrets.choice(username_chars) for _ in range(10))
+        email_address = f"{username}@{domain}"
+        password = FIXED_MAIL_PASSWORD
+
+        response = await mail_request(
+            "POST",
+            "/accounts",
+            json={"address": email_address, "password": password},
+            priority=priority,
+        )
+        if response is None:
+            print(f"⚠️ تعذر إنشاء حساب على الدومين @{domain}")
+            break
+        if response.status_code == 422:
+            continue
+        if response.status_code != 201:
+            print(f"⚠️ فشل إنشاء حساب على @{domain}: HTTP {response.status_code}")
+            break
+
+        token_response = await mail_request(
+            "POST",
+            "/token",
+            json={"address": email_address, "password": password},
+            priority=priority,
+        )
+        if token_response is None or token_response.status_code != 200:
+            status = token_response.status_code if token_response is not None else "network"
+            print(f"⚠️ فشل جلب توكن البريد {email_address}: {status}")
+            break
+
+        try:
+            token = token_response.json().get("token")
+        except (ValueError, AttributeError):
+            token = None
+        if token:
+            return email_address, token, password
+        break
+
+    return None, None, None
+
+
+async def create_email():
+    """إنشاء بريد مع تجربة الدومينات المجانية المتاحة تلقائياً عند فشل أحدها."""
+    try:
+        domains = await get_available_domains()
+        if not domains:
+            return None, None, None
+
+        domains = list(domains)
+        secrets.SystemRandom().shuffle(domains)
+
+        for domain in domains:
+            email_address, token, password = await create_account_on_domain(domain)
+            if email_address and token:
+                return email_address, token, password
+
+        return None, None, None
+    except Exception as error:
+        print(f"❌ create_email: {type(error).__name__}: {error}")
+        return None, None, None
+
+
+async def create_email_with_domain(domain):
+    """إنشاء بريد على دومين مجاني محدد من قائمة mail.tm المتاحة حالياً."""
+    try:
+        domain = str(domain or "").strip().lower().lstrip("@")
+        if not domain:
+            return None, None, None
+
+        available_domains = await get_available_domains()
+        if domain not in available_domains:
+            print(f"⚠️ الدومين @{domain} لم يعد متاحاً ضمن الدومينات المجانية العامة")
+            return None, None, None
+
+        return await create_account_on_domain(domain)
+    except Exception as error:
+        print(f"❌ create_email_with_domain: {type(error).__name__}: {error}")
+        return None, None, None
+
+
+# الدومينات التي بدأت تعبئتها تبقى قيد التعبئة حتى الحد الأعلى، لتجنب التذبذب عند الحد الأدنى.
+ACCOUNT_POOL_FILLING = set()
+ACCOUNT_POOL_STATS = {"hits": 0, "misses": 0, "refilled": 0}
+
+
+async def refill_account_pool() -> int:
+    """دورة تعبئة واحدة لمخزون الحسابات الجاهزة بحد أقصى ACCOUNT_POOL_REFILL_BATCH حساب."""
+    domains = await get_available_domains()
+    if not domains:
+        return 0
+
+    counts = await run_db(prune_account_pool, domains)
+    budget = ACCOUNT_POOL_REFILL_BATCH
+    created = 0
+    for domain in sorted(domains, key=lambda item: counts.get(item, 0)):
+        count = counts.get(domain, 0)
+        if count < ACCOUNT_POOL_LOW_WATERMARK:
+            ACCOUNT_POOL_FILLING.add(domain)
+        if count >= ACCOUNT_POOL_HIGH_WATERMARK:
+            ACCOUNT_POOL_FILLING.discard(domain)
+        if domain not in ACCOUNT_POOL_FILLING:
+            continue
+
+        while budget > 0 and count < ACCOUNT_POOL_HIGH_WATERMARK:
+            budget -= 1
+            email_address, token, password = await create_account_on_domain(domain, MAIL_PRIORITY_BACKGROUND)
+            if not (email_address and token):
+                break
+            if await run_db(store_pooled_account, email_address, domain, password, token):
+                count += 1
+                created += 1
+        if count >= ACCOUNT_POOL_HIGH_WATERMARK:
+            ACCOUNT_POOL_FILLING.discard(domain)
+        if budget <= 0:
+            break
+
+    ACCOUNT_POOL_STATS["refilled"] += created
+    return created
+
+
+async def account_pool_refill_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        await refill_account_pool()
+    except Exception as error:
+        print(f"⚠️ account_pool_refill_job: {type(error).__name__}: {error}")
+
+
+async def take_email(domain: str | None = None):
+    """تسليم حساب من المخزون الجاهز، والرجوع للإنشاء المباشر عند نفاده."""
+    if domain:
+        domain = str(domain).strip().lower().lstrip("@")
+        if domain not in await get_available_domains():
+            return None, None, None
+
+    email_address, token, password = await run_db(pop_pooled_account, domain)
+    if email_address and token:
+        ACCOUNT_POOL_STATS["hits"] += 1
+        return email_address, token, password
+
+    ACCOUNT_POOL_STATS["misses"] += 1
+    if domain:
+        return await create_email_with_domain(domain)
+    return await create_email()
+
+
+async def refresh_email_token_data(email_data, priority: int = MAIL_PRIORITY_TOKEN):
+    """تجديد توكن بريد واحد من العنوان وكلمة المرور المحفوظة."""
+    if not isinstance(email_data, dict):
+        return None
+
+    address = str(email_data.get("address") or "").strip()
+    password = str(email_data.get("password") or LEGACY_MAIL_PASSWORD)
+    if not address or not password:
+        return None
+
+    response = await mail_request(
+        "POST",
+        "/token",
+        json={"address": address, "password": password},
+        priority=priority,
+    )
+    if response is None or response.status_code != 200:
+        status = response.status_code if response is not None else "network"
+        print(f"⚠️ تعذر تجديد توكن {address}: {status}")
+        return None
+
+    try:
+        token = response.json().get("token")
+    except (ValueError, AttributeError):
+        token = None
+    if not token:
+        return None
+
+    email_data["token"] = token
+    email_data["password"] = password
+    return token
+
+
+TOKEN_REFRESH_MARGIN_SECONDS = int(os.getenv("TOKEN_REFRESH_MARGIN_SECONDS", "300"))
+TOKEN_REFRESH_INTERVAL_SECONDS = int(os.getenv("TOKEN_REFRESH_INTERVAL_SECONDS", "60"))
+# أقصى عدد توكنات تُجدَّد استباقياً في كل دورة، مع مهلة قصيرة بينها لتفادي HTTP 429.
+TOKEN_REFRESH_BATCH = int(os.getenv("TOKEN_REFRESH_BATCH", "5"))
+TOKEN_REFRESH_SPACING_SECONDS = float(os.getenv("TOKEN_REFRESH_SPACING_SECONDS", "0.5"))
+# البريد الذي لم يُفتح خلال هذه المدة يخرج من الكاش ولا يُجدَّد توكنه في الخلفية.
+TOKEN_CACHE_IDLE_SECONDS = int(os.getenv("TOKEN_CACHE_IDLE_SECONDS", "21600"))
+# address -> {"token", "exp", "password", "owner", "used_at"}
+TOKEN_CACHE = {}
+# address -> Future؛ كل من يطلب تجديد نفس البريد أثناء التجديد ينتظر نفس النتيجة.
+TOKEN_REFRESHES = {}
+TOKEN_STATS = {"hits": 0, "refreshes": 0, "proactive": 0, "failures": 0}
+
+
+def decode_token_payload(token) -> dict:
+    """محتوى JWT الخاص بـ mail.tm دون التحقق من التوقيع؛ قاموس فارغ إن تعذر."""
+    try:
+        payload = str(token).split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        data = json.loads(base64.urlsafe_b64decode(payload))
+        return data if isinstance(data, dict) else {}
+    except (IndexError, ValueError, TypeError):
+        return {}
+
+
+def decode_token_expiry(token):
+    """قراءة exp من JWT الخاص بـ mail.tm؛ None إن تعذر."""
+    try:
+        exp = decode_token_payload(token).get("exp")
+        return float(exp) if exp else None
+    except (ValueError, TypeError):
+        return None
+
+
+def _token_expiring(entry, margin=TOKEN_REFRESH_MARGIN_SECONDS) -> bool:
+    exp = entry.get("exp")
+    return exp is not None and exp - time.time() <= margin
+
+
+def remember_email_token(owner, email_data, token=None, touch: bool = True):
+    """تسجيل توكن البريد في الكاش مع تاريخ انتهائه المستخرج من JWT.
+
+    touch=False يحفظ التوكن دون اعتبار البريد مستخدماً الآن (تجديد في الخلفية أو اتصال Mercure).
+    """
+    address = str(email_data.get("address") or "").strip().lower()
+    token = token or email_data.get("token")
+    if not address or not token:
+        return None
+    entry = TOKEN_CACHE.get(address) or {}
+    entry.update({
+        "token": token,
+        "exp": decode_token_expiry(token),
+        "password": email_data.get("password") or entry.get("password"),
+        "owner": owner,
+        "used_at": time.monotonic() if touch else entry.get("used_at", 0.0),
+    })
+    TOKEN_CACHE[address] = entry
+    return entry
+
+
+async def refresh_cached_token(owner, email_data, priority: int = MAIL_PRIORITY_TOKEN):
+    """تجديد توكن بريد واحد مرة واحدة فقط مهما تزامن الطلب عليه، ثم حفظه."""
+    address = str(email_data.get("address") or "").strip().lower()
+    pending = TOKEN_REFRESHES.get(address)
+    if pending is not None:
+        return await asyncio.shield(pending)
+
+    future = asyncio.get_running_loop().create_future()
+    TOKEN_REFRESHES[address] = future
+    try:
+        token = await refresh_email_token_data(dict(email_data), priority)
+        TOKEN_STATS["refreshes"] += 1
+        if token:
+            remember_email_token(owner, email_data, token, touch=False)
+            email_data["token"] = token
+            for item in (user_cache.get(str(owner)) or {}).get("emails", []):
+                if str(item.get("address") or "").lower() == address:
+                    item["token"] = token
+            if owner is not None and not await run_db(save_email_token, owner, email_data.get("address"), token):
+                print(f"⚠️ تم تجديد التوكن لكن تعذر حفظه للمستخدم {owner}")
+        else:
+            TOKEN_STATS["failures"] += 1
+        future.set_result(token)
+        return token
+    except Exception as error:
+        TOKEN_STATS["failures"] += 1
+        print(f"⚠️ refresh_cached_token: {type(error).__name__}: {error}")
+        future.set_result(None)
+        return None
+    finally:
+        # إلغاء المُجدِّد (CancelledError) لا يمر بـ except، فلا يبقى المنتظرون معلقين.
+        if not future.done():
+            future.set_result(None)
+        TOKEN_REFRESHES.pop(address, None)
+
+
+async def get_email_token(owner, email_data, touch: bool = True):
+    """توكن صالح للبريد؛ يُجدَّد قبل انتهائه بدل انتظار رد HTTP 401.
+
+    فتح العضو فقط يحدّث used_at (touch)؛ الاستخدام الآلي لا يُبقي البريد في الكاش أو في Mercure.
+    """
+    address = str(email_data.get("address") or "").strip().lower()
+    entry = TOKEN_CACHE.get(address)
+    stored_token = email_data.get("token")
+    if entry is None or (
+        stored_token
+        and stored_token != entry.get("token")
+        and (decode_token_expiry(stored_token) or 0) > (entry.get("exp") or 0)
+    ):
+        entry = remember_email_token(owner, email_data, touch=touch)
+    if entry is None:
+        return stored_token
+
+    if touch:
+        entry["used_at"] = time.monotonic()
+    if not _token_expiring(entry):
+        TOKEN_STATS["hits"] += 1
+        return entry["token"]
+    return await refresh_cached_token(owner, email_data) or entry["token"]
+
+
+async def refresh_expiring_tokens() -> int:
+    """دورة تجديد استباقي لتوكنات البريد المستخدمة مؤخراً والقريبة من الانتهاء."""
+    now = time.monotonic()
+    for address, entry in list(TOKEN_CACHE.items()):
+        if now - entry.get("used_at", 0) > TOKEN_CACHE_IDLE_SECONDS:
+            TOKEN_CACHE.pop(address, None)
+
+    horizon = TOKEN_REFRESH_MARGIN_SECONDS + TOKEN_REFRESH_INTERVAL_SECONDS
+    expiring = sorted(
+        (
+            (entry["exp"], address, entry)
+            for address, entry in TOKEN_CACHE.items()
+            if address not in TOKEN_REFRESHES and _token_expiring(entry, horizon)
+        ),
+        key=lambda item: item[0],
+    )[:TOKEN_REFRESH_BATCH]
+
+    refreshed = 0
+    for index, (_exp, address, entry) in enumerate(expiring):
+        if index:
+            await asyncio.sleep(TOKEN_REFRESH_SPACING_SECONDS)
+        email_data = {"address": address, "password": entry.get("password"), "token": entry.get("token")}
+        if await refresh_cached_token(entry.get("owner"), email_data, MAIL_PRIORITY_BACKGROUND):
+            refreshed += 1
+    TOKEN_STATS["proactive"] += refreshed
+    return refreshed
+
+
+async def token_refresh_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        await refresh_expiring_tokens()
+    except Exception as error:
+        print(f"⚠️ token_refresh_job: {type(error).__name__}: {error}")
+
+
+async def refresh_user_email_token(user_id: int, email_index: int):
+    """تجديد توكن بريد المستخدم فوراً (بعد رد HTTP 401) وحفظه في PostgreSQL."""
+    emails = await get_user_emails_async(user_id)
+    if email_index < 0 or email_index >= len(emails):
+        return None
+    return await refresh_cached_token(user_id, emails[email_index])
+
+
+INBOX_LIST_CACHE_TTL_SECONDS = int(os.getenv("INBOX_LIST_CACHE_TTL_SECONDS", "30"))
+INBOX_LIST_CACHE_MAX_ENTRIES = int(os.getenv("INBOX_LIST_CACHE_MAX_ENTRIES", "5000"))
+# address -> (messages, fetched_at)؛ آخر قائمة رسائل عُرضت لكل بريد، والأقدم استخداماً يخرج أولاً.
+INBOX_LIST_CACHE = OrderedDict()
+INBOX_LIST_STATS = {"hits": 0, "misses": 0}
+
+
+def cache_inbox_listing(address: str, messages) -> None:
+    address = str(address or "").strip().lower()
+    if not address or messages is None:
+        return
+    INBOX_LIST_CACHE[address] = (list(messages), time.monotonic())
+    INBOX_LIST_CACHE.move_to_end(address)
+    while len(INBOX_LIST_CACHE) > INBOX_LIST_CACHE_MAX_ENTRIES:
+        INBOX_LIST_CACHE.popitem(last=False)
+
+
+def get_cached_inbox_listing(address: str, max_age: float = INBOX_LIST_CACHE_TTL_SECONDS):
+    """قائمة الرسائل المحفوظة إن كان عمرها أقل من max_age، أو None."""
+    entry = INBOX_LIST_CACHE.get(str(address or "").strip().lower())
+    if entry is None or time.monotonic() - entry[1] >= max_age:
+        INBOX_LIST_STATS["misses"] += 1
+        return None
+    INBOX_LIST_STATS["hits"] += 1
+    return list(entry[0])
+
+
+def inbox_message_ref(message):
+    """معرّف الرسالة الثابت لاستخدامه في callback_data بدل ترتيبها في القائمة، أو None إن لم يصلح."""
+    message_id = str((message or {}).get("id") or "")
+    if message_id.isascii() and message_id.isalnum() and len(message_id) <= 32:
+        return message_id
+    return None
+
+
+async def check_user_inbox_detailed(
+    user_id: int, email_index: int, max_age: float = 0, priority: int = MAIL_PRIORITY_INTERACTIVE
+):
+    """فحص الصندوق بتوكن صالح من الكاش، مع تجديد احتياطي مرة واحدة عند HTTP 401.
+
+    مع max_age تُستخدم قائمة الرسائل المحفوظة الأحدث منه دون طلب جديد إلى mail.tm.
+    """
+    emails = await get_user_emails_async(user_id)
+    if email_index < 0 or email_index >= len(emails):
+        return {"messages": None, "error": "email_missing", "status": None}
+
+    email_data = emails[email_index]
+    if max_age > 0:
+        cached = get_cached_inbox_listing(email_data.get("address"), max_age)
+        if cached is not None:
+            return {"messages": cached, "error": None, "status": 200, "cached": True}
+
+    if priority == MAIL_PRIORITY_INTERACTIVE:
+        # فتح العضو نفسه فقط؛ فحوص المراقبة في الخلفية لا تُعد فتحاً.
+        touch_user_email(user_id, email_data.get("address"))
+    token = await get_email_token(user_id, email_data, touch=priority == MAIL_PRIORITY_INTERACTIVE)
+    result = await check_inbox_detailed(token, priority)
+    if result.get("error") == "token_invalid":
+        new_token = await refresh_user_email_token(user_id, email_index)
+        if not new_token:
+            return result
+        result = await check_inbox_detailed(new_token, priority)
+        result["token_refreshed"] = result.get("error") is None
+
+    if result.get("error") is None:
+        cache_inbox_listing(email_data.get("address"), result.get("messages"))
+    return result
+
+
+MESSAGE_CACHE_MAX_BYTES = int(os.getenv("MESSAGE_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+MESSAGE_CACHE_MAX_ENTRY_BYTES = int(os.getenv("MESSAGE_CACHE_MAX_ENTRY_BYTES", str(1024 * 1024)))
+# مجلد اختياري تنتقل إليه الرسائل الخارجة من الذاكرة؛ فارغ = بدون طبقة القرص.
+MESSAGE_CACHE_SPILL_DIR = os.getenv("MESSAGE_CACHE_SPILL_DIR", "").strip()
+MESSAGE_CACHE_SPILL_MAX_BYTES = int(os.getenv("MESSAGE_CACHE_SPILL_MAX_BYTES", str(256 * 1024 * 1024)))
+
+
+class MessageBodyCache:
+    """كاش LRU محدود بالبايت لرسائل mail.tm الكاملة، مفتاحه (البريد، معرّف الرسالة).
+
+    رسائل mail.tm لا تتغير بعد وصولها، لذلك لا مدة صلاحية؛ ويُحفظ معها النص المستخرج وكود OTP
+    حتى لا يُعاد التحليل عند كل عرض. يُستخدم من حلقة الأحداث فقط، وعمليات القرص في خيط منفصل.
+    """
+
+    def __init__(self, max_bytes: int, max_entry_bytes: int, spill_dir: str = "", spill_max_bytes: int = 0):
+        self.max_bytes = max(0, max_bytes)
+        self.max_entry_bytes = max(0, min(max_entry_bytes, self.max_bytes))
+        self.spill_dir = spill_dir if spill_dir and spill_max_bytes > 0 else ""
+        self.spill_max_bytes = spill_max_bytes
+        self.bytes = 0
+        self.spill_bytes = 0
+        self._entries = OrderedDict()
+        self._spilled = OrderedDict()
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0, "spilled": 0}
+        if self.spill_dir:
+            try:
+                os.makedirs(self.spill_dir, exist_ok=True)
+                # ملفات تشغيل سابق لا يعرفها الفهرس الحالي، فتُحذف بدل أن تتراكم.
+                for name in os.listdir(self.spill_dir):
+                    if name.endswith(".json"):
+                        os.remove(os.path.join(self.spill_dir, name))
+            except OSError as error:
+                print(f"⚠️ تعذر تجهيز مجلد كاش الرسائل {self.spill_dir}: {error}")
+                self.spill_dir = ""
+
+    @staticmethod
+    def key(address: str, message_id: str) -> tuple:
+        return str(address or "").strip().lower(), str(message_id)
+
+    @staticmethod
+    def entry_size(entry) -> int:
+        message = entry["message"]
+        parts = [normalize_text_value(message.get(name)) for name in ("html", "text", "intro")]
+        parts.append(entry["text"])
+        return sum(len(part.encode("utf-8", "ignore")) for part in parts) + 512
+
+    def _spill_path(self, key) -> str:
+        name = hashlib.sha256("\0".join(key).encode()).hexdigest()
+        return os.path.join(self.spill_dir, f"{name}.json")
+
+    @staticmethod
+    def _write_file(path: str, entry) -> int:
+        data = json.dumps(entry, ensure_ascii=False).encode()
+        with open(path, "wb") as handle:
+            handle.write(data)
+        return len(data)
+
+    @staticmethod
+    def _read_file(path: str):
+        with open(path, "rb") as handle:
+            return json.loads(handle.read())
+
+    @staticmethod
+    def _remove_files(paths) -> None:
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _store(self, key, entry, size: int) -> list:
+        """حفظ في الذاكرة؛ يرجع العناصر التي خرجت لتُنقل إلى القرص."""
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.bytes -= old[1]
+        self._entries[key] = (entry, size)
+        self.bytes += size
+        evicted = []
+        while self.bytes > self.max_bytes and self._entries:
+            evicted_key, (evicted_entry, evicted_size) = self._entries.popitem(last=False)
+            self.bytes -= evicted_size
+            self.stats["evictions"] += 1
+            evicted.append((evicted_key, evicted_entry))
+        return evicted
+
+    async def _spill(self, evicted) -> None:
+        if not self.spill_dir:
+            return
+        for key, entry in evicted:
+            path = self._spill_path(key)
+            try:
+                written = await asyncio.to_thread(self._write_file, path, entry)
+            except (OSError, TypeError, ValueError) as error:
+                print(f"⚠️ تعذر نقل رسالة إلى كاش القرص: {error}")
+                continue
+            previous = self._spilled.pop(key, None)
+            self.spill_bytes += written - (previous or 0)
+            self._spilled[key] = written
+            self.stats["spilled"] += 1
+        removed = []
+        while self.spill_bytes > self.spill_max_bytes and self._spilled:
+            old_key, old_size = self._spilled.popitem(last=False)
+            self.spill_bytes -= old_size
+            removed.append(self._spill_path(old_key))
+        if removed:
+            await asyncio.to_thread(self._remove_files, removed)
+
+    async def get(self, address: str, message_id: str):
+        """العنصر المحفوظ {"message", "text", "otp"} من الذاكرة ثم القرص، أو None."""
+        key = self.key(address, message_id)
+        cached = self._entries.get(key)
+        if cached is not None:
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return cached[0]
+
+        if key in self._spilled:
+            path = self._spill_path(key)
+            size = self._spilled.pop(key)
+            self.spill_bytes -= size
+            try:
+                entry = await asyncio.to_thread(self._read_file, path)
+                await asyncio.to_thread(self._remove_files, [path])
+            except (OSError, ValueError) as error:
+                print(f"⚠️ تعذر قراءة رسالة من كاش القرص: {error}")
+                entry = None
+            if entry is not None:
+                self.stats["disk_hits"] += 1
+                await self._spill(self._store(key, entry, self.entry_size(entry)))
+                return entry
+
+        self.stats["misses"] += 1
+        return None
+
+    async def put(self, address: str, message_id: str, message: dict):
+        """تجهيز العنصر (النص وOTP) وحفظه إن لم يتجاوز الحد لكل رسالة؛ يرجع العنصر دائماً."""
+        text = get_message_text(message)
+        entry = {"message": message, "text": text, "otp": extract_otp(text)}
+        size = self.entry_size(entry)
+        if 0 < size <= self.max_entry_bytes:
+            await self._spill(self._store(self.key(address, message_id), entry, size))
+        return entry
+
+    def get_stats(self) -> dict:
+        stats = dict(self.stats)
+        stats.update({
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "spilled_entries": len(self._spilled),
+            "spill_bytes": self.spill_bytes,
+        })
+        lookups = stats["hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["hits"] + stats["disk_hits"]) * 100 / lookups) if lookups else 0
+        return stats
+
+
+MESSAGE_CACHE = MessageBodyCache(
+    MESSAGE_CACHE_MAX_BYTES,
+    MESSAGE_CACHE_MAX_ENTRY_BYTES,
+    MESSAGE_CACHE_SPILL_DIR,
+    MESSAGE_CACHE_SPILL_MAX_BYTES,
+)
+
+
+async def get_user_message_content(user_id: int, email_index: int, message_id: str):
+    """رسالة كاملة كعنصر {"message", "text", "otp"}: من الكاش إن وُجدت، وإلا من mail.tm
+    مع تجديد التوكن تلقائياً إذا انتهى أثناء الفتح."""
+    emails = await get_user_emails_async(user_id)
+    if email_index < 0 or email_index >= len(emails):
+        return None
+
+    address = emails[email_index].get("address")
+    cached = await MESSAGE_CACHE.get(address, message_id)
+    if cached is not None:
+        return cached
+
+    token = await get_email_token(user_id, emails[email_index])
+    for attempt in range(2):
+        headers = {"Authorization": f"Bearer {token}"}
+        response = await mail_request("GET", f"/messages/{message_id}", headers=headers)
+        if response is not None and response.status_code == 200:
+            try:
+                message = response.json()
+            except ValueError as error:
+                print(f"⚠️ رد محتوى الرسالة غير صالح: {error}")
+                return None
+            if not isinstance(message, dict):
+                return None
+            return await MESSAGE_CACHE.put(address, message_id, message)
+
+        if attempt == 0 and response is not None and response.status_code == 401:
+            token = await refresh_user_email_token(user_id, email_index)
+            if token:
+                continue
+        return None
+    return None
+
+
+async def check_inbox_detailed(token, priority: int = MAIL_PRIORITY_INTERACTIVE):
+    """فحص الصندوق مع سبب واضح للفشل دون كشف التوكن."""
+    headers = {"Authorization": f"Bearer {token}"}
+    response, request_error = await mail_request(
+        "GET",
+        "/messages",
+        headers=headers,
+        return_error=True,
+        priority=priority,
+    )
+
+    if response is None:
+        return {"messages": None, "error": request_error or "network", "status": None}
+
+    status = response.status_code
+    if status == 200:
+        try:
+            payload = response.json()
+            messages = payload.get("hydra:member", [])
+            if not isinstance(messages, list):
+                raise ValueError("hydra:member ليس قائمة")
+            return {"messages": messages, "error": None, "status": 200}
+        except (ValueError, AttributeError) as error:
+            print(f"⚠️ رد صندوق الوارد غير صالح: {error}")
+            return {"messages": None, "error": "invalid_response", "status": 200}
+
+    if status == 401:
+        print("⚠️ توكن البريد غير صالح أو منتهي")
+        error_code = "token_invalid"
+    elif status == 429:
+        print("⚠️ ضغط مؤقت على خدمة البريد: HTTP 429")
+        error_code = "rate_limited"
+    elif status in (500, 502, 503, 504):
+        print(f"⚠️ خدمة البريد غير متاحة مؤقتاً: HTTP {status}")
+        error_code = "service_unavailable"
+    else:
+        print(f"⚠️ فشل فحص الصندوق: HTTP {status}")
+        error_code = "http_error"
+
+    return {"messages": None, "error": error_code, "status": status}
+
+
+async def check_inbox(token):
+    """واجهة متوافقة مع منطق عرض تفاصيل الرسالة القديم."""
+    result = await check_inbox_detailed(token)
+    return result["messages"] if result.get("error") is None else None
+
+
+def build_inbox_error_view(error_code, email_index: int, status=None):
+    """رسالة وأزرار مناسبة لسبب فشل تحميل صندوق الوارد."""
+    if error_code == "token_invalid":
+        text = (
+            "⚠️ تعذر تجديد جلسة هذا البريد تلقائياً.\n\n"
+            "قد تكون بيانات البريد قديمة أو لم يعد البريد متاحاً حالياً."
+        )
+        rows = [
+            [InlineKeyboardButton(
+                "🗑️ حذف هذا البريد",
+                callback_data=f"confirm_delete_{email_index}",
+                style="danger",
+            )],
+            [InlineKeyboardButton(
+                "✨ إنشاء بريد جديد",
+                callback_data="create_email",
+                style="success",
+            )],
+            [InlineKeyboardButton(
+                get_text("ar", "btn_back"),
+                callback_data="select_inbox",
+                style="primary",
+            )],
+        ]
+        return text, InlineKeyboardMarkup(rows)
+
+    if error_code == "rate_limited":
+        text = (
+            "⏳ يوجد ضغط مؤقت على خدمة البريد.\n\n"
+            "انتظر قليلاً ثم اضغط تحديث للمحاولة من جديد."
+        )
+    elif error_code == "service_unavailable":
+        text = (
+            "🛠️ خدمة البريد متوقفة أو تواجه مشكلة مؤقتة.\n\n"
+            "حاول التحديث بعد قليل."
+        )
+    elif error_code == "timeout":
+        text = (
+            "⏱️ انتهت مهلة الاتصال بخدمة البريد.\n\n"
+            "هذه مشكلة مؤقتة، حاول التحديث لاحقاً."
+        )
+    elif error_code in ("connection", "network"):
+        text = (
+            "🌐 تعذر الاتصال بخدمة البريد مؤقتاً.\n\n"
+            "تحقق لاحقاً واضغط تحديث للمحاولة."
+        )
+    elif error_code == "invalid_response":
+        text = (
+            "⚠️ وصلت استجابة غير صالحة من خدمة البريد.\n\n"
+            "حاول التحديث بعد قليل."
+        )
+    elif error_code == "http_error" and status:
+        text = (
+            f"⚠️ تعذر تحميل الرسائل بسبب خطأ HTTP {status}.\n\n"
+            "حاول التحديث لاحقاً."
+        )
+    else:
+        text = get_text("ar", "error_load_messages")
+
+    rows = [
+        [InlineKeyboardButton(
+            get_text("ar", "btn_refresh"),
+            callback_data=f"inbox_{email_index}",
+            style="success",
+        )],
+        [InlineKeyboardButton(
+            get_text("ar", "btn_back"),
+            callback_data="select_inbox",
+            style="primary",
+        )],
+    ]
+    return text, InlineKeyboardMarkup(rows)
+
+
+async def get_message_content(message_id, token):
+    headers = {"Authorization": f"Bearer {token}"}
+    response = await mail_request("GET", f"/messages/{message_id}", headers=headers)
+    if response is None or response.status_code != 200:
+        return None
+    try:
+        return response.json()
+    except ValueError as error:
+        print(f"⚠️ رد محتوى الرسالة غير صالح: {error}")
+        return None
+
+
+def extract_otp(text):
+    if not text:
+        return None
+    match = re.search(r"\b(\d{4,8})\b", str(text))
+    return match.group(1) if match else None
+
+
+def normalize_text_value(value) -> str:
+    if isinstance(value, list):
+        return "\n".join(str(item) for item in value if item)
+    return str(value or "")
+
+
+def html_to_text(html_value) -> str:
+    """تحويل HTML إلى نص آمن للعرض داخل تلجرام."""
+    html_text = normalize_text_value(html_value)
+    if not html_text:
+        return ""
+
+    # فك الترميز أولاً حتى تُحذف الوسوم التي وصلت بصورة &lt;tag&gt;.
+    html_text = unescape(html_text)
+    html_text = re.sub(
+        r"<\s*(script|style)[^>]*>.*?<\s*/\s*\1\s*>",
+        " ",
+        html_text,
+        flags=re.IGNORECASE | re.DOTALL,
+    )
+    html_text = re.sub(r"<\s*br\s*/?>", "\n", html_text, flags=re.IGNORECASE)
+    html_text = re.sub(r"</\s*p\s*>", "\n", html_text, flags=re.IGNORECASE)
+    html_text = re.sub(r"<[^>]+>", " ", html_text)
+    html_text = re.sub(r"[\t\r ]+", " ", html_text)
+    html_text = re.sub(r"\n{3,}", "\n\n", html_text)
+    return html_text.strip()
+
+
+def get_message_text(full: dict) -> str:
+    """يرجع أفضل نص متاح من رسالة mail.tm."""
+    if not full:
+        return ""
+
+    text_value = normalize_text_value(full.get("text")).strip()
+    if text_value:
+        return text_value
+
+    intro = normalize_text_value(full.get("intro")).strip()
+    if intro:
+        return intro
+
+    html_value = full.get("html")
+    return html_to_text(html_value) if html_value else ""
+
+# ================== بيانات المستخدمين ==================
+
+warm_db_pool()
+init_database()
+if migrate_user_emails() or not member_stats_ready():
+    rebuild_member_stats()
+forwarding_enabled = get_setting("forwarding_enabled", "0") == "1"
+# الأعضاء يُقرؤون من PostgreSQL عند الحاجة فقط، ويبقى في الذاكرة آخر USER_CACHE_MAX_ENTRIES منهم.
+member_search_index = MemberPrefixIndex()
+user_cache = UserCache(USER_CACHE_MAX_ENTRIES, USER_CACHE_TTL_SECONDS, index=member_search_index)
+
+
+def get_user_data(user_id):
+    uid = str(user_id)
+    data = user_cache.get(uid)
+    if data is None:
+        data, loaded = load_user(uid)
+        if data is None:
+            data = {"lang": "ar", "emails": []}
+            if not loaded:
+                # تعذر القراءة مؤقتاً: لا نحفظ نسخة فارغة قد تخفي إيميلات العضو.
+                return data
+            save_single_user(uid, data)
+        user_cache[uid] = data
+    data["lang"] = "ar"
+    return data
+
+
+def get_user_emails(user_id):
+    return get_user_data(user_id).get("emails", [])
+
+
+def get_user_language(_user_id):
+    return "ar"
+
+
+def update_user_info(user_id, user) -> bool:
+    """تحديث بيانات العضو؛ يرجع True إذا أُضيف العضو لأول مرة في هذا الاستدعاء."""
+    if user is None:
+        return False
+    profile = {
+        "lang": "ar",
+        "first_name": user.first_name or "",
+        "last_name": user.last_name or "",
+        "username": user.username or "",
+    }
+    is_new = upsert_user_profile(user_id, profile)
+    data = user_cache.get(str(user_id))
+    if data is not None:
+        # نسخة جديدة عبر __setitem__ حتى يُعاد فهرسة الاسم واليوزر في member_search_index.
+        user_cache[str(user_id)] = {**data, **profile}
+    elif is_new:
+        user_cache[str(user_id)] = {**profile, "emails": []}
+    return bool(is_new)
+
+
+def set_user_language(user_id, _lang="ar", user=None):
+    """للتوافق مع البيانات القديمة؛ اللغة ثابتة دائماً على العربية."""
+    data = {**get_user_data(user_id), "lang": "ar"}
+    if user:
+        data["first_name"] = user.first_name or ""
+        data["last_name"] = user.last_name or ""
+        data["username"] = user.username or ""
+    user_cache[str(user_id)] = data
+    save_single_user(str(user_id), data)
+
+
+def add_user_email(user_id, email, token, password=None):
+    data = get_user_data(user_id)
+    email_record = {"address": email, "token": token}
+    if password:
+        email_record["password"] = password
+    data.setdefault("emails", []).append(email_record)
+    user_cache[str(user_id)] = data
+    insert_user_email(user_id, email, token, password)
+
+
+def remove_user_email(user_id, email):
+    data = get_user_data(user_id)
+    data["emails"] = [item for item in data.get("emails", []) if item.get("address") != email]
+    user_cache[str(user_id)] = data
+    if delete_user_email(user_id, email):
+        delete_email_seen_records([email])
+
+async def notify_admin_new_user(context: ContextTypes.DEFAULT_TYPE, user) -> None:
+    """إشعار المشرف الرئيسي مرة واحدة عند دخول عضو جديد للبوت."""
+    if user is None or user.id == ADMIN_ID:
+        return
+
+    full_name = user.first_name or "غير معروف"
+    if user.last_name:
+        full_name += f" {user.last_name}"
+    username = f"@{user.username}" if user.username else "لا يوجد"
+    text = (
+        "🆕 <b>مستخدم جديد دخل البوت</b>\n\n"
+        f"👤 الاسم: {telegram_html(full_name)}\n"
+        f"🆔 اليوزر: {telegram_html(username)}\n"
+        f"🔢 ID: <code>{user.id}</code>"
+    )
+    try:
+        await context.bot.send_message(chat_id=ADMIN_ID, text=text, parse_mode="HTML")
+    except Exception as e:
+        print(f"⚠️ فشل إرسال إشعار دخول المستخدم {user.id}: {e}")
+
+
+async def register_user_activity(context: ContextTypes.DEFAULT_TYPE, user) -> bool:
+    """تحديث بيانات العضو وإرسال إشعار الدخول عند أول ظهور فقط."""
+    if user is None:
+        return False
+
+    is_new = await update_user_info_async(user.id, user)
+    if user.id == ADMIN_ID and user.username and not await get_admin_contact_username_async():
+        await set_setting_async("admin_contact_username", user.username)
+    if is_new:
+        increment_daily_stat("new_users")
+        await notify_admin_new_user(context, user)
+    return is_new
+
+
+async def notify_admin_subscription(
+    context: ContextTypes.DEFAULT_TYPE,
+    user_id: int,
+    channel_info,
+) -> None:
+    """إشعار المشرف مرة واحدة عند تحقق اشتراك العضو بالقناة الإجبارية."""
+    if user_id == ADMIN_ID or not channel_info:
+        return
+
+    channel_username = str(channel_info.get("channel_username") or "").lstrip("@")
+    channel_id = channel_info.get("channel_id")
+    channel_key = str(channel_id or channel_username).lower()
+    if not channel_key or await subscription_notification_exists_async(user_id, channel_key):
+        return
+
+    info = await get_user_data_async(user_id)
+    full_name = info.get("first_name") or "غير معروف"
+    if info.get("last_name"):
+        full_name += f" {info['last_name']}"
+    username = f"@{info.get('username')}" if info.get("username") else "لا يوجد"
+    text = (
+        "✅ <b>عضو اشترك بالقناة الإجبارية</b>\n\n"
+        f"👤 الاسم: {telegram_html(full_name)}\n"
+        f"🆔 اليوزر: {telegram_html(username)}\n"
+        f"🔢 ID: <code>{user_id}</code>\n"
+        f"📢 القناة: @{telegram_html(channel_username)}"
+    )
+    try:
+        await context.bot.send_message(chat_id=ADMIN_ID, text=text, parse_mode="HTML")
+        await mark_subscription_notified_async(user_id, channel_key)
+    except Exception as e:
+        print(f"⚠️ فشل إرسال إشعار اشتراك المستخدم {user_id}: {e}")
+
+
+# ================== إشعارات البريد الفورية (Mercure) ==================
+# لا يُفحص كل بريد دورياً حتى لا يفرض mail.tm حد HTTP 429. بدلاً من ذلك يستمع البوت لمركز
+# Mercure الخاص بـ mail.tm لعناوين البريد المستخدمة مؤخراً فقط، ويرسل الرسالة الجديدة لصاحبها.
+
+# فارغ = تعطيل الإشعارات الفورية والاكتفاء بفتح الصندوق يدوياً.
+MERCURE_URL = os.getenv("MERCURE_URL", "https://mercure.mail.tm/.well-known/mercure").strip()
+MERCURE_MAX_STREAMS = int(os.getenv("MERCURE_MAX_STREAMS", "50"))
+MERCURE_SYNC_SECONDS = int(os.getenv("MERCURE_SYNC_SECONDS", "15"))
+# بدون أي حدث أو نبضة خلال هذه المدة يُعاد فتح الاتصال.
+MERCURE_READ_TIMEOUT_SECONDS = int(os.getenv("MERCURE_READ_TIMEOUT_SECONDS", "300"))
+
+
+def mercure_topic(token):
+    """موضوع حساب mail.tm في Mercure من JWT نفسه؛ كل توكن يخوّل الاشتراك بموضوع حسابه فقط."""
+    payload = decode_token_payload(token)
+    topics = (payload.get("mercure") or {}).get("subscribe") or []
+    if topics:
+        return str(topics[0])
+    account_id = payload.get("id")
+    return f"/accounts/{account_id}" if account_id else None
+
+
+def message_id_newer(message_id: str, last_seen: str) -> bool:
+    """معرّفات mail.tm (ObjectId) تبدأ بزمن الإنشاء، فترتيبها النصي يطابق ترتيب الوصول."""
+    if not last_seen:
+        return True
+    if len(message_id) == len(last_seen):
+        return message_id.lower() > last_seen.lower()
+    return message_id != last_seen
+
+
+def parse_sse_lines(lines):
+    """تجميع أسطر text/event-stream إلى أحداث (id، data)؛ يُستدعى بالأسطر حتى السطر الفارغ."""
+    event_id, data = None, []
+    for line in lines:
+        if not line or line.startswith(":"):
+            continue
+        field, _, value = line.partition(":")
+        if value.startswith(" "):
+            value = value[1:]
+        if field == "id":
+            event_id = value
+        elif field == "data":
+            data.append(value)
+    return event_id, "\n".join(data)
+
+
+class MercurePushManager:
+    """اتصال SSE طويل لكل بريد مستخدم مؤخراً (حتى max_streams)، عبر عميل HTTP مشترك.
+
+    الاتصالات تُعاد مع Last-Event-ID، والتكرار يُمنع عبر جدول email_seen. يُستخدم من حلقة الأحداث فقط.
+    """
+
+    def __init__(self, hub_url: str, max_streams: int, read_timeout: int):
+        self.hub_url = hub_url
+        self.max_streams = max(0, max_streams)
+        self.read_timeout = read_timeout
+        self._client = None
+        self._bot = None
+        self._streams = {}
+        self.stats = {"events": 0, "delivered": 0, "duplicates": 0, "reconnects": 0, "failures": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.hub_url) and self.max_streams > 0
+
+    def _http(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(10.0, read=self.read_timeout),
+                limits=httpx.Limits(max_connections=self.max_streams, max_keepalive_connections=0),
+                headers={"User-Agent": "TelegramTempMailBot/3.1", "Accept": "text/event-stream"},
+            )
+        return self._client
+
+    def desired_addresses(self) -> dict:
+        """address -> owner لأحدث البرائد استخداماً في كاش التوكنات."""
+        entries = sorted(
+            (
+                (entry.get("used_at", 0), address, entry.get("owner"))
+                for address, entry in TOKEN_CACHE.items()
+                if entry.get("owner") is not None
+            ),
+            reverse=True,
+        )[:self.max_streams]
+        return {address: owner for _used_at, address, owner in entries}
+
+    async def sync(self, bot) -> None:
+        """فتح اتصالات البرائد الجديدة وإغلاق ما لم يعد مستخدماً."""
+        if not self.enabled:
+            return
+        self._bot = bot
+        desired = self.desired_addresses()
+        for address in [address for address in self._streams if address not in desired]:
+            self.stop(address)
+        for address, owner in desired.items():
+            stream = self._streams.get(address)
+            if stream is not None and (stream.get("unsupported") or not stream["task"].done()):
+                stream["owner"] = owner
+                continue
+            stream = {"owner": owner, "last_event_id": (stream or {}).get("last_event_id"), "connected": False}
+            stream["task"] = asyncio.create_task(self._run_stream(address, stream))
+            self._streams[address] = stream
+
+    def is_connected(self, address: str) -> bool:
+        stream = self._streams.get(str(address or "").lower())
+        return stream is not None and stream["connected"]
+
+    def stop(self, address: str) -> None:
+        stream = self._streams.pop(address, None)
+        if stream is not None:
+            stream["task"].cancel()
+
+    async def _run_stream(self, address: str, stream: dict) -> None:
+        failures = 0
+        while True:
+            entry = TOKEN_CACHE.get(address)
+            if entry is None:
+                return
+            email_data = {"address": address, "password": entry.get("password"), "token": entry.get("token")}
+            token = await get_email_token(stream["owner"], email_data, touch=False)
+            topic = mercure_topic(token)
+            if not topic:
+                stream["unsupported"] = True
+                return
+
+            headers = {"Authorization": f"Bearer {token}"}
+            if stream["last_event_id"]:
+                headers["Last-Event-ID"] = stream["last_event_id"]
+            try:
+                async with self._http().stream("GET", self.hub_url, params={"topic": topic}, headers=headers) as response:
+                    if response.status_code == 401:
+                        await refresh_cached_token(stream["owner"], email_data)
+                        raise httpx.HTTPStatusError("HTTP 401", request=response.request, response=response)
+                    if response.status_code != 200:
+                        raise httpx.HTTPStatusError(
+                            f"HTTP {response.status_code}", request=response.request, response=response
+                        )
+                    stream["connected"] = True
+                    failures = 0
+                    lines = []
+                    async for line in response.aiter_lines():
+                        if line:
+                            lines.append(line)
+                            continue
+                        event_id, data = parse_sse_lines(lines)
+                        lines = []
+                        if event_id:
+                            stream["last_event_id"] = event_id
+                        if data:
+                            await self._handle_event(address, stream["owner"], data)
+            except asyncio.CancelledError:
+                raise
+            except httpx.HTTPError as error:
+                failures += 1
+                self.stats["failures"] += 1
+                if failures == 1 or failures % 10 == 0:
+                    print(f"⚠️ Mercure {address}: {type(error).__name__}: {error}")
+            finally:
+                stream["connected"] = False
+
+            self.stats["reconnects"] += 1
+            await asyncio.sleep(MailTmClient._backoff_seconds(min(failures, 6)))
+
+    async def _handle_event(self, address: str, owner: int, data: str) -> None:
+        try:
+            payload = json.loads(data)
+        except ValueError:
+            return
+        if not isinstance(payload, dict):
+            return
+        message_id = str(payload.get("id") or "")
+        if payload.get("@type") != "Message" and not str(payload.get("@id") or "").startswith("/messages/"):
+            return
+        if not message_id:
+            return
+
+        self.stats["events"] += 1
+        if not message_id_newer(message_id, await get_last_seen_message_id_async(address)):
+            self.stats["duplicates"] += 1
+            return
+        await set_last_seen_message_id_async(address, message_id)
+        INBOX_LIST_CACHE.pop(address, None)
+        if await deliver_new_mail_notification(self._bot, owner, address, payload):
+            self.stats["delivered"] += 1
+
+    async def close(self) -> None:
+        tasks = [stream["task"] for stream in self._streams.values()]
+        self._streams.clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
+
+    def get_stats(self) -> dict:
+        stats = dict(self.stats)
+        stats["streams"] = len(self._streams)
+        stats["connected"] = sum(1 for stream in self._streams.values() if stream["connected"])
+        stats["max_streams"] = self.max_streams
+        return stats
+
+
+MERCURE_PUSH = MercurePushManager(MERCURE_URL, MERCURE_MAX_STREAMS, MERCURE_READ_TIMEOUT_SECONDS)
+
+
+async def deliver_new_mail_notification(bot, owner: int, address: str, message: dict) -> bool:
+    """إرسال إشعار رسالة جديدة (مع OTP إن وُجد في الموضوع أو المقدمة) لصاحب البريد."""
+    if bot is None:
+        return False
+    emails = await get_user_emails_async(owner)
+    email_index = next(
+        (index for index, item in enumerate(emails) if str(item.get("address") or "").lower() == address),
+        None,
+    )
+    if email_index is None:
+        MERCURE_PUSH.stop(address)
+        return False
+
+    sender = (message.get("from") or {}).get("address") or "غير معروف"
+    subject = message.get("subject") or "بدون موضوع"
+    otp = extract_otp(f"{subject}\n{message.get('intro') or ''}")
+    text = get_text(
+        "ar", "new_mail_push",
+        email=telegram_html(emails[email_index]["address"]),
+        sender=telegram_html(sender),
+        subject=telegram_html(subject),
+    )
+    if otp:
+        text = get_text("ar", "otp_found", otp=telegram_html(otp)) + "\n\n" + text
+
+    message_ref = inbox_message_ref(message)
+    rows = []
+    if message_ref:
+        rows.append([InlineKeyboardButton(
+            "✉️ فتح الرسالة", callback_data=f"msgid_{email_index}_{message_ref}", style="primary"
+        )])
+    rows.append([InlineKeyboardButton(
+        get_text("ar", "btn_inbox"), callback_data=f"inbox_{email_index}", style="success"
+    )])
+    try:
+        await bot.send_message(chat_id=owner, text=text, parse_mode="HTML", reply_markup=InlineKeyboardMarkup(rows))
+        return True
+    except Forbidden:
+        MERCURE_PUSH.stop(address)
+    except TelegramError as error:
+        print(f"⚠️ فشل إرسال إشعار البريد للمستخدم {owner}: {error}")
+    return False
+
+# ================== النصوص العربية ==================
+
+TEXT_OVERRIDE_PREFIX = "text:"
+
+TEXTS = {
+    "welcome": "🎉 مرحباً بك في بوت الإيميلات المؤقتة!",
+    "main_menu": "📬 القائمة الرئيسية\n\nعدد الإيميلات النشطة: {emails_count}",
+    "email_created": "✅ تم إنشاء بريد إلكتروني جديد!\n\n📧 الإيميل: <code>{email}</code>\n\nاضغط على الإيميل للنسخ",
+    "no_emails": "❌ لا توجد إيميلات نشطة\n\nقم بإنشاء إيميل جديد أولاً",
+    "select_email": "📋 اختر الإيميل:\n\nعدد الإيميلات: {count}",
+    "no_messages": "📭 لا توجد رسائل\n\n📧 {email}",
+    "messages_list": "📬 الرسائل الواردة ({count})\n📧 الإيميل: {email}\n\n",
+    "message_detail": "✉️ تفاصيل الرسالة\n\n📧 من: {sender}\n📌 الموضوع: {subject}\n📅 التاريخ: {date}\n\n📝 المحتوى:\n{content}\n",
+    "otp_found": "🔢 تم العثور على رمز OTP:\n\nالرمز: <code>{otp}</code>\n\nاضغط على الرمز للنسخ",
+    "watch_started": "👀 تتم مراقبة {email} لمدة {minutes} دقائق.\n\nسيصلك رمز التحقق هنا فور وصوله، ولا حاجة للضغط على تحديث.",
+    "watch_stopped": "⏹️ تم إيقاف مراقبة {email}.",
+    "watch_timeout": "⌛ انتهت مراقبة {email} دون وصول رمز تحقق.",
+    "watch_busy": "⏳ المراقبة مشغولة حالياً بعدد كبير من الصناديق.\n\nحاول بعد قليل أو حدّث الصندوق يدوياً.",
+    "new_mail_push": "📨 رسالة جديدة\n\n📧 الإيميل: {email}\n📧 من: {sender}\n📌 الموضوع: {subject}",
+    "email_deleted": "🗑️ تم حذف الإيميل\n\n📧 {email}",
+    "all_emails_deleted": "🗑️ تم حذف جميع الإيميلات ({count})",
+    "error_create_email": "❌ فشل إنشاء الإيميل\n\nحاول مرة أخرى.",
+    "error_load_messages": "❌ فشل تحميل الرسائل\n\nاضغط 🔄 تحديث للمحاولة.",
+    "error_load_message": "❌ فشل تحميل الرسالة\n\nحاول لاحقاً.",
+    "unauthorized": "⛔ هذا الأمر للمشرف فقط",
+    "banned": "⛔ تم حظرك من استخدام البوت.",
+    "btn_create": "✨ إنشاء إيميل جديد",
+    "btn_my_emails": "📧 إيميلاتي",
+    "btn_inbox": "📥 الرسائل الواردة",
+    "btn_delete_all": "🗑️ حذف الكل",
+    "btn_back": "🔙 رجوع",
+    "btn_delete": "🗑️ حذف",
+    "btn_confirm": "✅ تأكيد",
+    "btn_cancel": "❌ إلغاء",
+    "btn_refresh": "🔄 تحديث",
+    "btn_admin_panel": "👑 لوحة المشرف",
+}
+
+
+def _compile_text(template: str) -> tuple:
+    has_fields = any(field is not None for _, field, _, _ in string.Formatter().parse(template))
+    return template, (template.format if has_fields else None)
+
+
+def compile_text_catalog(overrides: dict = None) -> dict:
+    """تجهيز النصوص مرة واحدة: النص الثابت يُرجع كما هو، وذو المتغيرات يحتفظ بدالة format الجاهزة."""
+    catalog = {key: _compile_text(template) for key, template in TEXTS.items()}
+    for key, template in (overrides or {}).items():
+        try:
+            catalog[key] = _compile_text(str(template))
+        except ValueError as error:
+            print(f"⚠️ تجاهل نص مخصص غير صالح للمفتاح {key}: {error}")
+    return catalog
+
+
+def reload_text_catalog() -> int:
+    """إعادة بناء النصوص مع أي تخصيصات محفوظة في bot_settings بمفاتيح text:<key>."""
+    global TEXT_CATALOG
+    overrides = get_text_overrides(TEXT_OVERRIDE_PREFIX)
+    TEXT_CATALOG = compile_text_catalog(overrides)
+    invalidate_keyboards()
+    return len(overrides)
+
+
+TEXT_CATALOG = compile_text_catalog()
+reload_text_catalog()
+
+
+def get_text(_lang, key, **kwargs):
+    entry = TEXT_CATALOG.get(key)
+    if entry is None:
+        return ""
+    template, render = entry
+    return render(**kwargs) if kwargs and render is not None else template
+
+
+# ================== لوحات الأزرار ==================
+
+def get_main_menu_keyboard(_lang, user_id):
+    admin_user = is_admin(user_id)
+    return cached_keyboard(
+        "main_menu",
+        "admin" if admin_user else "user",
+        lambda: _build_main_menu_keyboard(admin_user),
+    )
+
+
+def _build_main_menu_keyboard(admin_user: bool):
+    keyboard = [
+        [InlineKeyboardButton(get_text("ar", "btn_create"), callback_data="create_email", style="success")],
+        [
+            InlineKeyboardButton(get_text("ar", "btn_my_emails"), callback_data="my_emails", style="primary"),
+            InlineKeyboardButton(get_text("ar", "btn_inbox"), callback_data="select_inbox", style="primary"),
+        ],
+        [InlineKeyboardButton("⚙️ إدارة إيميلاتك", callback_data="manage_emails", style="danger")],
+    ]
+    if admin_user:
+        keyboard.append([
+            InlineKeyboardButton(get_text("ar", "btn_admin_panel"), callback_data="admin_panel", style="primary")
+        ])
+    return InlineKeyboardMarkup(keyboard)
+
+
+def get_free_domains_keyboard(domains):
+    """عرض الدومينات المجانية النشطة التي تم جلبها مباشرة من mail.tm."""
+    rows = []
+    for index, domain in enumerate(domains):
+        display_domain = str(domain)
+        if len(display_domain) > 40:
+            display_domain = display_domain[:37] + "..."
+        rows.append([
+            InlineKeyboardButton(
+                f"@{display_domain}",
+                callback_data=f"free_domain_{index}",
+                style="primary",
+            )
+        ])
+
+    rows.append([
+        InlineKeyboardButton(
+            "🔄 تحديث الدومينات",
+            callback_data="refresh_free_domains",
+            style="success",
+        )
+    ])
+    rows.append([
+        InlineKeyboardButton(
+            get_text("ar", "btn_back"),
+            callback_data="create_email",
+            style="primary",
+        )
+    ])
+    return InlineKeyboardMarkup(rows)
+
+
+def get_paid_domains_keyboard():
+    """لوحة الدومينات المدفوعة للمستخدم، أو None إذا لم تُضف أي دومينات بعد."""
+    return cached_keyboard("paid_domains", "user", _build_paid_domains_keyboard, depends_on="paid_domains")
+
+
+def _build_paid_domains_keyboard():
+    domains = get_paid_domains()
+    if not domains:
+        return None
+    rows = [
+        [InlineKeyboardButton(f"@{domain}", callback_data=f"paid_domain_{index}", transparent=True)]
+        for index, domain in enumerate(domains)
+    ]
+    rows.append([
+        InlineKeyboardButton(
+            get_text("ar", "btn_back"),
+            callback_data="create_email",
+            style="primary",
+        )
+    ])
+    return InlineKeyboardMarkup(rows)
+
+
+def get_email_list_keyboard(emails, action_prefix, _lang):
+    keyboard = []
+    for index, email_info in enumerate(emails):
+        email = email_info["address"]
+        display_email = email if len(email) <= 30 else email[:27] + "..."
+        keyboard.append([
+            InlineKeyboardButton(
+                f"📧 {display_email}",
+                callback_data=f"{action_prefix}_{index}",
+                style="primary",
+            )
+        ])
+    keyboard.append([InlineKeyboardButton(get_text("ar", "btn_back"), callback_data="back_to_menu")])
+    return InlineKeyboardMarkup(keyboard)
+
+
+def get_watch_keyboard(email_index: int, watching: bool, back_callback: str = None):
+    """زر بدء/إيقاف مراقبة البريد، مع زر فتح الصندوق أو الرجوع."""
+    if watching:
+        watch_button = InlineKeyboardButton(
+            "⏹️ إيقاف المراقبة", callback_data=f"unwatch_inbox_{email_index}", style="danger"
+        )
+    else:
+        watch_button = InlineKeyboardButton(
+            f"👀 مراقبة {WATCH_INBOX_MINUTES} دقائق", callback_data=f"watch_inbox_{email_index}", style="primary"
+        )
+    return InlineKeyboardMarkup([
+        [watch_button],
+        [InlineKeyboardButton(
+            get_text("ar", "btn_back") if back_callback else get_text("ar", "btn_inbox"),
+            callback_data=back_callback or f"inbox_{email_index}",
+        )],
+    ])
+
+
+def get_messages_keyboard(messages, email_index, _lang, watching: bool = False):
+    keyboard = []
+    for index, message in enumerate(messages[:10]):
+        subject = message.get("subject") or "بدون موضوع"
+        display_subject = subject if len(subject) <= 30 else subject[:27] + "..."
+        message_ref = inbox_message_ref(message)
+        keyboard.append([
+            InlineKeyboardButton(
+                f"✉️ {display_subject}",
+                callback_data=f"msgid_{email_index}_{message_ref}" if message_ref else f"msg_{email_index}_{index}",
+                style="primary",
+            )
+        ])
+    keyboard.append([
+        InlineKeyboardButton(get_text("ar", "btn_refresh"), callback_data=f"inbox_{email_index}", style="success"),
+        InlineKeyboardButton(get_text("ar", "btn_back"), callback_data="select_inbox"),
     ])
+    keyboard.append(get_watch_keyboard(email_index, watching).inline_keyboard[0])
     return InlineKeyboardMarkup(keyboard)
 
 
-def paginate_member_items(items, requested_page: int):
-    total_items = len(items)
-    total_pages = max(1, (total_items + MEMBERS_PAGE_SIZE - 1) // MEMBERS_PAGE_SIZE)
-    page = min(max(0, int(requested_page)), total_pages - 1)
-    start = page * MEMBERS_PAGE_SIZE
-    return items[start:start + MEMBERS_PAGE_SIZE], page, total_pages
+def get_admin_section_keyboard(buttons, back_callback="admin_panel"):
+    rows = [buttons[index:index + 2] for index in range(0, len(buttons), 2)]
+    rows.append([
+        InlineKeyboardButton(
+            get_text("ar", "btn_back"),
+            callback_data=back_callback,
+            style="primary",
+        )
+    ])
+    return InlineKeyboardMarkup(rows)
+
+
+def get_admin_panel_keyboard(_lang, user_id):
+    owner = user_id == ADMIN_ID
+    return cached_keyboard("admin_panel", "owner" if owner else "admin", lambda: _build_admin_panel_keyboard(owner))
+
+
+def _build_admin_panel_keyboard(owner: bool):
+    keyboard = [
+        [
+            InlineKeyboardButton("📊 قسم الإحصائيات", callback_data="section_stats", style="primary"),
+            InlineKeyboardButton("📢 قسم الإذاعة", callback_data="section_broadcast", style="primary"),
+        ],
+        [
+            InlineKeyboardButton("📨 قسم توجيه الرسائل", callback_data="section_forward", style="primary"),
+            InlineKeyboardButton("📢 إدارة القنوات", callback_data="channel_management", style="primary"),
+        ],
+        [
+            InlineKeyboardButton("⚙️ الإعدادات", callback_data="section_settings", style="primary"),
+            InlineKeyboardButton("👥 إدارة الأعضاء", callback_data="section_members", style="primary"),
+        ],
+        [
+            InlineKeyboardButton("🔢 حد إنشاء الإيميلات", callback_data="section_email_limit", style="primary"),
+            InlineKeyboardButton("🌐 إدارة الدومينات المدفوعة", callback_data="section_paid_domains", style="primary"),
+        ],
+        [InlineKeyboardButton("🩺 حالة البوت والخدمات", callback_data="section_health", style="primary")],
+    ]
+
+    if owner:
+        keyboard.append([
+            InlineKeyboardButton("👮 إدارة المشرفين", callback_data="section_admins", style="primary"),
+            InlineKeyboardButton("🛑 الحظر / فك الحظر", callback_data="section_ban", style="danger"),
+        ])
+    else:
+        keyboard.append([
+            InlineKeyboardButton("🛑 الحظر / فك الحظر", callback_data="section_ban", style="danger")
+        ])
+
+    keyboard.extend([
+        [
+            InlineKeyboardButton("👋 رسالة الترحيب", callback_data="section_welcome", style="success"),
+            InlineKeyboardButton("ℹ️ معلومات البوت", callback_data="bot_info", style="primary"),
+        ],
+        [InlineKeyboardButton(get_text("ar", "btn_back"), callback_data="back_to_menu", style="primary")],
+    ])
+    return InlineKeyboardMarkup(keyboard)
 
 
-def get_member_pages_keyboard(prefix: str, page: int, total_pages: int):
+def get_member_pages_keyboard(prefix: str, page: int, first_cursor, last_cursor, has_next: bool):
+    """أزرار التنقل تحمل مؤشر أول/آخر عضو في الصفحة (أقل من 64 بايت لـ callback_data)."""
     rows = []
     navigation = []
-    if page > 0:
+    if page > 0 and first_cursor:
+        previous_data = prefix if page == 1 else f"{prefix}_p_{page - 1}_{first_cursor[0]}_{first_cursor[1]}"
         navigation.append(InlineKeyboardButton(
-            "⬅️ السابق", callback_data=f"{prefix}_{page - 1}", style="primary"
+            "⬅️ السابق", callback_data=previous_data, style="primary"
         ))
-    if page + 1 < total_pages:
+    if has_next and last_cursor:
         navigation.append(InlineKeyboardButton(
-            "التالي ➡️", callback_data=f"{prefix}_{page + 1}", style="primary"
+            "التالي ➡️", callback_data=f"{prefix}_n_{page + 1}_{last_cursor[0]}_{last_cursor[1]}", style="primary"
         ))
     if navigation:
         rows.append(navigation)
@@ -2172,10 +4630,14 @@ def get_admin_member_messages_keyboard(messages, target_id: int, email_index: in
     for index, item in enumerate((messages or [])[:10]):
         subject = item.get("subject") or "بدون موضوع"
         display_subject = subject if len(subject) <= 30 else subject[:27] + "..."
+        message_ref = inbox_message_ref(item)
+        callback_data = f"member_msgid_{target_id}_{email_index}_{message_ref}_{email_page}"
+        if not message_ref or len(callback_data.encode()) > 64:
+            callback_data = f"member_msg_{target_id}_{email_index}_{index}_{email_page}"
         rows.append([
             InlineKeyboardButton(
                 f"✉️ {display_subject}",
-                callback_data=f"member_msg_{target_id}_{email_index}_{index}_{email_page}",
+                callback_data=callback_data,
                 style="primary",
             )
         ])
@@ -2186,1979 +4648,2609 @@ def get_admin_member_messages_keyboard(messages, target_id: int, email_index: in
             style="success",
         ),
         InlineKeyboardButton(
-            get_text("ar", "btn_back"),
-            callback_data=f"member_email_view_{target_id}_{email_index}_{email_page}",
-            style="primary",
-        ),
-    ])
-    return InlineKeyboardMarkup(rows)
-
-
-def build_admin_member_inbox_error_view(error_code, target_id: int, email_index: int, email_page: int, status=None):
-    """خطأ وارد عضو للمشرف بدون أزرار حذف أو تغيير بيانات العضو."""
-    if error_code == "token_invalid":
-        text = (
-            "⚠️ تعذر تجديد جلسة هذا البريد تلقائياً.\n\n"
-            "قد تكون بيانات البريد قديمة أو لم يعد الحساب متاحاً على Mail.tm."
-        )
-    elif error_code == "rate_limited":
-        text = "⏳ يوجد ضغط مؤقت على خدمة البريد.\n\nانتظر قليلاً ثم اضغط تحديث."
-    elif error_code == "service_unavailable":
-        text = "🛠️ خدمة البريد متوقفة أو تواجه مشكلة مؤقتة.\n\nحاول التحديث بعد قليل."
-    elif error_code == "timeout":
-        text = "⏱️ انتهت مهلة الاتصال بخدمة البريد.\n\nحاول التحديث لاحقاً."
-    elif error_code in ("connection", "network"):
-        text = "🌐 تعذر الاتصال بخدمة البريد مؤقتاً.\n\nحاول التحديث لاحقاً."
-    elif error_code == "invalid_response":
-        text = "⚠️ وصلت استجابة غير صالحة من خدمة البريد.\n\nحاول التحديث بعد قليل."
-    elif error_code == "http_error" and status:
-        text = f"⚠️ تعذر تحميل الرسائل بسبب خطأ HTTP {status}.\n\nحاول التحديث لاحقاً."
-    else:
-        text = get_text("ar", "error_load_messages")
-
-    return text, InlineKeyboardMarkup([
-        [InlineKeyboardButton(
-            get_text("ar", "btn_refresh"),
-            callback_data=f"member_inbox_{target_id}_{email_index}_{email_page}",
-            style="success",
-        )],
-        [InlineKeyboardButton(
-            get_text("ar", "btn_back"),
-            callback_data=f"member_email_view_{target_id}_{email_index}_{email_page}",
-            style="primary",
-        )],
-    ])
-
-
-def get_channel_management_keyboard(_lang):
-    channels = get_channels(only_enabled=False)
-    rows = [[
-        InlineKeyboardButton(
-            "➕ إضافة قناة",
-            callback_data="set_channel",
-            style="success",
-        ),
-        InlineKeyboardButton(
-            "✏️ تعديل رسالة الاشتراك",
-            callback_data="edit_subscription_message",
-            style="primary",
-        ),
-    ]]
-    rows.append([
-        InlineKeyboardButton(
-            "📊 إحصائيات القنوات",
-            callback_data="channel_stats",
-            style="primary",
-        )
-    ])
-
-    channel_buttons = []
-    for channel in channels:
-        status_icon = "✅" if channel.get("subscription_enabled") else "❌"
-        username = str(channel.get("channel_username") or "")
-        channel_buttons.append(
-            InlineKeyboardButton(
-                f"{status_icon} @{username}",
-                callback_data=f"manage_channel_{channel['id']}",
-                style="primary",
-            )
-        )
-    rows.extend([
-        channel_buttons[index:index + 2]
-        for index in range(0, len(channel_buttons), 2)
-    ])
-    rows.append([
-        InlineKeyboardButton(
-            get_text("ar", "btn_back"),
-            callback_data="admin_panel",
-            style="primary",
-        )
-    ])
-    return InlineKeyboardMarkup(rows)
-
-
-# ================== أدوات منع/سماح (جديد) ==================
-# ================== أدوات منع/سماح (جديد) ==================
-# ================== أدوات منع/سماح (جديد) ==================
-
-async def guard_user(update_or_query, context, user_id: int, lang: str) -> bool:
-    """
-    يرجع False إذا لازم نوقف (محظور/غير مشترك/البوت مطفي)
-    """
-    admin_user = is_admin(user_id)
-
-    # محظور؟
-    if not admin_user and is_banned(user_id):
-        msg = get_text(lang, "banned")
-        if hasattr(update_or_query, "message") and update_or_query.message:
-            await update_or_query.message.reply_text(msg)
-        else:
-            try:
-                await update_or_query.edit_message_text(msg)
-            except:
-                pass
-        return False
-
-    # بوت مطفي؟
-    if not bot_active and not admin_user:
-        if bot_offline_message:
-            prefix = "⚠️ البوت متوقف مؤقتاً\n\n"
-            text = prefix + bot_offline_message
-            rich_body = bot_offline_message_html or escape(bot_offline_message, quote=False)
-            rich_text = escape(prefix, quote=False) + rich_body
-        else:
-            text = "⚠️ البوت متوقف مؤقتاً."
-            rich_text = escape(text, quote=False)
-        if hasattr(update_or_query, "message") and update_or_query.message:
-            await update_or_query.message.reply_text(rich_text, parse_mode="HTML")
-        else:
-            try:
-                await update_or_query.edit_message_text(rich_text, parse_mode="HTML")
-            except Exception:
-                pass
-        return False
-
-    # اشتراك صارم بكل القنوات المفعّلة (لغير الأدمن)
-    if not admin_user:
-        active_channels = get_channels(only_enabled=True)
-        missing_channels = await get_missing_subscription_channels(user_id, context)
-        if missing_channels:
-            text, kb = subscription_prompt(lang, missing_channels)
-            if hasattr(update_or_query, "message") and update_or_query.message:
-                await update_or_query.message.reply_text(
-                    text,
-                    reply_markup=kb,
-                    parse_mode="HTML",
-                )
-            else:
-                try:
-                    await update_or_query.edit_message_text(
-                        text,
-                        reply_markup=kb,
-                        parse_mode="HTML",
-                    )
-                except Exception:
-                    pass
-            return False
-
-        for active_channel in active_channels:
-            await notify_admin_subscription(context, user_id, active_channel)
-
-    return True
-
-
-# ================== أوامر ==================
-
-async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    message = update.effective_message
-    if user is None or message is None:
-        return
-
-    user_id = user.id
-    await register_user_activity(context, user)
-    lang = "ar"
-
-    if not await guard_user(update, context, user_id, lang):
-        return
-
-    await message.reply_text(
-        build_main_menu_html(user_id),
-        reply_markup=get_main_menu_keyboard(lang, user_id),
-        parse_mode="HTML",
-    )
+            get_text("ar", "btn_back"),
+            callback_data=f"member_email_view_{target_id}_{email_index}_{email_page}",
+            style="primary",
+        ),
+    ])
+    return InlineKeyboardMarkup(rows)
 
 
-async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    message = update.effective_message
-    if user is None or message is None:
-        return
+def build_admin_member_inbox_error_view(error_code, target_id: int, email_index: int, email_page: int, status=None):
+    """خطأ وارد عضو للمشرف بدون أزرار حذف أو تغيير بيانات العضو."""
+    if error_code == "token_invalid":
+        text = (
+            "⚠️ تعذر تجديد جلسة هذا البريد تلقائياً.\n\n"
+            "قد تكون بيانات البريد قديمة أو لم يعد الحساب متاحاً على Mail.tm."
+        )
+    elif error_code == "rate_limited":
+        text = "⏳ يوجد ضغط مؤقت على خدمة البريد.\n\nانتظر قليلاً ثم اضغط تحديث."
+    elif error_code == "service_unavailable":
+        text = "🛠️ خدمة البريد متوقفة أو تواجه مشكلة مؤقتة.\n\nحاول التحديث بعد قليل."
+    elif error_code == "timeout":
+        text = "⏱️ انتهت مهلة الاتصال بخدمة البريد.\n\nحاول التحديث لاحقاً."
+    elif error_code in ("connection", "network"):
+        text = "🌐 تعذر الاتصال بخدمة البريد مؤقتاً.\n\nحاول التحديث لاحقاً."
+    elif error_code == "invalid_response":
+        text = "⚠️ وصلت استجابة غير صالحة من خدمة البريد.\n\nحاول التحديث بعد قليل."
+    elif error_code == "http_error" and status:
+        text = f"⚠️ تعذر تحميل الرسائل بسبب خطأ HTTP {status}.\n\nحاول التحديث لاحقاً."
+    else:
+        text = get_text("ar", "error_load_messages")
 
-    user_id = user.id
-    if not is_admin(user_id):
-        await message.reply_text(get_text("ar", "unauthorized"))
-        return
-    await message.reply_text("👑 لوحة المشرف", reply_markup=get_admin_panel_keyboard("ar", user_id))
+    return text, InlineKeyboardMarkup([
+        [InlineKeyboardButton(
+            get_text("ar", "btn_refresh"),
+            callback_data=f"member_inbox_{target_id}_{email_index}_{email_page}",
+            style="success",
+        )],
+        [InlineKeyboardButton(
+            get_text("ar", "btn_back"),
+            callback_data=f"member_email_view_{target_id}_{email_index}_{email_page}",
+            style="primary",
+        )],
+    ])
 
 
-# ================== الأزرار ==================
+def get_channel_management_keyboard(_lang):
+    markup = cached_keyboard("channel_management", "admin", _build_channel_management_keyboard, depends_on="channels")
+    if markup is None:
+        # تعذر جلب القنوات: لوحة بدون أزرار القنوات ولا تُحفظ، حتى لا تختفي القنوات حتى التعديل التالي.
+        markup = _channel_management_markup([])
+    return markup
 
-async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global forwarding_enabled, bot_active, bot_offline_message
 
-    query = update.callback_query
-    user = update.effective_user
-    if query is None or user is None:
-        return
+def _build_channel_management_keyboard():
+    channels = _fetch_channels(False)
+    if channels is None:
+        return None
+    return _channel_management_markup(channels)
 
-    user_id = user.id
-    data = query.data or ""
-    lang = "ar"
 
-    cooldown_remaining = 0
-    if data == "create_email_fast" or re.fullmatch(r"free_domain_\d+", data):
-        cooldown_remaining = consume_action_cooldown(
-            user_id, "create_email", CREATE_EMAIL_COOLDOWN_SECONDS
-        )
-    elif data == "refresh_free_domains":
-        cooldown_remaining = consume_action_cooldown(
-            user_id, "free_domains", INBOX_COOLDOWN_SECONDS
-        )
-    elif re.fullmatch(r"inbox_\d+", data):
-        cooldown_remaining = consume_action_cooldown(
-            user_id, "inbox", INBOX_COOLDOWN_SECONDS
-        )
-    elif re.fullmatch(r"member_inbox_\d+_\d+_\d+", data):
-        cooldown_remaining = consume_action_cooldown(
-            user_id, "admin_member_inbox", INBOX_COOLDOWN_SECONDS
+def _channel_management_markup(channels):
+    rows = [[
+        InlineKeyboardButton(
+            "➕ إضافة قناة",
+            callback_data="set_channel",
+            style="success",
+        ),
+        InlineKeyboardButton(
+            "✏️ تعديل رسالة الاشتراك",
+            callback_data="edit_subscription_message",
+            style="primary",
+        ),
+    ]]
+    rows.append([
+        InlineKeyboardButton(
+            "📊 إحصائيات القنوات",
+            callback_data="channel_stats",
+            style="primary",
         )
+    ])
 
-    if cooldown_remaining > 0:
-        try:
-            await query.answer(
-                f"⏳ انتظر {cooldown_remaining} ثانية قبل إعادة المحاولة.",
-                show_alert=False,
+    channel_buttons = []
+    for channel in channels:
+        status_icon = "✅" if channel.get("subscription_enabled") else "❌"
+        username = str(channel.get("channel_username") or "")
+        channel_buttons.append(
+            InlineKeyboardButton(
+                f"{status_icon} @{username}",
+                callback_data=f"manage_channel_{channel['id']}",
+                style="primary",
             )
-        except Exception:
-            pass
-        return
-
-    if data == "verify_subscription":
-        missing_channels = await get_missing_subscription_channels(user_id, context)
-        if missing_channels:
-            try:
-                await query.answer(
-                    "⚠️ يرجى الاشتراك بالقنوات لاستخدام البوت.",
-                    show_alert=True,
-                )
-            except Exception:
-                pass
-            return
-
-        try:
-            await query.answer("✅ تم التحقق من الاشتراك.", show_alert=False)
-        except Exception:
-            pass
-        for active_channel in get_channels(only_enabled=True):
-            await notify_admin_subscription(context, user_id, active_channel)
-        text = (
-            "✅ تم التحقق من اشتراكك في جميع القنوات بنجاح!\n\n"
-            + build_main_menu_html(user_id)
         )
-        await query.edit_message_text(
-            text,
-            reply_markup=get_main_menu_keyboard(lang, user_id),
-            parse_mode="HTML",
+    rows.extend([
+        channel_buttons[index:index + 2]
+        for index in range(0, len(channel_buttons), 2)
+    ])
+    rows.append([
+        InlineKeyboardButton(
+            get_text("ar", "btn_back"),
+            callback_data="admin_panel",
+            style="primary",
         )
-        return
+    ])
+    return InlineKeyboardMarkup(rows)
+
 
+# ================== طبقة قاعدة البيانات غير المتزامنة ==================
+# المعالجات لا تستدعي دوال psycopg2 مباشرة على حلقة asyncio؛ كل استدعاء يمر عبر منفذ خيوط
+# مخصص بحجم مجمع الاتصالات، فلا يوقف استعلام بطيء تحديثات باقي المستخدمين ولا يزاحم
+# منفذ asyncio الافتراضي.
+DB_EXECUTOR = ThreadPoolExecutor(max_workers=DB_POOL_MAX_SIZE, thread_name_prefix="db")
+
+
+async def run_db(func, *args, **kwargs):
+    """تشغيل دالة قاعدة بيانات متزامنة على منفذ قاعدة البيانات دون حجب الحلقة."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(DB_EXECUTOR, functools.partial(func, *args, **kwargs))
+
+
+def _db_async(func):
+    """إنشاء نسخة async من دالة قاعدة بيانات باسم <الاسم>_async."""
+    async def wrapper(*args, **kwargs):
+        return await run_db(func, *args, **kwargs)
+
+    wrapper.__name__ = wrapper.__qualname__ = f"{func.__name__}_async"
+    wrapper.__doc__ = f"نسخة غير متزامنة من {func.__name__} تعمل على منفذ قاعدة البيانات."
+    return wrapper
+
+
+set_setting_async = _db_async(set_setting)
+save_rich_text_setting_async = _db_async(save_rich_text_setting)
+get_rich_text_setting_async = _db_async(get_rich_text_setting)
+get_last_seven_days_usage_async = _db_async(get_last_seven_days_usage)
+get_global_subscription_message_html_async = _db_async(get_global_subscription_message_html)
+get_email_limit_async = _db_async(get_email_limit)
+get_member_email_limit_async = _db_async(get_member_email_limit)
+set_member_email_limit_async = _db_async(set_member_email_limit)
+get_effective_email_limit_async = _db_async(get_effective_email_limit)
+check_database_health_async = _db_async(check_database_health)
+get_admin_contact_username_async = _db_async(get_admin_contact_username)
+get_paid_domains_async = _db_async(get_paid_domains)
+add_paid_domain_async = _db_async(add_paid_domain)
+remove_paid_domain_async = _db_async(remove_paid_domain)
+build_main_menu_html_async = _db_async(build_main_menu_html)
+is_banned_async = _db_async(is_banned)
+ban_user_db_async = _db_async(ban_user_db)
+unban_user_db_async = _db_async(unban_user_db)
+subscription_notification_exists_async = _db_async(subscription_notification_exists)
+mark_subscription_notified_async = _db_async(mark_subscription_notified)
+get_last_seen_message_id_async = _db_async(get_last_seen_message_id)
+set_last_seen_message_id_async = _db_async(set_last_seen_message_id)
+find_user_by_username_or_id_async = _db_async(find_user_by_username_or_id)
+clear_user_emails_async = _db_async(clear_user_emails)
+get_all_admins_async = _db_async(get_all_admins)
+is_admin_async = _db_async(is_admin)
+remove_admin_async = _db_async(remove_admin)
+get_channels_async = _db_async(get_channels)
+get_channel_by_id_async = _db_async(get_channel_by_id)
+get_channel_info_async = _db_async(get_channel_info)
+set_channel_async = _db_async(set_channel)
+delete_channel_async = _db_async(delete_channel)
+toggle_subscription_async = _db_async(toggle_subscription)
+get_channel_subscription_stats_async = _db_async(get_channel_subscription_stats)
+get_user_data_async = _db_async(get_user_data)
+get_user_emails_async = _db_async(get_user_emails)
+update_user_info_async = _db_async(update_user_info)
+add_user_email_async = _db_async(add_user_email)
+remove_user_email_async = _db_async(remove_user_email)
+subscription_prompt_async = _db_async(subscription_prompt)
+get_main_menu_keyboard_async = _db_async(get_main_menu_keyboard)
+get_channel_management_keyboard_async = _db_async(get_channel_management_keyboard)
+get_admin_member_emails_view_async = _db_async(get_admin_member_emails_view)
+
+
+async def mercure_sync_job(context: ContextTypes.DEFAULT_TYPE) -> None:
     try:
-        await query.answer()
-    except Exception:
-        pass
+        await MERCURE_PUSH.sync(context.bot)
+    except Exception as error:
+        print(f"⚠️ mercure_sync_job: {type(error).__name__}: {error}")
 
-    if not await guard_user(query, context, user_id, lang):
-        return
 
-    # رجوع للقائمة
-    if data == "back_to_menu":
-        await query.edit_message_text(
-            build_main_menu_html(user_id),
-            reply_markup=get_main_menu_keyboard(lang, user_id),
-            parse_mode="HTML",
-        )
-        return
+async def daily_stats_flush_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        await run_db(flush_daily_stats)
+        await run_db(flush_email_touches)
+    except Exception as error:
+        print(f"⚠️ daily_stats_flush_job: {type(error).__name__}: {error}")
+
+
+# ================== الإذاعة ==================
+
+# حد تلجرام العام ~30 رسالة/ثانية؛ نبقى أدنى منه بهامش، ولكل عضو رسالة واحدة فلا يُقترب من حد المحادثة الواحدة.
+BROADCAST_RATE_PER_SECOND = float(os.getenv("BROADCAST_RATE_PER_SECOND", "25"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "8"))
+BROADCAST_BATCH_SIZE = int(os.getenv("BROADCAST_BATCH_SIZE", "100"))
+BROADCAST_MAX_ATTEMPTS = int(os.getenv("BROADCAST_MAX_ATTEMPTS", "3"))
+BROADCAST_PROGRESS_INTERVAL_SECONDS = float(os.getenv("BROADCAST_PROGRESS_INTERVAL_SECONDS", "5"))
+BROADCAST_DRAIN_SECONDS = float(os.getenv("BROADCAST_DRAIN_SECONDS", "15"))
+# أقصى انتظار بين محاولات قاعدة البيانات أثناء انقطاعها؛ الإذاعة تنتظر ولا تتخلى عن دفعتها.
+BROADCAST_DB_RETRY_MAX_SECONDS = float(os.getenv("BROADCAST_DB_RETRY_MAX_SECONDS", "60"))
+# job_id -> Task للإذاعات الجارية في هذه العملية.
+BROADCAST_TASKS = {}
+# يُضبط عند الإيقاف: كل إذاعة تنهي دفعتها الحالية وتتوقف، ثم تُستكمل عند التشغيل القادم.
+BROADCAST_SHUTDOWN = asyncio.Event()
+
+
+class TokenBucket:
+    """محدد معدل بسيط: رصيد يمتلئ بمعدل ثابت، مع إيقاف مؤقت للجميع عند RetryAfter."""
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = max(rate, 0.1)
+        self.capacity = capacity or max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float) -> None:
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
 
-    # عرض الدومينات الشكلية المدفوعة للمستخدم
-    if data == "change_domain":
-        domains = get_paid_domains()
-        if not domains:
-            await query.edit_message_text(
-                "💎 لا توجد دومينات مدفوعة متاحة حالياً.",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton(
-                        get_text(lang, "btn_back"),
-                        callback_data="create_email",
-                        style="primary",
-                    )
-                ]]),
-            )
-            return
 
-        rows = []
-        for index, domain in enumerate(domains):
-            rows.append([
-                InlineKeyboardButton(
-                    f"@{domain}",
-                    callback_data=f"paid_domain_{index}",
-                    transparent=True,
-                )
-            ])
-        rows.append([
-            InlineKeyboardButton(
-                get_text(lang, "btn_back"),
-                callback_data="create_email",
-                style="primary",
-            )
-        ])
-        await query.edit_message_text(
-            "💎 الدومينات المدفوعة\n\nاختر أحد الدومينات المدفوعة المتاحة:",
-            reply_markup=InlineKeyboardMarkup(rows),
-        )
-        return
+def _retry_after_seconds(error: RetryAfter) -> float:
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
 
-    if re.fullmatch(r"paid_domain_\d+", data):
-        domain_index = int(data.rsplit("_", 1)[1])
-        domains = get_paid_domains()
-        if domain_index >= len(domains):
-            await query.edit_message_text(
-                "⚠️ هذا الدومين لم يعد متاحاً.",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton(
-                        get_text(lang, "btn_back"),
-                        callback_data="change_domain",
-                        style="primary",
-                    )
-                ]]),
-            )
-            return
 
-        domain = domains[domain_index]
-        rows = []
-        contact_username = get_admin_contact_username()
-        if contact_username:
-            rows.append([
-                InlineKeyboardButton(
-                    "💬 التواصل مع الأدمن",
-                    url=f"https://t.me/{contact_username}",
-                    style="success",
-                )
-            ])
-        rows.append([
-            InlineKeyboardButton(
-                get_text(lang, "btn_back"),
-                callback_data="change_domain",
-                style="primary",
-            )
-        ])
-        await query.edit_message_text(
-            "💎 هذه الخدمة مدفوعة.\n\n"
-            f"🌐 الدومين المختار: @{domain}\n\n"
-            "يرجى التواصل مع الأدمن لاستخدام هذا الدومين.",
-            reply_markup=InlineKeyboardMarkup(rows),
-        )
-        return
+async def send_broadcast_message(bot, bucket: TokenBucket, chat_id: int, text: str) -> str:
+    """إرسال رسالة إذاعة لعضو واحد؛ يرجع sent أو blocked أو failed."""
+    for attempt in range(BROADCAST_MAX_ATTEMPTS):
+        await bucket.acquire()
+        try:
+            await bot.send_message(chat_id=chat_id, text=text, parse_mode="HTML")
+            return "sent"
+        except RetryAfter as error:
+            seconds = _retry_after_seconds(error)
+            bucket.pause(seconds)
+            await asyncio.sleep(seconds)
+        except Forbidden:
+            return "blocked"
+        except BadRequest as error:
+            if "chat not found" in str(error).lower():
+                return "blocked"
+            print(f"⚠️ فشل إرسال الإذاعة إلى {chat_id}: {error}")
+            return "failed"
+        except NetworkError:
+            await asyncio.sleep(1 + attempt)
+        except TelegramError as error:
+            print(f"⚠️ فشل إرسال الإذاعة إلى {chat_id}: {type(error).__name__}: {error}")
+            return "failed"
+    return "failed"
+
+
+def build_broadcast_progress(job, finished: bool = False, paused: bool = False):
+    done = int(job["sent"]) + int(job["failed"]) + int(job["blocked"])
+    total = int(job["total"])
+    percent = int(done * 100 / total) if total else 100
+    if job["status"] == "cancelled":
+        title = "⏹️ تم إيقاف الإذاعة"
+    elif finished or job["status"] == "done":
+        title = "✅ اكتملت الإذاعة"
+    elif paused:
+        title = "⏸️ الإذاعة متوقفة مؤقتاً (تعذر الوصول لقاعدة البيانات)، وستُستأنف تلقائياً"
+    else:
+        title = "⏳ جاري إرسال الإذاعة"
+    text = (
+        f"{title} #{job['id']}\n\n"
+        f"📊 التقدم: {done}/{total} ({percent}%)\n"
+        f"✅ نجح: {job['sent']}\n"
+        f"❌ فشل: {job['failed']}\n"
+        f"🚫 حظروا البوت: {job['blocked']}"
+    )
+    if job["status"] == "running" and not finished:
+        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton(
+            "⏹️ إيقاف الإذاعة",
+            callback_data=f"broadcast_cancel_{job['id']}",
+            style="danger",
+        )]])
+    else:
+        keyboard = back_keyboard("section_broadcast", "primary")
+    return text, keyboard
 
-    # إنشاء إيميل: يختار المستخدم بين الإنشاء السريع أو دومين مجاني محدد.
-    if data == "create_email":
-        current_count = len(get_user_emails(user_id))
-        email_limit = get_effective_email_limit(user_id)
-        if (not is_admin(user_id)) and email_limit > 0 and current_count >= email_limit:
-            contact_username = get_admin_contact_username()
-            rows = []
-            if contact_username:
-                rows.append([
-                    InlineKeyboardButton(
-                        "💬 التواصل مع الأدمن",
-                        url=f"https://t.me/{contact_username}",
-                        style="primary",
-                    )
-                ])
-            rows.append([
-                InlineKeyboardButton(
-                    get_text(lang, "btn_back"),
-                    callback_data="back_to_menu",
-                    style="primary",
-                )
-            ])
-            await query.edit_message_text(
-                "⚠️ لقد وصلت إلى الحد المسموح لإنشاء الإيميلات.\n\n"
-                "يرجى التواصل مع الأدمن لإنشاء المزيد من الإيميلات.",
-                reply_markup=InlineKeyboardMarkup(rows),
-            )
-            return
 
-        text = (
-            "✨ إنشاء إيميل جديد\n\n"
-            "من هنا يمكنك اختيار طريقة إنشاء بريدك الإلكتروني.\n\n"
-            "🎲 الإنشاء السريع:\n"
-            "ينشئ لك البوت إيميل جديد مباشرة ويختار أحد\n"
-            "الدومينات المجانية المتاحة تلقائياً.\n\n"
-            "🌐 اختيار الدومين:\n"
-            "اختر بنفسك أحد الدومينات المجانية المتاحة\n"
-            "لإنشاء الإيميل عليه.\n\n"
-            "💎 الدومينات المدفوعة:\n"
-            "استعرض الدومينات المدفوعة المتوفرة واختر\n"
-            "الدومين الذي ترغب باستخدامه."
-        )
-        await query.edit_message_text(
+async def update_broadcast_progress(bot, job, finished: bool = False, paused: bool = False) -> None:
+    if not job or not job.get("progress_chat_id") or not job.get("progress_message_id"):
+        return
+    text, keyboard = build_broadcast_progress(job, finished, paused)
+    try:
+        await bot.edit_message_text(
             text,
-            reply_markup=InlineKeyboardMarkup([
-                [
-                    InlineKeyboardButton(
-                        "🎲 إنشاء سريع",
-                        callback_data="create_email_fast",
-                        style="success",
-                    ),
-                    InlineKeyboardButton(
-                        "🌐 اختيار الدومين",
-                        callback_data="select_free_domain",
-                        style="primary",
-                    ),
-                ],
-                [InlineKeyboardButton(
-                    "💎 الدومينات المدفوعة",
-                    callback_data="change_domain",
-                    style="primary",
-                )],
-                [InlineKeyboardButton(
-                    get_text(lang, "btn_back"),
-                    callback_data="back_to_menu",
-                    style="primary",
-                )],
-            ]),
+            chat_id=job["progress_chat_id"],
+            message_id=job["progress_message_id"],
+            reply_markup=keyboard,
         )
-        return
+    except TelegramError as error:
+        if "message is not modified" not in str(error).lower():
+            print(f"⚠️ تعذر تحديث رسالة تقدم الإذاعة #{job['id']}: {error}")
 
-    if data == "create_email_fast":
-        current_count = len(get_user_emails(user_id))
-        email_limit = get_effective_email_limit(user_id)
-        if (not is_admin(user_id)) and email_limit > 0 and current_count >= email_limit:
-            await query.edit_message_text(
-                "⚠️ لقد وصلت إلى الحد المسموح لإنشاء الإيميلات.",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton(
-                        get_text(lang, "btn_back"),
-                        callback_data="back_to_menu",
-                        style="primary",
-                    )
-                ]]),
-            )
-            return
 
-        await query.edit_message_text(
-            "🎲 إنشاء سريع\n\n"
-            "جاري إنشاء إيميل جديد باستخدام أحد الدومينات المجانية المتاحة..."
-        )
-        email, token, password = await asyncio.to_thread(create_email)
-        if email and token:
-            add_user_email(user_id, email, token, password)
-            await asyncio.to_thread(increment_daily_stat, "emails_created")
-            await query.edit_message_text(
-                get_text(lang, "email_created", email=telegram_html(email)),
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton(
-                        get_text(lang, "btn_back"),
-                        callback_data="back_to_menu",
-                        style="primary",
-                    )
-                ]]),
-                parse_mode="HTML",
-            )
-        else:
-            await query.edit_message_text(
-                get_text(lang, "error_create_email"),
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton(
-                        "🔄 إعادة المحاولة",
-                        callback_data="create_email_fast",
-                        style="success",
-                    )],
-                    [InlineKeyboardButton(
-                        get_text(lang, "btn_back"),
-                        callback_data="create_email",
-                        style="primary",
-                    )],
-                ]),
-            )
-        return
+async def _retry_broadcast_db(bot, job, func, *args):
+    """تكرار استدعاء قاعدة بيانات للإذاعة حتى ينجح، بانتظار متزايد حتى حد أقصى.
 
-    if data in ("select_free_domain", "refresh_free_domains"):
-        domains = await asyncio.to_thread(get_available_domains)
-        if not domains:
-            context.user_data.pop("free_domains", None)
-            await query.edit_message_text(
-                "🌐 اختيار الدومين\n\n"
-                "تعذر تحميل الدومينات المجانية المتاحة حالياً.\n"
-                "حاول التحديث بعد قليل.",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton(
-                        "🔄 تحديث الدومينات",
-                        callback_data="refresh_free_domains",
-                        style="success",
-                    )],
-                    [InlineKeyboardButton(
-                        get_text(lang, "btn_back"),
-                        callback_data="create_email",
-                        style="primary",
-                    )],
-                ]),
+    يرجع None فقط عند إيقاف البوت، وعندها تُستكمل الإذاعة عند التشغيل القادم.
+    """
+    attempt = 0
+    while not BROADCAST_SHUTDOWN.is_set():
+        result = await run_db(func, *args)
+        if result is not None:
+            if attempt:
+                # إزالة حالة "متوقفة مؤقتاً" من رسالة التقدم بعد عودة قاعدة البيانات.
+                await update_broadcast_progress(bot, await run_db(get_broadcast_job, job["id"]))
+            return result
+        if attempt == 0:
+            print(f"⚠️ تعذر الوصول لقاعدة البيانات أثناء الإذاعة #{job['id']}؛ إعادة المحاولة")
+            await update_broadcast_progress(bot, job, paused=True)
+        attempt += 1
+        try:
+            await asyncio.wait_for(
+                BROADCAST_SHUTDOWN.wait(),
+                timeout=min(2 ** attempt, BROADCAST_DB_RETRY_MAX_SECONDS),
             )
-            return
+        except asyncio.TimeoutError:
+            pass
+    return None
+
+
+async def run_broadcast_job(bot, job_id: int) -> None:
+    """إرسال مهمة إذاعة محفوظة حتى نهايتها، بدفعات تُحفظ نتيجتها أولاً بأول.
+
+    عند إعادة التشغيل يكمل من المستلمين الذين ما زالت حالتهم pending.
+    """
+    bucket = TokenBucket(BROADCAST_RATE_PER_SECOND)
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    cursor = 0
+    last_progress = 0.0
 
-        context.user_data["free_domains"] = list(domains)
-        await query.edit_message_text(
-            "🌐 اختيار الدومين\n\n"
-            "اختر أحد الدومينات المجانية المتاحة أدناه.\n"
-            "بعد اختيار الدومين سيتم إنشاء إيميل جديد\n"
-            "تلقائياً عليه.",
-            reply_markup=get_free_domains_keyboard(domains),
-        )
-        return
+    async def deliver(chat_id: int, text: str):
+        async with semaphore:
+            return chat_id, await send_broadcast_message(bot, bucket, chat_id, text)
 
-    if re.fullmatch(r"free_domain_\d+", data):
-        domain_index = int(data.rsplit("_", 1)[1])
-        domains = list(context.user_data.get("free_domains") or [])
-        if domain_index >= len(domains):
-            domains = await asyncio.to_thread(get_available_domains)
-            context.user_data["free_domains"] = list(domains)
-            await query.edit_message_text(
-                "🌐 اختيار الدومين\n\n"
-                "تم تحديث قائمة الدومينات. اختر الدومين من جديد.",
-                reply_markup=(
-                    get_free_domains_keyboard(domains)
-                    if domains
-                    else InlineKeyboardMarkup([[
-                        InlineKeyboardButton(
-                            "🔄 تحديث الدومينات",
-                            callback_data="refresh_free_domains",
-                            style="success",
-                        )
-                    ], [
-                        InlineKeyboardButton(
-                            get_text(lang, "btn_back"),
-                            callback_data="create_email",
-                            style="primary",
-                        )
-                    ]])
-                ),
-            )
+    try:
+        job = await run_db(get_broadcast_job, job_id)
+        if not job or job["status"] != "running":
             return
+        text = job["message_html"]
+
+        status = "running"
+        while status == "running" and not BROADCAST_SHUTDOWN.is_set():
+            # انقطاع قاعدة البيانات ليس نهاية الإذاعة: ننتظر عودتها، وعند إيقاف البوت تبقى running
+            # وتُستكمل من آخر دفعة محفوظة عند التشغيل القادم.
+            batch = await _retry_broadcast_db(bot, job, claim_broadcast_batch, job_id, cursor, BROADCAST_BATCH_SIZE)
+            if not batch:
+                break
+            results = await asyncio.gather(*(deliver(chat_id, text) for chat_id in batch))
+            # نفس النتائج تُعاد حتى تُحفظ، فلا يُرسل للدفعة مرة ثانية.
+            recorded_status = await _retry_broadcast_db(bot, job, record_broadcast_results, job_id, results, batch[-1])
+            if recorded_status is None:
+                break
+            cursor = batch[-1]
+            status = recorded_status
 
-        current_count = len(get_user_emails(user_id))
-        email_limit = get_effective_email_limit(user_id)
-        if (not is_admin(user_id)) and email_limit > 0 and current_count >= email_limit:
-            await query.edit_message_text(
-                "⚠️ لقد وصلت إلى الحد المسموح لإنشاء الإيميلات.",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton(
-                        get_text(lang, "btn_back"),
-                        callback_data="back_to_menu",
-                        style="primary",
-                    )
-                ]]),
-            )
+            if time.monotonic() - last_progress >= BROADCAST_PROGRESS_INTERVAL_SECONDS:
+                last_progress = time.monotonic()
+                job = await run_db(get_broadcast_job, job_id) or job
+                await update_broadcast_progress(bot, job)
+
+        if BROADCAST_SHUTDOWN.is_set():
+            print(f"⏸️ أُوقفت الإذاعة #{job_id} مؤقتاً حتى التشغيل القادم")
             return
+        if status == "running":
+            await run_db(finish_broadcast_job, job_id, "done")
+        await update_broadcast_progress(bot, await run_db(get_broadcast_job, job_id), finished=True)
+    except asyncio.CancelledError:
+        # إيقاف العملية: الحالة محفوظة وتُستكمل الإذاعة عند التشغيل القادم.
+        raise
+    except Exception as error:
+        print(f"❌ توقفت الإذاعة #{job_id}: {type(error).__name__}: {error}")
+    finally:
+        BROADCAST_TASKS.pop(job_id, None)
 
-        domain = domains[domain_index]
-        await query.edit_message_text(
-            "🌐 إنشاء الإيميل\n\n"
-            f"جاري إنشاء إيميل جديد على الدومين:\n@{domain}"
-        )
-        email, token, password = await asyncio.to_thread(create_email_with_domain, domain)
-        if email and token:
-            add_user_email(user_id, email, token, password)
-            await asyncio.to_thread(increment_daily_stat, "emails_created")
-            await query.edit_message_text(
-                get_text(lang, "email_created", email=telegram_html(email)),
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton(
-                        get_text(lang, "btn_back"),
-                        callback_data="back_to_menu",
-                        style="primary",
-                    )
-                ]]),
-                parse_mode="HTML",
-            )
-        else:
-            await query.edit_message_text(
-                "❌ فشل إنشاء الإيميل على الدومين المحدد.\n\n"
-                "قد يكون الدومين لم يعد متاحاً، حدّث القائمة وحاول مرة أخرى.",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton(
-                        "🔄 تحديث الدومينات",
-                        callback_data="refresh_free_domains",
-                        style="success",
-                    )],
-                    [InlineKeyboardButton(
-                        get_text(lang, "btn_back"),
-                        callback_data="create_email",
-                        style="primary",
-                    )],
-                ]),
-            )
-        return
 
-    # إيميلاتي
-    if data == "my_emails":
-        emails = get_user_emails(user_id)
-        if not emails:
-            await query.edit_message_text(get_text(lang, "no_emails"),
-                                          reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="back_to_menu")]]))
-        else:
-            await query.edit_message_text(get_text(lang, "select_email", count=len(emails)),
-                                          reply_markup=get_email_list_keyboard(emails, "view_email", lang))
+def start_broadcast_task(application: Application, job_id: int) -> None:
+    # مهمة asyncio عادية وليست application.create_task، لأن Application.stop ينتظر تلك المهام
+    # حتى نهايتها وقد تستغرق الإذاعة ساعات؛ الإيقاف يتم عبر drain_broadcast_tasks.
+    if job_id in BROADCAST_TASKS:
         return
+    BROADCAST_TASKS[job_id] = asyncio.create_task(
+        run_broadcast_job(application.bot, job_id),
+        name=f"broadcast_{job_id}",
+    )
 
-    # اختيار صندوق الوارد
-    if data == "select_inbox":
-        emails = get_user_emails(user_id)
-        if not emails:
-            await query.edit_message_text(get_text(lang, "no_emails"),
-                                          reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="back_to_menu")]]))
-        else:
-            await query.edit_message_text(get_text(lang, "select_email", count=len(emails)),
-                                          reply_markup=get_email_list_keyboard(emails, "inbox", lang))
+
+async def drain_broadcast_tasks() -> None:
+    """إيقاف الإذاعات الجارية بعد دفعتها الحالية، مع إلغائها إن تجاوزت مهلة الإيقاف."""
+    BROADCAST_SHUTDOWN.set()
+    tasks = list(BROADCAST_TASKS.values())
+    if not tasks:
         return
+    _done, pending = await asyncio.wait(tasks, timeout=BROADCAST_DRAIN_SECONDS)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
 
-    # عرض صندوق وارد إيميل
-    if data.startswith("inbox_"):
-        idx_str = data.split("_", 1)[1]
-        if not idx_str.isdigit():
-            return
-        email_index = int(idx_str)
-        emails = get_user_emails(user_id)
-        if email_index >= len(emails):
-            return
-        email_data = emails[email_index]
-        await asyncio.to_thread(increment_daily_stat, "inbox_opens")
-        inbox_result = await asyncio.to_thread(check_user_inbox_detailed, user_id, email_index)
-        messages = inbox_result.get("messages")
 
-        if inbox_result.get("error") is not None:
-            error_text, error_keyboard = build_inbox_error_view(
-                inbox_result.get("error"),
-                email_index,
-                inbox_result.get("status"),
-            )
-            await query.edit_message_text(error_text, reply_markup=error_keyboard)
-            return
+async def start_broadcast(context: ContextTypes.DEFAULT_TYPE, audience: str, message_html: str, admin_id: int, chat_id: int):
+    """تسجيل إذاعة جديدة وبدء إرسالها في الخلفية دون حجز معالج الأدمن."""
+    text = f"📢 رسالة من الإدارة:\n\n{message_html}"
+    job_id, _total = await run_db(create_broadcast_job, audience, text, admin_id)
+    if job_id is None:
+        return None
 
-        if len(messages) == 0:
-            await query.edit_message_text(get_text(lang, "no_messages", email=email_data["address"]),
-                                          reply_markup=InlineKeyboardMarkup([
-                                              [InlineKeyboardButton(get_text(lang, "btn_refresh"), callback_data=f"inbox_{email_index}")],
-                                              [InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="select_inbox")]
-                                          ]))
-            return
+    job = await run_db(get_broadcast_job, job_id)
+    progress_text, keyboard = build_broadcast_progress(job)
+    progress_message = await context.bot.send_message(chat_id=chat_id, text=progress_text, reply_markup=keyboard)
+    await run_db(set_broadcast_progress_message, job_id, chat_id, progress_message.message_id)
+    start_broadcast_task(context.application, job_id)
+    return job_id
 
-        text = get_text(lang, "messages_list", count=len(messages), email=email_data["address"])
-        await query.edit_message_text(text, reply_markup=get_messages_keyboard(messages, email_index, lang))
-        return
 
-    # تفاصيل رسالة
-    if data.startswith("msg_"):
-        parts = data.split("_")
-        if len(parts) < 3 or (not parts[1].isdigit()) or (not parts[2].isdigit()):
-            return
-        email_index = int(parts[1])
-        msg_index = int(parts[2])
-        emails = get_user_emails(user_id)
-        if email_index >= len(emails):
-            return
-        email_data = emails[email_index]
+async def resume_broadcast_jobs(application: Application) -> None:
+    for job_id in await run_db(get_running_broadcast_job_ids):
+        print(f"🔁 استكمال الإذاعة #{job_id}")
+        start_broadcast_task(application, job_id)
 
-        inbox_result = await asyncio.to_thread(check_user_inbox_detailed, user_id, email_index)
-        messages = inbox_result.get("messages")
-        if inbox_result.get("error") is not None:
-            error_text, error_keyboard = build_inbox_error_view(
-                inbox_result.get("error"),
-                email_index,
-                inbox_result.get("status"),
-            )
-            await query.edit_message_text(error_text, reply_markup=error_keyboard)
-            return
-        if not messages or msg_index >= len(messages):
-            return
-        msg_id = messages[msg_index]["id"]
 
-        full = await asyncio.to_thread(get_user_message_content, user_id, email_index, msg_id)
-        if not full:
-            await query.edit_message_text(get_text(lang, "error_load_message"),
-                                          reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "btn_back"), callback_data=f"inbox_{email_index}")]]))
-            return
+# ================== مراقبة صندوق الوارد ==================
+
+# بدل الضغط المتكرر على «تحديث» ينتظر العضو رمز التحقق، وجدول واحد يفحص كل الصناديق المراقبة
+# بميزانية طلبات ثابتة إلى mail.tm مهما كان عددها.
+WATCH_INBOX_MINUTES = int(os.getenv("WATCH_INBOX_MINUTES", "5"))
+WATCH_REQUESTS_PER_SECOND = float(os.getenv("WATCH_REQUESTS_PER_SECOND", "2"))
+WATCH_MIN_INTERVAL_SECONDS = float(os.getenv("WATCH_MIN_INTERVAL_SECONDS", "5"))
+WATCH_MAX_INTERVAL_SECONDS = float(os.getenv("WATCH_MAX_INTERVAL_SECONDS", "30"))
+WATCH_MAX_ACTIVE = int(os.getenv("WATCH_MAX_ACTIVE", "200"))
 
-        sender_raw = (full.get("from") or {}).get("address") or "غير معروف"
-        subject_raw = full.get("subject") or "بدون موضوع"
-        date_raw = full.get("createdAt") or "غير معروف"
-        content_raw = get_message_text(full)
 
-        otp = extract_otp(content_raw)
-        if len(content_raw) > 3500:
-            content_raw = content_raw[:3500] + "\n\n... (الرسالة طويلة جداً)"
+class InboxWatchScheduler:
+    """جدول فحص مركزي للصناديق المراقبة: طلب واحد في كل مرة تحت TokenBucket عام،
+    وفترة لكل بريد تتباعد تدريجياً ما دام لا جديد، وتنتهي المراقبة بأول OTP أو بانتهاء مدتها.
 
-        safe_values = {
-            "sender": telegram_html(sender_raw),
-            "subject": telegram_html(subject_raw),
-            "date": telegram_html(date_raw),
-            "content": telegram_html(content_raw),
+    يُستخدم من حلقة الأحداث فقط.
+    """
+
+    def __init__(self, rate: float, min_interval: float, max_interval: float, max_active: int):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.max_active = max_active
+        self._bucket = TokenBucket(rate, capacity=1)
+        self._watches = {}
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._bot = None
+        self.stats = {"started": 0, "polls": 0, "found": 0, "timeouts": 0, "rate_limited": 0}
+
+    def is_watching(self, address: str) -> bool:
+        return str(address or "").lower() in self._watches
+
+    def watch(self, bot, owner: int, address: str, minutes: int, baseline=None):
+        """تسجيل بريد للمراقبة؛ يرجع موعد الانتهاء، أو None إذا اكتمل عدد المراقبات."""
+        address = str(address or "").lower()
+        if address not in self._watches and len(self._watches) >= self.max_active:
+            return None
+        now = time.monotonic()
+        previous = self._watches.get(address) or {}
+        self._watches[address] = {
+            "owner": owner,
+            "deadline": now + minutes * 60,
+            "next_at": now + self.min_interval,
+            "interval": self.min_interval,
+            # بدون قائمة مسبقة يصبح أول فحص هو الأساس ولا يُرسل منه شيء.
+            "baseline": set(baseline) if baseline is not None else previous.get("baseline"),
         }
-        if otp:
-            text = get_text(lang, "otp_found", otp=telegram_html(otp)) + "\n\n" + get_text(
-                lang, "message_detail", **safe_values
-            )
-        else:
-            text = get_text(lang, "message_detail", **safe_values)
+        self._bot = bot
+        self.stats["started"] += 1
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        self._wakeup.set()
+        return self._watches[address]["deadline"]
+
+    def stop(self, address: str) -> bool:
+        return self._watches.pop(str(address or "").lower(), None) is not None
+
+    async def _run(self) -> None:
+        while self._watches:
+            address, watch = min(self._watches.items(), key=lambda item: item[1]["next_at"])
+            delay = watch["next_at"] - time.monotonic()
+            if delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
 
-        await query.edit_message_text(text,
-                                      reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "btn_back"), callback_data=f"inbox_{email_index}")]]),
-                                      parse_mode="HTML")
-        return
+            if time.monotonic() >= watch["deadline"]:
+                self._watches.pop(address, None)
+                self.stats["timeouts"] += 1
+                await self._notify_timeout(watch["owner"], address)
+                continue
 
-    # إدارة إيميلات المستخدم من قسم واحد بعيداً عن القائمة الرئيسية
-    if data == "manage_emails":
-        emails = get_user_emails(user_id)
-        text = (
-            "⚙️ إدارة إيميلاتك\n\n"
-            f"📧 عدد إيميلاتك الحالية: {len(emails)}\n\n"
-            "اختر العملية التي تريدها:"
+            await self._bucket.acquire()
+            if self._watches.get(address) is not watch:
+                continue
+            watch["next_at"] = time.monotonic() + watch["interval"]
+            try:
+                await self._poll(address, watch)
+            except Exception as error:
+                print(f"⚠️ مراقبة {address}: {type(error).__name__}: {error}")
+            watch["next_at"] = min(time.monotonic() + watch["interval"], watch["deadline"])
+
+    async def _poll(self, address: str, watch: dict) -> None:
+        owner = watch["owner"]
+        emails = await get_user_emails_async(owner)
+        email_index = next(
+            (index for index, item in enumerate(emails) if str(item.get("address") or "").lower() == address),
+            None,
         )
-        rows = []
-        if emails:
-            rows.extend([
-                [InlineKeyboardButton(
-                    "🗑️ حذف إيميل محدد",
-                    callback_data="manage_delete_one",
-                    style="danger",
-                )],
-                [InlineKeyboardButton(
-                    "🗑️ حذف كل الإيميلات",
-                    callback_data="manage_confirm_delete_all",
-                    style="danger",
-                )],
-            ])
-        else:
-            text += "\n\n📭 لا توجد إيميلات حالياً."
-        rows.append([
-            InlineKeyboardButton(
-                get_text(lang, "btn_back"),
-                callback_data="back_to_menu",
-                style="primary",
-            )
-        ])
-        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(rows))
-        return
-
-    if data == "manage_delete_one":
-        emails = get_user_emails(user_id)
-        if not emails:
-            await query.edit_message_text(
-                get_text(lang, "no_emails"),
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton(
-                        get_text(lang, "btn_back"),
-                        callback_data="manage_emails",
-                        style="primary",
-                    )
-                ]]),
-            )
+        if email_index is None:
+            self._watches.pop(address, None)
             return
 
-        rows = []
-        for email_index, email_info in enumerate(emails):
-            address = str(email_info.get("address") or "بريد غير معروف")
-            display_address = address if len(address) <= 34 else address[:31] + "..."
-            rows.append([
-                InlineKeyboardButton(
-                    f"🗑️ {display_address}",
-                    callback_data=f"manage_confirm_delete_{email_index}",
-                    style="danger",
-                )
-            ])
-        rows.append([
-            InlineKeyboardButton(
-                get_text(lang, "btn_back"),
-                callback_data="manage_emails",
-                style="primary",
-            )
-        ])
-        await query.edit_message_text(
-            "🗑️ اختر الإيميل الذي تريد حذفه:",
-            reply_markup=InlineKeyboardMarkup(rows),
-        )
-        return
+        self.stats["polls"] += 1
+        result = await check_user_inbox_detailed(owner, email_index, priority=MAIL_PRIORITY_BACKGROUND)
+        error_code = result.get("error")
+        if error_code == "rate_limited":
+            # 429 يخص الخدمة كلها، فيتوقف كل الفحص قليلاً لا هذا البريد وحده.
+            self.stats["rate_limited"] += 1
+            self._bucket.pause(self.max_interval)
+            watch["interval"] = self.max_interval
+            return
+        if error_code in ("token_invalid", "email_missing"):
+            self._watches.pop(address, None)
+            return
+        if error_code is not None:
+            watch["interval"] = min(self.max_interval, watch["interval"] * 2)
+            return
 
-    if re.fullmatch(r"manage_confirm_delete_\d+", data):
-        email_index = int(data.rsplit("_", 1)[1])
-        emails = get_user_emails(user_id)
-        if email_index >= len(emails):
-            await query.edit_message_text(
-                "⚠️ هذا الإيميل لم يعد موجوداً.",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton(
-                        get_text(lang, "btn_back"),
-                        callback_data="manage_delete_one",
-                        style="primary",
-                    )
-                ]]),
-            )
+        messages = result.get("messages") or []
+        ids = [str(message.get("id") or "") for message in messages]
+        if watch["baseline"] is None:
+            watch["baseline"] = set(ids)
             return
 
-        address = str(emails[email_index].get("address") or "غير معروف")
-        text = (
-            "⚠️ تأكيد حذف الإيميل\n\n"
-            f"📧 {address}\n\n"
-            "هل أنت متأكد؟"
-        )
-        await query.edit_message_text(
-            text,
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton(
-                    "✅ تأكيد الحذف",
-                    callback_data=f"manage_delete_{email_index}",
-                    style="success",
-                ),
-                InlineKeyboardButton(
-                    "❌ إلغاء",
-                    callback_data="manage_delete_one",
-                    style="danger",
-                ),
-            ]]),
-        )
-        return
+        new_messages = [message for message, message_id in zip(messages, ids) if message_id not in watch["baseline"]]
+        if not new_messages:
+            # Mercure يغطي البريد المتصل، فيكفي فحصه بأبعد فترة.
+            if MERCURE_PUSH.is_connected(address):
+                watch["interval"] = self.max_interval
+            else:
+                watch["interval"] = min(self.max_interval, watch["interval"] * 1.5)
+            return
 
-    if re.fullmatch(r"manage_delete_\d+", data):
-        email_index = int(data.rsplit("_", 1)[1])
-        emails = get_user_emails(user_id)
-        if email_index >= len(emails):
+        found_otp = False
+        last_seen = await get_last_seen_message_id_async(address)
+        for message in reversed(new_messages):
+            message_id = str(message.get("id") or "")
+            watch["baseline"].add(message_id)
+            found_otp = found_otp or bool(extract_otp(f"{message.get('subject') or ''}\n{message.get('intro') or ''}"))
+            # ما وصل عبر Mercure مسجل في email_seen ولا يُرسل مرة ثانية.
+            if message_id_newer(message_id, last_seen):
+                last_seen = message_id
+                await set_last_seen_message_id_async(address, message_id)
+                await deliver_new_mail_notification(self._bot, owner, address, message)
+        watch["interval"] = self.min_interval
+        if found_otp:
+            self._watches.pop(address, None)
+            self.stats["found"] += 1
+
+    async def _notify_timeout(self, owner: int, address: str) -> None:
+        if self._bot is None:
             return
-        email_data = emails[email_index]
-        remove_user_email(user_id, email_data["address"])
-        await query.edit_message_text(
-            get_text(lang, "email_deleted", email=email_data["address"]),
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton(
-                    get_text(lang, "btn_back"),
-                    callback_data="manage_emails",
-                    style="primary",
-                )
-            ]]),
+        emails = await get_user_emails_async(owner)
+        email_index = next(
+            (index for index, item in enumerate(emails) if str(item.get("address") or "").lower() == address),
+            None,
         )
-        return
-
-    if data == "manage_confirm_delete_all":
-        emails = get_user_emails(user_id)
-        if not emails:
-            await query.edit_message_text(
-                get_text(lang, "no_emails"),
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton(
-                        get_text(lang, "btn_back"),
-                        callback_data="manage_emails",
-                        style="primary",
-                    )
-                ]]),
-            )
+        if email_index is None:
             return
+        try:
+            await self._bot.send_message(
+                chat_id=owner,
+                text=get_text("ar", "watch_timeout", email=telegram_html(emails[email_index]["address"])),
+                parse_mode="HTML",
+                reply_markup=get_watch_keyboard(email_index, False),
+            )
+        except TelegramError as error:
+            print(f"⚠️ فشل إرسال انتهاء المراقبة للمستخدم {owner}: {error}")
+
+    async def close(self) -> None:
+        self._watches.clear()
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    def get_stats(self) -> dict:
+        stats = dict(self.stats)
+        stats["active"] = len(self._watches)
+        stats["max_active"] = self.max_active
+        return stats
+
+
+INBOX_WATCHER = InboxWatchScheduler(
+    WATCH_REQUESTS_PER_SECOND,
+    WATCH_MIN_INTERVAL_SECONDS,
+    WATCH_MAX_INTERVAL_SECONDS,
+    WATCH_MAX_ACTIVE,
+)
 
-        text = (
-            "⚠️ تأكيد حذف جميع الإيميلات\n\n"
-            f"📧 سيتم حذف جميع إيميلاتك الحالية: {len(emails)}\n\n"
-            "⚠️ لا يمكن التراجع عن العملية بعد التأكيد."
-        )
-        await query.edit_message_text(
-            text,
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton(
-                    "✅ نعم، حذف الكل",
-                    callback_data="manage_delete_all",
-                    style="danger",
-                ),
-                InlineKeyboardButton(
-                    "❌ إلغاء",
-                    callback_data="manage_emails",
-                    style="primary",
-                ),
-            ]]),
-        )
-        return
 
-    if data == "manage_delete_all":
-        success, count = clear_user_emails(user_id)
-        text = (
-            get_text(lang, "all_emails_deleted", count=count)
-            if success
-            else "❌ فشل حذف الإيميلات"
-        )
-        await query.edit_message_text(
-            text,
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton(
-                    get_text(lang, "btn_back"),
-                    callback_data="manage_emails",
-                    style="primary",
+# ================== أدوات منع/سماح (جديد) ==================
+# ================== أدوات منع/سماح (جديد) ==================
+# ================== أدوات منع/سماح (جديد) ==================
+
+async def guard_user(update_or_query, context, user_id: int, lang: str) -> bool:
+    """
+    يرجع False إذا لازم نوقف (محظور/غير مشترك/البوت مطفي)
+    """
+    # الكاش الساخن يُقرأ مباشرة دون المرور بخيوط قاعدة البيانات.
+    if auth_cache_ready("admins", "banned"):
+        admin_user = is_admin(user_id)
+        banned = not admin_user and is_banned(user_id)
+    else:
+        admin_user = await is_admin_async(user_id)
+        banned = not admin_user and await is_banned_async(user_id)
+
+    # محظور؟
+    if banned:
+        msg = get_text(lang, "banned")
+        if hasattr(update_or_query, "message") and update_or_query.message:
+            await update_or_query.message.reply_text(msg)
+        else:
+            try:
+                await update_or_query.edit_message_text(msg)
+            except:
+                pass
+        return False
+
+    # بوت مطفي؟
+    if not bot_active and not admin_user:
+        if bot_offline_message:
+            prefix = "⚠️ البوت متوقف مؤقتاً\n\n"
+            text = prefix + bot_offline_message
+            rich_body = bot_offline_message_html or escape(bot_offline_message, quote=False)
+            rich_text = escape(prefix, quote=False) + rich_body
+        else:
+            text = "⚠️ البوت متوقف مؤقتاً."
+            rich_text = escape(text, quote=False)
+        if hasattr(update_or_query, "message") and update_or_query.message:
+            await update_or_query.message.reply_text(rich_text, parse_mode="HTML")
+        else:
+            try:
+                await update_or_query.edit_message_text(rich_text, parse_mode="HTML")
+            except Exception:
+                pass
+        return False
+
+    # اشتراك صارم بكل القنوات المفعّلة (لغير الأدمن)
+    if not admin_user:
+        if auth_cache_ready("channels"):
+            active_channels = get_channels(only_enabled=True)
+        else:
+            active_channels = await get_channels_async(only_enabled=True)
+        missing_channels = await get_missing_subscription_channels(user_id, context, active_channels)
+        if missing_channels:
+            text, kb = await subscription_prompt_async(lang, missing_channels)
+            if hasattr(update_or_query, "message") and update_or_query.message:
+                await update_or_query.message.reply_text(
+                    text,
+                    reply_markup=kb,
+                    parse_mode="HTML",
                 )
-            ]]),
-        )
+            else:
+                try:
+                    await update_or_query.edit_message_text(
+                        text,
+                        reply_markup=kb,
+                        parse_mode="HTML",
+                    )
+                except Exception:
+                    pass
+            return False
+
+        for active_channel in active_channels:
+            await notify_admin_subscription(context, user_id, active_channel)
+
+    return True
+
+
+# ================== أوامر ==================
+
+async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    message = update.effective_message
+    if user is None or message is None:
         return
 
-    # عرض تفاصيل إيميل
-    if data.startswith("view_email_"):
-        idx_str = data.split("_", 2)[2]
-        if not idx_str.isdigit():
-            return
-        email_index = int(idx_str)
-        emails = get_user_emails(user_id)
-        if email_index >= len(emails):
-            return
-        email_data = emails[email_index]
-        email_password = email_data.get("password") or LEGACY_MAIL_PASSWORD
-        text = f"📧 <code>{email_data['address']}</code>\n🔑 <code>{telegram_html(email_password)}</code>"
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton(get_text(lang, "btn_inbox"), callback_data=f"inbox_{email_index}", style="primary")],
-            [InlineKeyboardButton(get_text(lang, "btn_delete"), callback_data=f"confirm_delete_{email_index}", style="danger")],
-            [InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="my_emails")]
-        ])
-        await query.edit_message_text(text, reply_markup=kb, parse_mode="HTML")
-        return
+    user_id = user.id
+    await register_user_activity(context, user)
+    lang = "ar"
 
-    # تأكيد حذف إيميل
-    if re.fullmatch(r"confirm_delete_\d+", data):
-        idx_str = data.split("_", 2)[2]
-        if not idx_str.isdigit():
-            return
-        email_index = int(idx_str)
-        emails = get_user_emails(user_id)
-        if email_index >= len(emails):
-            return
-        email_data = emails[email_index]
-        text = f"⚠️ هل أنت متأكد من حذف هذا الإيميل؟\n\n📧 {email_data['address']}"
-        kb = InlineKeyboardMarkup([[
-            InlineKeyboardButton(get_text(lang, "btn_confirm"), callback_data=f"delete_{email_index}", style="danger"),
-            InlineKeyboardButton(get_text(lang, "btn_cancel"), callback_data="my_emails")
-        ]])
-        await query.edit_message_text(text, reply_markup=kb)
+    if not await guard_user(update, context, user_id, lang):
         return
 
-    if re.fullmatch(r"delete_\d+", data):
-        idx_str = data.split("_", 1)[1]
-        if not idx_str.isdigit():
-            return
-        email_index = int(idx_str)
-        emails = get_user_emails(user_id)
-        if email_index >= len(emails):
-            return
-        email_data = emails[email_index]
-        remove_user_email(user_id, email_data["address"])
-        await query.edit_message_text(get_text(lang, "email_deleted", email=email_data["address"]),
-                                      reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="back_to_menu")]]))
-        return
+    await message.reply_text(
+        await build_main_menu_html_async(user_id),
+        reply_markup=await get_main_menu_keyboard_async(lang, user_id),
+        parse_mode="HTML",
+    )
 
-    # حذف الكل
-    if data == "confirm_delete_all":
-        emails = get_user_emails(user_id)
-        if not emails:
-            await query.edit_message_text(get_text(lang, "no_emails"),
-                                          reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="back_to_menu")]]))
-            return
-        text = f"⚠️ هل أنت متأكد من حذف جميع الإيميلات؟\n\nالعدد: {len(emails)}"
-        kb = InlineKeyboardMarkup([[
-            InlineKeyboardButton(get_text(lang, "btn_confirm"), callback_data="delete_all", style="danger"),
-            InlineKeyboardButton(get_text(lang, "btn_cancel"), callback_data="back_to_menu")
-        ]])
-        await query.edit_message_text(text, reply_markup=kb)
-        return
 
-    if data == "delete_all":
-        success, count = clear_user_emails(user_id)
-        text = get_text(lang, "all_emails_deleted", count=count) if success else "❌ فشل حذف الإيميلات"
-        await query.edit_message_text(
-            text,
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="back_to_menu")
-            ]]),
-        )
+async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    message = update.effective_message
+    if user is None or message is None:
         return
 
-    # ================== لوحة الأدمن (القديمة) ==================
-    # ================== لوحة الأدمن (القديمة) ==================
-    if data == "admin_panel":
-        if not is_admin(user_id):
-            await query.answer(get_text(lang, "unauthorized"), show_alert=True)
-            return
-        await query.edit_message_text("👑 لوحة تحكم المشرف\n\nاختر القسم:",
-                                      reply_markup=get_admin_panel_keyboard(lang, user_id))
+    user_id = user.id
+    if not await is_admin_async(user_id):
+        await message.reply_text(get_text("ar", "unauthorized"))
         return
+    await message.reply_text("👑 لوحة المشرف", reply_markup=get_admin_panel_keyboard("ar", user_id))
 
-    if data == "section_health":
-        if not is_admin(user_id):
-            await query.answer(get_text(lang, "unauthorized"), show_alert=True)
-            return
 
-        db_health, mail_health = await asyncio.gather(
-            asyncio.to_thread(check_database_health),
-            asyncio.to_thread(check_mail_service_health),
-        )
-        telegram_started = time.perf_counter()
-        telegram_ok = True
-        telegram_error = ""
-        try:
-            await context.bot.get_me()
-        except Exception as error:
-            telegram_ok = False
-            telegram_error = str(error)[:120]
-        telegram_ms = int((time.perf_counter() - telegram_started) * 1000)
-
-        db_ok, db_ms, db_error = db_health
-        mail_ok, mail_ms, mail_error = mail_health
-        bot_status = "✅ يعمل" if bot_active else "⛔ متوقف للمستخدمين"
-        telegram_status = f"✅ متصل ({telegram_ms} ms)" if telegram_ok else "❌ غير متصل"
-        db_status = f"✅ متصلة ({db_ms} ms)" if db_ok else "❌ غير متصلة"
-        mail_status = f"✅ متاحة ({mail_ms} ms)" if mail_ok else "❌ غير متاحة"
-
-        errors = []
-        if not telegram_ok:
-            errors.append(f"تلجرام: {telegram_error}")
-        if not db_ok:
-            errors.append(f"قاعدة البيانات: {db_error}")
-        if not mail_ok:
-            errors.append(f"mail.tm: {mail_error}")
-        errors_text = "\n".join(f"• {item}" for item in errors) if errors else "لا توجد أخطاء في الفحص الحالي."
+# ================== الأزرار ==================
 
-        text = (
-            "🩺 حالة البوت والخدمات\n\n"
-            f"🤖 حالة البوت: {bot_status}\n"
-            f"📨 اتصال تلجرام: {telegram_status}\n"
-            f"🗄️ قاعدة البيانات: {db_status}\n"
-            f"📧 خدمة mail.tm: {mail_status}\n"
-            f"⏱️ مدة التشغيل: {format_bot_uptime()}\n\n"
-            f"⚠️ نتيجة الأخطاء:\n{errors_text}"
-        )
-        await query.edit_message_text(
-            text,
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔄 تحديث الفحص", callback_data="section_health", style="success")],
-                [InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="admin_panel", style="primary")],
-            ]),
-        )
-        return
+class CallbackRouter:
+    """توجيه ضغطات الأزرار حسب callback_data بدل سلسلة if/regex طويلة.
+
+    المسارات الثابتة في قاموس مطابقة تامة، وذات المعاملات (مثل msg_{email_index:int}_{msg_index:int})
+    في شجرة بادئات مقسمة على "_"، فتكلفة التوجيه ثابتة مهما زاد عدد الأزرار. لكل مسار شروطه
+    (مشرف/مشرف رئيسي، مفتاح تبريد) وإحصائيات زمن تنفيذه.
+    """
 
-    if data == "channel_management":
-        if not is_admin(user_id):
-            await query.answer(get_text(lang, "unauthorized"), show_alert=True)
+    PARAM_TYPES = {"int": int, "str": str}
+    PARAM_RE = re.compile(r"\{(\w+):(\w+)\}")
+    # "_" خارج الأقواس فقط، لأن أسماء المعاملات نفسها قد تحتوي "_".
+    TOKEN_SPLIT_RE = re.compile(r"_(?![^{]*\})")
+
+    def __init__(self):
+        self._exact = {}
+        self._trie = {"literals": {}, "params": [], "route": None}
+        self.stats = {}
+
+    def route(self, pattern: str, access: str = None, denied_text: str = None,
+              cooldown: tuple = None, guard: bool = True):
+        """مزخرف لتسجيل معالج زر. access: None أو "admin" أو "owner"، cooldown: (المفتاح، الثواني)."""
+        def decorator(handler):
+            self.add(pattern, handler, access=access, denied_text=denied_text, cooldown=cooldown, guard=guard)
+            return handler
+        return decorator
+
+    def add(self, pattern: str, handler, access: str = None, denied_text: str = None,
+            cooldown: tuple = None, guard: bool = True):
+        route = {
+            "pattern": pattern,
+            "handler": handler,
+            "access": access,
+            "denied_text": denied_text,
+            "cooldown": cooldown,
+            "guard": guard,
+        }
+        if not self.PARAM_RE.search(pattern):
+            if pattern in self._exact:
+                raise ValueError(f"مسار مكرر: {pattern}")
+            self._exact[pattern] = route
             return
 
-        channels = get_channels(only_enabled=False)
-        enabled_count = sum(1 for item in channels if item.get("subscription_enabled"))
-        text = (
-            "📢 إدارة قنوات الاشتراك الإجباري\n\n"
-            f"📋 عدد القنوات المضافة: {len(channels)}\n"
-            f"✅ القنوات المفعّلة: {enabled_count}\n\n"
-        )
-        if channels:
-            text += "اضغط على أي قناة لإدارتها، أو أضف قناة جديدة."
-        else:
-            text += "لا توجد قنوات حالياً. أضف أول قناة للبدء."
+        node = self._trie
+        for token in self.TOKEN_SPLIT_RE.split(pattern):
+            param = self.PARAM_RE.fullmatch(token)
+            if param is None:
+                node = node["literals"].setdefault(token, {"literals": {}, "params": [], "route": None})
+                continue
+            name, type_name = param.groups()
+            converter = self.PARAM_TYPES[type_name]
+            for edge in node["params"]:
+                if edge["name"] == name and edge["type"] is converter:
+                    node = edge["node"]
+                    break
+            else:
+                edge = {"name": name, "type": converter, "node": {"literals": {}, "params": [], "route": None}}
+                node["params"].append(edge)
+                node = edge["node"]
+        if node["route"] is not None:
+            raise ValueError(f"مسار مكرر: {pattern}")
+        node["route"] = route
+
+    @staticmethod
+    def _parse(converter, token: str):
+        if converter is int:
+            return int(token) if token.isdigit() else None
+        return converter(token) if token else None
+
+    def _match(self, node, tokens, position, params):
+        if position == len(tokens):
+            return node["route"]
+        token = tokens[position]
+        child = node["literals"].get(token)
+        if child is not None:
+            found = self._match(child, tokens, position + 1, params)
+            if found is not None:
+                return found
+        for edge in node["params"]:
+            value = self._parse(edge["type"], token)
+            if value is None:
+                continue
+            params[edge["name"]] = value
+            found = self._match(edge["node"], tokens, position + 1, params)
+            if found is not None:
+                return found
+            params.pop(edge["name"], None)
+        return None
 
-        await query.edit_message_text(
-            text,
-            reply_markup=get_channel_management_keyboard(lang),
-        )
-        return
+    def resolve(self, data: str):
+        """يرجع (المسار، المعاملات المحوّلة) أو (None, None) لو لم يطابق أي مسار."""
+        route = self._exact.get(data)
+        if route is not None:
+            return route, {}
+        params = {}
+        route = self._match(self._trie, data.split("_"), 0, params)
+        if route is None:
+            return None, None
+        return route, params
+
+    def record(self, route, elapsed_ms: float, failed: bool = False):
+        stats = self.stats.get(route["pattern"])
+        if stats is None:
+            stats = self.stats[route["pattern"]] = {"count": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0}
+        stats["count"] += 1
+        stats["total_ms"] += elapsed_ms
+        stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+        if failed:
+            stats["errors"] += 1
+
+    def get_stats(self, top: int = 3) -> dict:
+        total = sum(stats["count"] for stats in self.stats.values())
+        slowest = sorted(
+            (
+                (pattern, stats["total_ms"] / stats["count"], stats["max_ms"], stats["count"])
+                for pattern, stats in self.stats.items()
+                if stats["count"]
+            ),
+            key=lambda item: item[1],
+            reverse=True,
+        )[:top]
+        return {
+            "routes": len(self._exact) + self._count_trie_routes(self._trie),
+            "calls": total,
+            "errors": sum(stats["errors"] for stats in self.stats.values()),
+            "slowest": slowest,
+        }
 
+    def _count_trie_routes(self, node) -> int:
+        count = 1 if node["route"] is not None else 0
+        for child in node["literals"].values():
+            count += self._count_trie_routes(child)
+        for edge in node["params"]:
+            count += self._count_trie_routes(edge["node"])
+        return count
 
-    if data == "channel_stats":
-        if not is_admin(user_id):
-            return
 
-        channel_stats = await asyncio.to_thread(get_channel_subscription_stats)
-        if channel_stats is None:
-            await query.edit_message_text(
-                "❌ تعذر تحميل إحصائيات القنوات حالياً.",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton(
-                        get_text(lang, "btn_back"),
-                        callback_data="channel_management",
-                        style="primary",
-                    )
-                ]]),
+CALLBACK_ROUTER = CallbackRouter()
+
+
+@CALLBACK_ROUTER.route("verify_subscription", guard=False)
+async def cb_verify_subscription(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    invalidate_membership(user_id)
+    missing_channels = await get_missing_subscription_channels(user_id, context)
+    if missing_channels:
+        try:
+            await query.answer(
+                "⚠️ يرجى الاشتراك بالقنوات لاستخدام البوت.",
+                show_alert=True,
             )
-            return
+        except Exception:
+            pass
+        return
 
-        enabled_count = sum(1 for item in channel_stats if item.get("subscription_enabled"))
-        disabled_count = len(channel_stats) - enabled_count
-        total_verified = sum(int(item.get("verified_count") or 0) for item in channel_stats)
-        text = (
-            "📊 إحصائيات قنوات الاشتراك\n\n"
-            f"📢 إجمالي القنوات: {len(channel_stats)}\n"
-            f"✅ المفعّلة: {enabled_count}\n"
-            f"❌ المعطّلة: {disabled_count}\n\n"
-            f"👥 إجمالي عمليات الاشتراك التي تحقق منها البوت: {total_verified}\n"
-        )
+    try:
+        await query.answer("✅ تم التحقق من الاشتراك.", show_alert=False)
+    except Exception:
+        pass
+    for active_channel in await get_channels_async(only_enabled=True):
+        await notify_admin_subscription(context, user_id, active_channel)
+    text = (
+        "✅ تم التحقق من اشتراكك في جميع القنوات بنجاح!\n\n"
+        + await build_main_menu_html_async(user_id)
+    )
+    await query.edit_message_text(
+        text,
+        reply_markup=await get_main_menu_keyboard_async(lang, user_id),
+        parse_mode="HTML",
+    )
 
-        if channel_stats:
-            text += "\n━━━━━━━━━━━━━━\n"
-            shown = 0
-            for item in channel_stats:
-                title = item.get("channel_title") or item.get("channel_username") or "غير محدد"
-                username = str(item.get("channel_username") or "").lstrip("@")
-                status = "✅ مفعّلة" if item.get("subscription_enabled") else "❌ معطّلة"
-                verified_count = int(item.get("verified_count") or 0)
-                block = (
-                    f"\n📢 <b>{telegram_html(title)}</b>\n"
-                    f"🔗 @{telegram_html(username)}\n"
-                    f"⚙️ الحالة: {status}\n"
-                    f"👥 تحقق البوت من اشتراك: {verified_count} عضو\n"
-                )
-                if len(text) + len(block) > 3800:
-                    remaining = len(channel_stats) - shown
-                    text += f"\n… ويوجد {remaining} قناة إضافية."
-                    break
-                text += block
-                shown += 1
-        else:
-            text += "\nلا توجد قنوات مضافة حالياً."
 
+# رجوع للقائمة
+@CALLBACK_ROUTER.route("back_to_menu")
+async def cb_back_to_menu(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    await query.edit_message_text(
+        await build_main_menu_html_async(user_id),
+        reply_markup=await get_main_menu_keyboard_async(lang, user_id),
+        parse_mode="HTML",
+    )
+
+
+# عرض الدومينات الشكلية المدفوعة للمستخدم
+@CALLBACK_ROUTER.route("change_domain")
+async def cb_change_domain(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    keyboard = await run_db(get_paid_domains_keyboard)
+    if keyboard is None:
         await query.edit_message_text(
-            text,
-            parse_mode="HTML",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton(
-                    "🔄 تحديث الإحصائيات",
-                    callback_data="channel_stats",
-                    style="success",
-                )],
-                [InlineKeyboardButton(
-                    get_text(lang, "btn_back"),
-                    callback_data="channel_management",
-                    style="primary",
-                )],
-            ]),
+            "💎 لا توجد دومينات مدفوعة متاحة حالياً.",
+            reply_markup=back_keyboard("create_email", "primary"),
         )
         return
 
-    if data == "edit_subscription_message":
-        if not is_admin(user_id):
-            return
-        current_message = get_global_subscription_message_html()
-        context.user_data["waiting_for"] = "global_subscription_message"
+    await query.edit_message_text(
+        "💎 الدومينات المدفوعة\n\nاختر أحد الدومينات المدفوعة المتاحة:",
+        reply_markup=keyboard,
+    )
+
+
+@CALLBACK_ROUTER.route("paid_domain_{domain_index:int}")
+async def cb_paid_domain(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str, domain_index: int):
+    domains = await get_paid_domains_async()
+    if domain_index >= len(domains):
         await query.edit_message_text(
-            "✏️ تعديل رسالة الاشتراك الإجباري\n\n"
-            "الرسالة الحالية:\n\n"
-            f"{current_message}\n\n"
-            "أرسل الرسالة الجديدة الآن.\n\n"
-            "📌 قائمة القنوات ستظهر تلقائياً بين أول فقرة وباقي الرسالة.\n"
-            "🌟 الإيموجي المميز يُحفظ تلقائياً عند إرساله داخل النص.",
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton(
-                    get_text(lang, "btn_back"),
-                    callback_data="channel_management",
-                    style="primary",
-                )
-            ]]),
-            parse_mode="HTML",
+            "⚠️ هذا الدومين لم يعد متاحاً.",
+            reply_markup=back_keyboard("change_domain", "primary"),
         )
         return
 
-    if data == "set_channel":
-        if not is_admin(user_id):
-            return
-        context.user_data["waiting_for"] = "channel_username"
-        await query.edit_message_text(
-            "➕ إضافة قناة للاشتراك الإجباري\n\n"
-            "أرسل username القناة بدون @.\n"
-            "مثال: mychannel\n\n"
-            "يمكنك إضافة أكثر من قناة، ولن تُحذف القنوات السابقة.",
-            reply_markup=InlineKeyboardMarkup([[
+    domain = domains[domain_index]
+    rows = []
+    contact_username = await get_admin_contact_username_async()
+    if contact_username:
+        rows.append([
+            InlineKeyboardButton(
+                "💬 التواصل مع الأدمن",
+                url=f"https://t.me/{contact_username}",
+                style="success",
+            )
+        ])
+    rows.append([
+        InlineKeyboardButton(
+            get_text(lang, "btn_back"),
+            callback_data="change_domain",
+            style="primary",
+        )
+    ])
+    await query.edit_message_text(
+        "💎 هذه الخدمة مدفوعة.\n\n"
+        f"🌐 الدومين المختار: @{domain}\n\n"
+        "يرجى التواصل مع الأدمن لاستخدام هذا الدومين.",
+        reply_markup=InlineKeyboardMarkup(rows),
+    )
+
+
+# إنشاء إيميل: يختار المستخدم بين الإنشاء السريع أو دومين مجاني محدد.
+@CALLBACK_ROUTER.route("create_email")
+async def cb_create_email(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    current_count = len(await get_user_emails_async(user_id))
+    email_limit = await get_effective_email_limit_async(user_id)
+    if (not await is_admin_async(user_id)) and email_limit > 0 and current_count >= email_limit:
+        contact_username = await get_admin_contact_username_async()
+        rows = []
+        if contact_username:
+            rows.append([
                 InlineKeyboardButton(
-                    get_text(lang, "btn_back"),
-                    callback_data="channel_management",
+                    "💬 التواصل مع الأدمن",
+                    url=f"https://t.me/{contact_username}",
                     style="primary",
                 )
-            ]]),
+            ])
+        rows.append([
+            InlineKeyboardButton(
+                get_text(lang, "btn_back"),
+                callback_data="back_to_menu",
+                style="primary",
+            )
+        ])
+        await query.edit_message_text(
+            "⚠️ لقد وصلت إلى الحد المسموح لإنشاء الإيميلات.\n\n"
+            "يرجى التواصل مع الأدمن لإنشاء المزيد من الإيميلات.",
+            reply_markup=InlineKeyboardMarkup(rows),
         )
         return
 
-    if re.fullmatch(r"manage_channel_\d+", data):
-        if not is_admin(user_id):
-            return
-        channel_db_id = int(data.rsplit("_", 1)[1])
-        channel_info = get_channel_by_id(channel_db_id)
-        if not channel_info:
-            await query.edit_message_text(
-                "❌ هذه القناة لم تعد موجودة.",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton(
-                        get_text(lang, "btn_back"),
-                        callback_data="channel_management",
-                        style="primary",
-                    )
-                ]]),
-            )
-            return
-
-        status = "✅ مفعّل" if channel_info.get("subscription_enabled") else "❌ معطّل"
-        status_button = "❌ تعطيل الاشتراك" if channel_info.get("subscription_enabled") else "✅ تفعيل الاشتراك"
-        status_style = "danger" if channel_info.get("subscription_enabled") else "success"
-        cid = channel_info.get("channel_id", "غير محدد")
-        title = channel_info.get("channel_title", "غير محدد")
-        username = channel_info["channel_username"]
-        text = (
-            "📢 إدارة القناة\n\n"
-            f"📢 الاسم: <b>{telegram_html(title)}</b>\n"
-            f"🔗 القناة: @{telegram_html(username)}\n"
-            f"🆔 المعرّف: <code>{cid}</code>\n"
-            f"⚙️ الحالة: {status}"
-        )
-        kb = InlineKeyboardMarkup([
+    text = (
+        "✨ إنشاء إيميل جديد\n\n"
+        "من هنا يمكنك اختيار طريقة إنشاء بريدك الإلكتروني.\n\n"
+        "🎲 الإنشاء السريع:\n"
+        "ينشئ لك البوت إيميل جديد مباشرة ويختار أحد\n"
+        "الدومينات المجانية المتاحة تلقائياً.\n\n"
+        "🌐 اختيار الدومين:\n"
+        "اختر بنفسك أحد الدومينات المجانية المتاحة\n"
+        "لإنشاء الإيميل عليه.\n\n"
+        "💎 الدومينات المدفوعة:\n"
+        "استعرض الدومينات المدفوعة المتوفرة واختر\n"
+        "الدومين الذي ترغب باستخدامه."
+    )
+    await query.edit_message_text(
+        text,
+        reply_markup=InlineKeyboardMarkup([
             [
                 InlineKeyboardButton(
-                    status_button,
-                    callback_data=f"toggle_subscription_{channel_db_id}",
-                    style=status_style,
+                    "🎲 إنشاء سريع",
+                    callback_data="create_email_fast",
+                    style="success",
                 ),
                 InlineKeyboardButton(
-                    "🗑 حذف القناة",
-                    callback_data=f"delete_channel_{channel_db_id}",
-                    style="danger",
+                    "🌐 اختيار الدومين",
+                    callback_data="select_free_domain",
+                    style="primary",
                 ),
             ],
+            [InlineKeyboardButton(
+                "💎 الدومينات المدفوعة",
+                callback_data="change_domain",
+                style="primary",
+            )],
             [InlineKeyboardButton(
                 get_text(lang, "btn_back"),
-                callback_data="channel_management",
+                callback_data="back_to_menu",
                 style="primary",
             )],
-        ])
-        await query.edit_message_text(text, reply_markup=kb, parse_mode="HTML")
-        return
+        ]),
+    )
 
-    if re.fullmatch(r"delete_channel_\d+", data):
-        if not is_admin(user_id):
-            return
-        channel_db_id = int(data.rsplit("_", 1)[1])
-        channel_info = get_channel_by_id(channel_db_id)
-        if channel_info and delete_channel(channel_info["channel_username"]):
-            await query.edit_message_text(
-                f"✅ تم حذف القناة @{channel_info['channel_username']} بنجاح.",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton(
-                        get_text(lang, "btn_back"),
-                        callback_data="channel_management",
-                        style="primary",
-                    )
-                ]]),
-            )
-        else:
-            await query.edit_message_text(
-                "❌ تعذر حذف القناة.",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton(
-                        get_text(lang, "btn_back"),
-                        callback_data="channel_management",
-                        style="primary",
-                    )
-                ]]),
-            )
+
+@CALLBACK_ROUTER.route("create_email_fast", cooldown=("create_email", CREATE_EMAIL_COOLDOWN_SECONDS))
+async def cb_create_email_fast(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    current_count = len(await get_user_emails_async(user_id))
+    email_limit = await get_effective_email_limit_async(user_id)
+    if (not await is_admin_async(user_id)) and email_limit > 0 and current_count >= email_limit:
+        await query.edit_message_text(
+            "⚠️ لقد وصلت إلى الحد المسموح لإنشاء الإيميلات.",
+            reply_markup=back_keyboard("back_to_menu", "primary"),
+        )
         return
 
-    if re.fullmatch(r"toggle_subscription_\d+", data):
-        if not is_admin(user_id):
-            return
-        channel_db_id = int(data.rsplit("_", 1)[1])
-        channel_info = get_channel_by_id(channel_db_id)
-        if not channel_info:
-            return
-        new_status = toggle_subscription(channel_info["channel_username"])
-        action = "تفعيل" if new_status else "تعطيل"
+    await query.edit_message_text(
+        "🎲 إنشاء سريع\n\n"
+        "جاري إنشاء إيميل جديد باستخدام أحد الدومينات المجانية المتاحة..."
+    )
+    email, token, password = await take_email()
+    if email and token:
+        await add_user_email_async(user_id, email, token, password)
+        # البريد الجديد هو الأرجح لاستقبال رمز تحقق، فيدخل كاش التوكنات ليُتابع فوراً عبر Mercure.
+        remember_email_token(user_id, {"address": email, "token": token, "password": password})
+        increment_daily_stat("emails_created")
         await query.edit_message_text(
-            f"✅ تم {action} الاشتراك الإجباري لقناة @{channel_info['channel_username']}.",
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton(
+            get_text(lang, "email_created", email=telegram_html(email)),
+            reply_markup=back_keyboard("back_to_menu", "primary"),
+            parse_mode="HTML",
+        )
+    else:
+        await query.edit_message_text(
+            get_text(lang, "error_create_email"),
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton(
+                    "🔄 إعادة المحاولة",
+                    callback_data="create_email_fast",
+                    style="success",
+                )],
+                [InlineKeyboardButton(
                     get_text(lang, "btn_back"),
-                    callback_data=f"manage_channel_{channel_db_id}",
+                    callback_data="create_email",
                     style="primary",
-                )
-            ]]),
+                )],
+            ]),
         )
-        return
 
-    if data == "delete_channel":
-        if not is_admin(user_id):
-            return
-        channel_info = get_channel_info(only_enabled=False)
-        if channel_info:
-            delete_channel(channel_info["channel_username"])
-            await query.edit_message_text(
-                "✅ تم حذف القناة بنجاح",
-                reply_markup=get_channel_management_keyboard(lang),
-            )
-        else:
-            await query.edit_message_text(
-                "❌ لا توجد قناة",
-                reply_markup=get_channel_management_keyboard(lang),
-            )
+
+@CALLBACK_ROUTER.route("select_free_domain")
+@CALLBACK_ROUTER.route("refresh_free_domains", cooldown=("free_domains", INBOX_COOLDOWN_SECONDS))
+async def cb_select_free_domain(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    domains = await get_available_domains()
+    if not domains:
+        context.user_data.pop("free_domains", None)
+        await query.edit_message_text(
+            "🌐 اختيار الدومين\n\n"
+            "تعذر تحميل الدومينات المجانية المتاحة حالياً.\n"
+            "حاول التحديث بعد قليل.",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton(
+                    "🔄 تحديث الدومينات",
+                    callback_data="refresh_free_domains",
+                    style="success",
+                )],
+                [InlineKeyboardButton(
+                    get_text(lang, "btn_back"),
+                    callback_data="create_email",
+                    style="primary",
+                )],
+            ]),
+        )
         return
 
-    if data == "toggle_subscription":
-        if not is_admin(user_id):
-            return
-        channel_info = get_channel_info(only_enabled=False)
-        if channel_info:
-            new_status = toggle_subscription(channel_info["channel_username"])
-            action = "تفعيل" if new_status else "تعطيل"
-            await query.edit_message_text(
-                f"✅ تم {action} الاشتراك الإجباري",
-                reply_markup=InlineKeyboardMarkup([[
+    context.user_data["free_domains"] = list(domains)
+    await query.edit_message_text(
+        "🌐 اختيار الدومين\n\n"
+        "اختر أحد الدومينات المجانية المتاحة أدناه.\n"
+        "بعد اختيار الدومين سيتم إنشاء إيميل جديد\n"
+        "تلقائياً عليه.",
+        reply_markup=get_free_domains_keyboard(domains),
+    )
+
+
+@CALLBACK_ROUTER.route("free_domain_{domain_index:int}", cooldown=("create_email", CREATE_EMAIL_COOLDOWN_SECONDS))
+async def cb_free_domain(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str, domain_index: int):
+    domains = list(context.user_data.get("free_domains") or [])
+    if domain_index >= len(domains):
+        domains = await get_available_domains()
+        context.user_data["free_domains"] = list(domains)
+        await query.edit_message_text(
+            "🌐 اختيار الدومين\n\n"
+            "تم تحديث قائمة الدومينات. اختر الدومين من جديد.",
+            reply_markup=(
+                get_free_domains_keyboard(domains)
+                if domains
+                else InlineKeyboardMarkup([[
+                    InlineKeyboardButton(
+                        "🔄 تحديث الدومينات",
+                        callback_data="refresh_free_domains",
+                        style="success",
+                    )
+                ], [
                     InlineKeyboardButton(
                         get_text(lang, "btn_back"),
-                        callback_data=f"manage_channel_{channel_info['id']}",
+                        callback_data="create_email",
                         style="primary",
-                    )
-                ]]),
-            )
-        return
-
-    # أقسام الأدمن القديمة الأساسية (موجودة ومفعلة)
-    # أقسام الأدمن القديمة الأساسية (موجودة ومفعلة)
-    if data == "section_stats":
-        if not is_admin(user_id):
-            return
-        kb = InlineKeyboardMarkup([
-            [
-                InlineKeyboardButton(
-                    "📊 الإحصائيات العامة",
-                    callback_data="stats_general",
-                    transparent=True,
-                ),
-                InlineKeyboardButton(
-                    "📈 إحصائيات الاستخدام اليومية",
-                    callback_data="stats_daily",
-                    transparent=True,
-                ),
-            ],
-            [InlineKeyboardButton(
-                get_text(lang, "btn_back"),
-                callback_data="admin_panel",
-                style="primary",
-            )],
-        ])
-        await query.edit_message_text(
-            "📊 قسم الإحصائيات\n\nاختر نوع الإحصائيات التي تريد عرضها:",
-            reply_markup=kb,
+                    )
+                ]])
+            ),
         )
         return
 
-    if data == "stats_general":
-        if not is_admin(user_id):
-            return
-        total_users = len(user_database)
-        total_emails = sum(len(u.get("emails", [])) for u in user_database.values())
-        active_users = sum(1 for u in user_database.values() if len(u.get("emails", [])) > 0)
-        text = (
-            "📊 الإحصائيات العامة\n\n"
-            f"👥 إجمالي المستخدمين: {total_users}\n"
-            f"📧 إجمالي الإيميلات: {total_emails}\n"
-            f"🔄 المستخدمون النشطون: {active_users}\n"
-        )
+    current_count = len(await get_user_emails_async(user_id))
+    email_limit = await get_effective_email_limit_async(user_id)
+    if (not await is_admin_async(user_id)) and email_limit > 0 and current_count >= email_limit:
         await query.edit_message_text(
-            text,
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton(
-                    get_text(lang, "btn_back"),
-                    callback_data="section_stats",
-                    style="primary",
-                )
-            ]]),
+            "⚠️ لقد وصلت إلى الحد المسموح لإنشاء الإيميلات.",
+            reply_markup=back_keyboard("back_to_menu", "primary"),
         )
         return
 
-    if data == "stats_daily":
-        if not is_admin(user_id):
-            return
-        days = await asyncio.to_thread(get_last_seven_days_usage)
-        if not days:
-            text = "📈 إحصائيات الاستخدام اليومية\n\n❌ تعذر قراءة الإحصائيات حالياً."
-        else:
-            today = days[0]
-            labels = ["اليوم", "أمس"]
-            day_lines = []
-            for index, item in enumerate(days):
-                if index < len(labels):
-                    label = labels[index]
-                else:
-                    label = item["stat_date"].strftime("%Y-%m-%d")
-                day_lines.append(f"📅 {label}: {item['emails_created']} إيميل")
-
-            best_day = max(days, key=lambda item: item["emails_created"])
-            if best_day["stat_date"] == days[0]["stat_date"]:
-                best_label = "اليوم"
-            elif len(days) > 1 and best_day["stat_date"] == days[1]["stat_date"]:
-                best_label = "أمس"
-            else:
-                best_label = best_day["stat_date"].strftime("%Y-%m-%d")
-
-            text = (
-                "📈 إحصائيات الاستخدام اليومية\n\n"
-                "📅 إحصائيات اليوم:\n\n"
-                f"👤 المستخدمون الجدد: {today['new_users']}\n"
-                f"📧 الإيميلات المنشأة: {today['emails_created']}\n"
-                f"📥 مرات فتح صندوق الوارد: {today['inbox_opens']}\n\n"
-                "━━━━━━━━━━━━━━\n\n"
-                "📊 آخر 7 أيام:\n\n"
-                + "\n".join(day_lines)
-                + "\n\n"
-                "🏆 أعلى يوم استخدام خلال آخر 7 أيام:\n"
-                f"{best_label}: {best_day['emails_created']} إيميل"
-            )
-
+    domain = domains[domain_index]
+    await query.edit_message_text(
+        "🌐 إنشاء الإيميل\n\n"
+        f"جاري إنشاء إيميل جديد على الدومين:\n@{domain}"
+    )
+    email, token, password = await take_email(domain)
+    if email and token:
+        await add_user_email_async(user_id, email, token, password)
+        # البريد الجديد هو الأرجح لاستقبال رمز تحقق، فيدخل كاش التوكنات ليُتابع فوراً عبر Mercure.
+        remember_email_token(user_id, {"address": email, "token": token, "password": password})
+        increment_daily_stat("emails_created")
         await query.edit_message_text(
-            text,
+            get_text(lang, "email_created", email=telegram_html(email)),
+            reply_markup=back_keyboard("back_to_menu", "primary"),
+            parse_mode="HTML",
+        )
+    else:
+        await query.edit_message_text(
+            "❌ فشل إنشاء الإيميل على الدومين المحدد.\n\n"
+            "قد يكون الدومين لم يعد متاحاً، حدّث القائمة وحاول مرة أخرى.",
             reply_markup=InlineKeyboardMarkup([
                 [InlineKeyboardButton(
-                    "🔄 تحديث الإحصائيات",
-                    callback_data="stats_daily",
+                    "🔄 تحديث الدومينات",
+                    callback_data="refresh_free_domains",
                     style="success",
                 )],
                 [InlineKeyboardButton(
-                    "🔙 رجوع إلى قسم الإحصائيات",
-                    callback_data="section_stats",
+                    get_text(lang, "btn_back"),
+                    callback_data="create_email",
                     style="primary",
                 )],
             ]),
         )
+
+
+# إيميلاتي
+@CALLBACK_ROUTER.route("my_emails")
+async def cb_my_emails(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    emails = await get_user_emails_async(user_id)
+    if not emails:
+        await query.edit_message_text(get_text(lang, "no_emails"),
+                                      reply_markup=back_keyboard("back_to_menu"))
+    else:
+        await query.edit_message_text(get_text(lang, "select_email", count=len(emails)),
+                                      reply_markup=get_email_list_keyboard(emails, "view_email", lang))
+
+
+# اختيار صندوق الوارد
+@CALLBACK_ROUTER.route("select_inbox")
+async def cb_select_inbox(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    emails = await get_user_emails_async(user_id)
+    if not emails:
+        await query.edit_message_text(get_text(lang, "no_emails"),
+                                      reply_markup=back_keyboard("back_to_menu"))
+    else:
+        await query.edit_message_text(get_text(lang, "select_email", count=len(emails)),
+                                      reply_markup=get_email_list_keyboard(emails, "inbox", lang))
+
+
+# عرض صندوق وارد إيميل
+@CALLBACK_ROUTER.route("inbox_{email_index:int}", cooldown=("inbox", INBOX_COOLDOWN_SECONDS))
+async def cb_inbox(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str, email_index: int):
+    emails = await get_user_emails_async(user_id)
+    if email_index >= len(emails):
+        return
+    email_data = emails[email_index]
+    increment_daily_stat("inbox_opens")
+    inbox_result = await check_user_inbox_detailed(user_id, email_index)
+    messages = inbox_result.get("messages")
+
+    if inbox_result.get("error") is not None:
+        error_text, error_keyboard = build_inbox_error_view(
+            inbox_result.get("error"),
+            email_index,
+            inbox_result.get("status"),
+        )
+        await query.edit_message_text(error_text, reply_markup=error_keyboard)
         return
 
-    if data == "section_forward":
-        if not is_admin(user_id):
-            return
-        status = "✅ مفعّل" if forwarding_enabled else "❌ معطّل"
-        text = (
-            f"📨 قسم توجيه الرسائل\n\nالحالة: {status}\n\n"
-            "عند التفعيل، كل ما يرسله المستخدم سيصلك كمحول منه مباشرة: "
-            "الأوامر مثل /start، النصوص، الصور، الفيديو، الفويس، الملفات والملصقات."
+    watching = INBOX_WATCHER.is_watching(email_data["address"])
+    if len(messages) == 0:
+        await query.edit_message_text(get_text(lang, "no_messages", email=email_data["address"]),
+                                      reply_markup=InlineKeyboardMarkup([
+                                          [InlineKeyboardButton(get_text(lang, "btn_refresh"), callback_data=f"inbox_{email_index}")],
+                                          get_watch_keyboard(email_index, watching).inline_keyboard[0],
+                                          [InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="select_inbox")]
+                                      ]))
+        return
+
+    text = get_text(lang, "messages_list", count=len(messages), email=email_data["address"])
+    await query.edit_message_text(text, reply_markup=get_messages_keyboard(messages, email_index, lang, watching))
+
+
+# مراقبة الصندوق حتى وصول رمز التحقق بدل الضغط المتكرر على «تحديث»
+@CALLBACK_ROUTER.route("watch_inbox_{email_index:int}", cooldown=("inbox", INBOX_COOLDOWN_SECONDS))
+async def cb_watch_inbox(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str, email_index: int):
+    emails = await get_user_emails_async(user_id)
+    if email_index >= len(emails):
+        return
+    address = emails[email_index]["address"]
+    cached = get_cached_inbox_listing(address)
+    baseline = [str(message.get("id") or "") for message in cached] if cached is not None else None
+    if INBOX_WATCHER.watch(context.bot, user_id, address, WATCH_INBOX_MINUTES, baseline) is None:
+        await query.edit_message_text(
+            get_text(lang, "watch_busy"),
+            reply_markup=back_keyboard(f"inbox_{email_index}", "primary"),
         )
-        kb = get_admin_section_keyboard([
-            InlineKeyboardButton("✅ تفعيل التوجيه", callback_data="forward_on", style="success"),
-            InlineKeyboardButton("❌ تعطيل التوجيه", callback_data="forward_off", style="danger"),
-        ], "admin_panel")
-        await query.edit_message_text(text, reply_markup=kb)
         return
+    await query.edit_message_text(
+        get_text(lang, "watch_started", email=telegram_html(address), minutes=WATCH_INBOX_MINUTES),
+        parse_mode="HTML",
+        reply_markup=get_watch_keyboard(email_index, True, back_callback=f"inbox_{email_index}"),
+    )
+
+
+@CALLBACK_ROUTER.route("unwatch_inbox_{email_index:int}")
+async def cb_unwatch_inbox(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str, email_index: int):
+    emails = await get_user_emails_async(user_id)
+    if email_index >= len(emails):
+        return
+    address = emails[email_index]["address"]
+    INBOX_WATCHER.stop(address)
+    await query.edit_message_text(
+        get_text(lang, "watch_stopped", email=telegram_html(address)),
+        parse_mode="HTML",
+        reply_markup=get_watch_keyboard(email_index, False, back_callback=f"inbox_{email_index}"),
+    )
 
-    if data == "forward_on":
-        if not is_admin(user_id):
-            return
-        if not set_setting("forwarding_enabled", "1"):
-            await query.edit_message_text(
-                "❌ تعذر حفظ حالة التوجيه في قاعدة البيانات.",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="section_forward")]]),
-            )
-            return
-        forwarding_enabled = True
-        await query.edit_message_text("✅ تم تفعيل توجيه الرسائل!",
-                                      reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="section_forward")]]))
+
+# تفاصيل رسالة
+@CALLBACK_ROUTER.route("msgid_{email_index:int}_{message_id:str}")
+@CALLBACK_ROUTER.route("msg_{email_index:int}_{msg_index:int}")
+async def cb_msg(
+    query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str,
+    email_index: int, message_id: str = None, msg_index: int = 0,
+):
+    emails = await get_user_emails_async(user_id)
+    if email_index >= len(emails):
         return
 
-    if data == "forward_off":
-        if not is_admin(user_id):
-            return
-        if not set_setting("forwarding_enabled", "0"):
-            await query.edit_message_text(
-                "❌ تعذر حفظ حالة التوجيه في قاعدة البيانات.",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="section_forward")]]),
+    if message_id is None:
+        # الأزرار التي تحمل ترتيب الرسالة فقط تُحل من آخر قائمة معروضة قبل سؤال mail.tm.
+        inbox_result = await check_user_inbox_detailed(user_id, email_index, max_age=INBOX_LIST_CACHE_TTL_SECONDS)
+        messages = inbox_result.get("messages")
+        if inbox_result.get("error") is not None:
+            error_text, error_keyboard = build_inbox_error_view(
+                inbox_result.get("error"),
+                email_index,
+                inbox_result.get("status"),
             )
+            await query.edit_message_text(error_text, reply_markup=error_keyboard)
+            return
+        if not messages or msg_index >= len(messages):
             return
-        forwarding_enabled = False
-        await query.edit_message_text("❌ تم تعطيل توجيه الرسائل!",
-                                      reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="section_forward")]]))
+        message_id = messages[msg_index]["id"]
+
+    cached_message = await get_user_message_content(user_id, email_index, message_id)
+    if not cached_message:
+        await query.edit_message_text(get_text(lang, "error_load_message"),
+                                      reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "btn_back"), callback_data=f"inbox_{email_index}")]]))
         return
 
-    if data == "section_settings":
-        if not is_admin(user_id):
-            return
-        status_icon = "✅" if bot_active else "❌"
-        status_text = "يعمل" if bot_active else "متوقف"
-        text = f"⚙️ الإعدادات\n\n• حالة البوت: {status_icon} {status_text}\n"
-        if not bot_active and bot_offline_message:
-            text += f"• رسالة الإيقاف: {bot_offline_message[:80]}..."
-        kb = get_admin_section_keyboard([
-            InlineKeyboardButton(f"🔄 حالة البوت: {status_icon}", callback_data="toggle_bot_status"),
-            InlineKeyboardButton("✏️ رسالة الإيقاف", callback_data="set_offline_message"),
-        ], "admin_panel")
-        await query.edit_message_text(text, reply_markup=kb)
+    full = cached_message["message"]
+    sender_raw = (full.get("from") or {}).get("address") or "غير معروف"
+    subject_raw = full.get("subject") or "بدون موضوع"
+    date_raw = full.get("createdAt") or "غير معروف"
+    content_raw = cached_message["text"]
+
+    otp = cached_message["otp"]
+    if len(content_raw) > 3500:
+        content_raw = content_raw[:3500] + "\n\n... (الرسالة طويلة جداً)"
+
+    safe_values = {
+        "sender": telegram_html(sender_raw),
+        "subject": telegram_html(subject_raw),
+        "date": telegram_html(date_raw),
+        "content": telegram_html(content_raw),
+    }
+    if otp:
+        text = get_text(lang, "otp_found", otp=telegram_html(otp)) + "\n\n" + get_text(
+            lang, "message_detail", **safe_values
+        )
+    else:
+        text = get_text(lang, "message_detail", **safe_values)
+
+    await query.edit_message_text(text,
+                                  reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "btn_back"), callback_data=f"inbox_{email_index}")]]),
+                                  parse_mode="HTML")
+
+
+# إدارة إيميلات المستخدم من قسم واحد بعيداً عن القائمة الرئيسية
+@CALLBACK_ROUTER.route("manage_emails")
+async def cb_manage_emails(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    emails = await get_user_emails_async(user_id)
+    text = (
+        "⚙️ إدارة إيميلاتك\n\n"
+        f"📧 عدد إيميلاتك الحالية: {len(emails)}\n\n"
+        "اختر العملية التي تريدها:"
+    )
+    rows = []
+    if emails:
+        rows.extend([
+            [InlineKeyboardButton(
+                "🗑️ حذف إيميل محدد",
+                callback_data="manage_delete_one",
+                style="danger",
+            )],
+            [InlineKeyboardButton(
+                "🗑️ حذف كل الإيميلات",
+                callback_data="manage_confirm_delete_all",
+                style="danger",
+            )],
+        ])
+    else:
+        text += "\n\n📭 لا توجد إيميلات حالياً."
+    rows.append([
+        InlineKeyboardButton(
+            get_text(lang, "btn_back"),
+            callback_data="back_to_menu",
+            style="primary",
+        )
+    ])
+    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(rows))
+
+
+@CALLBACK_ROUTER.route("manage_delete_one")
+async def cb_manage_delete_one(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    emails = await get_user_emails_async(user_id)
+    if not emails:
+        await query.edit_message_text(
+            get_text(lang, "no_emails"),
+            reply_markup=back_keyboard("manage_emails", "primary"),
+        )
         return
 
-    if data == "toggle_bot_status":
-        if not is_admin(user_id):
-            return
-        bot_active = not bot_active
-        txt = "✅ تم تشغيل البوت!" if bot_active else "❌ تم إيقاف البوت!"
-        await query.edit_message_text(txt, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="section_settings")]]))
+    rows = []
+    for email_index, email_info in enumerate(emails):
+        address = str(email_info.get("address") or "بريد غير معروف")
+        display_address = address if len(address) <= 34 else address[:31] + "..."
+        rows.append([
+            InlineKeyboardButton(
+                f"🗑️ {display_address}",
+                callback_data=f"manage_confirm_delete_{email_index}",
+                style="danger",
+            )
+        ])
+    rows.append([
+        InlineKeyboardButton(
+            get_text(lang, "btn_back"),
+            callback_data="manage_emails",
+            style="primary",
+        )
+    ])
+    await query.edit_message_text(
+        "🗑️ اختر الإيميل الذي تريد حذفه:",
+        reply_markup=InlineKeyboardMarkup(rows),
+    )
+
+
+@CALLBACK_ROUTER.route("manage_confirm_delete_{email_index:int}")
+async def cb_manage_confirm_delete(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str, email_index: int):
+    emails = await get_user_emails_async(user_id)
+    if email_index >= len(emails):
+        await query.edit_message_text(
+            "⚠️ هذا الإيميل لم يعد موجوداً.",
+            reply_markup=back_keyboard("manage_delete_one", "primary"),
+        )
         return
 
-    if data == "set_offline_message":
-        if not is_admin(user_id):
-            return
-        context.user_data["waiting_for"] = "offline_message"
-        await query.edit_message_text("✏️ أرسل رسالة الإيقاف التي ستظهر للمستخدمين:",
-                                      reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="section_settings")]]))
+    address = str(emails[email_index].get("address") or "غير معروف")
+    text = (
+        "⚠️ تأكيد حذف الإيميل\n\n"
+        f"📧 {address}\n\n"
+        "هل أنت متأكد؟"
+    )
+    await query.edit_message_text(
+        text,
+        reply_markup=InlineKeyboardMarkup([[
+            InlineKeyboardButton(
+                "✅ تأكيد الحذف",
+                callback_data=f"manage_delete_{email_index}",
+                style="success",
+            ),
+            InlineKeyboardButton(
+                "❌ إلغاء",
+                callback_data="manage_delete_one",
+                style="danger",
+            ),
+        ]]),
+    )
+
+
+@CALLBACK_ROUTER.route("manage_delete_{email_index:int}")
+async def cb_manage_delete(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str, email_index: int):
+    emails = await get_user_emails_async(user_id)
+    if email_index >= len(emails):
         return
+    email_data = emails[email_index]
+    await remove_user_email_async(user_id, email_data["address"])
+    await query.edit_message_text(
+        get_text(lang, "email_deleted", email=email_data["address"]),
+        reply_markup=back_keyboard("manage_emails", "primary"),
+    )
 
-    if data == "section_broadcast":
-        if not is_admin(user_id):
-            return
-        kb = get_admin_section_keyboard([
-            InlineKeyboardButton("📨 إذاعة للكل", callback_data="broadcast_all", style="primary"),
-            InlineKeyboardButton("👥 إذاعة للنشطين فقط", callback_data="broadcast_active", style="primary"),
-        ], "admin_panel")
-        await query.edit_message_text("📢 قسم الإذاعة\n\nاختر نوع الإذاعة:", reply_markup=kb)
+
+@CALLBACK_ROUTER.route("manage_confirm_delete_all")
+async def cb_manage_confirm_delete_all(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    emails = await get_user_emails_async(user_id)
+    if not emails:
+        await query.edit_message_text(
+            get_text(lang, "no_emails"),
+            reply_markup=back_keyboard("manage_emails", "primary"),
+        )
         return
 
-    if data == "broadcast_all":
-        if not is_admin(user_id):
-            return
-        context.user_data["waiting_for"] = "broadcast_all"
-        await query.edit_message_text(f"📢 أرسل رسالة الإذاعة للكل\n\n⚠️ سيتم إرسالها لـ {len(user_database)} مستخدم",
-                                      reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="section_broadcast")]]))
+    text = (
+        "⚠️ تأكيد حذف جميع الإيميلات\n\n"
+        f"📧 سيتم حذف جميع إيميلاتك الحالية: {len(emails)}\n\n"
+        "⚠️ لا يمكن التراجع عن العملية بعد التأكيد."
+    )
+    await query.edit_message_text(
+        text,
+        reply_markup=InlineKeyboardMarkup([[
+            InlineKeyboardButton(
+                "✅ نعم، حذف الكل",
+                callback_data="manage_delete_all",
+                style="danger",
+            ),
+            InlineKeyboardButton(
+                "❌ إلغاء",
+                callback_data="manage_emails",
+                style="primary",
+            ),
+        ]]),
+    )
+
+
+@CALLBACK_ROUTER.route("manage_delete_all")
+async def cb_manage_delete_all(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    success, count = await clear_user_emails_async(user_id)
+    text = (
+        get_text(lang, "all_emails_deleted", count=count)
+        if success
+        else "❌ فشل حذف الإيميلات"
+    )
+    await query.edit_message_text(
+        text,
+        reply_markup=back_keyboard("manage_emails", "primary"),
+    )
+
+
+# عرض تفاصيل إيميل
+@CALLBACK_ROUTER.route("view_email_{email_index:int}")
+async def cb_view_email(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str, email_index: int):
+    emails = await get_user_emails_async(user_id)
+    if email_index >= len(emails):
         return
+    email_data = emails[email_index]
+    email_password = email_data.get("password") or LEGACY_MAIL_PASSWORD
+    text = f"📧 <code>{email_data['address']}</code>\n🔑 <code>{telegram_html(email_password)}</code>"
+    kb = InlineKeyboardMarkup([
+        [InlineKeyboardButton(get_text(lang, "btn_inbox"), callback_data=f"inbox_{email_index}", style="primary")],
+        [InlineKeyboardButton(get_text(lang, "btn_delete"), callback_data=f"confirm_delete_{email_index}", style="danger")],
+        [InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="my_emails")]
+    ])
+    await query.edit_message_text(text, reply_markup=kb, parse_mode="HTML")
 
-    if data == "broadcast_active":
-        if not is_admin(user_id):
-            return
-        context.user_data["waiting_for"] = "broadcast_active"
-        active_count = sum(1 for u in user_database.values() if len(u.get("emails", [])) > 0)
-        await query.edit_message_text(f"📢 أرسل رسالة الإذاعة للنشطين فقط\n\n👥 النشطين: {active_count}",
-                                      reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="section_broadcast")]]))
+
+# تأكيد حذف إيميل
+@CALLBACK_ROUTER.route("confirm_delete_{email_index:int}")
+async def cb_confirm_delete(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str, email_index: int):
+    emails = await get_user_emails_async(user_id)
+    if email_index >= len(emails):
+        return
+    email_data = emails[email_index]
+    text = f"⚠️ هل أنت متأكد من حذف هذا الإيميل؟\n\n📧 {email_data['address']}"
+    kb = InlineKeyboardMarkup([[
+        InlineKeyboardButton(get_text(lang, "btn_confirm"), callback_data=f"delete_{email_index}", style="danger"),
+        InlineKeyboardButton(get_text(lang, "btn_cancel"), callback_data="my_emails")
+    ]])
+    await query.edit_message_text(text, reply_markup=kb)
+
+
+@CALLBACK_ROUTER.route("delete_{email_index:int}")
+async def cb_delete(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str, email_index: int):
+    emails = await get_user_emails_async(user_id)
+    if email_index >= len(emails):
         return
+    email_data = emails[email_index]
+    await remove_user_email_async(user_id, email_data["address"])
+    await query.edit_message_text(get_text(lang, "email_deleted", email=email_data["address"]),
+                                  reply_markup=back_keyboard("back_to_menu"))
+
+
+# حذف الكل
+@CALLBACK_ROUTER.route("confirm_delete_all")
+async def cb_confirm_delete_all(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    emails = await get_user_emails_async(user_id)
+    if not emails:
+        await query.edit_message_text(get_text(lang, "no_emails"),
+                                      reply_markup=back_keyboard("back_to_menu"))
+        return
+    text = f"⚠️ هل أنت متأكد من حذف جميع الإيميلات؟\n\nالعدد: {len(emails)}"
+    kb = InlineKeyboardMarkup([[
+        InlineKeyboardButton(get_text(lang, "btn_confirm"), callback_data="delete_all", style="danger"),
+        InlineKeyboardButton(get_text(lang, "btn_cancel"), callback_data="back_to_menu")
+    ]])
+    await query.edit_message_text(text, reply_markup=kb)
+
+
+@CALLBACK_ROUTER.route("delete_all")
+async def cb_delete_all(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    success, count = await clear_user_emails_async(user_id)
+    text = get_text(lang, "all_emails_deleted", count=count) if success else "❌ فشل حذف الإيميلات"
+    await query.edit_message_text(
+        text,
+        reply_markup=back_keyboard("back_to_menu"),
+    )
 
-    if data == "section_paid_domains":
-        if not is_admin(user_id):
-            return
 
-        domains = get_paid_domains()
-        text = "🌐 إدارة الدومينات المدفوعة\n\n"
-        if domains:
-            text += "الدومينات المعروضة للمستخدمين:\n"
-            for index, domain in enumerate(domains, start=1):
-                text += f"{index}. @{domain}\n"
-        else:
-            text += "لا توجد دومينات مضافة حالياً."
+# ================== لوحة الأدمن (القديمة) ==================
 
-        buttons = [
-            InlineKeyboardButton("➕ إضافة دومين", callback_data="add_paid_domain", style="success"),
-        ]
-        if domains:
-            buttons.append(
-                InlineKeyboardButton("🗑️ حذف دومين", callback_data="delete_paid_domain", style="danger")
+
+@CALLBACK_ROUTER.route("admin_panel", access="admin", denied_text=get_text("ar", "unauthorized"))
+async def cb_admin_panel(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    await query.edit_message_text("👑 لوحة تحكم المشرف\n\nاختر القسم:",
+                                  reply_markup=get_admin_panel_keyboard(lang, user_id))
+
+
+@CALLBACK_ROUTER.route("section_health", access="admin", denied_text=get_text("ar", "unauthorized"))
+async def cb_section_health(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    db_health, mail_health = await asyncio.gather(
+        check_database_health_async(),
+        check_mail_service_health(),
+    )
+    telegram_started = time.perf_counter()
+    telegram_ok = True
+    telegram_error = ""
+    try:
+        await context.bot.get_me()
+    except Exception as error:
+        telegram_ok = False
+        telegram_error = str(error)[:120]
+    telegram_ms = int((time.perf_counter() - telegram_started) * 1000)
+
+    db_ok, db_ms, db_error = db_health
+    mail_ok, mail_ms, mail_error = mail_health
+    bot_status = "✅ يعمل" if bot_active else "⛔ متوقف للمستخدمين"
+    telegram_status = f"✅ متصل ({telegram_ms} ms)" if telegram_ok else "❌ غير متصل"
+    db_status = f"✅ متصلة ({db_ms} ms)" if db_ok else "❌ غير متصلة"
+    mail_status = f"✅ متاحة ({mail_ms} ms)" if mail_ok else "❌ غير متاحة"
+    pool_stats = get_db_pool_stats()
+    pool_status = (
+        f"{pool_stats['in_use']} مستخدم / {pool_stats['idle']} خامل "
+        f"(الحد {pool_stats['min_size']}-{pool_stats['max_size']})"
+    )
+    pool_waits = (
+        f"انتظار {pool_stats['waits']} (متوسط {pool_stats['avg_wait_ms']} ms) | "
+        f"مهلة {pool_stats['timeouts']} | تسريب {pool_stats['leaking']}"
+    )
+    account_pool_size = await run_db(get_account_pool_size)
+    account_pool_status = (
+        f"{account_pool_size} حساب (إصابة {ACCOUNT_POOL_STATS['hits']} | "
+        f"إنشاء مباشر {ACCOUNT_POOL_STATS['misses']})"
+    )
+    user_cache_stats = user_cache.get_stats()
+    user_cache_status = (
+        f"{user_cache_stats['size']}/{user_cache_stats['max_entries']} عضو | "
+        f"إصابة {user_cache_stats['hit_rate']}% | "
+        f"إخراج {user_cache_stats['evictions']} | منتهي {user_cache_stats['expired']}"
+    )
+    update_stats = UPDATE_PROCESSOR.get_stats()
+    update_status = (
+        f"{update_stats['in_flight']}/{update_stats['limit']} قيد المعالجة | "
+        f"بالانتظار {update_stats['waiting']} (أقصى {update_stats['max_waiting']}) | "
+        f"متوسط الانتظار {update_stats['avg_wait_ms']} ms"
+    )
+    daily_stats_status = (
+        f"بانتظار الحفظ {get_pending_daily_stats()} | آخر حفظ {DAILY_STATS_FLUSH['last_ms']} ms "
+        f"(أقصى {DAILY_STATS_FLUSH['max_ms']}) | فشل {DAILY_STATS_FLUSH['failures']}"
+    )
+    keyboard_status = (
+        f"{len(KEYBOARD_CACHE)} لوحة | إصابة {KEYBOARD_STATS['hits']} | بناء {KEYBOARD_STATS['builds']}"
+    )
+    route_stats = CALLBACK_ROUTER.get_stats()
+    slowest_routes = "، ".join(
+        f"{pattern} {avg_ms:.0f}/{max_ms:.0f} ms" for pattern, avg_ms, max_ms, _count in route_stats["slowest"]
+    ) or "لا يوجد"
+    route_status = (
+        f"{route_stats['routes']} مسار | {route_stats['calls']} ضغطة | أخطاء {route_stats['errors']} | "
+        f"الأبطأ (متوسط/أقصى): {slowest_routes}"
+    )
+    membership_status = (
+        f"{len(MEMBERSHIP_CACHE)} عضو | إصابة {MEMBERSHIP_STATS['hits']} | "
+        f"فحص {MEMBERSHIP_STATS['misses']} | تحديثات القنوات {MEMBERSHIP_STATS['updates']}"
+    )
+    token_cache_status = (
+        f"{len(TOKEN_CACHE)} بريد | إصابة {TOKEN_STATS['hits']} | "
+        f"تجديد {TOKEN_STATS['refreshes']} (استباقي {TOKEN_STATS['proactive']}) | "
+        f"فشل {TOKEN_STATS['failures']}"
+    )
+    message_cache_stats = MESSAGE_CACHE.get_stats()
+    message_cache_status = (
+        f"{message_cache_stats['entries']} رسالة ({message_cache_stats['bytes'] // 1024}/"
+        f"{message_cache_stats['max_bytes'] // 1024} KB) | إصابة {message_cache_stats['hit_rate']}% "
+        f"(قرص {message_cache_stats['disk_hits']}) | فحص {message_cache_stats['misses']} | "
+        f"إخراج {message_cache_stats['evictions']}"
+    )
+    if MESSAGE_CACHE.spill_dir:
+        message_cache_status += (
+            f" | على القرص {message_cache_stats['spilled_entries']} "
+            f"({message_cache_stats['spill_bytes'] // 1024} KB)"
+        )
+    limiter_stats = MAIL_RATE_LIMITER.get_stats()
+    waiting_by_priority = "، ".join(
+        f"{MAIL_PRIORITY_NAMES.get(priority, priority)} {count}"
+        for priority, count in sorted(limiter_stats["waiting_by_priority"].items())
+    ) or "لا يوجد"
+    limiter_status = (
+        f"{limiter_stats['rate']} طلب/ثانية | فوري {limiter_stats['immediate']}/{limiter_stats['requests']} | "
+        f"بالطابور {limiter_stats['waiting']} ({waiting_by_priority}) | "
+        f"أقصى طابور {limiter_stats['max_waiting']} | متوسط الانتظار {limiter_stats['avg_wait_ms']} ms | "
+        f"429: {limiter_stats['throttled']}"
+    )
+    if limiter_stats["paused_seconds"]:
+        limiter_status += f" | متوقف {limiter_stats['paused_seconds']} ثانية"
+    watch_stats = INBOX_WATCHER.get_stats()
+    watch_status = (
+        f"{watch_stats['active']}/{watch_stats['max_active']} صندوق | فحص {watch_stats['polls']} | "
+        f"رموز {watch_stats['found']} | انتهت {watch_stats['timeouts']} | 429: {watch_stats['rate_limited']}"
+    )
+    push_stats = MERCURE_PUSH.get_stats()
+    push_status = (
+        f"{push_stats['connected']}/{push_stats['streams']} متصل (الحد {push_stats['max_streams']}) | "
+        f"أحداث {push_stats['events']} | أُرسل {push_stats['delivered']} | مكرر {push_stats['duplicates']} | "
+        f"إعادة اتصال {push_stats['reconnects']}"
+        if MERCURE_PUSH.enabled
+        else "معطّل"
+    )
+    inbox_list_status = (
+        f"{len(INBOX_LIST_CACHE)} صندوق | إصابة {INBOX_LIST_STATS['hits']} | فحص {INBOX_LIST_STATS['misses']}"
+    )
+    domain_cache_age = get_domain_cache_age()
+    domain_cache_status = (
+        f"{len(DOMAIN_CACHE['domains'])} دومين (عمره {domain_cache_age} ثانية)"
+        if domain_cache_age is not None
+        else "فارغ"
+    )
+
+    errors = []
+    if not telegram_ok:
+        errors.append(f"تلجرام: {telegram_error}")
+    if not db_ok:
+        errors.append(f"قاعدة البيانات: {db_error}")
+    if not mail_ok:
+        errors.append(f"mail.tm: {mail_error}")
+    errors_text = "\n".join(f"• {item}" for item in errors) if errors else "لا توجد أخطاء في الفحص الحالي."
+
+    text = (
+        "🩺 حالة البوت والخدمات\n\n"
+        f"🤖 حالة البوت: {bot_status}\n"
+        f"📨 اتصال تلجرام: {telegram_status}\n"
+        f"🗄️ قاعدة البيانات: {db_status}\n"
+        f"🔌 مجمع الاتصالات: {pool_status}\n"
+        f"⏳ {pool_waits}\n"
+        f"📧 خدمة mail.tm: {mail_status}\n"
+        f"🚦 معدل mail.tm: {limiter_status}\n"
+        f"📥 التحديثات: {update_status}\n"
+        f"🧭 الأزرار: {route_status}\n"
+        f"⌨️ كاش اللوحات: {keyboard_status}\n"
+        f"📈 العدادات اليومية: {daily_stats_status}\n"
+        f"📡 الإشعارات الفورية: {push_status}\n"
+        f"👀 مراقبة الصناديق: {watch_status}\n"
+        f"📬 قوائم الصناديق: {inbox_list_status}\n"
+        f"✉️ كاش الرسائل: {message_cache_status}\n"
+        f"🌐 كاش الدومينات: {domain_cache_status}\n"
+        f"🎲 الحسابات الجاهزة: {account_pool_status}\n"
+        f"👥 كاش الأعضاء: {user_cache_status}\n"
+        f"🔑 كاش التوكنات: {token_cache_status}\n"
+        f"📢 كاش الاشتراكات: {membership_status}\n"
+        f"⏱️ مدة التشغيل: {format_bot_uptime()}\n\n"
+        f"⚠️ نتيجة الأخطاء:\n{errors_text}"
+    )
+    await query.edit_message_text(
+        text,
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔄 تحديث الفحص", callback_data="section_health", style="success")],
+            [InlineKeyboardButton(
+                "🧹 تفريغ كاش الدومينات",
+                callback_data="invalidate_domain_cache",
+                style="primary",
+            )],
+            [InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="admin_panel", style="primary")],
+        ]),
+    )
+
+
+@CALLBACK_ROUTER.route("invalidate_domain_cache", access="admin", denied_text=get_text("ar", "unauthorized"))
+async def cb_invalidate_domain_cache(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    invalidate_domain_cache()
+    domains = await get_available_domains()
+    text = (
+        "✅ تم تفريغ كاش الدومينات وإعادة تحميله.\n\n"
+        f"🌐 الدومينات المجانية المتاحة الآن: {len(domains)}"
+        if domains
+        else "⚠️ تم تفريغ كاش الدومينات، لكن تعذر تحميل القائمة من mail.tm حالياً."
+    )
+    await query.edit_message_text(
+        text,
+        reply_markup=back_keyboard("section_health", "primary"),
+    )
+
+
+@CALLBACK_ROUTER.route("channel_management", access="admin", denied_text=get_text("ar", "unauthorized"))
+async def cb_channel_management(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    channels = await get_channels_async(only_enabled=False)
+    enabled_count = sum(1 for item in channels if item.get("subscription_enabled"))
+    text = (
+        "📢 إدارة قنوات الاشتراك الإجباري\n\n"
+        f"📋 عدد القنوات المضافة: {len(channels)}\n"
+        f"✅ القنوات المفعّلة: {enabled_count}\n\n"
+    )
+    if channels:
+        text += "اضغط على أي قناة لإدارتها، أو أضف قناة جديدة."
+    else:
+        text += "لا توجد قنوات حالياً. أضف أول قناة للبدء."
+
+    await query.edit_message_text(
+        text,
+        reply_markup=await get_channel_management_keyboard_async(lang),
+    )
+
+
+@CALLBACK_ROUTER.route("channel_stats", access="admin")
+async def cb_channel_stats(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    channel_stats = await get_channel_subscription_stats_async()
+    if channel_stats is None:
+        await query.edit_message_text(
+            "❌ تعذر تحميل إحصائيات القنوات حالياً.",
+            reply_markup=back_keyboard("channel_management", "primary"),
+        )
+        return
+
+    enabled_count = sum(1 for item in channel_stats if item.get("subscription_enabled"))
+    disabled_count = len(channel_stats) - enabled_count
+    total_verified = sum(int(item.get("verified_count") or 0) for item in channel_stats)
+    text = (
+        "📊 إحصائيات قنوات الاشتراك\n\n"
+        f"📢 إجمالي القنوات: {len(channel_stats)}\n"
+        f"✅ المفعّلة: {enabled_count}\n"
+        f"❌ المعطّلة: {disabled_count}\n\n"
+        f"👥 إجمالي عمليات الاشتراك التي تحقق منها البوت: {total_verified}\n"
+    )
+
+    if channel_stats:
+        text += "\n━━━━━━━━━━━━━━\n"
+        shown = 0
+        for item in channel_stats:
+            title = item.get("channel_title") or item.get("channel_username") or "غير محدد"
+            username = str(item.get("channel_username") or "").lstrip("@")
+            status = "✅ مفعّلة" if item.get("subscription_enabled") else "❌ معطّلة"
+            verified_count = int(item.get("verified_count") or 0)
+            block = (
+                f"\n📢 <b>{telegram_html(title)}</b>\n"
+                f"🔗 @{telegram_html(username)}\n"
+                f"⚙️ الحالة: {status}\n"
+                f"👥 تحقق البوت من اشتراك: {verified_count} عضو\n"
             )
+            if len(text) + len(block) > 3800:
+                remaining = len(channel_stats) - shown
+                text += f"\n… ويوجد {remaining} قناة إضافية."
+                break
+            text += block
+            shown += 1
+    else:
+        text += "\nلا توجد قنوات مضافة حالياً."
+
+    await query.edit_message_text(
+        text,
+        parse_mode="HTML",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton(
+                "🔄 تحديث الإحصائيات",
+                callback_data="channel_stats",
+                style="success",
+            )],
+            [InlineKeyboardButton(
+                get_text(lang, "btn_back"),
+                callback_data="channel_management",
+                style="primary",
+            )],
+        ]),
+    )
+
+
+@CALLBACK_ROUTER.route("edit_subscription_message", access="admin")
+async def cb_edit_subscription_message(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    current_message = await get_global_subscription_message_html_async()
+    context.user_data["waiting_for"] = "global_subscription_message"
+    await query.edit_message_text(
+        "✏️ تعديل رسالة الاشتراك الإجباري\n\n"
+        "الرسالة الحالية:\n\n"
+        f"{current_message}\n\n"
+        "أرسل الرسالة الجديدة الآن.\n\n"
+        "📌 قائمة القنوات ستظهر تلقائياً بين أول فقرة وباقي الرسالة.\n"
+        "🌟 الإيموجي المميز يُحفظ تلقائياً عند إرساله داخل النص.",
+        reply_markup=back_keyboard("channel_management", "primary"),
+        parse_mode="HTML",
+    )
+
+
+@CALLBACK_ROUTER.route("set_channel", access="admin")
+async def cb_set_channel(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    context.user_data["waiting_for"] = "channel_username"
+    await query.edit_message_text(
+        "➕ إضافة قناة للاشتراك الإجباري\n\n"
+        "أرسل username القناة بدون @.\n"
+        "مثال: mychannel\n\n"
+        "يمكنك إضافة أكثر من قناة، ولن تُحذف القنوات السابقة.",
+        reply_markup=back_keyboard("channel_management", "primary"),
+    )
+
+
+@CALLBACK_ROUTER.route("manage_channel_{channel_db_id:int}", access="admin")
+async def cb_manage_channel(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str, channel_db_id: int):
+    channel_info = await get_channel_by_id_async(channel_db_id)
+    if not channel_info:
         await query.edit_message_text(
-            text,
-            reply_markup=get_admin_section_keyboard(buttons, "admin_panel"),
+            "❌ هذه القناة لم تعد موجودة.",
+            reply_markup=back_keyboard("channel_management", "primary"),
         )
         return
 
-    if data == "add_paid_domain":
-        if not is_admin(user_id):
-            return
-        context.user_data["waiting_for"] = "paid_domain_add"
+    status = "✅ مفعّل" if channel_info.get("subscription_enabled") else "❌ معطّل"
+    status_button = "❌ تعطيل الاشتراك" if channel_info.get("subscription_enabled") else "✅ تفعيل الاشتراك"
+    status_style = "danger" if channel_info.get("subscription_enabled") else "success"
+    cid = channel_info.get("channel_id", "غير محدد")
+    title = channel_info.get("channel_title", "غير محدد")
+    username = channel_info["channel_username"]
+    text = (
+        "📢 إدارة القناة\n\n"
+        f"📢 الاسم: <b>{telegram_html(title)}</b>\n"
+        f"🔗 القناة: @{telegram_html(username)}\n"
+        f"🆔 المعرّف: <code>{cid}</code>\n"
+        f"⚙️ الحالة: {status}"
+    )
+    kb = InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton(
+                status_button,
+                callback_data=f"toggle_subscription_{channel_db_id}",
+                style=status_style,
+            ),
+            InlineKeyboardButton(
+                "🗑 حذف القناة",
+                callback_data=f"delete_channel_{channel_db_id}",
+                style="danger",
+            ),
+        ],
+        [InlineKeyboardButton(
+            get_text(lang, "btn_back"),
+            callback_data="channel_management",
+            style="primary",
+        )],
+    ])
+    await query.edit_message_text(text, reply_markup=kb, parse_mode="HTML")
+
+
+@CALLBACK_ROUTER.route("delete_channel_{channel_db_id:int}", access="admin")
+async def cb_delete_channel_by_id(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str, channel_db_id: int):
+    channel_info = await get_channel_by_id_async(channel_db_id)
+    if channel_info and await delete_channel_async(channel_info["channel_username"]):
+        await query.edit_message_text(
+            f"✅ تم حذف القناة @{channel_info['channel_username']} بنجاح.",
+            reply_markup=back_keyboard("channel_management", "primary"),
+        )
+    else:
         await query.edit_message_text(
-            "➕ أرسل اسم الدومين الذي تريد عرضه للمستخدمين.\n\nمثال: example.com",
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton(
-                    get_text(lang, "btn_back"),
-                    callback_data="section_paid_domains",
-                    style="primary",
-                )
-            ]]),
+            "❌ تعذر حذف القناة.",
+            reply_markup=back_keyboard("channel_management", "primary"),
         )
-        return
 
-    if data == "delete_paid_domain":
-        if not is_admin(user_id):
-            return
-        domains = get_paid_domains()
-        if not domains:
-            await query.edit_message_text(
-                "❌ لا توجد دومينات للحذف.",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton(
-                        get_text(lang, "btn_back"),
-                        callback_data="section_paid_domains",
-                        style="primary",
-                    )
-                ]]),
-            )
-            return
 
-        buttons = [
+@CALLBACK_ROUTER.route("toggle_subscription_{channel_db_id:int}", access="admin")
+async def cb_toggle_subscription_by_id(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str, channel_db_id: int):
+    channel_info = await get_channel_by_id_async(channel_db_id)
+    if not channel_info:
+        return
+    new_status = await toggle_subscription_async(channel_info["channel_username"])
+    action = "تفعيل" if new_status else "تعطيل"
+    await query.edit_message_text(
+        f"✅ تم {action} الاشتراك الإجباري لقناة @{channel_info['channel_username']}.",
+        reply_markup=InlineKeyboardMarkup([[
             InlineKeyboardButton(
-                f"🗑️ @{domain}",
-                callback_data=f"remove_paid_domain_{index}",
-                style="danger",
+                get_text(lang, "btn_back"),
+                callback_data=f"manage_channel_{channel_db_id}",
+                style="primary",
             )
-            for index, domain in enumerate(domains)
-        ]
+        ]]),
+    )
+
+
+@CALLBACK_ROUTER.route("delete_channel", access="admin")
+async def cb_delete_channel(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    channel_info = await get_channel_info_async(only_enabled=False)
+    if channel_info:
+        await delete_channel_async(channel_info["channel_username"])
         await query.edit_message_text(
-            "🗑️ اختر الدومين الذي تريد حذفه:",
-            reply_markup=get_admin_section_keyboard(buttons, "section_paid_domains"),
+            "✅ تم حذف القناة بنجاح",
+            reply_markup=await get_channel_management_keyboard_async(lang),
         )
-        return
-
-    if re.fullmatch(r"remove_paid_domain_\d+", data):
-        if not is_admin(user_id):
-            return
-        domain_index = int(data.rsplit("_", 1)[1])
-        success, removed_domain = remove_paid_domain(domain_index)
-        result_text = (
-            f"✅ تم حذف الدومين @{removed_domain}."
-            if success
-            else "❌ تعذر حذف الدومين."
+    else:
+        await query.edit_message_text(
+            "❌ لا توجد قناة",
+            reply_markup=await get_channel_management_keyboard_async(lang),
         )
+
+
+@CALLBACK_ROUTER.route("toggle_subscription", access="admin")
+async def cb_toggle_subscription(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    channel_info = await get_channel_info_async(only_enabled=False)
+    if channel_info:
+        new_status = await toggle_subscription_async(channel_info["channel_username"])
+        action = "تفعيل" if new_status else "تعطيل"
         await query.edit_message_text(
-            result_text,
+            f"✅ تم {action} الاشتراك الإجباري",
             reply_markup=InlineKeyboardMarkup([[
                 InlineKeyboardButton(
                     get_text(lang, "btn_back"),
-                    callback_data="section_paid_domains",
+                    callback_data=f"manage_channel_{channel_info['id']}",
                     style="primary",
                 )
             ]]),
         )
-        return
 
-    if data == "section_email_limit":
-        if not is_admin(user_id):
-            return
-        limit = get_email_limit()
-        current = "غير محدود" if limit == 0 else str(limit)
-        contact_username = get_admin_contact_username()
-        contact_text = f"@{contact_username}" if contact_username else "غير محدد"
-        buttons = [
-            InlineKeyboardButton("✏️ تحديد العدد", callback_data="set_email_limit", style="primary"),
-        ]
-        if user_id == ADMIN_ID:
-            buttons.append(
-                InlineKeyboardButton(
-                    "🎯 تحديد حد عضو عبر ID",
-                    callback_data="set_member_email_limit",
-                    style="primary",
-                )
-            )
-        buttons.extend([
+
+# أقسام الأدمن القديمة الأساسية (موجودة ومفعلة)
+
+
+@CALLBACK_ROUTER.route("section_stats", access="admin")
+async def cb_section_stats(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    kb = InlineKeyboardMarkup([
+        [
             InlineKeyboardButton(
-                "👤 إضافة يوزر التواصل",
-                callback_data="set_admin_contact_username",
+                "📊 الإحصائيات العامة",
+                callback_data="stats_general",
                 transparent=True,
             ),
-            InlineKeyboardButton("♾️ إلغاء الحد", callback_data="clear_email_limit", style="danger"),
-        ])
-        await query.edit_message_text(
-            "🔢 حد إنشاء الإيميلات\n\n"
-            f"الحد الحالي لكل مستخدم: {current}\n"
-            f"يوزر التواصل مع الأدمن: {contact_text}",
-            reply_markup=get_admin_section_keyboard(buttons, "admin_panel"),
+            InlineKeyboardButton(
+                "📈 إحصائيات الاستخدام اليومية",
+                callback_data="stats_daily",
+                transparent=True,
+            ),
+        ],
+        [InlineKeyboardButton(
+            get_text(lang, "btn_back"),
+            callback_data="admin_panel",
+            style="primary",
+        )],
+    ])
+    await query.edit_message_text(
+        "📊 قسم الإحصائيات\n\nاختر نوع الإحصائيات التي تريد عرضها:",
+        reply_markup=kb,
+    )
+
+
+@CALLBACK_ROUTER.route("stats_general", access="admin")
+async def cb_stats_general(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    counts = await run_db(get_member_counts)
+    total_users = counts["total_users"]
+    total_emails = counts["total_emails"]
+    active_users = counts["active_users"]
+    text = (
+        "📊 الإحصائيات العامة\n\n"
+        f"👥 إجمالي المستخدمين: {total_users}\n"
+        f"📧 إجمالي الإيميلات: {total_emails}\n"
+        f"🔄 المستخدمون النشطون: {active_users}\n"
+    )
+    await query.edit_message_text(
+        text,
+        reply_markup=back_keyboard("section_stats", "primary"),
+    )
+
+
+@CALLBACK_ROUTER.route("stats_daily", access="admin")
+async def cb_stats_daily(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    await run_db(flush_daily_stats)
+    days = await get_last_seven_days_usage_async()
+    if not days:
+        text = "📈 إحصائيات الاستخدام اليومية\n\n❌ تعذر قراءة الإحصائيات حالياً."
+    else:
+        today = days[0]
+        labels = ["اليوم", "أمس"]
+        day_lines = []
+        for index, item in enumerate(days):
+            if index < len(labels):
+                label = labels[index]
+            else:
+                label = item["stat_date"].strftime("%Y-%m-%d")
+            day_lines.append(f"📅 {label}: {item['emails_created']} إيميل")
+
+        best_day = max(days, key=lambda item: item["emails_created"])
+        if best_day["stat_date"] == days[0]["stat_date"]:
+            best_label = "اليوم"
+        elif len(days) > 1 and best_day["stat_date"] == days[1]["stat_date"]:
+            best_label = "أمس"
+        else:
+            best_label = best_day["stat_date"].strftime("%Y-%m-%d")
+
+        text = (
+            "📈 إحصائيات الاستخدام اليومية\n\n"
+            "📅 إحصائيات اليوم:\n\n"
+            f"👤 المستخدمون الجدد: {today['new_users']}\n"
+            f"📧 الإيميلات المنشأة: {today['emails_created']}\n"
+            f"📥 مرات فتح صندوق الوارد: {today['inbox_opens']}\n\n"
+            "━━━━━━━━━━━━━━\n\n"
+            "📊 آخر 7 أيام:\n\n"
+            + "\n".join(day_lines)
+            + "\n\n"
+            "🏆 أعلى يوم استخدام خلال آخر 7 أيام:\n"
+            f"{best_label}: {best_day['emails_created']} إيميل"
         )
-        return
 
-    if data == "set_email_limit":
-        if not is_admin(user_id):
-            return
-        context.user_data["waiting_for"] = "email_limit"
+    await query.edit_message_text(
+        text,
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton(
+                "🔄 تحديث الإحصائيات",
+                callback_data="stats_daily",
+                style="success",
+            )],
+            [InlineKeyboardButton(
+                "🔙 رجوع إلى قسم الإحصائيات",
+                callback_data="section_stats",
+                style="primary",
+            )],
+        ]),
+    )
+
+
+@CALLBACK_ROUTER.route("section_forward", access="admin")
+async def cb_section_forward(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    status = "✅ مفعّل" if forwarding_enabled else "❌ معطّل"
+    text = (
+        f"📨 قسم توجيه الرسائل\n\nالحالة: {status}\n\n"
+        "عند التفعيل، كل ما يرسله المستخدم سيصلك كمحول منه مباشرة: "
+        "الأوامر مثل /start، النصوص، الصور، الفيديو، الفويس، الملفات والملصقات."
+    )
+    kb = get_admin_section_keyboard([
+        InlineKeyboardButton("✅ تفعيل التوجيه", callback_data="forward_on", style="success"),
+        InlineKeyboardButton("❌ تعطيل التوجيه", callback_data="forward_off", style="danger"),
+    ], "admin_panel")
+    await query.edit_message_text(text, reply_markup=kb)
+
+
+@CALLBACK_ROUTER.route("forward_on", access="admin")
+async def cb_forward_on(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    global forwarding_enabled
+    if not await set_setting_async("forwarding_enabled", "1"):
         await query.edit_message_text(
-            "🔢 أرسل العدد الأقصى الذي يستطيع كل مستخدم إنشاءه.\n\nمثال: 3",
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="section_email_limit")
-            ]]),
+            "❌ تعذر حفظ حالة التوجيه في قاعدة البيانات.",
+            reply_markup=back_keyboard("section_forward"),
         )
         return
+    forwarding_enabled = True
+    await query.edit_message_text("✅ تم تفعيل توجيه الرسائل!",
+                                  reply_markup=back_keyboard("section_forward"))
 
-    if data == "set_member_email_limit":
-        if user_id != ADMIN_ID:
-            await query.answer("هذا الخيار للمشرف الرئيسي فقط.", show_alert=True)
-            return
-        context.user_data["waiting_for"] = "member_email_limit_id"
-        context.user_data.pop("member_email_limit_target", None)
+
+@CALLBACK_ROUTER.route("forward_off", access="admin")
+async def cb_forward_off(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    global forwarding_enabled
+    if not await set_setting_async("forwarding_enabled", "0"):
         await query.edit_message_text(
-            "🎯 أرسل ID العضو فقط لتحديد الحد الخاص به.\n\nمثال: 123456789",
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="section_email_limit")
-            ]]),
+            "❌ تعذر حفظ حالة التوجيه في قاعدة البيانات.",
+            reply_markup=back_keyboard("section_forward"),
         )
         return
+    forwarding_enabled = False
+    await query.edit_message_text("❌ تم تعطيل توجيه الرسائل!",
+                                  reply_markup=back_keyboard("section_forward"))
+
+
+@CALLBACK_ROUTER.route("section_settings", access="admin")
+async def cb_section_settings(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    status_icon = "✅" if bot_active else "❌"
+    status_text = "يعمل" if bot_active else "متوقف"
+    text = f"⚙️ الإعدادات\n\n• حالة البوت: {status_icon} {status_text}\n"
+    if not bot_active and bot_offline_message:
+        text += f"• رسالة الإيقاف: {bot_offline_message[:80]}..."
+    kb = get_admin_section_keyboard([
+        InlineKeyboardButton(f"🔄 حالة البوت: {status_icon}", callback_data="toggle_bot_status"),
+        InlineKeyboardButton("✏️ رسالة الإيقاف", callback_data="set_offline_message"),
+    ], "admin_panel")
+    await query.edit_message_text(text, reply_markup=kb)
+
+
+@CALLBACK_ROUTER.route("toggle_bot_status", access="admin")
+async def cb_toggle_bot_status(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    global bot_active
+    bot_active = not bot_active
+    txt = "✅ تم تشغيل البوت!" if bot_active else "❌ تم إيقاف البوت!"
+    await query.edit_message_text(txt, reply_markup=back_keyboard("section_settings"))
+
+
+@CALLBACK_ROUTER.route("set_offline_message", access="admin")
+async def cb_set_offline_message(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    context.user_data["waiting_for"] = "offline_message"
+    await query.edit_message_text("✏️ أرسل رسالة الإيقاف التي ستظهر للمستخدمين:",
+                                  reply_markup=back_keyboard("section_settings"))
+
+
+@CALLBACK_ROUTER.route("section_broadcast", access="admin")
+async def cb_section_broadcast(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    kb = get_admin_section_keyboard([
+        InlineKeyboardButton("📨 إذاعة للكل", callback_data="broadcast_all", style="primary"),
+        InlineKeyboardButton("👥 إذاعة للنشطين فقط", callback_data="broadcast_active", style="primary"),
+    ], "admin_panel")
+    await query.edit_message_text("📢 قسم الإذاعة\n\nاختر نوع الإذاعة:", reply_markup=kb)
+
+
+@CALLBACK_ROUTER.route("broadcast_all", access="admin")
+async def cb_broadcast_all(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    context.user_data["waiting_for"] = "broadcast_all"
+    audience_count = await run_db(count_broadcast_audience)
+    await query.edit_message_text(f"📢 أرسل رسالة الإذاعة للكل\n\n⚠️ سيتم إرسالها لـ {audience_count} مستخدم",
+                                  reply_markup=back_keyboard("section_broadcast"))
+
+
+@CALLBACK_ROUTER.route("broadcast_active", access="admin")
+async def cb_broadcast_active(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    context.user_data["waiting_for"] = "broadcast_active"
+    active_count = await run_db(count_broadcast_audience, True)
+    await query.edit_message_text(f"📢 أرسل رسالة الإذاعة للنشطين فقط\n\n👥 النشطين: {active_count}",
+                                  reply_markup=back_keyboard("section_broadcast"))
+
+
+@CALLBACK_ROUTER.route("broadcast_cancel_{job_id:int}", access="admin")
+async def cb_broadcast_cancel(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str, job_id: int):
+    # تتوقف حلقة الإرسال عند قراءة الحالة بعد الدفعة الحالية.
+    await run_db(finish_broadcast_job, job_id, "cancelled")
+    await update_broadcast_progress(context.bot, await run_db(get_broadcast_job, job_id))
+
+
+@CALLBACK_ROUTER.route("section_paid_domains", access="admin")
+async def cb_section_paid_domains(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    domains = await get_paid_domains_async()
+    text = "🌐 إدارة الدومينات المدفوعة\n\n"
+    if domains:
+        text += "الدومينات المعروضة للمستخدمين:\n"
+        for index, domain in enumerate(domains, start=1):
+            text += f"{index}. @{domain}\n"
+    else:
+        text += "لا توجد دومينات مضافة حالياً."
 
-    if data == "set_admin_contact_username":
-        if user_id != ADMIN_ID:
-            await query.answer("هذا الإعداد للمشرف الرئيسي فقط.", show_alert=True)
-            return
-        context.user_data["waiting_for"] = "admin_contact_username"
-        await query.edit_message_text(
-            "👤 أرسل يوزر الأدمن الذي سيظهر للمستخدم عند وصوله للحد.\n\nمثال: @username",
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="section_email_limit")
-            ]]),
+    buttons = [
+        InlineKeyboardButton("➕ إضافة دومين", callback_data="add_paid_domain", style="success"),
+    ]
+    if domains:
+        buttons.append(
+            InlineKeyboardButton("🗑️ حذف دومين", callback_data="delete_paid_domain", style="danger")
         )
-        return
+    await query.edit_message_text(
+        text,
+        reply_markup=get_admin_section_keyboard(buttons, "admin_panel"),
+    )
 
-    if data == "clear_email_limit":
-        if not is_admin(user_id):
-            return
-        set_setting("email_limit", "0")
+
+@CALLBACK_ROUTER.route("add_paid_domain", access="admin")
+async def cb_add_paid_domain(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    context.user_data["waiting_for"] = "paid_domain_add"
+    await query.edit_message_text(
+        "➕ أرسل اسم الدومين الذي تريد عرضه للمستخدمين.\n\nمثال: example.com",
+        reply_markup=back_keyboard("section_paid_domains", "primary"),
+    )
+
+
+@CALLBACK_ROUTER.route("delete_paid_domain", access="admin")
+async def cb_delete_paid_domain(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    domains = await get_paid_domains_async()
+    if not domains:
         await query.edit_message_text(
-            "✅ تم إلغاء الحد وأصبح إنشاء الإيميلات غير محدود.",
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="section_email_limit")
-            ]]),
+            "❌ لا توجد دومينات للحذف.",
+            reply_markup=back_keyboard("section_paid_domains", "primary"),
         )
         return
 
-    if data == "section_members":
-        if not is_admin(user_id):
-            return
-        total_users = len(user_database)
-        active_users = sum(1 for u in user_database.values() if len(u.get("emails", [])) > 0)
-        inactive_users = total_users - active_users
-        total_emails = sum(len(u.get("emails", [])) for u in user_database.values())
-        text = (
-            "👥 إدارة الأعضاء\n\n"
-            f"• إجمالي الأعضاء: {total_users}\n"
-            f"• الأعضاء النشطون: {active_users}\n"
-            f"• الأعضاء غير النشطين: {inactive_users}\n"
-            f"• إجمالي الإيميلات: {total_emails}\n"
+    buttons = [
+        InlineKeyboardButton(
+            f"🗑️ @{domain}",
+            callback_data=f"remove_paid_domain_{index}",
+            style="danger",
         )
-        buttons = [
-            InlineKeyboardButton("📋 قائمة كل الأعضاء", callback_data="users_list_all", style="primary"),
-            InlineKeyboardButton("✅ الأعضاء النشطين", callback_data="users_list_active", style="success"),
-            InlineKeyboardButton("🏆 الأكثر إيميلات", callback_data="users_list_top", style="primary"),
-            InlineKeyboardButton("🔍 بحث عن عضو", callback_data="search_member", style="primary"),
-            InlineKeyboardButton("📧 إيميلات عضو", callback_data="member_emails", style="primary"),
-        ]
-        if user_id == ADMIN_ID:
-            buttons.append(
-                InlineKeyboardButton(
-                    "🗑️ حذف إيميلات عضو",
-                    callback_data="delete_user_emails",
-                    style="danger",
-                )
+        for index, domain in enumerate(domains)
+    ]
+    await query.edit_message_text(
+        "🗑️ اختر الدومين الذي تريد حذفه:",
+        reply_markup=get_admin_section_keyboard(buttons, "section_paid_domains"),
+    )
+
+
+@CALLBACK_ROUTER.route("remove_paid_domain_{domain_index:int}", access="admin")
+async def cb_remove_paid_domain(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str, domain_index: int):
+    success, removed_domain = await remove_paid_domain_async(domain_index)
+    result_text = (
+        f"✅ تم حذف الدومين @{removed_domain}."
+        if success
+        else "❌ تعذر حذف الدومين."
+    )
+    await query.edit_message_text(
+        result_text,
+        reply_markup=back_keyboard("section_paid_domains", "primary"),
+    )
+
+
+@CALLBACK_ROUTER.route("section_email_limit", access="admin")
+async def cb_section_email_limit(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    limit = await get_email_limit_async()
+    current = "غير محدود" if limit == 0 else str(limit)
+    contact_username = await get_admin_contact_username_async()
+    contact_text = f"@{contact_username}" if contact_username else "غير محدد"
+    buttons = [
+        InlineKeyboardButton("✏️ تحديد العدد", callback_data="set_email_limit", style="primary"),
+    ]
+    if user_id == ADMIN_ID:
+        buttons.append(
+            InlineKeyboardButton(
+                "🎯 تحديد حد عضو عبر ID",
+                callback_data="set_member_email_limit",
+                style="primary",
             )
-        await query.edit_message_text(
-            text,
-            reply_markup=get_admin_section_keyboard(buttons, "admin_panel"),
         )
-        return
+    buttons.extend([
+        InlineKeyboardButton(
+            "👤 إضافة يوزر التواصل",
+            callback_data="set_admin_contact_username",
+            transparent=True,
+        ),
+        InlineKeyboardButton("♾️ إلغاء الحد", callback_data="clear_email_limit", style="danger"),
+    ])
+    await query.edit_message_text(
+        "🔢 حد إنشاء الإيميلات\n\n"
+        f"الحد الحالي لكل مستخدم: {current}\n"
+        f"يوزر التواصل مع الأدمن: {contact_text}",
+        reply_markup=get_admin_section_keyboard(buttons, "admin_panel"),
+    )
 
-    if data == "users_list_all" or re.fullmatch(r"users_list_all_\d+", data):
-        if not is_admin(user_id):
-            return
-        requested_page = int(data.rsplit("_", 1)[1]) if re.fullmatch(r"users_list_all_\d+", data) else 0
-        members, page, total_pages = paginate_member_items(list(user_database.items()), requested_page)
-        text = f"📋 قائمة كل الأعضاء — الصفحة {page + 1}/{total_pages}\n━━━━━━━━━━━━━━━\n\n"
-        start_number = page * MEMBERS_PAGE_SIZE + 1
-        for offset, (uid, info) in enumerate(members):
-            name = (info.get("first_name") or "مجهول") + (f" {info.get('last_name')}" if info.get("last_name") else "")
-            username = f"@{info.get('username')}" if info.get("username") else "—"
-            emails_count = len(info.get("emails", []))
-            status = "✅" if emails_count > 0 else "⚪"
-            text += f"{start_number + offset}. {status} <b>{telegram_html(name)}</b>\n    🆔 {telegram_html(username)} | 📧 {emails_count}\n    ID: <code>{uid}</code>\n\n"
-        if not members:
-            text += "لا يوجد أعضاء."
-        await query.edit_message_text(
-            text, parse_mode="HTML",
-            reply_markup=get_member_pages_keyboard("users_list_all", page, total_pages),
-        )
-        return
 
-    if data == "users_list_active" or re.fullmatch(r"users_list_active_\d+", data):
-        if not is_admin(user_id):
-            return
-        active_members = [(uid, info) for uid, info in user_database.items() if len(info.get("emails", [])) > 0]
-        requested_page = int(data.rsplit("_", 1)[1]) if re.fullmatch(r"users_list_active_\d+", data) else 0
-        members, page, total_pages = paginate_member_items(active_members, requested_page)
-        text = f"✅ الأعضاء النشطين ({len(active_members)}) — الصفحة {page + 1}/{total_pages}\n━━━━━━━━━━━━━━━\n\n"
-        start_number = page * MEMBERS_PAGE_SIZE + 1
-        for offset, (uid, info) in enumerate(members):
-            name = (info.get("first_name") or "مجهول") + (f" {info.get('last_name')}" if info.get("last_name") else "")
-            username = f"@{info.get('username')}" if info.get("username") else "—"
-            emails_count = len(info.get("emails", []))
-            text += f"{start_number + offset}. <b>{telegram_html(name)}</b>\n    🆔 {telegram_html(username)} | 📧 {emails_count}\n    ID: <code>{uid}</code>\n\n"
-        if not members:
-            text += "لا يوجد أعضاء نشطون."
-        await query.edit_message_text(
-            text, parse_mode="HTML",
-            reply_markup=get_member_pages_keyboard("users_list_active", page, total_pages),
-        )
-        return
+@CALLBACK_ROUTER.route("set_email_limit", access="admin")
+async def cb_set_email_limit(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    context.user_data["waiting_for"] = "email_limit"
+    await query.edit_message_text(
+        "🔢 أرسل العدد الأقصى الذي يستطيع كل مستخدم إنشاءه.\n\nمثال: 3",
+        reply_markup=back_keyboard("section_email_limit"),
+    )
 
-    if data == "users_list_top" or re.fullmatch(r"users_list_top_\d+", data):
-        if not is_admin(user_id):
-            return
-        sorted_users = sorted(
-            ((uid, info) for uid, info in user_database.items() if len(info.get("emails", [])) > 0),
-            key=lambda item: len(item[1].get("emails", [])), reverse=True,
-        )
-        requested_page = int(data.rsplit("_", 1)[1]) if re.fullmatch(r"users_list_top_\d+", data) else 0
-        members, page, total_pages = paginate_member_items(sorted_users, requested_page)
-        text = f"🏆 الأكثر إيميلات — الصفحة {page + 1}/{total_pages}\n━━━━━━━━━━━━━━━\n\n"
-        start_rank = page * MEMBERS_PAGE_SIZE + 1
-        medals = ["🥇", "🥈", "🥉"]
-        for offset, (uid, info) in enumerate(members):
-            rank = start_rank + offset
-            medal = medals[rank - 1] if rank <= 3 else f"{rank}."
-            name = (info.get("first_name") or "مجهول") + (f" {info.get('last_name')}" if info.get("last_name") else "")
-            username = f"@{info.get('username')}" if info.get("username") else "—"
-            emails_count = len(info.get("emails", []))
-            text += f"{medal} <b>{telegram_html(name)}</b>\n    🆔 {telegram_html(username)}\n    📧 {emails_count}\n    ID: <code>{uid}</code>\n\n"
-        if not members:
-            text += "لا توجد بيانات."
-        await query.edit_message_text(
-            text, parse_mode="HTML",
-            reply_markup=get_member_pages_keyboard("users_list_top", page, total_pages),
+
+@CALLBACK_ROUTER.route("set_member_email_limit", access="owner", denied_text="هذا الخيار للمشرف الرئيسي فقط.")
+async def cb_set_member_email_limit(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    context.user_data["waiting_for"] = "member_email_limit_id"
+    context.user_data.pop("member_email_limit_target", None)
+    await query.edit_message_text(
+        "🎯 أرسل ID العضو فقط لتحديد الحد الخاص به.\n\nمثال: 123456789",
+        reply_markup=back_keyboard("section_email_limit"),
+    )
+
+
+@CALLBACK_ROUTER.route("set_admin_contact_username", access="owner", denied_text="هذا الإعداد للمشرف الرئيسي فقط.")
+async def cb_set_admin_contact_username(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    context.user_data["waiting_for"] = "admin_contact_username"
+    await query.edit_message_text(
+        "👤 أرسل يوزر الأدمن الذي سيظهر للمستخدم عند وصوله للحد.\n\nمثال: @username",
+        reply_markup=back_keyboard("section_email_limit"),
+    )
+
+
+@CALLBACK_ROUTER.route("clear_email_limit", access="admin")
+async def cb_clear_email_limit(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    await set_setting_async("email_limit", "0")
+    await query.edit_message_text(
+        "✅ تم إلغاء الحد وأصبح إنشاء الإيميلات غير محدود.",
+        reply_markup=back_keyboard("section_email_limit"),
+    )
+
+
+@CALLBACK_ROUTER.route("section_members", access="admin")
+async def cb_section_members(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    counts = await run_db(get_member_counts)
+    total_users = counts["total_users"]
+    active_users = counts["active_users"]
+    inactive_users = total_users - active_users
+    total_emails = counts["total_emails"]
+    text = (
+        "👥 إدارة الأعضاء\n\n"
+        f"• إجمالي الأعضاء: {total_users}\n"
+        f"• الأعضاء النشطون: {active_users}\n"
+        f"• الأعضاء غير النشطين: {inactive_users}\n"
+        f"• إجمالي الإيميلات: {total_emails}\n"
+    )
+    buttons = [
+        InlineKeyboardButton("📋 قائمة كل الأعضاء", callback_data="users_list_all", style="primary"),
+        InlineKeyboardButton("✅ الأعضاء النشطين", callback_data="users_list_active", style="success"),
+        InlineKeyboardButton("🏆 الأكثر إيميلات", callback_data="users_list_top", style="primary"),
+        InlineKeyboardButton("🔍 بحث عن عضو", callback_data="search_member", style="primary"),
+        InlineKeyboardButton("📧 إيميلات عضو", callback_data="member_emails", style="primary"),
+    ]
+    if user_id == ADMIN_ID:
+        buttons.append(
+            InlineKeyboardButton(
+                "🗑️ حذف إيميلات عضو",
+                callback_data="delete_user_emails",
+                style="danger",
+            )
         )
-        return
+    await query.edit_message_text(
+        text,
+        reply_markup=get_admin_section_keyboard(buttons, "admin_panel"),
+    )
 
-    if data == "member_emails":
-        if not is_admin(user_id):
-            return
-        context.user_data["waiting_for"] = "member_emails_id"
-        context.user_data.pop("member_emails_target", None)
+
+@CALLBACK_ROUTER.route("users_list_all", access="admin")
+@CALLBACK_ROUTER.route("users_list_all_{legacy_page:int}", access="admin")
+@CALLBACK_ROUTER.route("users_list_all_{direction:str}_{page:int}_{cursor_key:int}_{cursor_id:int}", access="admin")
+async def cb_users_list_all(
+    query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str,
+    legacy_page: int = 0, direction: str = None, page: int = 0, cursor_key: int = None, cursor_id: int = None,
+):
+    if direction not in ("n", "p"):
+        # الأزرار القديمة (رقم صفحة فقط) تفتح الصفحة الأولى.
+        direction, page = None, 0
+    members, total, first_cursor, last_cursor, has_next = await run_db(
+        get_members_page, "all", direction, cursor_key, cursor_id
+    )
+    total_pages = max(1, (total + MEMBERS_PAGE_SIZE - 1) // MEMBERS_PAGE_SIZE)
+    text = f"📋 قائمة كل الأعضاء — الصفحة {page + 1}/{total_pages}\n━━━━━━━━━━━━━━━\n\n"
+    start_number = page * MEMBERS_PAGE_SIZE + 1
+    for offset, (uid, info) in enumerate(members):
+        name = (info.get("first_name") or "مجهول") + (f" {info.get('last_name')}" if info.get("last_name") else "")
+        username = f"@{info.get('username')}" if info.get("username") else "—"
+        emails_count = info["emails_count"]
+        status = "✅" if emails_count > 0 else "⚪"
+        text += f"{start_number + offset}. {status} <b>{telegram_html(name)}</b>\n    🆔 {telegram_html(username)} | 📧 {emails_count}\n    ID: <code>{uid}</code>\n\n"
+    if not members:
+        text += "لا يوجد أعضاء."
+    await query.edit_message_text(
+        text, parse_mode="HTML",
+        reply_markup=get_member_pages_keyboard("users_list_all", page, first_cursor, last_cursor, has_next),
+    )
+
+
+@CALLBACK_ROUTER.route("users_list_active", access="admin")
+@CALLBACK_ROUTER.route("users_list_active_{legacy_page:int}", access="admin")
+@CALLBACK_ROUTER.route("users_list_active_{direction:str}_{page:int}_{cursor_key:int}_{cursor_id:int}", access="admin")
+async def cb_users_list_active(
+    query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str,
+    legacy_page: int = 0, direction: str = None, page: int = 0, cursor_key: int = None, cursor_id: int = None,
+):
+    if direction not in ("n", "p"):
+        # الأزرار القديمة (رقم صفحة فقط) تفتح الصفحة الأولى.
+        direction, page = None, 0
+    members, active_total, first_cursor, last_cursor, has_next = await run_db(
+        get_members_page, "active", direction, cursor_key, cursor_id
+    )
+    total_pages = max(1, (active_total + MEMBERS_PAGE_SIZE - 1) // MEMBERS_PAGE_SIZE)
+    text = f"✅ الأعضاء النشطين ({active_total}) — الصفحة {page + 1}/{total_pages}\n━━━━━━━━━━━━━━━\n\n"
+    start_number = page * MEMBERS_PAGE_SIZE + 1
+    for offset, (uid, info) in enumerate(members):
+        name = (info.get("first_name") or "مجهول") + (f" {info.get('last_name')}" if info.get("last_name") else "")
+        username = f"@{info.get('username')}" if info.get("username") else "—"
+        emails_count = info["emails_count"]
+        text += f"{start_number + offset}. <b>{telegram_html(name)}</b>\n    🆔 {telegram_html(username)} | 📧 {emails_count}\n    ID: <code>{uid}</code>\n\n"
+    if not members:
+        text += "لا يوجد أعضاء نشطون."
+    await query.edit_message_text(
+        text, parse_mode="HTML",
+        reply_markup=get_member_pages_keyboard("users_list_active", page, first_cursor, last_cursor, has_next),
+    )
+
+
+@CALLBACK_ROUTER.route("users_list_top", access="admin")
+@CALLBACK_ROUTER.route("users_list_top_{legacy_page:int}", access="admin")
+@CALLBACK_ROUTER.route("users_list_top_{direction:str}_{page:int}_{cursor_key:int}_{cursor_id:int}", access="admin")
+async def cb_users_list_top(
+    query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str,
+    legacy_page: int = 0, direction: str = None, page: int = 0, cursor_key: int = None, cursor_id: int = None,
+):
+    if direction not in ("n", "p"):
+        # الأزرار القديمة (رقم صفحة فقط) تفتح الصفحة الأولى.
+        direction, page = None, 0
+    members, total, first_cursor, last_cursor, has_next = await run_db(
+        get_members_page, "top", direction, cursor_key, cursor_id
+    )
+    total_pages = max(1, (total + MEMBERS_PAGE_SIZE - 1) // MEMBERS_PAGE_SIZE)
+    text = f"🏆 الأكثر إيميلات — الصفحة {page + 1}/{total_pages}\n━━━━━━━━━━━━━━━\n\n"
+    start_rank = page * MEMBERS_PAGE_SIZE + 1
+    medals = ["🥇", "🥈", "🥉"]
+    for offset, (uid, info) in enumerate(members):
+        rank = start_rank + offset
+        medal = medals[rank - 1] if rank <= 3 else f"{rank}."
+        name = (info.get("first_name") or "مجهول") + (f" {info.get('last_name')}" if info.get("last_name") else "")
+        username = f"@{info.get('username')}" if info.get("username") else "—"
+        emails_count = info["emails_count"]
+        text += f"{medal} <b>{telegram_html(name)}</b>\n    🆔 {telegram_html(username)}\n    📧 {emails_count}\n    ID: <code>{uid}</code>\n\n"
+    if not members:
+        text += "لا توجد بيانات."
+    await query.edit_message_text(
+        text, parse_mode="HTML",
+        reply_markup=get_member_pages_keyboard("users_list_top", page, first_cursor, last_cursor, has_next),
+    )
+
+
+@CALLBACK_ROUTER.route("member_emails", access="admin")
+async def cb_member_emails(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    context.user_data["waiting_for"] = "member_emails_id"
+    context.user_data.pop("member_emails_target", None)
+    await query.edit_message_text(
+        "📧 عرض إيميلات عضو\n\nأرسل ID العضو الآن.\n\nمثال: 123456789",
+        reply_markup=back_keyboard("section_members", "primary"),
+    )
+
+
+@CALLBACK_ROUTER.route("member_emails_list_{target_id:int}_{page:int}", access="admin")
+async def cb_member_emails_list(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str, target_id: int, page: int):
+    view = await get_admin_member_emails_view_async(target_id, page)
+    if not view:
         await query.edit_message_text(
-            "📧 عرض إيميلات عضو\n\nأرسل ID العضو الآن.\n\nمثال: 123456789",
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton(
-                    get_text(lang, "btn_back"),
-                    callback_data="section_members",
-                    style="primary",
-                )
-            ]]),
+            "❌ لم يعد هذا العضو موجوداً في بيانات البوت.",
+            reply_markup=back_keyboard("section_members", "primary"),
         )
         return
+    text, keyboard = view
+    await query.edit_message_text(text, reply_markup=keyboard, parse_mode="HTML")
 
-    match = re.fullmatch(r"member_emails_list_(\d+)_(\d+)", data)
-    if match:
-        if not is_admin(user_id):
-            return
-        target_id = int(match.group(1))
-        page = int(match.group(2))
-        view = get_admin_member_emails_view(target_id, page)
-        if not view:
-            await query.edit_message_text(
-                "❌ لم يعد هذا العضو موجوداً في بيانات البوت.",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="section_members", style="primary")
-                ]]),
-            )
-            return
-        text, keyboard = view
-        await query.edit_message_text(text, reply_markup=keyboard, parse_mode="HTML")
-        return
 
-    match = re.fullmatch(r"member_email_view_(\d+)_(\d+)_(\d+)", data)
-    if match:
-        if not is_admin(user_id):
-            return
-        target_id = int(match.group(1))
-        email_index = int(match.group(2))
-        email_page = int(match.group(3))
-        found = find_user_by_username_or_id(str(target_id))
-        if not found:
-            return
-        _, info = found
-        emails = list(info.get("emails") or [])
-        if email_index >= len(emails):
-            return
-        email_data = emails[email_index]
-        address = str(email_data.get("address") or "غير معروف")
-        text = (
-            "📧 بيانات إيميل العضو\n\n"
-            f"🔢 ID العضو: <code>{target_id}</code>\n"
-            f"📧 الإيميل: <code>{telegram_html(address)}</code>"
-        )
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton(
-                "📥 فتح البريد الوارد",
-                callback_data=f"member_inbox_{target_id}_{email_index}_{email_page}",
-                style="success",
-            )],
-            [InlineKeyboardButton(
-                "🔙 رجوع إلى إيميلات العضو",
-                callback_data=f"member_emails_list_{target_id}_{email_page}",
-                style="primary",
-            )],
-        ])
-        await query.edit_message_text(text, reply_markup=keyboard, parse_mode="HTML")
+@CALLBACK_ROUTER.route("member_email_view_{target_id:int}_{email_index:int}_{email_page:int}", access="admin")
+async def cb_member_email_view(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str, target_id: int, email_index: int, email_page: int):
+    found = await find_user_by_username_or_id_async(str(target_id))
+    if not found:
         return
+    _, info = found
+    emails = list(info.get("emails") or [])
+    if email_index >= len(emails):
+        return
+    email_data = emails[email_index]
+    address = str(email_data.get("address") or "غير معروف")
+    text = (
+        "📧 بيانات إيميل العضو\n\n"
+        f"🔢 ID العضو: <code>{target_id}</code>\n"
+        f"📧 الإيميل: <code>{telegram_html(address)}</code>"
+    )
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton(
+            "📥 فتح البريد الوارد",
+            callback_data=f"member_inbox_{target_id}_{email_index}_{email_page}",
+            style="success",
+        )],
+        [InlineKeyboardButton(
+            "🔙 رجوع إلى إيميلات العضو",
+            callback_data=f"member_emails_list_{target_id}_{email_page}",
+            style="primary",
+        )],
+    ])
+    await query.edit_message_text(text, reply_markup=keyboard, parse_mode="HTML")
 
-    match = re.fullmatch(r"member_inbox_(\d+)_(\d+)_(\d+)", data)
-    if match:
-        if not is_admin(user_id):
-            return
-        target_id = int(match.group(1))
-        email_index = int(match.group(2))
-        email_page = int(match.group(3))
-        found = find_user_by_username_or_id(str(target_id))
-        if not found:
-            return
-        _, info = found
-        emails = list(info.get("emails") or [])
-        if email_index >= len(emails):
-            return
-        email_data = emails[email_index]
-
-        inbox_result = await asyncio.to_thread(check_user_inbox_detailed, target_id, email_index)
-        messages = inbox_result.get("messages")
-        if inbox_result.get("error") is not None:
-            error_text, error_keyboard = build_admin_member_inbox_error_view(
-                inbox_result.get("error"),
-                target_id,
-                email_index,
-                email_page,
-                inbox_result.get("status"),
-            )
-            await query.edit_message_text(error_text, reply_markup=error_keyboard)
-            return
 
-        address = str(email_data.get("address") or "غير معروف")
-        if not messages:
-            await query.edit_message_text(
-                f"📭 لا توجد رسائل\n\n📧 {telegram_html(address)}\n🔢 ID العضو: <code>{target_id}</code>",
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton(
-                        get_text(lang, "btn_refresh"),
-                        callback_data=f"member_inbox_{target_id}_{email_index}_{email_page}",
-                        style="success",
-                    )],
-                    [InlineKeyboardButton(
-                        get_text(lang, "btn_back"),
-                        callback_data=f"member_email_view_{target_id}_{email_index}_{email_page}",
-                        style="primary",
-                    )],
-                ]),
-            )
-            return
+@CALLBACK_ROUTER.route("member_inbox_{target_id:int}_{email_index:int}_{email_page:int}", access="admin", cooldown=("admin_member_inbox", INBOX_COOLDOWN_SECONDS))
+async def cb_member_inbox(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str, target_id: int, email_index: int, email_page: int):
+    found = await find_user_by_username_or_id_async(str(target_id))
+    if not found:
+        return
+    _, info = found
+    emails = list(info.get("emails") or [])
+    if email_index >= len(emails):
+        return
+    email_data = emails[email_index]
 
-        text = (
-            f"📬 البريد الوارد للعضو ({len(messages)})\n"
-            f"📧 الإيميل: {telegram_html(address)}\n"
-            f"🔢 ID العضو: <code>{target_id}</code>\n\n"
-            "اختر الرسالة لعرض محتواها:"
+    inbox_result = await check_user_inbox_detailed(target_id, email_index)
+    messages = inbox_result.get("messages")
+    if inbox_result.get("error") is not None:
+        error_text, error_keyboard = build_admin_member_inbox_error_view(
+            inbox_result.get("error"),
+            target_id,
+            email_index,
+            email_page,
+            inbox_result.get("status"),
         )
+        await query.edit_message_text(error_text, reply_markup=error_keyboard)
+        return
+
+    address = str(email_data.get("address") or "غير معروف")
+    if not messages:
         await query.edit_message_text(
-            text,
+            f"📭 لا توجد رسائل\n\n📧 {telegram_html(address)}\n🔢 ID العضو: <code>{target_id}</code>",
             parse_mode="HTML",
-            reply_markup=get_admin_member_messages_keyboard(
-                messages, target_id, email_index, email_page
-            ),
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton(
+                    get_text(lang, "btn_refresh"),
+                    callback_data=f"member_inbox_{target_id}_{email_index}_{email_page}",
+                    style="success",
+                )],
+                [InlineKeyboardButton(
+                    get_text(lang, "btn_back"),
+                    callback_data=f"member_email_view_{target_id}_{email_index}_{email_page}",
+                    style="primary",
+                )],
+            ]),
         )
         return
 
-    match = re.fullmatch(r"member_msg_(\d+)_(\d+)_(\d+)_(\d+)", data)
-    if match:
-        if not is_admin(user_id):
-            return
-        target_id = int(match.group(1))
-        email_index = int(match.group(2))
-        msg_index = int(match.group(3))
-        email_page = int(match.group(4))
+    text = (
+        f"📬 البريد الوارد للعضو ({len(messages)})\n"
+        f"📧 الإيميل: {telegram_html(address)}\n"
+        f"🔢 ID العضو: <code>{target_id}</code>\n\n"
+        "اختر الرسالة لعرض محتواها:"
+    )
+    await query.edit_message_text(
+        text,
+        parse_mode="HTML",
+        reply_markup=get_admin_member_messages_keyboard(
+            messages, target_id, email_index, email_page
+        ),
+    )
 
-        found = find_user_by_username_or_id(str(target_id))
-        if not found:
-            return
-        _, info = found
-        emails = list(info.get("emails") or [])
-        if email_index >= len(emails):
-            return
 
-        inbox_result = await asyncio.to_thread(check_user_inbox_detailed, target_id, email_index)
+@CALLBACK_ROUTER.route("member_msgid_{target_id:int}_{email_index:int}_{message_id:str}_{email_page:int}", access="admin")
+@CALLBACK_ROUTER.route("member_msg_{target_id:int}_{email_index:int}_{msg_index:int}_{email_page:int}", access="admin")
+async def cb_member_msg(
+    query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str,
+    target_id: int, email_index: int, email_page: int, message_id: str = None, msg_index: int = 0,
+):
+    found = await find_user_by_username_or_id_async(str(target_id))
+    if not found:
+        return
+    _, info = found
+    emails = list(info.get("emails") or [])
+    if email_index >= len(emails):
+        return
+
+    if message_id is None:
+        inbox_result = await check_user_inbox_detailed(target_id, email_index, max_age=INBOX_LIST_CACHE_TTL_SECONDS)
         messages = inbox_result.get("messages")
         if inbox_result.get("error") is not None:
             error_text, error_keyboard = build_admin_member_inbox_error_view(
@@ -4172,48 +7264,13 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         if not messages or msg_index >= len(messages):
             return
-
-        msg_id = messages[msg_index].get("id")
-        if not msg_id:
-            return
-        full = await asyncio.to_thread(get_user_message_content, target_id, email_index, msg_id)
-        if not full:
-            await query.edit_message_text(
-                get_text(lang, "error_load_message"),
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton(
-                        get_text(lang, "btn_back"),
-                        callback_data=f"member_inbox_{target_id}_{email_index}_{email_page}",
-                        style="primary",
-                    )
-                ]]),
-            )
+        message_id = messages[msg_index].get("id")
+        if not message_id:
             return
-
-        sender_raw = (full.get("from") or {}).get("address") or "غير معروف"
-        subject_raw = full.get("subject") or "بدون موضوع"
-        date_raw = full.get("createdAt") or "غير معروف"
-        content_raw = get_message_text(full)
-        otp = extract_otp(content_raw)
-        if len(content_raw) > 3500:
-            content_raw = content_raw[:3500] + "\n\n... (الرسالة طويلة جداً)"
-
-        safe_values = {
-            "sender": telegram_html(sender_raw),
-            "subject": telegram_html(subject_raw),
-            "date": telegram_html(date_raw),
-            "content": telegram_html(content_raw),
-        }
-        if otp:
-            text = get_text(lang, "otp_found", otp=telegram_html(otp)) + "\n\n" + get_text(
-                lang, "message_detail", **safe_values
-            )
-        else:
-            text = get_text(lang, "message_detail", **safe_values)
-
+    cached_message = await get_user_message_content(target_id, email_index, message_id)
+    if not cached_message:
         await query.edit_message_text(
-            text,
-            parse_mode="HTML",
+            get_text(lang, "error_load_message"),
             reply_markup=InlineKeyboardMarkup([[
                 InlineKeyboardButton(
                     get_text(lang, "btn_back"),
@@ -4224,184 +7281,261 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    if data == "search_member":
-        if not is_admin(user_id):
-            return
-        context.user_data["waiting_for"] = "search_member"
-        await query.edit_message_text("🔍 أرسل ID أو username أو اسم للبحث:",
-                                      reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="section_members")]]))
-        return
-
-    if data == "delete_user_emails":
-        if user_id != ADMIN_ID:
-            await query.answer("هذا الخيار للمشرف الرئيسي فقط.", show_alert=True)
-            return
-        context.user_data["waiting_for"] = "delete_user_emails"
-        await query.edit_message_text(
-            "🗑️ أرسل ID العضو أو @username لحذف جميع إيميلاته من بيانات البوت.",
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="section_members")
-            ]]),
+    full = cached_message["message"]
+    sender_raw = (full.get("from") or {}).get("address") or "غير معروف"
+    subject_raw = full.get("subject") or "بدون موضوع"
+    date_raw = full.get("createdAt") or "غير معروف"
+    content_raw = cached_message["text"]
+    otp = cached_message["otp"]
+    if len(content_raw) > 3500:
+        content_raw = content_raw[:3500] + "\n\n... (الرسالة طويلة جداً)"
+
+    safe_values = {
+        "sender": telegram_html(sender_raw),
+        "subject": telegram_html(subject_raw),
+        "date": telegram_html(date_raw),
+        "content": telegram_html(content_raw),
+    }
+    if otp:
+        text = get_text(lang, "otp_found", otp=telegram_html(otp)) + "\n\n" + get_text(
+            lang, "message_detail", **safe_values
         )
-        return
+    else:
+        text = get_text(lang, "message_detail", **safe_values)
 
-    if data.startswith("confirm_delete_user_emails_"):
-        if user_id != ADMIN_ID:
-            return
-        target_value = data.replace("confirm_delete_user_emails_", "", 1)
-        if not target_value.isdigit():
-            return
-        target_id = int(target_value)
-        success, deleted_count = clear_user_emails(target_id)
-        context.user_data.pop("delete_user_emails_target", None)
-        if success:
-            result_text = f"✅ تم حذف {deleted_count} إيميل من بيانات العضو."
-        else:
-            result_text = "❌ فشل حذف إيميلات العضو."
-        await query.edit_message_text(
-            result_text,
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="section_members")
-            ]]),
-        )
-        return
+    await query.edit_message_text(
+        text,
+        parse_mode="HTML",
+        reply_markup=InlineKeyboardMarkup([[
+            InlineKeyboardButton(
+                get_text(lang, "btn_back"),
+                callback_data=f"member_inbox_{target_id}_{email_index}_{email_page}",
+                style="primary",
+            )
+        ]]),
+    )
 
-    # ================== إدارة المشرفين (للرئيسي فقط) ==================
-    if data == "section_admins":
-        if not is_admin(user_id):
-            return
-        if user_id != ADMIN_ID:
-            await query.answer("هذا القسم للمشرف الرئيسي فقط!", show_alert=True)
-            return
 
-        admins = get_all_admins()
-        text = "👮 إدارة المشرفين\n━━━━━━━━━━━━━━━\n\n"
-        text += f"👑 المشرف الرئيسي: <code>{ADMIN_ID}</code>\n\n"
-        if admins:
-            text += f"👮 المشرفون الإضافيون ({len(admins)}):\n"
-            for a in admins:
-                name = a.get("first_name") or "مجهول"
-                username = f"@{a.get('username')}" if a.get("username") else "—"
-                text += f"• {telegram_html(name)} | {telegram_html(username)}\n  ID: <code>{a['telegram_id']}</code>\n"
-        else:
-            text += "لا يوجد مشرفون إضافيون حالياً\n"
+@CALLBACK_ROUTER.route("search_member", access="admin")
+async def cb_search_member(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    context.user_data["waiting_for"] = "search_member"
+    await query.edit_message_text("🔍 أرسل ID أو username أو اسم للبحث:",
+                                  reply_markup=back_keyboard("section_members"))
 
-        kb = get_admin_section_keyboard([
-            InlineKeyboardButton("➕ إضافة مشرف", callback_data="add_admin", style="success"),
-            InlineKeyboardButton("➖ إزالة مشرف", callback_data="remove_admin", style="danger"),
-        ], "admin_panel")
-        await query.edit_message_text(text, parse_mode="HTML", reply_markup=kb)
-        return
 
-    if data == "add_admin":
-        if user_id != ADMIN_ID:
-            return
-        context.user_data["waiting_for"] = "add_admin"
-        await query.edit_message_text("➕ أرسل ID أو @username لإضافة مشرف (لازم يكون استخدم البوت مسبقاً)",
-                                      reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="section_admins")]]))
+@CALLBACK_ROUTER.route("delete_user_emails", access="owner", denied_text="هذا الخيار للمشرف الرئيسي فقط.")
+async def cb_delete_user_emails(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    context.user_data["waiting_for"] = "delete_user_emails"
+    await query.edit_message_text(
+        "🗑️ أرسل ID العضو أو @username لحذف جميع إيميلاته من بيانات البوت.",
+        reply_markup=back_keyboard("section_members"),
+    )
+
+
+@CALLBACK_ROUTER.route("confirm_delete_user_emails_{target_id:int}", access="owner")
+async def cb_confirm_delete_user_emails(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str, target_id: int):
+    success, deleted_count = await clear_user_emails_async(target_id)
+    context.user_data.pop("delete_user_emails_target", None)
+    if success:
+        result_text = f"✅ تم حذف {deleted_count} إيميل من بيانات العضو."
+    else:
+        result_text = "❌ فشل حذف إيميلات العضو."
+    await query.edit_message_text(
+        result_text,
+        reply_markup=back_keyboard("section_members"),
+    )
+
+
+# ================== إدارة المشرفين (للرئيسي فقط) ==================
+
+
+@CALLBACK_ROUTER.route("section_admins", access="admin")
+async def cb_section_admins(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    if user_id != ADMIN_ID:
+        await query.answer("هذا القسم للمشرف الرئيسي فقط!", show_alert=True)
         return
 
-    if data == "remove_admin":
-        if user_id != ADMIN_ID:
-            return
-        admins = get_all_admins()
-        if not admins:
-            await query.edit_message_text("❌ لا يوجد مشرفون للإزالة",
-                                          reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="section_admins")]]))
-            return
-        buttons = []
+    admins = await get_all_admins_async()
+    text = "👮 إدارة المشرفين\n━━━━━━━━━━━━━━━\n\n"
+    text += f"👑 المشرف الرئيسي: <code>{ADMIN_ID}</code>\n\n"
+    if admins:
+        text += f"👮 المشرفون الإضافيون ({len(admins)}):\n"
         for a in admins:
-            name = a.get("first_name") or str(a["telegram_id"])
-            buttons.append(
-                InlineKeyboardButton(
-                    f"❌ {name}",
-                    callback_data=f"confirm_remove_admin_{a['telegram_id']}",
-                    style="danger",
-                )
+            name = a.get("first_name") or "مجهول"
+            username = f"@{a.get('username')}" if a.get("username") else "—"
+            text += f"• {telegram_html(name)} | {telegram_html(username)}\n  ID: <code>{a['telegram_id']}</code>\n"
+    else:
+        text += "لا يوجد مشرفون إضافيون حالياً\n"
+
+    kb = get_admin_section_keyboard([
+        InlineKeyboardButton("➕ إضافة مشرف", callback_data="add_admin", style="success"),
+        InlineKeyboardButton("➖ إزالة مشرف", callback_data="remove_admin", style="danger"),
+    ], "admin_panel")
+    await query.edit_message_text(text, parse_mode="HTML", reply_markup=kb)
+
+
+@CALLBACK_ROUTER.route("add_admin", access="owner")
+async def cb_add_admin(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    context.user_data["waiting_for"] = "add_admin"
+    await query.edit_message_text("➕ أرسل ID أو @username لإضافة مشرف (لازم يكون استخدم البوت مسبقاً)",
+                                  reply_markup=back_keyboard("section_admins"))
+
+
+@CALLBACK_ROUTER.route("remove_admin", access="owner")
+async def cb_remove_admin(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    admins = await get_all_admins_async()
+    if not admins:
+        await query.edit_message_text("❌ لا يوجد مشرفون للإزالة",
+                                      reply_markup=back_keyboard("section_admins"))
+        return
+    buttons = []
+    for a in admins:
+        name = a.get("first_name") or str(a["telegram_id"])
+        buttons.append(
+            InlineKeyboardButton(
+                f"❌ {name}",
+                callback_data=f"confirm_remove_admin_{a['telegram_id']}",
+                style="danger",
             )
-        await query.edit_message_text(
-            "➖ اختر المشرف لإزالته:",
-            reply_markup=get_admin_section_keyboard(buttons, "section_admins"),
         )
-        return
+    await query.edit_message_text(
+        "➖ اختر المشرف لإزالته:",
+        reply_markup=get_admin_section_keyboard(buttons, "section_admins"),
+    )
 
-    if data.startswith("confirm_remove_admin_"):
-        if user_id != ADMIN_ID:
-            return
-        aid_str = data.replace("confirm_remove_admin_", "")
-        if not aid_str.isdigit():
-            return
-        aid = int(aid_str)
-        ok = remove_admin(aid)
-        await query.edit_message_text("✅ تم إزالة المشرف" if ok else "❌ فشل إزالة المشرف",
-                                      reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="section_admins")]]))
-        return
 
-    # ================== ✅ ميزاتك الجديدة (حظر/ترحيب) ==================
-    if data == "section_ban":
-        if not is_admin(user_id):
-            return
-        kb = get_admin_section_keyboard([
-            InlineKeyboardButton("🛑 حظر مستخدم", callback_data="ban_user", style="danger"),
-            InlineKeyboardButton("✅ فك حظر مستخدم", callback_data="unban_user", style="success"),
-        ], "admin_panel")
-        await query.edit_message_text("🛑 قسم الحظر\n\nاختر:", reply_markup=kb)
-        return
+@CALLBACK_ROUTER.route("confirm_remove_admin_{aid:int}", access="owner")
+async def cb_confirm_remove_admin(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str, aid: int):
+    ok = await remove_admin_async(aid)
+    await query.edit_message_text("✅ تم إزالة المشرف" if ok else "❌ فشل إزالة المشرف",
+                                  reply_markup=back_keyboard("section_admins"))
 
-    if data == "ban_user":
-        if not is_admin(user_id):
-            return
-        context.user_data["waiting_for"] = "ban_user"
-        await query.edit_message_text("🛑 أرسل ID المستخدم للحظر (مثال: 123456789)\nويمكنك تكتب سبب بالحظر بعده بسطر ثاني (اختياري).",
-                                      reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="section_ban")]]))
-        return
 
-    if data == "unban_user":
-        if not is_admin(user_id):
-            return
-        context.user_data["waiting_for"] = "unban_user"
-        await query.edit_message_text("✅ أرسل ID المستخدم لفك الحظر:",
-                                      reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="section_ban")]]))
-        return
+# ================== ✅ ميزاتك الجديدة (حظر/ترحيب) ==================
 
-    if data == "section_welcome":
-        if not is_admin(user_id):
-            return
-        current, current_html = get_rich_text_setting("welcome_message", "")
-        kb = get_admin_section_keyboard([
-            InlineKeyboardButton("✏️ تعيين رسالة الترحيب", callback_data="set_welcome_message", style="success"),
-            InlineKeyboardButton("🧹 حذف رسالة الترحيب", callback_data="clear_welcome_message", style="danger"),
-        ], "admin_panel")
-        text = "👋 رسالة الترحيب الحالية:\n\n"
-        text += (current_html if str(current or "").strip() else "— لا توجد رسالة —")
-        await query.edit_message_text(text, reply_markup=kb, parse_mode="HTML")
+
+@CALLBACK_ROUTER.route("section_ban", access="admin")
+async def cb_section_ban(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    kb = get_admin_section_keyboard([
+        InlineKeyboardButton("🛑 حظر مستخدم", callback_data="ban_user", style="danger"),
+        InlineKeyboardButton("✅ فك حظر مستخدم", callback_data="unban_user", style="success"),
+    ], "admin_panel")
+    await query.edit_message_text("🛑 قسم الحظر\n\nاختر:", reply_markup=kb)
+
+
+@CALLBACK_ROUTER.route("ban_user", access="admin")
+async def cb_ban_user(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    context.user_data["waiting_for"] = "ban_user"
+    await query.edit_message_text("🛑 أرسل ID المستخدم للحظر (مثال: 123456789)\nويمكنك تكتب سبب بالحظر بعده بسطر ثاني (اختياري).",
+                                  reply_markup=back_keyboard("section_ban"))
+
+
+@CALLBACK_ROUTER.route("unban_user", access="admin")
+async def cb_unban_user(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    context.user_data["waiting_for"] = "unban_user"
+    await query.edit_message_text("✅ أرسل ID المستخدم لفك الحظر:",
+                                  reply_markup=back_keyboard("section_ban"))
+
+
+@CALLBACK_ROUTER.route("section_welcome", access="admin")
+async def cb_section_welcome(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    current, current_html = await get_rich_text_setting_async("welcome_message", "")
+    kb = get_admin_section_keyboard([
+        InlineKeyboardButton("✏️ تعيين رسالة الترحيب", callback_data="set_welcome_message", style="success"),
+        InlineKeyboardButton("🧹 حذف رسالة الترحيب", callback_data="clear_welcome_message", style="danger"),
+    ], "admin_panel")
+    text = "👋 رسالة الترحيب الحالية:\n\n"
+    text += (current_html if str(current or "").strip() else "— لا توجد رسالة —")
+    await query.edit_message_text(text, reply_markup=kb, parse_mode="HTML")
+
+
+@CALLBACK_ROUTER.route("set_welcome_message", access="admin")
+async def cb_set_welcome_message(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    context.user_data["waiting_for"] = "welcome_message"
+    await query.edit_message_text("✏️ أرسل رسالة الترحيب الجديدة. ستظهر مدمجة أعلى القائمة الرئيسية وعدد الإيميلات:",
+                                  reply_markup=back_keyboard("section_welcome"))
+
+
+@CALLBACK_ROUTER.route("clear_welcome_message", access="admin")
+async def cb_clear_welcome_message(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    await set_setting_async("welcome_message", "")
+    await set_setting_async("welcome_message_rich_html", "")
+    await query.edit_message_text("✅ تم حذف رسالة الترحيب",
+                                  reply_markup=back_keyboard("section_welcome"))
+
+
+@CALLBACK_ROUTER.route("bot_info", access="admin", denied_text=get_text("ar", "unauthorized"))
+async def cb_bot_info(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str):
+    text = "ℹ️ معلومات البوت\n\n🤖 الاسم: بوت الإيميلات المؤقتة\n📌 الإصدار: 3.1\n📧 الخدمة: mail.tm\n✅ الواجهة: العربية"
+    await query.edit_message_text(text, reply_markup=back_keyboard("admin_panel"))
+
+
+async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user = update.effective_user
+    if query is None or user is None:
         return
 
-    if data == "set_welcome_message":
-        if not is_admin(user_id):
+    user_id = user.id
+    data = query.data or ""
+    lang = "ar"
+    route, params = CALLBACK_ROUTER.resolve(data)
+
+    if route is not None and route["cooldown"]:
+        cooldown_key, cooldown_seconds = route["cooldown"]
+        cooldown_remaining = consume_action_cooldown(user_id, cooldown_key, cooldown_seconds)
+        if cooldown_remaining > 0:
+            try:
+                await query.answer(
+                    f"⏳ انتظر {cooldown_remaining} ثانية قبل إعادة المحاولة.",
+                    show_alert=False,
+                )
+            except Exception:
+                pass
             return
-        context.user_data["waiting_for"] = "welcome_message"
-        await query.edit_message_text("✏️ أرسل رسالة الترحيب الجديدة. ستظهر مدمجة أعلى القائمة الرئيسية وعدد الإيميلات:",
-                                      reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="section_welcome")]]))
-        return
 
-    if data == "clear_welcome_message":
-        if not is_admin(user_id):
+    if route is not None and route["access"]:
+        if route["access"] == "owner":
+            allowed = user_id == ADMIN_ID
+        else:
+            allowed = await is_admin_async(user_id)
+        if not allowed:
+            try:
+                if route["denied_text"]:
+                    await query.answer(route["denied_text"], show_alert=True)
+                else:
+                    await query.answer()
+            except Exception:
+                pass
             return
-        set_setting("welcome_message", "")
-        set_setting("welcome_message_rich_html", "")
-        await query.edit_message_text("✅ تم حذف رسالة الترحيب",
-                                      reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="section_welcome")]]))
-        return
 
-    if data == "bot_info":
-        if not is_admin(user_id):
-            await query.answer(get_text(lang, "unauthorized"), show_alert=True)
+    # المسارات بدون حارس (مثل التحقق من الاشتراك) ترد على الضغطة بنفسها.
+    if route is not None and route["guard"]:
+        try:
+            await query.answer()
+        except Exception:
+            pass
+
+        if not await guard_user(query, context, user_id, lang):
             return
-        text = "ℹ️ معلومات البوت\n\n🤖 الاسم: بوت الإيميلات المؤقتة\n📌 الإصدار: 3.1\n📧 الخدمة: mail.tm\n✅ الواجهة: العربية"
-        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="admin_panel")]]))
+
+    if route is None:
+        try:
+            await query.answer()
+        except Exception:
+            pass
         return
 
+    started = time.perf_counter()
+    failed = False
+    try:
+        await route["handler"](query, context, user_id, lang, **params)
+    except Exception:
+        failed = True
+        raise
+    finally:
+        CALLBACK_ROUTER.record(route, (time.perf_counter() - started) * 1000, failed)
+
 
 # ================== معالج الرسائل النصية (مثل كودك + إضافات انتظار الإدخال) ==================
 
@@ -4446,11 +7580,11 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # تعيين قناة
-    if waiting_for == "channel_username" and is_admin(user_id):
+    if waiting_for == "channel_username" and await is_admin_async(user_id):
         channel_username = (update.message.text or "").strip().replace("@", "")
         try:
             chat = await context.bot.get_chat(f"@{channel_username}")
-            ok = set_channel(channel_username, chat.id, chat.title)
+            ok = await set_channel_async(channel_username, chat.id, chat.title)
             text = (
                 f"✅ تمت إضافة/تحديث القناة @{channel_username}\n"
                 f"🆔 {chat.id}\n"
@@ -4463,125 +7597,59 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data["waiting_for"] = None
         await update.message.reply_text(
             text,
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton(
-                    get_text(lang, "btn_back"),
-                    callback_data="channel_management",
-                    style="primary",
-                )
-            ]]),
+            reply_markup=back_keyboard("channel_management", "primary"),
         )
         return
 
     # تعديل رسالة الاشتراك الإجبارية العامة
-    if waiting_for == "global_subscription_message" and is_admin(user_id):
+    if waiting_for == "global_subscription_message" and await is_admin_async(user_id):
         msg = update.message.text or ""
         if not msg.strip():
             await update.message.reply_text(
                 "❌ الرسالة لا يمكن أن تكون فارغة.",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton(
-                        get_text(lang, "btn_back"),
-                        callback_data="channel_management",
-                        style="primary",
-                    )
-                ]]),
+                reply_markup=back_keyboard("channel_management", "primary"),
             )
             return
         if len(msg) > 2500:
             await update.message.reply_text(
                 "❌ الرسالة طويلة جداً. الحد الأقصى 2500 حرف.",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton(
-                        get_text(lang, "btn_back"),
-                        callback_data="channel_management",
-                        style="primary",
-                    )
-                ]]),
+                reply_markup=back_keyboard("channel_management", "primary"),
             )
             return
 
-        ok = save_rich_text_setting("global_subscription_message", message)
+        ok = await save_rich_text_setting_async("global_subscription_message", message)
         if ok:
             context.user_data["waiting_for"] = None
         await update.message.reply_text(
             "✅ تم حفظ رسالة الاشتراك العامة." if ok else "❌ فشل حفظ الرسالة.",
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton(
-                    get_text(lang, "btn_back"),
-                    callback_data="channel_management",
-                    style="primary",
-                )
-            ]]),
+            reply_markup=back_keyboard("channel_management", "primary"),
         )
         return
 
     # رسالة الإيقاف
     # رسالة الإيقاف
-    if waiting_for == "offline_message" and is_admin(user_id):
+    if waiting_for == "offline_message" and await is_admin_async(user_id):
         bot_offline_message = update.message.text or ""
         bot_offline_message_html = message_custom_emoji_html(message)
         context.user_data["waiting_for"] = None
         await update.message.reply_text("✅ تم حفظ رسالة الإيقاف",
-                                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="section_settings")]]))
-        return
-
-    # إذاعة للكل
-    if waiting_for == "broadcast_all" and is_admin(user_id):
-        context.user_data["waiting_for"] = None
-        msg = update.message.text or ""
-        msg_html = message_custom_emoji_html(message)
-        wait_msg = await update.message.reply_text("⏳ جاري إرسال الإذاعة...")
-        okc = 0
-        fail = 0
-        for uid in list(user_database.keys()):
-            try:
-                await context.bot.send_message(
-                    chat_id=int(uid),
-                    text=f"📢 رسالة من الإدارة:\n\n{msg_html}",
-                    parse_mode="HTML",
-                )
-                okc += 1
-            except:
-                fail += 1
-        try:
-            await wait_msg.delete()
-        except:
-            pass
-        await update.message.reply_text(f"✅ تم الإرسال\nنجح: {okc}\nفشل: {fail}",
-                                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="section_broadcast")]]))
+                                        reply_markup=back_keyboard("section_settings"))
         return
 
-    # إذاعة للنشطين
-    if waiting_for == "broadcast_active" and is_admin(user_id):
+    # إذاعة للكل / للنشطين: تُسجل كمهمة وتُرسل في الخلفية مع رسالة تقدم حية.
+    if waiting_for in ("broadcast_all", "broadcast_active") and await is_admin_async(user_id):
         context.user_data["waiting_for"] = None
-        msg = update.message.text or ""
         msg_html = message_custom_emoji_html(message)
-        wait_msg = await update.message.reply_text("⏳ جاري إرسال الإذاعة للنشطين...")
-        okc = 0
-        fail = 0
-        for uid, info in user_database.items():
-            if len(info.get("emails", [])) > 0:
-                try:
-                    await context.bot.send_message(
-                        chat_id=int(uid),
-                        text=f"📢 رسالة من الإدارة:\n\n{msg_html}",
-                        parse_mode="HTML",
-                    )
-                    okc += 1
-                except:
-                    fail += 1
-        try:
-            await wait_msg.delete()
-        except:
-            pass
-        await update.message.reply_text(f"✅ تم الإرسال\nنجح: {okc}\nفشل: {fail}",
-                                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="section_broadcast")]]))
+        audience = "active" if waiting_for == "broadcast_active" else "all"
+        job_id = await start_broadcast(context, audience, msg_html, user_id, update.effective_chat.id)
+        if job_id is None:
+            await update.message.reply_text("❌ تعذر بدء الإذاعة، حاول مرة أخرى.",
+                                            reply_markup=back_keyboard("section_broadcast"))
         return
 
     # إضافة دومين شكلي مدفوع من لوحة الأدمن
-    if waiting_for == "paid_domain_add" and is_admin(user_id):
-        success, result, domain = add_paid_domain(message.text or "")
+    if waiting_for == "paid_domain_add" and await is_admin_async(user_id):
+        success, result, domain = await add_paid_domain_async(message.text or "")
         if not success:
             if result == "invalid":
                 response_text = "❌ اسم الدومين غير صحيح. أرسله مثل example.com"
@@ -4592,48 +7660,32 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
             await message.reply_text(
                 response_text,
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton(
-                        get_text(lang, "btn_back"),
-                        callback_data="section_paid_domains",
-                        style="primary",
-                    )
-                ]]),
+                reply_markup=back_keyboard("section_paid_domains", "primary"),
             )
             return
 
         context.user_data["waiting_for"] = None
         await message.reply_text(
             f"✅ تم إضافة الدومين الشكلي @{domain} للمستخدمين.",
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton(
-                    get_text(lang, "btn_back"),
-                    callback_data="section_paid_domains",
-                    style="primary",
-                )
-            ]]),
+            reply_markup=back_keyboard("section_paid_domains", "primary"),
         )
         return
 
     # تحديد الحد العام لإنشاء الإيميلات
-    if waiting_for == "email_limit" and is_admin(user_id):
+    if waiting_for == "email_limit" and await is_admin_async(user_id):
         raw_limit = (message.text or "").strip()
         if not raw_limit.isdigit() or not (1 <= int(raw_limit) <= 100):
             await message.reply_text(
                 "❌ أرسل رقماً صحيحاً من 1 إلى 100.",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="section_email_limit")
-                ]]),
+                reply_markup=back_keyboard("section_email_limit"),
             )
             return
 
-        set_setting("email_limit", raw_limit)
+        await set_setting_async("email_limit", raw_limit)
         context.user_data["waiting_for"] = None
         await message.reply_text(
             f"✅ تم تحديد الحد إلى {raw_limit} إيميل لكل مستخدم.",
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="section_email_limit")
-            ]]),
+            reply_markup=back_keyboard("section_email_limit"),
         )
         return
 
@@ -4643,25 +7695,21 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not raw_id.isdigit():
             await message.reply_text(
                 "❌ أرسل ID رقمي صحيح فقط، بدون @ أو username.",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="section_email_limit")
-                ]]),
+                reply_markup=back_keyboard("section_email_limit"),
             )
             return
 
-        found = find_user_by_username_or_id(raw_id)
+        found = await find_user_by_username_or_id_async(raw_id)
         if not found:
             await message.reply_text(
                 "❌ لا يوجد عضو مسجل بهذا الـ ID.",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="section_email_limit")
-                ]]),
+                reply_markup=back_keyboard("section_email_limit"),
             )
             return
 
         target_id, target_info = found
-        current_special = get_member_email_limit(target_id)
-        current_global = get_email_limit()
+        current_special = await get_member_email_limit_async(target_id)
+        current_global = await get_email_limit_async()
         current_text = "غير محدد ويستخدم الحد العام" if current_special is None else (
             "غير محدود" if current_special == 0 else f"{current_special} إيميل"
         )
@@ -4680,9 +7728,7 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"الحد العام: {global_text}\n\n"
             "أرسل الآن عدد الإيميلات المسموح به من 0 إلى 100.\n"
             "الرقم 0 يعني غير محدود لهذا العضو.",
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="section_email_limit")
-            ]]),
+            reply_markup=back_keyboard("section_email_limit"),
         )
         return
 
@@ -4697,14 +7743,12 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not raw_limit.isdigit() or not (0 <= int(raw_limit) <= 100):
             await message.reply_text(
                 "❌ أرسل رقماً صحيحاً من 0 إلى 100.",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="section_email_limit")
-                ]]),
+                reply_markup=back_keyboard("section_email_limit"),
             )
             return
 
         limit_value = int(raw_limit)
-        if not set_member_email_limit(int(target_id), limit_value):
+        if not await set_member_email_limit_async(int(target_id), limit_value):
             await message.reply_text("❌ تعذر حفظ الحد الخاص، حاول مرة أخرى.")
             return
 
@@ -4713,9 +7757,7 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         limit_text = "غير محدود" if limit_value == 0 else f"{limit_value} إيميل"
         await message.reply_text(
             f"✅ تم تحديد حد العضو صاحب ID {target_id} إلى: {limit_text}.",
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="section_email_limit")
-            ]]),
+            reply_markup=back_keyboard("section_email_limit"),
         )
         return
 
@@ -4725,59 +7767,43 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not username:
             await message.reply_text(
                 "❌ اليوزر غير صحيح. أرسله مثل @username ويتكوّن من أحرف إنجليزية أو أرقام أو _.",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="section_email_limit")
-                ]]),
+                reply_markup=back_keyboard("section_email_limit"),
             )
             return
 
-        if not set_setting("admin_contact_username", username):
+        if not await set_setting_async("admin_contact_username", username):
             await message.reply_text("❌ فشل حفظ يوزر الأدمن، حاول مرة أخرى.")
             return
 
         context.user_data["waiting_for"] = None
         await message.reply_text(
             f"✅ تم حفظ يوزر التواصل: @{username}",
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="section_email_limit")
-            ]]),
+            reply_markup=back_keyboard("section_email_limit"),
         )
         return
 
     # عرض إيميلات عضو ووارده - للمشرفين فقط
-    if waiting_for == "member_emails_id" and is_admin(user_id):
+    if waiting_for == "member_emails_id" and await is_admin_async(user_id):
         raw_id = (message.text or "").strip()
         if not raw_id.isdigit():
             await message.reply_text(
                 "❌ أرسل ID رقمي صحيح فقط.",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton(
-                        get_text(lang, "btn_back"),
-                        callback_data="section_members",
-                        style="primary",
-                    )
-                ]]),
+                reply_markup=back_keyboard("section_members", "primary"),
             )
             return
 
-        found = find_user_by_username_or_id(raw_id)
+        found = await find_user_by_username_or_id_async(raw_id)
         if not found:
             await message.reply_text(
                 "❌ لا يوجد عضو مسجل بهذا الـ ID.",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton(
-                        get_text(lang, "btn_back"),
-                        callback_data="section_members",
-                        style="primary",
-                    )
-                ]]),
+                reply_markup=back_keyboard("section_members", "primary"),
             )
             return
 
         target_id, _ = found
         context.user_data["waiting_for"] = None
         context.user_data["member_emails_target"] = target_id
-        view = get_admin_member_emails_view(target_id, 0)
+        view = await get_admin_member_emails_view_async(target_id, 0)
         if not view:
             await message.reply_text("❌ تعذر تحميل بيانات العضو.")
             return
@@ -4787,13 +7813,11 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # اختيار عضو لحذف إيميلاته - للمشرف الرئيسي فقط
     if waiting_for == "delete_user_emails" and user_id == ADMIN_ID:
-        found = find_user_by_username_or_id(message.text or "")
+        found = await find_user_by_username_or_id_async(message.text or "")
         if not found:
             await message.reply_text(
                 "❌ لم يتم العثور على العضو. أرسل ID صحيحاً أو @username.",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="section_members")
-                ]]),
+                reply_markup=back_keyboard("section_members"),
             )
             return
 
@@ -4825,54 +7849,43 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # بحث عضو
-    if waiting_for == "search_member" and is_admin(user_id):
+    if waiting_for == "search_member" and await is_admin_async(user_id):
         q = (update.message.text or "").strip().lower()
         context.user_data["waiting_for"] = None
 
-        results = []
-        for uid, info in user_database.items():
-            if q in uid:
-                results.append((uid, info))
-                continue
-            name = f"{info.get('first_name','')} {info.get('last_name','')}".lower()
-            if q and q in name:
-                results.append((uid, info))
-                continue
-            un = (info.get("username") or "").lower()
-            if q and q in un:
-                results.append((uid, info))
+        results = await run_db(search_members, q)
 
         if not results:
             await update.message.reply_text("❌ لم يتم العثور على عضو",
-                                            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="section_members")]]))
+                                            reply_markup=back_keyboard("section_members"))
             return
 
         text = f"🔍 نتائج البحث عن '{telegram_html(q)}':\n━━━━━━━━━━━━━━━\n\n"
         for uid, info in results[:10]:
             name = (info.get("first_name") or "مجهول") + (f" {info.get('last_name')}" if info.get("last_name") else "")
             username = f"@{info.get('username')}" if info.get("username") else "—"
-            emails_count = len(info.get("emails", []))
+            emails_count = info["emails_count"]
             status = "✅ نشط" if emails_count > 0 else "⚪ غير نشط"
             text += f"👤 <b>{telegram_html(name)}</b>\n🆔 {telegram_html(username)}\n📧 {emails_count} | {status}\n🔢 ID: <code>{uid}</code>\n\n"
 
         await update.message.reply_text(text, parse_mode="HTML",
-                                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="section_members")]]))
+                                        reply_markup=back_keyboard("section_members"))
         return
 
     # ✅ تعيين رسالة الترحيب (جديد)
-    if waiting_for == "welcome_message" and is_admin(user_id):
+    if waiting_for == "welcome_message" and await is_admin_async(user_id):
         msg = update.message.text or ""
-        ok = save_rich_text_setting("welcome_message", message)
+        ok = await save_rich_text_setting_async("welcome_message", message)
         if ok:
             context.user_data["waiting_for"] = None
         await update.message.reply_text(
             "✅ تم حفظ رسالة الترحيب والإيموجيات المميزة" if ok else "❌ فشل حفظ رسالة الترحيب",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="section_welcome")]]),
+            reply_markup=back_keyboard("section_welcome"),
         )
         return
 
     # ✅ حظر مستخدم (جديد)
-    if waiting_for == "ban_user" and is_admin(user_id):
+    if waiting_for == "ban_user" and await is_admin_async(user_id):
         context.user_data["waiting_for"] = None
         raw = (update.message.text or "").strip()
         lines = raw.splitlines()
@@ -4880,26 +7893,26 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             target_id = int(lines[0].strip())
         except:
             await update.message.reply_text("❌ ارسل ID صحيح",
-                                            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="section_ban")]]))
+                                            reply_markup=back_keyboard("section_ban"))
             return
         reason = lines[1].strip() if len(lines) > 1 else "—"
-        ok = ban_user_db(target_id, reason, user_id)
+        ok = await ban_user_db_async(target_id, reason, user_id)
         await update.message.reply_text("✅ تم حظر المستخدم" if ok else "❌ فشل الحظر",
-                                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="section_ban")]]))
+                                        reply_markup=back_keyboard("section_ban"))
         return
 
     # ✅ فك حظر مستخدم (جديد)
-    if waiting_for == "unban_user" and is_admin(user_id):
+    if waiting_for == "unban_user" and await is_admin_async(user_id):
         context.user_data["waiting_for"] = None
         try:
             target_id = int((update.message.text or "").strip())
         except:
             await update.message.reply_text("❌ ارسل ID صحيح",
-                                            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="section_ban")]]))
+                                            reply_markup=back_keyboard("section_ban"))
             return
-        ok = unban_user_db(target_id)
+        ok = await unban_user_db_async(target_id)
         await update.message.reply_text("✅ تم فك الحظر" if ok else "⚠️ المستخدم غير محظور أصلاً",
-                                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "btn_back"), callback_data="section_ban")]]))
+                                        reply_markup=back_keyboard("section_ban"))
         return
 
 
@@ -4916,15 +7929,143 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
     traceback.print_exception(type(error), error, error.__traceback__)
 
 
+# ================== معالجة التحديثات بالتوازي ==================
+
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "32"))
+# أقصى عدد تحديثات مقبولة في نفس الوقت (قيد المعالجة أو بانتظار دورها)، حماية للذاكرة عند الذروة.
+UPDATE_MAX_PENDING = int(os.getenv("UPDATE_MAX_PENDING", "512"))
+
+
+class UserLaneUpdateProcessor(BaseUpdateProcessor):
+    """معالجة تحديثات الأعضاء المختلفين بالتوازي مع إبقاء تحديثات العضو الواحد بالترتيب.
+
+    سيمافور PTB الأساسي يحد عدد التحديثات المقبولة كلها (UPDATE_MAX_PENDING)، أما الحد الفعلي
+    للتوازي فيُؤخذ بعد قفل مسار العضو، حتى لا يحجز عضو يرسل بكثرة كل أماكن المعالجة وهو ينتظر دوره.
+    """
+
+    def __init__(self, max_concurrent_updates: int, max_pending_updates: int):
+        super().__init__(max(max_pending_updates, max_concurrent_updates))
+        self.concurrency_limit = max_concurrent_updates
+        self._workers = asyncio.Semaphore(max_concurrent_updates)
+        self._lanes = {}
+        self.stats = {
+            "processed": 0,
+            "in_flight": 0,
+            "waiting": 0,
+            "max_waiting": 0,
+            "max_lane_depth": 0,
+            "wait_ms_total": 0.0,
+        }
+
+    @staticmethod
+    def _lane_key(update):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update, coroutine) -> None:
+        key = self._lane_key(update)
+        lane = None
+        if key is not None:
+            lane = self._lanes.get(key)
+            if lane is None:
+                lane = self._lanes[key] = {"lock": asyncio.Lock(), "depth": 0}
+            lane["depth"] += 1
+            self.stats["max_lane_depth"] = max(self.stats["max_lane_depth"], lane["depth"])
+
+        queued_at = time.perf_counter()
+        started = False
+        self.stats["waiting"] += 1
+        self.stats["max_waiting"] = max(self.stats["max_waiting"], self.stats["waiting"])
+        try:
+            async with (lane["lock"] if lane else nullcontext()):
+                async with self._workers:
+                    started = True
+                    self.stats["waiting"] -= 1
+                    self.stats["wait_ms_total"] += (time.perf_counter() - queued_at) * 1000
+                    self.stats["in_flight"] += 1
+                    try:
+                        await coroutine
+                    finally:
+                        self.stats["in_flight"] -= 1
+                        self.stats["processed"] += 1
+        finally:
+            if not started:
+                self.stats["waiting"] -= 1
+            if lane is not None:
+                lane["depth"] -= 1
+                if lane["depth"] == 0:
+                    self._lanes.pop(key, None)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def get_stats(self) -> dict:
+        stats = dict(self.stats)
+        stats["lanes"] = len(self._lanes)
+        stats["limit"] = self.concurrency_limit
+        stats["avg_wait_ms"] = int(stats["wait_ms_total"] / stats["processed"]) if stats["processed"] else 0
+        return stats
+
+
+UPDATE_PROCESSOR = UserLaneUpdateProcessor(UPDATE_CONCURRENCY, UPDATE_MAX_PENDING)
+
+
 # ================== تشغيل ==================
 
+# عند ضبط WEBHOOK_URL يعمل البوت بوضع Webhook بدل long polling.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip().rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram").strip().strip("/")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT") or os.getenv("PORT") or "8443")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip()
+
+
+def derive_webhook_secret(token: str) -> str:
+    """سر ثابت مشتق من توكن البوت حتى تتفق كل النسخ عليه عند عدم ضبط WEBHOOK_SECRET."""
+    return hashlib.sha256(f"webhook:{token}".encode()).hexdigest()
+
+
+async def on_application_start(application: Application) -> None:
+    """استكمال المهام الطويلة التي انقطعت بإعادة التشغيل."""
+    await resume_broadcast_jobs(application)
+
+
+async def on_application_stop(application: Application) -> None:
+    """بعد توقف استقبال التحديثات وإنهاء المعالجات الجارية: إيقاف المهام الخلفية وحفظ العدادات المتبقية."""
+    await drain_broadcast_tasks()
+    await INBOX_WATCHER.close()
+    await MERCURE_PUSH.close()
+    await run_db(flush_daily_stats)
+    await run_db(flush_email_touches)
+
+
+async def on_application_shutdown(application: Application) -> None:
+    """إغلاق الاتصالات المفتوحة مع الخدمات الخارجية قبل إنهاء العملية."""
+    await MAIL_CLIENT.close()
+
+
 def main():
     token = os.getenv("TELEGRAM_BOT_TOKEN")
     if not token:
         print("❌ ضع TELEGRAM_BOT_TOKEN في متغيرات Railway")
         return
 
-    application = Application.builder().token(token).build()
+    application = (
+        Application.builder()
+        .token(token)
+        .concurrent_updates(UPDATE_PROCESSOR)
+        .post_init(on_application_start)
+        .post_stop(on_application_stop)
+        .post_shutdown(on_application_shutdown)
+        .build()
+    )
     # المجموعة -1 تلتقط كل الرسائل الخاصة أولاً، بما فيها /start وباقي الأوامر والوسائط،
     # ثم تترك المعالجات الأصلية تنفذ وظائف البوت بشكل طبيعي.
     application.add_handler(
@@ -4934,18 +8075,66 @@ def main():
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CommandHandler("admin", admin_command))
     application.add_handler(CallbackQueryHandler(button_callback))
+    application.add_handler(ChatMemberHandler(track_channel_membership, ChatMemberHandler.CHAT_MEMBER))
     application.add_handler(MessageHandler(
         filters.ChatType.PRIVATE,
         message_handler,
     ))
     application.add_error_handler(error_handler)
 
-    # يبقى صندوق الوارد يدوياً: المستخدم يختار الإيميل ثم يفتح رسائله.
-    # لا تُشغّل مهمة فحص كل الإيميلات تلقائياً حتى لا يفرض mail.tm حد HTTP 429.
+    if application.job_queue is not None:
+        application.job_queue.run_repeating(
+            account_pool_refill_job,
+            interval=ACCOUNT_POOL_REFILL_INTERVAL_SECONDS,
+            first=10,
+            name="account_pool_refill",
+        )
+        print("✅ تعبئة مخزون الحسابات الجاهزة تعمل في الخلفية")
+        application.job_queue.run_repeating(
+            token_refresh_job,
+            interval=TOKEN_REFRESH_INTERVAL_SECONDS,
+            first=TOKEN_REFRESH_INTERVAL_SECONDS,
+            name="token_refresh",
+        )
+        application.job_queue.run_repeating(
+            daily_stats_flush_job,
+            interval=DAILY_STATS_FLUSH_SECONDS,
+            first=DAILY_STATS_FLUSH_SECONDS,
+            name="daily_stats_flush",
+        )
+        if MERCURE_PUSH.enabled:
+            application.job_queue.run_repeating(
+                mercure_sync_job,
+                interval=MERCURE_SYNC_SECONDS,
+                first=5,
+                name="mercure_sync",
+            )
+            print(f"✅ إشعارات البريد الفورية تعمل عبر Mercure (حتى {MERCURE_MAX_STREAMS} بريد)")
+
+    # لا تُشغّل مهمة فحص كل الإيميلات تلقائياً حتى لا يفرض mail.tm حد HTTP 429؛
+    # الإشعارات الفورية تأتي من Mercure، وصندوق الوارد يبقى متاحاً يدوياً.
     print("✅ فحص البريد يعمل يدوياً من زر الرسائل الواردة")
 
     print("🤖 البوت يعمل الآن...")
-    application.run_polling(drop_pending_updates=True, allowed_updates=Update.ALL_TYPES)
+    try:
+        if WEBHOOK_URL:
+            # التحديثات المعلقة أثناء إعادة النشر تبقى لدى تلجرام وتصل للنسخة الجديدة.
+            # عند الإيقاف يتوقف خادم الويب أولاً، ثم تُنهى التحديثات قيد المعالجة قبل الخروج.
+            print(f"🌐 وضع Webhook على المنفذ {WEBHOOK_PORT}")
+            application.run_webhook(
+                listen=WEBHOOK_LISTEN,
+                port=WEBHOOK_PORT,
+                url_path=WEBHOOK_PATH,
+                webhook_url=f"{WEBHOOK_URL}/{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET or derive_webhook_secret(token),
+                drop_pending_updates=False,
+                allowed_updates=Update.ALL_TYPES,
+            )
+        else:
+            application.run_polling(drop_pending_updates=True, allowed_updates=Update.ALL_TYPES)
+    finally:
+        DB_EXECUTOR.shutdown(wait=True)
+        close_db_pool()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,64 @@
+import pytest
+
+import telegram_bot as tb
+
+
+async def _handler(query, context, user_id, lang, **params):
+    return params
+
+
+def test_fixed_and_parameterized_patterns():
+    router = tb.CallbackRouter()
+    router.add("inbox", _handler)
+    router.add("inbox_{email_index:int}", _handler)
+    router.add("msgid_{email_index:int}_{message_id:str}", _handler)
+
+    route, params = router.resolve("inbox")
+    assert route["pattern"] == "inbox" and params == {}
+    route, params = router.resolve("inbox_7")
+    assert route["pattern"] == "inbox_{email_index:int}" and params == {"email_index": 7}
+    route, params = router.resolve("msgid_2_65a1f0c2e4b0a1b2c3d4e5f6")
+    assert params == {"email_index": 2, "message_id": "65a1f0c2e4b0a1b2c3d4e5f6"}
+
+
+@pytest.mark.parametrize("data", ["inbox_x", "inbox_1_2", "msgid_x_abc", "unknown", ""])
+def test_unmatched_data(data):
+    router = tb.CallbackRouter()
+    router.add("inbox_{email_index:int}", _handler)
+    router.add("msgid_{email_index:int}_{message_id:str}", _handler)
+    assert router.resolve(data) == (None, None)
+
+
+def test_literal_edges_win_over_params():
+    router = tb.CallbackRouter()
+    router.add("users_list_{kind:str}", _handler)
+    router.add("users_list_all", _handler)
+    assert router.resolve("users_list_all")[0]["pattern"] == "users_list_all"
+    assert router.resolve("users_list_top")[1] == {"kind": "top"}
+
+
+@pytest.mark.parametrize("kind", ["all", "active", "top"])
+def test_users_list_overlap(kind):
+    route, params = tb.CALLBACK_ROUTER.resolve(f"users_list_{kind}")
+    assert route["pattern"] == f"users_list_{kind}" and params == {}
+
+    route, params = tb.CALLBACK_ROUTER.resolve(f"users_list_{kind}_3")
+    assert route["pattern"] == f"users_list_{kind}_{{legacy_page:int}}"
+    assert params == {"legacy_page": 3}
+
+    route, params = tb.CALLBACK_ROUTER.resolve(f"users_list_{kind}_n_2_1700000000000000_123456789")
+    assert route["handler"] is getattr(tb, f"cb_users_list_{kind}")
+    assert params == {"direction": "n", "page": 2, "cursor_key": 1700000000000000, "cursor_id": 123456789}
+
+    # مؤشر ناقص أو رقم غير صحيح لا يطابق أي مسار.
+    assert tb.CALLBACK_ROUTER.resolve(f"users_list_{kind}_n_2_x_1") == (None, None)
+    assert tb.CALLBACK_ROUTER.resolve(f"users_list_{kind}_n_2_5") == (None, None)
+
+
+def test_member_message_routes_do_not_collide():
+    route, params = tb.CALLBACK_ROUTER.resolve("member_msgid_7123456789_1_65a1f0c2e4b0a1b2c3d4e5f6_2")
+    assert params == {
+        "target_id": 7123456789, "email_index": 1, "message_id": "65a1f0c2e4b0a1b2c3d4e5f6", "email_page": 2,
+    }
+    route, params = tb.CALLBACK_ROUTER.resolve("member_msg_7123456789_1_3_2")
+    assert params == {"target_id": 7123456789, "email_index": 1, "msg_index": 3, "email_page": 2}
@@ -0,0 +1,155 @@
+from contextlib import contextmanager
+from datetime import datetime
+
+import pytest
+
+import telegram_bot as tb
+
+BIG_CREATED_AT = datetime(2099, 12, 31, 23, 59, 59, 999999)
+BIG_ID = 9_999_999_999_999
+
+
+def _callbacks(markup):
+    return [button.callback_data for row in markup.inline_keyboard for button in row]
+
+
+@pytest.mark.parametrize("kind", ["all", "active", "top"])
+def test_navigation_round_trip(kind):
+    prefix = f"users_list_{kind}"
+    cursor_key = tb._member_cursor_key("all", {"created_at": BIG_CREATED_AT, "emails_count": 0})
+    markup = tb.get_member_pages_keyboard(prefix, 5, (cursor_key, BIG_ID), (cursor_key, BIG_ID), True)
+    previous_data, next_data = _callbacks(markup)[:2]
+    for data in (previous_data, next_data):
+        assert len(data.encode()) <= 64
+
+    _route, params = tb.CALLBACK_ROUTER.resolve(next_data)
+    assert params == {"direction": "n", "page": 6, "cursor_key": cursor_key, "cursor_id": BIG_ID}
+    _route, params = tb.CALLBACK_ROUTER.resolve(previous_data)
+    assert params == {"direction": "p", "page": 4, "cursor_key": cursor_key, "cursor_id": BIG_ID}
+
+
+def test_previous_from_second_page_is_bare_prefix():
+    markup = tb.get_member_pages_keyboard("users_list_all", 1, (1, 2), (3, 4), False)
+    assert _callbacks(markup)[0] == "users_list_all"
+
+
+def test_first_page_has_no_previous():
+    markup = tb.get_member_pages_keyboard("users_list_top", 0, (1, 2), (3, 4), True)
+    assert _callbacks(markup)[0] == "users_list_top_n_1_3_4"
+
+
+class FakeCursor:
+    def __init__(self, rows, calls):
+        self.rows = rows
+        self.calls = calls
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params=None):
+        self.calls.append((" ".join(sql.split()), params))
+
+    def fetchone(self):
+        return {"total": 42}
+
+    def fetchall(self):
+        return list(self.rows)
+
+
+class FakeConnection:
+    def __init__(self, rows, calls):
+        self.rows = rows
+        self.calls = calls
+
+    def cursor(self, cursor_factory=None):
+        return FakeCursor(self.rows, self.calls)
+
+
+def _fake_db(monkeypatch, rows):
+    calls = []
+
+    @contextmanager
+    def fake_connection(timeout=None):
+        yield FakeConnection(rows, calls)
+
+    monkeypatch.setattr(tb, "db_connection", fake_connection)
+    return calls
+
+
+def _row(telegram_id, created_at, emails_count=1):
+    return {
+        "telegram_id": telegram_id, "first_name": "", "last_name": "", "username": "",
+        "emails_count": emails_count, "created_at": created_at,
+    }
+
+
+def test_created_at_cursor_decodes_to_same_datetime(monkeypatch):
+    created_at = datetime(2024, 5, 6, 7, 8, 9, 123456)
+    cursor_key = tb._member_cursor_key("all", _row(1, created_at))
+    calls = _fake_db(monkeypatch, [_row(11, created_at), _row(12, created_at)])
+
+    _members, total, first_cursor, last_cursor, has_next = tb.get_members_page("all", "n", cursor_key, 10)
+    sql, params = calls[-1]
+    assert "(u.created_at, u.telegram_id) > (%s, %s)" in sql
+    assert "ORDER BY u.created_at ASC, u.telegram_id ASC" in sql
+    assert params[:2] == (created_at, 10)
+    assert total == 42 and has_next is False
+    assert first_cursor == (cursor_key, 11) and last_cursor == (cursor_key, 12)
+
+
+def test_previous_page_reverses_scan_and_rows(monkeypatch):
+    created_at = datetime(2024, 1, 1)
+    # الرجوع يقرأ بالترتيب العكسي، ثم تُعاد الصفوف لترتيب العرض.
+    calls = _fake_db(monkeypatch, [_row(9, created_at), _row(8, created_at)])
+    cursor_key = tb._member_cursor_key("active", _row(10, created_at))
+
+    members, _total, first_cursor, last_cursor, has_next = tb.get_members_page("active", "p", cursor_key, 10)
+    sql, params = calls[-1]
+    assert "(u.created_at, u.telegram_id) < (%s, %s)" in sql
+    assert "ORDER BY u.created_at DESC, u.telegram_id DESC" in sql
+    assert [uid for uid, _info in members] == ["8", "9"]
+    assert first_cursor[1] == 8 and last_cursor[1] == 9
+    assert has_next is True
+
+
+def test_top_cursor_uses_emails_count(monkeypatch):
+    calls = _fake_db(monkeypatch, [_row(5, datetime(2024, 1, 1), emails_count=3)])
+    _members, _total, first_cursor, _last, _has_next = tb.get_members_page("top", "n", 4, 7)
+    sql, params = calls[-1]
+    assert "(u.emails_count, u.telegram_id) < (%s, %s)" in sql
+    assert "ORDER BY u.emails_count DESC, u.telegram_id DESC" in sql
+    assert params[:2] == (4, 7)
+    assert first_cursor == (3, 5)
+
+
+def test_first_page_has_no_cursor_condition(monkeypatch):
+    rows = [_row(index, datetime(2024, 1, 1)) for index in range(tb.MEMBERS_PAGE_SIZE + 1)]
+    calls = _fake_db(monkeypatch, rows)
+    members, _total, _first, _last, has_next = tb.get_members_page("all")
+    sql, params = calls[-1]
+    assert "telegram_id) >" not in sql and params == (tb.MEMBERS_PAGE_SIZE + 1,)
+    assert len(members) == tb.MEMBERS_PAGE_SIZE and has_next is True
+
+
+def test_prefix_index_limits_and_exact():
+    index = tb.MemberPrefixIndex()
+    for uid in range(10):
+        index.add(str(uid), {"first_name": "sam", "username": f"user{uid}"})
+    index.add("42", {"first_name": "zed", "username": "sam"})
+    assert len(index.search("s", limit=3)) == 3
+    assert "42" in index.exact("sam")
+
+
+def test_profile_update_reindexes_cached_user(monkeypatch):
+    monkeypatch.setattr(tb, "upsert_user_profile", lambda uid, profile: False)
+    tb.user_cache["777"] = {"first_name": "old", "username": "olduser", "emails": []}
+    user = type("User", (), {"first_name": "new", "last_name": "", "username": "newuser"})()
+    try:
+        tb.update_user_info(777, user)
+        assert "777" not in tb.member_search_index.search("olduser")
+        assert "777" in tb.member_search_index.exact("newuser")
+    finally:
+        tb.user_cache.pop("777")